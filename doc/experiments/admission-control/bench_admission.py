@@ -0,0 +1,177 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Benchmark of admission control in the communication manager. A runaway
+process reading and writing a byte at a time runs alongside a shell
+workload, both under the interposition library in full mode. The calls,
+summaries and gaps admitted for the runaway and for the rest of the
+workload are counted for each admission setting.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from opus import messaging, production, uds_msg_pb2
+
+
+RUNAWAY = ["dd", "if=/dev/zero", "of=/dev/null", "bs=1", "count={count}"]
+
+SHELL_WORKLOAD = ("for i in $(seq {iters}); do "
+                  "ls -l /usr/bin > /dev/null; "
+                  "cat /etc/passwd /etc/hostname > /dev/null; done")
+
+SETTINGS = {
+    'none': None,
+    'coalesce': {'pid_rate': 20000, 'drop_after': None},
+    'drop': {'pid_rate': 20000, 'drop_after': 0.25},
+    'detach': {'pid_rate': 20000, 'drop_after': 0.25, 'detach_after': 0.5}}
+
+HEADER = struct.Struct(str(messaging.Header.struct_string))
+
+
+class Sink(threading.Thread):
+    '''Polls a communication manager, counting the calls, summaries and
+    gaps admitted for each pid and the worst stage of each offender.'''
+    def __init__(self, comm_manager):
+        super(Sink, self).__init__()
+        self.comm_manager = comm_manager
+        self.calls = {}
+        self.summaries = {}
+        self.gaps = {}
+        self.stages = {}
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            for hdr_buf, pay_buf in self.comm_manager.do_poll():
+                hdr = HEADER.unpack(hdr_buf)
+                pid = hdr[1]
+                if hdr[2] == uds_msg_pb2.FUNCINFO_MSG:
+                    self.calls[pid] = self.calls.get(pid, 0) + 1
+                elif hdr[2] == uds_msg_pb2.AGGREGATION_MSG:
+                    agg_msg = uds_msg_pb2.AggregationMessage()
+                    agg_msg.ParseFromString(pay_buf)
+                    self.calls[pid] = (self.calls.get(pid, 0) +
+                                       len(agg_msg.messages))
+                elif hdr[2] == uds_msg_pb2.SUMMARY_MSG:
+                    sum_msg = uds_msg_pb2.SummaryMessage()
+                    sum_msg.ParseFromString(pay_buf)
+                    table = self.gaps if sum_msg.gap else self.summaries
+                    table[pid] = table.get(pid, 0) + sum_msg.count
+            for offender in self.comm_manager.offenders():
+                self.stages[offender['pid']] = max(
+                    self.stages.get(offender['pid'], "NONE"),
+                    offender['stage'], key=STAGE_ORDER.index)
+
+
+STAGE_ORDER = ["NONE", "SUMMARISE", "DROP", "DETACH"]
+
+
+class DetachLog(logging.Handler):
+    '''Records the pids the communication manager detaches.'''
+    def __init__(self):
+        super(DetachLog, self).__init__()
+        self.pids = set()
+
+    def emit(self, record):
+        if record.msg.startswith("Detaching process"):
+            self.pids.add(record.args[0])
+
+
+def run_setting(args, admission, work_dir):
+    '''Runs the runaway and the shell workload with the given admission
+    arguments, returning the seconds each took, the runaway pid and the
+    sink.'''
+    sock_path = os.path.join(work_dir, "prov.sock")
+    comm_manager = production.MultiCommunicationManager(
+        "unix://" + sock_path, max_conn=64, select_timeout=0.2,
+        admission=admission)
+    sink = Sink(comm_manager)
+    sink.start()
+
+    env = dict(os.environ)
+    env.update({'LD_PRELOAD': os.path.abspath(args.lib),
+                'OPUS_PROV_COMM_MODE': "unix",
+                'OPUS_UDS_PATH': sock_path,
+                'OPUS_LOG_LEVEL': "3",
+                'OPUS_INTERPOSE_MODE': "2",
+                'OPUS_MSG_AGGR': "1",
+                'OPUS_MAX_AGGR_MSG_SIZE': "65536",
+                'OPUS_PROTOCOL_VERSION': "2"})
+    try:
+        with open(os.devnull, "w") as devnull:
+            start = time.time()
+            runaway = subprocess.Popen(
+                [arg.format(count=args.count) for arg in RUNAWAY],
+                env=env, stdout=devnull, stderr=devnull)
+            subprocess.check_call(
+                ["bash", "-c", SHELL_WORKLOAD.format(iters=args.iters)],
+                env=env, stdout=devnull)
+            shell_time = time.time() - start
+            runaway.wait()
+            runaway_time = time.time() - start
+        time.sleep(1.0)
+    finally:
+        sink.stop.set()
+        sink.join()
+        comm_manager.close()
+    return runaway_time, shell_time, runaway.pid, sink
+
+
+def main():
+    '''Run the workloads with each admission setting.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark admission control of runaway processes.")
+    parser.add_argument("lib", help="Path to libopusinterpose.so.")
+    parser.add_argument("--iters", type=int, default=20,
+                        help="Set the number of iterations of the shell "
+                        "workload.")
+    parser.add_argument("--count", type=int, default=300000,
+                        help="Set the bytes copied by the runaway.")
+    parser.add_argument("--settings", nargs="+",
+                        default=["none", "coalesce", "drop", "detach"],
+                        help="Set the admission settings to test, from %s." %
+                        ", ".join(sorted(SETTINGS)))
+    args = parser.parse_args()
+
+    detach_log = DetachLog()
+    logging.getLogger().addHandler(detach_log)
+    work_dir = tempfile.mkdtemp()
+    try:
+        print("{:<9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10} {:>9} "
+              "{:>9}".format("setting", "runaway", "summed", "gap", "stage",
+                             "other", "other sum", "runaway s",
+                             "shell s"))
+        for name in args.settings:
+            runaway_time, shell_time, pid, sink = run_setting(
+                args, SETTINGS[name], work_dir)
+            stage = sink.stages.get(pid, "NONE")
+            if pid in detach_log.pids:
+                stage = "DETACH"
+            other = sum(calls for cpid, calls in sink.calls.items()
+                        if cpid != pid)
+            other_sum = sum(calls for cpid, calls in sink.summaries.items()
+                            if cpid != pid)
+            print("{:<9} {:>9d} {:>9d} {:>9d} {:>9} {:>10d} {:>10d} "
+                  "{:>9.2f} {:>9.2f}".format(
+                      name, sink.calls.get(pid, 0),
+                      sink.summaries.get(pid, 0), sink.gaps.get(pid, 0),
+                      stage, other, other_sum,
+                      runaway_time, shell_time))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
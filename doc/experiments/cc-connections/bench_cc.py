@@ -0,0 +1,135 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Benchmark of command and control connections. A CommandControl is run
+against in-process ANALYSER and PRODUCER workers, and the round trip time
+of status requests is measured with a new connection per request, over a
+persistent connection, pipelined, and while a slow query is running.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import threading
+import time
+
+from opus import cc_utils, command, ipc
+
+
+class Alive(object):
+    '''Stands in for the threads and processes of a backend.'''
+    def is_alive(self):
+        return True
+
+
+class DaemonManager(object):
+    '''Stands in for the daemon manager of a backend.'''
+    def __init__(self):
+        self.analyser_ctl = type(str("AnalyserController"), (), {})()
+        self.analyser_ctl.fetcher = Alive()
+        self.producer = Alive()
+
+
+def analyser_handler(msg):
+    '''Answers status requests at once and sleeps through queries.'''
+    if msg.cont['cmd'] == "exec_qry_method":
+        time.sleep(msg.cont['qry_args']['secs'])
+        return {"success": True}
+    return {"num_msgs": 0}
+
+
+def producer_handler(_):
+    '''Answers ps requests.'''
+    return {"success": True, "pid_map": {}}
+
+
+def start_backend(addr, cmd_threads, worker_threads):
+    '''Starts a CommandControl listening on addr, returning it and its
+    thread.'''
+    router = ipc.Router()
+    ipc.Worker(analyser_handler, ident="ANALYSER", router=router,
+               threads=cmd_threads).run_forever()
+    ipc.Worker(producer_handler, ident="PRODUCER",
+               router=router).run_forever()
+    cac = command.CommandControl(DaemonManager(), router, addr,
+                                 worker_threads=worker_threads)
+    cac_thread = threading.Thread(target=cac.run)
+    cac_thread.daemon = True
+    cac_thread.start()
+    return cac, cac_thread
+
+
+def time_requests(func, reqs):
+    '''Returns the mean time of func per request in microseconds.'''
+    start = time.time()
+    func()
+    return (time.time() - start) * 1e6 / reqs
+
+
+def main():
+    '''Time status requests in each mode.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark command and control connections.")
+    parser.add_argument("--reqs", type=int, default=1000,
+                        help="Set the number of requests timed in each mode.")
+    parser.add_argument("--query-secs", type=float, default=2.0,
+                        help="Set the length of the slow query.")
+    parser.add_argument("--port", type=int, default=10777,
+                        help="Set the first port to listen on.")
+    args = parser.parse_args()
+
+    status = {'cmd': "status"}
+    query = {'cmd': "exec_qry_method", 'qry_method': "slow",
+             'qry_args': {'secs': args.query_secs}}
+
+    print("{:<24} {:>12} {:>12}".format("mode", "status us", "ps us"))
+    for name, cmd_threads, worker_threads, port in [
+            ("serial", 1, 1, args.port),
+            ("pooled", 4, 4, args.port + 1)]:
+        addr = "tcp://127.0.0.1:%d" % port
+        cac, cac_thread = start_backend(addr, cmd_threads, worker_threads)
+        time.sleep(0.2)
+        helper = cc_utils.CommandConnectionHelper(addr)
+
+        def per_conn(msg):
+            for _ in range(args.reqs):
+                conn_helper = cc_utils.CommandConnectionHelper(addr)
+                conn_helper.make_request(msg)
+                conn_helper.close()
+
+        def persistent(msg):
+            for _ in range(args.reqs):
+                helper.make_request(msg)
+
+        def pipelined(msg):
+            helper.make_requests([msg] * args.reqs)
+
+        def during_query(msg):
+            query_helper = cc_utils.CommandConnectionHelper(addr)
+            query_id = query_helper.send_request(query)
+            time.sleep(0.1)
+            start = time.time()
+            helper.make_request(msg)
+            elapsed = time.time() - start
+            query_helper.get_response(query_id)
+            query_helper.close()
+            return elapsed
+
+        for mode, func in [("new connection", per_conn),
+                           ("persistent", persistent),
+                           ("pipelined", pipelined)]:
+            print("{:<24} {:>12.1f} {:>12.1f}".format(
+                "%s %s" % (name, mode),
+                time_requests(lambda: func(status), args.reqs),
+                time_requests(lambda: func({'cmd': "ps"}), args.reqs)))
+        print("{:<24} {:>12.1f} {:>12.1f}".format(
+            "%s during query" % name,
+            during_query(status) * 1e6, during_query({'cmd': "ps"}) * 1e6))
+        helper.close()
+        cac.stop()
+        cac_thread.join()
+
+
+if __name__ == "__main__":
+    main()
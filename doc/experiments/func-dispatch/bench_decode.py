@@ -0,0 +1,114 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Microbenchmark of FuncController argument decoding, comparing the original
+per argument parsing of a message against the decoders compiled from
+pvm.yaml at load time.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import timeit
+
+import pkg_resources
+import yaml
+
+from opus import uds_msg_pb2
+from opus.pvm.posix import functions, utils
+
+
+def legacy_parse_mapping(msg, mapping):
+    '''The decoding performed by FuncController before compilation.'''
+    if mapping[0] == "msg_arg":
+        args = utils.parse_kvpair_list(msg.args)
+        return args[mapping[1]]
+    elif mapping[0] == "msg_field":
+        if msg.HasField(mapping[1]):
+            return getattr(msg, mapping[1])
+        else:
+            return None
+    elif mapping[0] == "ret_val":
+        return str(msg.ret_val)
+    elif mapping[0] == "const":
+        return str(mapping[1])
+
+
+def legacy_decode(msg, arg_map):
+    arg_set = {}
+    for k, val in arg_map.items():
+        arg_set[k] = legacy_parse_mapping(msg, val)
+    return arg_set
+
+
+def make_msg(func_name, arg_map):
+    '''Builds a synthetic message carrying every argument the mapping
+    reads, plus a couple of unmapped arguments as the frontend sends.'''
+    msg = uds_msg_pb2.FuncInfoMessage()
+    msg.func_name = func_name
+    msg.ret_val = 3
+    msg.begin_time = 1000
+    msg.end_time = 1001
+    msg.error_num = 0
+    for mapping in arg_map.values():
+        if mapping[0] == "msg_arg":
+            arg = msg.args.add()
+            arg.key = mapping[1]
+            arg.value = "3"
+    for extra in ["buf", "count"]:
+        arg = msg.args.add()
+        arg.key = extra
+        arg.value = "0"
+    return msg.SerializeToString()
+
+
+def bench(iters):
+    with pkg_resources.resource_stream("opus.pvm.posix", "pvm.yaml") as conf:
+        func_map = yaml.safe_load(conf)
+
+    print("{:<20} {:>5} {:>12} {:>12} {:>8}".format(
+        "Function", "Args", "Legacy(us)", "Compiled(us)", "Speedup"))
+
+    total_legacy = total_compiled = 0
+    for func_name in sorted(func_map):
+        arg_map = func_map[func_name]['arg_map']
+        buf = make_msg(func_name, arg_map)
+        decode = functions.compile_arg_map(arg_map)
+
+        def run_legacy():
+            msg = uds_msg_pb2.FuncInfoMessage()
+            msg.ParseFromString(buf)
+            legacy_decode(msg, arg_map)
+
+        def run_compiled():
+            msg = uds_msg_pb2.FuncInfoMessage()
+            msg.ParseFromString(buf)
+            decode(msg, utils.parse_kvpair_list(msg.args))
+
+        legacy = min(timeit.repeat(run_legacy, number=iters, repeat=3))
+        compiled = min(timeit.repeat(run_compiled, number=iters, repeat=3))
+        total_legacy += legacy
+        total_compiled += compiled
+
+        print("{:<20} {:>5d} {:>12.2f} {:>12.2f} {:>7.2f}x".format(
+            func_name, len(arg_map),
+            legacy / iters * 1e6, compiled / iters * 1e6,
+            legacy / compiled))
+
+    print("{:<20} {:>5} {:>12.2f} {:>12.2f} {:>7.2f}x".format(
+        "Total", "", total_legacy / iters * 1e6,
+        total_compiled / iters * 1e6, total_legacy / total_compiled))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark FuncController argument decoding.")
+    parser.add_argument("--iters", type=int, default=10000,
+                        help="Set the number of decodes per function.")
+    args = parser.parse_args()
+    bench(args.iters)
+
+
+if __name__ == "__main__":
+    main()
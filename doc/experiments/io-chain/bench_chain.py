@@ -0,0 +1,225 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Benchmark of slotting late aggregated IO events into a long fd chain,
+comparing the original list backed IndexList with per event relinking
+against the SkipList backed FdChain with one relink per flush.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import bisect
+import random
+import time
+
+from opus import storage
+from opus.pvm.posix import functions
+
+# Approximate serialised size of a read/write FuncInfoMessage.
+MSG_SIZE = 80
+AGGR_MSG_SIZE = 65536
+
+
+class FakeRels(object):
+    def __init__(self):
+        self.outgoing = []
+
+
+class FakeNode(dict):
+    '''Minimal stand in for a neo4j node exposing the relationships used by
+    the chain code.'''
+    def __init__(self, *args, **kwargs):
+        super(FakeNode, self).__init__(*args, **kwargs)
+        self.id = id(self)
+        self.PREV_EVENT = FakeRels()
+        self.IO_EVENTS = FakeRels()
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other
+
+
+class FakeRel(object):
+    def __init__(self, start, end, rel_type):
+        self.start = start
+        self.end = end
+        self.rel_type = rel_type
+
+
+class FakeCache(object):
+    def invalidate(self, cache, key):
+        pass
+
+
+class FakeDB(object):
+    '''Counts the relationship writes made against the graph.'''
+    def __init__(self):
+        self.writes = 0
+        self.cache_man = FakeCache()
+
+    def create_relationship(self, from_node, to_node, rel_type):
+        self.writes += 1
+        rel = FakeRel(from_node, to_node, rel_type)
+        getattr(from_node, rel_type).outgoing.append(rel)
+        return rel
+
+    def delete_relationship(self, rel):
+        self.writes += 1
+        getattr(rel.start, rel.rel_type).outgoing.remove(rel)
+
+
+class LegacyIndexList(object):
+    '''The IndexList the chains were previously held in.'''
+    def __init__(self, key):
+        self.key = key
+        self.list = []
+        self.index = []
+
+    def insert(self, i, val):
+        self.list.insert(i, val)
+        self.index.insert(i, self.key(val))
+
+    def append(self, val):
+        self.insert(len(self.list), val)
+
+    def find(self, val):
+        return bisect.bisect(self.index, self.key(val))
+
+    def __getitem__(self, i):
+        return self.list[i]
+
+    def __len__(self):
+        return len(self.list)
+
+
+def make_history(n_events):
+    '''Returns the events of an existing chain, newest first as returned
+    by the cache loading query.'''
+    return [FakeNode(before_time=str(i * 10)) for i in range(n_events)][::-1]
+
+
+def make_batches(n_events, n_batches, late_frac):
+    '''Returns aggregation batches, each a 64KB message worth of events.
+    A fraction of each batch is late, landing somewhere in the last tenth
+    of the history, the rest follows the end of the chain.'''
+    per_batch = AGGR_MSG_SIZE // MSG_SIZE
+    next_time = n_events * 10
+    batches = []
+    for _ in range(n_batches):
+        batch = []
+        for _ in range(per_batch):
+            if random.random() < late_frac:
+                when = random.randint(n_events * 9, n_events * 10) - 5
+            else:
+                next_time += 10
+                when = next_time
+            batch.append(FakeNode(before_time=str(when)))
+        batches.append(batch)
+    return batches
+
+
+def run_legacy(db, local, history, batches):
+    chain = LegacyIndexList(lambda x: int(x['before_time']))
+    start = time.time()
+    for node in history:
+        chain.insert(0, node)
+    load = time.time() - start
+
+    start = time.time()
+    for batch in batches:
+        for evt in batch:
+            i = chain.find(evt)
+            if i == 0:
+                db.create_relationship(chain[0], evt, "PREV_EVENT")
+                chain.insert(0, evt)
+            elif i == len(chain):
+                for tmp_rel in list(local.IO_EVENTS.outgoing):
+                    db.delete_relationship(tmp_rel)
+                db.create_relationship(evt, chain[len(chain) - 1],
+                                       "PREV_EVENT")
+                db.create_relationship(local, evt, "IO_EVENTS")
+                chain.append(evt)
+            else:
+                for tmp_rel in list(chain[i].PREV_EVENT.outgoing):
+                    db.delete_relationship(tmp_rel)
+                db.create_relationship(chain[i], evt, "PREV_EVENT")
+                db.create_relationship(evt, chain[i - 1], "PREV_EVENT")
+                chain.insert(i, evt)
+    return load, time.time() - start
+
+
+def run_skiplist(db, local, history, batches):
+    fd_chain = storage.FdChain()
+    fd_chain.local = local
+    start = time.time()
+    for node in reversed(history):
+        fd_chain.chain.append(node)
+    load = time.time() - start
+
+    start = time.time()
+    for batch in batches:
+        for evt in batch:
+            fd_chain.pending.add(fd_chain.chain.insert(evt))
+        functions.relink_chain(db, fd_chain)
+    return load, time.time() - start
+
+
+def link_history(db, local, history):
+    '''Writes the pre-existing chain to the fake graph.'''
+    for newer, older in zip(history, history[1:]):
+        newer.PREV_EVENT.outgoing.append(FakeRel(newer, older, "PREV_EVENT"))
+    local.IO_EVENTS.outgoing.append(FakeRel(local, history[0], "IO_EVENTS"))
+
+
+def check_chain(local, n_expected):
+    '''Walks the graph from the local and checks events are in order.'''
+    node = local.IO_EVENTS.outgoing[0].end
+    count = 1
+    while node.PREV_EVENT.outgoing:
+        prev = node.PREV_EVENT.outgoing[0].end
+        assert int(prev['before_time']) <= int(node['before_time'])
+        node = prev
+        count += 1
+    assert count == n_expected, (count, n_expected)
+
+
+def bench(n_events, n_batches, late_frac):
+    random.seed(0)
+    batches = make_batches(n_events, n_batches, late_frac)
+    total = n_events + sum(len(batch) for batch in batches)
+
+    print("{:<10} {:>10} {:>10} {:>12}".format(
+        "Structure", "Load(s)", "Insert(s)", "Rel writes"))
+    for name, runner in [("IndexList", run_legacy),
+                         ("SkipList", run_skiplist)]:
+        db = FakeDB()
+        local = FakeNode(mono_time="0")
+        history = make_history(n_events)
+        link_history(db, local, history)
+        fresh = [[FakeNode(evt) for evt in batch] for batch in batches]
+
+        load, insert = runner(db, local, history, fresh)
+        check_chain(local, total)
+        print("{:<10} {:>10.3f} {:>10.3f} {:>12d}".format(
+            name, load, insert, db.writes))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark out of order insertion into IO event chains.")
+    parser.add_argument("--events", type=int, default=100000,
+                        help="Set the number of events already on the fd.")
+    parser.add_argument("--batches", type=int, default=50,
+                        help="Set the number of 64KB aggregation messages.")
+    parser.add_argument("--late", type=float, default=0.2,
+                        help="Set the fraction of events arriving late.")
+    args = parser.parse_args()
+    bench(args.events, args.batches, args.late)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the round trip of requests from command and control to the
+analyser and producer workers. Requests are sent through the relay of the
+previous router and through the direct channels of ipc.Router, both idle
+and while messages stream from the main process to the analyser process.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import collections
+import multiprocessing
+import Queue
+import struct
+import threading
+import time
+import uuid
+
+from opus import ipc
+
+
+RelayMessage = collections.namedtuple("RelayMessage",
+                                      ['id', 'src', 'dest', 'type', 'cont'])
+
+REQUEST, RESPONSE = 0, 1
+
+
+class RelayQueuePair(object):
+    '''The queue pair of the previous router.'''
+    def __init__(self, recv_queue, send_queue, watch_queue=None):
+        self.recv = recv_queue
+        self.send = send_queue
+        self.watch = watch_queue
+
+    def get(self):
+        return self.recv.get()
+
+    def put(self, msg):
+        if self.watch is not None:
+            self.watch.put(msg.src)
+        self.send.put(msg)
+
+
+class RelayRouter(object):
+    '''The previous router, which relays every message between the
+    multiprocessing queues of its clients from a thread of its own.'''
+    def __init__(self):
+        self.clients = {}
+        self.wait_queue = multiprocessing.Queue()
+        thread = threading.Thread(target=self._main_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _main_loop(self):
+        while True:
+            try:
+                msg = self.clients[self.wait_queue.get()].get()
+            except EOFError:
+                return
+            self.clients[msg.dest].put(msg)
+
+    def add(self, ident):
+        roli = multiprocessing.Queue()
+        rilo = multiprocessing.Queue()
+        self.clients[ident] = RelayQueuePair(rilo, roli)
+        return RelayQueuePair(roli, rilo, self.wait_queue)
+
+
+class RelayWorker(object):
+    '''A worker of the previous router.'''
+    def __init__(self, handler, ident, queue, threads=1):
+        self.handler = handler
+        self.ident = ident
+        self.queue = queue
+        self.threads = threads
+        self.requests = Queue.Queue()
+
+    def _respond(self, msg):
+        self.queue.put(RelayMessage(msg.id, self.ident, msg.src, RESPONSE,
+                                    self.handler(msg)))
+
+    def _run_pool_thread(self):
+        while True:
+            self._respond(self.requests.get())
+
+    def _main_loop(self):
+        for _ in range(self.threads if self.threads > 1 else 0):
+            start_thread(self._run_pool_thread)
+        while True:
+            try:
+                msg = self.queue.get()
+            except EOFError:
+                return
+            if self.threads > 1:
+                self.requests.put(msg)
+            else:
+                self._respond(msg)
+
+    def run_forever(self):
+        start_thread(self._main_loop)
+
+
+class RelayMaster(object):
+    '''The master of the previous router.'''
+    def __init__(self, queue):
+        self.queue = queue
+        self.futures = {}
+        start_thread(self._main_loop)
+
+    def send(self, dest, msg):
+        future = ipc.Future()
+        msg_id = uuid.uuid4().hex
+        self.futures[msg_id] = future
+        self.queue.put(RelayMessage(msg_id, "CAC", dest, REQUEST, msg))
+        return future
+
+    def _main_loop(self):
+        while True:
+            try:
+                msg = self.queue.get()
+            except EOFError:
+                return
+            self.futures.pop(msg.id).fulfill(msg.cont)
+
+
+def start_thread(target, *args):
+    '''Starts a daemon thread running target.'''
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+MSG = struct.Struct(str("QQQQQQ"))
+
+
+def ingest(msg_queue, stop, batch, sent):
+    '''Streams batches of messages into msg_queue, as the producer hands
+    them to the fetcher, until stop is set. The messages sent are counted
+    in sent.'''
+    payload = str("x") * 200
+    while not stop.is_set():
+        msg_queue.put([(MSG.pack(i, 1, 2, 200, 3, 4), payload)
+                       for i in range(batch)])
+        sent[0] += batch
+    msg_queue.put(None)
+
+
+def consume(msg_queue):
+    '''Takes batches of messages from msg_queue and decodes their headers,
+    as the analyser does.'''
+    for msgs in iter(msg_queue.get, None):
+        for hdr, _ in msgs:
+            MSG.unpack(hdr)
+
+
+def analyser_status(_):
+    return {'num_msgs': 120, 'num_spilled': 0, 'inbound_rate': 5000.0,
+            'outbound_rate': 5000.0}
+
+
+def producer_ps(_):
+    return {'success': True, 'pid_map': {'1234': 1.0}}
+
+
+def run_analyser(mode, link, msg_queue, cmd_threads):
+    '''Body of the analyser process.'''
+    if mode == "router":
+        node = RelayWorker(analyser_status, "ANALYSER", RelayQueuePair(*link),
+                           threads=cmd_threads)
+    else:
+        node = ipc.Worker(analyser_status, "ANALYSER", channel=link,
+                          threads=cmd_threads)
+    node.run_forever()
+    if msg_queue is not None:
+        start_thread(consume, msg_queue)
+    while True:
+        time.sleep(1.0)
+
+
+def time_requests(master, dest, cmd, reqs):
+    '''Returns the round trips of reqs requests to dest, in microseconds.'''
+    times = []
+    for _ in range(reqs):
+        start = time.time()
+        master.send(dest, {'cmd': cmd}).result()
+        times.append((time.time() - start) * 1e6)
+    return sorted(times)
+
+
+def run(mode, load, args, results):
+    '''Times requests to each worker with the given transport and load,
+    putting the times on results.'''
+    if mode == "router":
+        router = RelayRouter()
+        pair = router.add("ANALYSER")
+        link = (pair.recv, pair.send, pair.watch)
+        RelayWorker(producer_ps, "PRODUCER",
+                    router.add("PRODUCER")).run_forever()
+        master = RelayMaster(router.add("CAC"))
+    else:
+        router = ipc.Router()
+        link = router.add("ANALYSER", process=True)
+        ipc.Worker(producer_ps, "PRODUCER", router=router).run_forever()
+        master = ipc.Master("CAC", router)
+
+    msg_queue = multiprocessing.Queue(64) if load == "ingest" else None
+    analyser = multiprocessing.Process(
+        target=run_analyser, args=(mode, link, msg_queue, args.cmd_threads))
+    analyser.start()
+    if mode == "channels":
+        link.close()
+    stop = threading.Event()
+    sent = [0]
+    if msg_queue is not None:
+        ingester = start_thread(ingest, msg_queue, stop, args.batch, sent)
+    try:
+        time_requests(master, "ANALYSER", "status", 50)
+        start = time.time()
+        sent[0] = 0
+        times = [time_requests(master, dest, cmd, args.reqs)
+                 for dest, cmd in [("ANALYSER", "status"),
+                                   ("PRODUCER", "ps")]]
+        results.put(times + [sent[0] / (time.time() - start)])
+    finally:
+        stop.set()
+        if msg_queue is not None:
+            ingester.join()
+            msg_queue.close()
+            msg_queue.join_thread()
+        analyser.terminate()
+        analyser.join()
+
+
+def main():
+    '''Time requests with each transport and load.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark requests to the backend workers.")
+    parser.add_argument("--reqs", type=int, default=2000,
+                        help="Set the number of requests timed to each "
+                        "worker.")
+    parser.add_argument("--batch", type=int, default=100,
+                        help="Set the messages in each batch ingested.")
+    parser.add_argument("--cmd-threads", type=int, default=4,
+                        help="Set the command threads of the analyser.")
+    args = parser.parse_args()
+
+    print("{:<9} {:<7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "mode", "load", "status us", "status p99", "ps us", "ps p99",
+        "max us", "ingest/s"))
+    results = multiprocessing.Queue()
+    for load in ["idle", "ingest"]:
+        for mode in ["router", "channels"]:
+            # Each setting runs in a fresh process, so that the threads of
+            # one do not compete with the next.
+            proc = multiprocessing.Process(target=run,
+                                           args=(mode, load, args, results))
+            proc.start()
+            status, ps, rate = results.get()
+            proc.join()
+            p99 = int(len(status) * 0.99)
+            print("{:<9} {:<7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} "
+                  "{:>10.1f} {:>10.0f}".format(
+                      mode, load, sum(status) / len(status), status[p99],
+                      sum(ps) / len(ps), ps[p99], max(status[-1], ps[-1]),
+                      rate))
+
+
+if __name__ == "__main__":
+    main()
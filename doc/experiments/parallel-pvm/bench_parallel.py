@@ -0,0 +1,219 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Scaling benchmark of the ParallelPVMAnalyser. A synthetic workload of
+independent process trees, each forking children that open, read, write and
+close files, is applied to a fresh database by the serial PVMAnalyser and by
+the parallel analyser with an increasing number of partitions.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from opus import analysis, messaging
+from opus import uds_msg_pb2 as uds_msg
+from opus.pvm import posix
+
+
+NEO4J_CFG = {'max_jvm_heap_size': 'default',
+             'min_jvm_heap_size': 'default',
+             'jvm_from_avail_mem': 0.25,
+             'buffer_cache': {'buffer_cache_size': 'default',
+                              'buff_cache_auto': 0.25,
+                              'propstore': 0.20,
+                              'nodestore': 0.20,
+                              'relstore': 0.30}}
+
+
+class Clock(object):
+    '''Hands out increasing monotonic nanosecond timestamps.'''
+    def __init__(self):
+        self.now = 10**12
+
+    def tick(self):
+        self.now += 1000
+        return self.now
+
+
+def make_msg(clock, pid, payload_type, pay):
+    '''Frames a payload with a header as the producer does.'''
+    pay_buf = pay.SerializeToString()
+    hdr = messaging.Header()
+    hdr.timestamp = clock.tick()
+    hdr.pid = pid
+    hdr.payload_type = payload_type
+    hdr.payload_len = len(pay_buf)
+    hdr.tid = pid
+    hdr.sys_time = int(time.time())
+    return (hdr.dumps(), pay_buf)
+
+
+def func_msg(clock, func_name, ret_val, args):
+    '''Builds a function info message.'''
+    msg = uds_msg.FuncInfoMessage()
+    msg.func_name = func_name
+    msg.ret_val = ret_val
+    msg.begin_time = clock.tick()
+    msg.end_time = clock.tick()
+    for key, val in args:
+        arg = msg.args.add()
+        arg.key = key
+        arg.value = val
+    return msg
+
+
+def startup_msg(clock, ppid):
+    '''Builds a process startup message.'''
+    msg = uds_msg.StartupMessage()
+    msg.exec_name = "/usr/bin/cc"
+    msg.cwd = "/home/build"
+    msg.cmd_line_args = "cc -c"
+    msg.user_name = "build"
+    msg.group_name = "build"
+    msg.ppid = ppid
+    msg.start_time = clock.tick()
+    env = msg.environment.add()
+    env.key = "PATH"
+    env.value = "/usr/bin:/bin"
+    return msg
+
+
+def process_workload(clock, pid, tree, files, shared, events):
+    '''Messages of a process opening each of its files, doing aggregated IO
+    on it and closing it.'''
+    msgs = []
+    for i in range(files):
+        if i < shared:
+            path = "/usr/include/shared%d.h" % i
+        else:
+            path = "/home/build/tree%d/pid%d/file%d.c" % (tree, pid, i)
+        msgs.append(make_msg(clock, pid, uds_msg.FUNCINFO_MSG,
+                             func_msg(clock, "open", 3,
+                                      [("pathname", path),
+                                       ("flags", str(os.O_RDWR))])))
+
+        agg = uds_msg.AggregationMessage()
+        for j in range(events):
+            func_name = "read" if j % 2 == 0 else "write"
+            agg.messages.append(func_msg(clock, func_name, 4096,
+                                         [("fd", "3")]).SerializeToString())
+        msgs.append(make_msg(clock, pid, uds_msg.AGGREGATION_MSG, agg))
+
+        msgs.append(make_msg(clock, pid, uds_msg.FUNCINFO_MSG,
+                             func_msg(clock, "close", 0, [("fd", "3")])))
+    return msgs
+
+
+def make_workload(trees, children, files, shared, events):
+    '''Builds the messages of every process tree, interleaved as they would
+    arrive from concurrently running builds.'''
+    clock = Clock()
+    streams = []
+    for tree in range(trees):
+        root = 1000 + tree * (children + 1)
+        msgs = [make_msg(clock, root, uds_msg.STARTUP_MSG,
+                         startup_msg(clock, 1))]
+        for child in range(root + 1, root + children + 1):
+            msgs.append(make_msg(clock, root, uds_msg.FUNCINFO_MSG,
+                                 func_msg(clock, "fork", child, [])))
+            msgs.append(make_msg(clock, child, uds_msg.STARTUP_MSG,
+                                 startup_msg(clock, root)))
+            msgs += process_workload(clock, child, tree, files, shared,
+                                     events)
+            discon = uds_msg.GenericMessage()
+            discon.msg_type = uds_msg.DISCON
+            msgs.append(make_msg(clock, child, uds_msg.GENERIC_MSG, discon))
+        streams.append(msgs)
+
+    workload = []
+    for i in range(max(len(msgs) for msgs in streams)):
+        for msgs in streams:
+            if i < len(msgs):
+                workload.append(msgs[i])
+    return workload
+
+
+def lock_mix(workload):
+    '''Returns the messages and calls of the workload applied under the
+    shared lock and under the exclusive lock.'''
+    counts = {False: [0, 0], True: [0, 0]}
+    for msg in workload:
+        dec = analysis.DecodedMsg(*msg)
+        exclusive = posix.touches_globals(dec.hdr_obj, dec.pay_obj)
+        counts[exclusive][0] += 1
+        counts[exclusive][1] += len(dec.funcs) if dec.funcs else 1
+    return counts[False], counts[True]
+
+
+def run(workload, workers, batch):
+    '''Applies the workload to a fresh database, returning the time taken.'''
+    tmp_dir = tempfile.mkdtemp()
+    storage_args = {'filename': os.path.join(tmp_dir, "prov_db")}
+    if workers == 0:
+        anal = analysis.PVMAnalyser("DBInterface", storage_args, True,
+                                    NEO4J_CFG, tmp_dir)
+    else:
+        anal = analysis.ParallelPVMAnalyser("DBInterface", storage_args,
+                                            True, NEO4J_CFG, tmp_dir,
+                                            workers=workers)
+    anal.start()
+
+    start = time.time()
+    for i in range(0, len(workload), batch):
+        anal.put_msg(workload[i:i + batch])
+    anal.do_shutdown()
+    elapsed = time.time() - start
+
+    shutil.rmtree(tmp_dir)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark PVM analysis across partitions.")
+    parser.add_argument("--trees", type=int, default=16,
+                        help="Set the number of independent process trees.")
+    parser.add_argument("--children", type=int, default=8,
+                        help="Set the number of children of each tree root.")
+    parser.add_argument("--files", type=int, default=20,
+                        help="Set the number of files each child opens.")
+    parser.add_argument("--shared", type=int, default=2,
+                        help="Set how many of those files all trees share.")
+    parser.add_argument("--events", type=int, default=64,
+                        help="Set the number of IO events per open file.")
+    parser.add_argument("--batch", type=int, default=100,
+                        help="Set the number of messages per put_msg call.")
+    parser.add_argument("--lock-mix", action="store_true",
+                        help="Only report the messages and calls applied "
+                        "under each lock, without a database.")
+    args = parser.parse_args()
+
+    workload = make_workload(args.trees, args.children, args.files,
+                             args.shared, args.events)
+    print("{} messages".format(len(workload)))
+    shared, exclusive = lock_mix(workload)
+    print("{:>10} {:>10} {:>10}".format("Lock", "Msgs", "Calls"))
+    print("{:>10} {:>10} {:>10}".format("shared", *shared))
+    print("{:>10} {:>10} {:>10}".format("exclusive", *exclusive))
+    if args.lock_mix:
+        return
+    print("{:>10} {:>10} {:>10} {:>8}".format("Workers", "Time(s)",
+                                              "Msgs/s", "Speedup"))
+    base = None
+    for workers in [0, 1, 2, 4, 8]:
+        elapsed = run(workload, workers, args.batch)
+        if base is None:
+            base = elapsed
+        print("{:>10} {:>10.2f} {:>10.0f} {:>8.2f}".format(
+            "serial" if workers == 0 else workers, elapsed,
+            len(workload) / elapsed, base / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Benchmark of filtering client messages in the producer. A workload is run
+under the interposition library and the messages the producer reads are
+recorded. The recording is then passed through a MessageFilter with each
+set of rules, timing the filter and counting the messages, function calls
+and bytes left for the analyser.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+import yaml
+
+from opus import filtering, messaging, production, uds_msg_pb2
+
+
+SHELL_WORKLOAD = ("cd {work_dir}; for i in $(seq {iters}); do "
+                  "ls -l /usr/bin > /dev/null; "
+                  "cat /etc/passwd /etc/hostname > /dev/null; "
+                  "echo $i >> out.txt; done")
+
+# The paths the workflow generator discards at query time
+SYSTEM_PATHS = {'name': "system_paths",
+                'path_prefixes': ['/etc/', '/lib/', '/var/', '/dev/', '/usr/',
+                                  '/run', '/bin', '/sbin', '/proc', '/opt'],
+                'path_suffixes': ['.sh_history', '.bashrc', '.cache',
+                                  '.config']}
+
+RULE_SETS = {
+    'paths': [SYSTEM_PATHS],
+    'paths-sum': [dict(SYSTEM_PATHS, action="summarise")],
+    'paths+ls': [SYSTEM_PATHS, {'name': "ls", 'binaries': ["/usr/bin/ls",
+                                                           "/bin/ls"]}],
+    'nomatch': [{'name': "nomatch", 'path_prefixes': ["/nonexistent/"]}]}
+
+HEADER = struct.Struct(str(messaging.Header.struct_string))
+
+
+class Sink(threading.Thread):
+    '''Polls a communication manager and keeps the messages received.'''
+    def __init__(self, comm_manager):
+        super(Sink, self).__init__()
+        self.comm_manager = comm_manager
+        self.msgs = []
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            self.msgs += self.comm_manager.do_poll()
+
+
+def record(cmd, lib, work_dir):
+    '''Runs cmd under the interposition library, returning the messages
+    read by the producer.'''
+    sock_path = os.path.join(work_dir, "prov.sock")
+    comm_manager = production.MultiCommunicationManager(
+        "unix://" + sock_path, max_conn=64, select_timeout=0.5)
+    sink = Sink(comm_manager)
+    sink.start()
+
+    env = dict(os.environ)
+    env.update({'LD_PRELOAD': lib,
+                'OPUS_PROV_COMM_MODE': "unix",
+                'OPUS_UDS_PATH': sock_path,
+                'OPUS_LOG_LEVEL': "3",
+                'OPUS_INTERPOSE_MODE': "1",
+                'OPUS_MSG_AGGR': "1",
+                'OPUS_MAX_AGGR_MSG_SIZE': "65536",
+                'OPUS_PROTOCOL_VERSION': "2"})
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(cmd, env=env, stdout=devnull)
+        time.sleep(1.0)
+    finally:
+        sink.stop.set()
+        sink.join()
+        comm_manager.close()
+    return sink.msgs
+
+
+def count_calls(msg_list):
+    '''Returns the number of function calls in msg_list.'''
+    calls = 0
+    for hdr_buf, pay_buf in msg_list:
+        pay_type = HEADER.unpack(hdr_buf)[2]
+        if pay_type == uds_msg_pb2.FUNCINFO_MSG:
+            calls += 1
+        elif pay_type == uds_msg_pb2.AGGREGATION_MSG:
+            agg_msg = uds_msg_pb2.AggregationMessage()
+            agg_msg.ParseFromString(pay_buf)
+            calls += len(agg_msg.messages)
+    return calls
+
+
+def run_rules(msg_list, rules, work_dir, batch):
+    '''Filters msg_list in batches with the given rules, returning the
+    messages kept, the seconds spent filtering and the rule counts.'''
+    rule_file = os.path.join(work_dir, "filters.yaml")
+    with open(rule_file, "w") as rule_fp:
+        yaml.safe_dump({'rules': rules}, rule_fp)
+    msg_filter = filtering.MessageFilter(rule_file)
+
+    kept = []
+    start = time.time()
+    for pos in range(0, len(msg_list), batch):
+        kept += msg_filter.filter(msg_list[pos:pos + batch])
+    kept += msg_filter.flush()
+    return kept, time.time() - start, msg_filter.stats()
+
+
+def main():
+    '''Run the workload and filter its messages with each rule set.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark filtering of messages in the producer.")
+    parser.add_argument("lib", help="Path to libopusinterpose.so.")
+    parser.add_argument("--iters", type=int, default=100,
+                        help="Set the number of iterations of the workload.")
+    parser.add_argument("--batch", type=int, default=64,
+                        help="Set the number of messages filtered at once.")
+    parser.add_argument("--rules", nargs="+",
+                        default=["nomatch", "paths", "paths-sum", "paths+ls"],
+                        help="Set the rule sets to test, from %s." %
+                        ", ".join(sorted(RULE_SETS)))
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        cmd = ["bash", "-c", SHELL_WORKLOAD.format(work_dir=work_dir,
+                                                   iters=args.iters)]
+        msg_list = record(cmd, os.path.abspath(args.lib), work_dir)
+        msgs = max(len(msg_list), 1)
+        size = sum(len(hdr) + len(pay) for hdr, pay in msg_list)
+        calls = count_calls(msg_list)
+
+        print("{:<10} {:>8} {:>8} {:>10} {:>7} {:>7} {:>10}".format(
+            "rules", "msgs", "calls", "bytes", "calls%", "bytes%",
+            "filter us"))
+        print("{:<10} {:>8d} {:>8d} {:>10d} {:>7.1f} {:>7.1f} {:>10.2f}"
+              .format("-", len(msg_list), calls, size, 100.0, 100.0, 0.0))
+        for name in args.rules:
+            kept, elapsed, stats = run_rules(msg_list, RULE_SETS[name],
+                                             work_dir, args.batch)
+            kept_size = sum(len(hdr) + len(pay) for hdr, pay in kept)
+            kept_calls = count_calls(kept)
+            print("{:<10} {:>8d} {:>8d} {:>10d} {:>7.1f} {:>7.1f} {:>10.2f}"
+                  .format(name, len(kept), kept_calls, kept_size,
+                          kept_calls * 100.0 / max(calls, 1),
+                          kept_size * 100.0 / max(size, 1),
+                          elapsed * 10**6 / msgs))
+            for rule in stats:
+                print("    {:<16} {:<10} {:>8d} calls {:>10d} bytes".format(
+                    rule['name'], rule['action'], rule['calls'],
+                    rule['bytes']))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
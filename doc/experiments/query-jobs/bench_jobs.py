@@ -0,0 +1,156 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Benchmark of asynchronous query jobs. A CommandControl is run against an
+in-process ANALYSER worker whose queries are answered by a QueryJobManager
+over a database that sleeps through each query. A number of slow queries
+are made at once, either waiting for each with exec_qry_method or
+submitting each as a job, and the round trip time of a status request made
+meanwhile is measured, along with the time until every query has finished.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import threading
+import time
+
+from opus import cc_utils, command, ipc
+from opus.query import client_query, jobs
+
+
+class SleepingDB(object):
+    '''Stands in for the database, sleeping through each query.'''
+    def __init__(self, query_secs):
+        self.query_secs = query_secs
+
+    def locked_query(self, qry, **_):
+        time.sleep(self.query_secs)
+        return [qry]
+
+
+@client_query.ClientQueryControl.register_query_method("bench_rows",
+                                                       rows_key="data")
+def bench_rows(db_iface, args):
+    '''Makes args['queries'] database queries and returns args['rows']
+    rows.'''
+    for _ in range(args['queries']):
+        db_iface.locked_query("")
+    return {"success": True,
+            "data": [{'row': row} for row in range(args['rows'])]}
+
+
+class Alive(object):
+    '''Stands in for the threads and processes of a backend.'''
+    def is_alive(self):
+        return True
+
+
+class DaemonManager(object):
+    '''Stands in for the daemon manager of a backend.'''
+    def __init__(self):
+        self.analyser_ctl = type(str("AnalyserController"), (), {})()
+        self.analyser_ctl.fetcher = Alive()
+        self.producer = Alive()
+
+
+def start_backend(addr, args):
+    '''Starts a CommandControl listening on addr, returning it and its
+    thread.'''
+    db_iface = SleepingDB(args.query_secs)
+    query_jobs = jobs.QueryJobManager(lambda: db_iface,
+                                      max_jobs=args.max_jobs)
+
+    def analyser_handler(msg):
+        if msg.cont['cmd'] == "status":
+            return {"num_msgs": 0}
+        elif msg.cont['cmd'] == "exec_qry_method":
+            return query_jobs.run(msg.cont)
+        return query_jobs.handle(msg.cont)
+
+    router = ipc.Router()
+    ipc.Worker(analyser_handler, ident="ANALYSER", router=router,
+               threads=args.cmd_threads).run_forever()
+    ipc.Worker(lambda _: {"success": True}, ident="PRODUCER",
+               router=router).run_forever()
+    cac = command.CommandControl(DaemonManager(), router, addr,
+                                 worker_threads=args.cmd_threads)
+    cac_thread = threading.Thread(target=cac.run)
+    cac_thread.daemon = True
+    cac_thread.start()
+    return cac, cac_thread
+
+
+def main():
+    '''Time a status request while queries run.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark asynchronous query jobs.")
+    parser.add_argument("--queries", type=int, default=8,
+                        help="Set the number of queries made at once.")
+    parser.add_argument("--query-secs", type=float, default=0.1,
+                        help="Set the length of each database query.")
+    parser.add_argument("--db-queries", type=int, default=10,
+                        help="Set the database queries made by each query.")
+    parser.add_argument("--rows", type=int, default=2000,
+                        help="Set the rows returned by each query.")
+    parser.add_argument("--max-jobs", type=int, default=2,
+                        help="Set the number of jobs run at once.")
+    parser.add_argument("--cmd-threads", type=int, default=4,
+                        help="Set the command threads of the backend.")
+    parser.add_argument("--port", type=int, default=10787,
+                        help="Set the first port to listen on.")
+    args = parser.parse_args()
+
+    qry = {'qry_method': "bench_rows",
+           'qry_args': {'queries': args.db_queries, 'rows': args.rows}}
+
+    print("{:<8} {:>12} {:>12} {:>12} {:>10}".format(
+        "mode", "status ms", "first s", "all s", "rows"))
+    for mode, port in [("sync", args.port), ("jobs", args.port + 1)]:
+        addr = "tcp://127.0.0.1:%d" % port
+        cac, cac_thread = start_backend(addr, args)
+        time.sleep(0.2)
+        helper = cc_utils.CommandConnectionHelper(addr)
+        firsts = []
+        rows = [0]
+        lock = threading.Lock()
+        start = time.time()
+
+        def run_query():
+            qry_helper = cc_utils.CommandConnectionHelper(addr)
+            if mode == "sync":
+                rsp = qry_helper.make_request(dict(qry,
+                                                   cmd="exec_qry_method"))
+                with lock:
+                    firsts.append(time.time() - start)
+                    rows[0] += len(rsp['data'])
+            else:
+                rsp = qry_helper.make_request(dict(qry, cmd="query_submit"))
+                for rsp in qry_helper.fetch_query(rsp['job_id'], 0.05):
+                    with lock:
+                        if rsp['chunks'] and not firsts:
+                            firsts.append(time.time() - start)
+                        rows[0] += sum(len(chunk)
+                                       for chunk in rsp['chunks'])
+            qry_helper.close()
+
+        threads = [threading.Thread(target=run_query)
+                   for _ in range(args.queries)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        status_start = time.time()
+        helper.make_request({'cmd': "status"})
+        status_ms = (time.time() - status_start) * 1e3
+        for thread in threads:
+            thread.join()
+        print("{:<8} {:>12.1f} {:>12.2f} {:>12.2f} {:>10d}".format(
+            mode, status_ms, min(firsts), time.time() - start, rows[0]))
+        helper.close()
+        cac.stop()
+        cac_thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Bandwidth benchmark of relay backends. A workload is run on each of a number
+of simulated hosts under the interposition library. It is first connected
+over TCP straight to a central producer and then to a relay backend per
+host, which forwards it in batches to a RelayCommunicationManager. The
+connections, messages and bytes reaching the central producer are compared.
+With --outage the central producer is started only once the workload has
+finished, and the bytes spooled by the relays and the time taken to drain
+them are reported.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from opus import analysis, production
+
+
+SHELL_WORKLOAD = ("for i in $(seq {iters}); do "
+                  "ls -l /usr/bin > /dev/null; "
+                  "cat /etc/passwd /etc/hostname > /dev/null; done")
+
+
+class ClosedStatsMixin(object):
+    '''Keeps the counters of closed connections.'''
+    def __init__(self, *args, **kwargs):
+        super(ClosedStatsMixin, self).__init__(*args, **kwargs)
+        self.closed_stats = []
+
+    def _handle_close_connection(self, sock_obj, ret_list):
+        sock_rdr = self.input_client_map.get(sock_obj.fileno())
+        if sock_rdr is not None:
+            self.closed_stats.append(sock_rdr.stats())
+        super(ClosedStatsMixin,
+              self)._handle_close_connection(sock_obj, ret_list)
+
+
+class DirectCentral(ClosedStatsMixin, production.MultiCommunicationManager):
+    '''Central producer read by the clients of every host.'''
+    pass
+
+
+class RelayCentral(ClosedStatsMixin, production.RelayCommunicationManager):
+    '''Central producer read by the relays.'''
+    pass
+
+
+class Poller(threading.Thread):
+    '''Polls a communication manager, passing the messages received to
+    handler.'''
+    def __init__(self, comm_manager, handler):
+        super(Poller, self).__init__()
+        self.comm_manager = comm_manager
+        self.handler = handler
+        self.msgs = 0
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            msg_list = self.comm_manager.do_poll()
+            if msg_list:
+                self.msgs += len(msg_list)
+                self.handler(msg_list)
+
+    def close(self):
+        '''Stops polling and closes the communication manager.'''
+        self.stop.set()
+        self.join()
+        self.comm_manager.close()
+
+
+class Relay(object):
+    '''A relay backend run in the benchmark process, a producer reading the
+    UDS clients of a host and a RelayAnalyser forwarding their messages.'''
+    def __init__(self, work_dir, host_id, central_addr, batch_size):
+        self.path = os.path.join(work_dir, host_id + ".sock")
+        self.analyser = analysis.RelayAnalyser(
+            central_addr, os.path.join(work_dir, host_id + ".spool"),
+            host_id=host_id, batch_size=batch_size, retry_interval=0.2)
+        self.analyser.start()
+        self.poller = Poller(production.MultiCommunicationManager(
+            "unix://" + self.path, max_conn=64, select_timeout=0.1),
+                             self.analyser.put_msg)
+        self.poller.start()
+
+    def close(self):
+        '''Stops the producer and forwards the remaining messages.'''
+        self.poller.close()
+        self.analyser.do_shutdown()
+
+
+def run_hosts(cmd, lib, envs):
+    '''Runs cmd under the interposition library once per host environment,
+    all at once, returning the seconds taken.'''
+    start = time.time()
+    procs = []
+    with open(os.devnull, "w") as devnull:
+        for host_env in envs:
+            env = dict(os.environ)
+            env.update({'LD_PRELOAD': lib,
+                        'OPUS_LOG_LEVEL': "3",
+                        'OPUS_INTERPOSE_MODE': "1",
+                        'OPUS_MSG_AGGR': "1",
+                        'OPUS_MAX_AGGR_MSG_SIZE': "65536",
+                        'OPUS_PROTOCOL_VERSION': "2"})
+            env.update(host_env)
+            procs.append(subprocess.Popen(cmd, env=env, stdout=devnull))
+        for proc in procs:
+            proc.wait()
+    return time.time() - start
+
+
+def wait_drained(central, relays):
+    '''Waits for the relays to empty their spools and the central producer
+    to stop receiving messages.'''
+    last = -1
+    while True:
+        time.sleep(0.5)
+        if (central.msgs == last and
+                not any(rel.analyser.spool.pending() for rel in relays)):
+            return
+        last = central.msgs
+
+
+def run_setting(cmd, lib, port, hosts, work_dir, batch_size, outage):
+    '''Runs cmd on each host either straight to the central producer, if
+    batch_size is None, or through relays. Returns the seconds taken by the
+    workload, the bytes spooled, the seconds taken to drain them, the
+    messages received by the central producer and the counters of its
+    connections.'''
+    addr = "tcp://127.0.0.1:{:d}".format(port)
+    host_ids = ["host{:d}".format(i) for i in range(hosts)]
+    relays = []
+    central = None
+    if batch_size is None:
+        central = Poller(DirectCentral(addr, max_conn=64, select_timeout=0.1),
+                         lambda msg_list: None)
+        central.start()
+        envs = [{'OPUS_PROV_COMM_MODE': "tcp",
+                 'OPUS_TCP_ADDRESS': "127.0.0.1",
+                 'OPUS_TCP_PORT': str(port),
+                 'OPUS_TCP_COMPRESSION': "1"} for _ in host_ids]
+    else:
+        if not outage:
+            central = Poller(RelayCentral(addr, max_conn=64,
+                                          select_timeout=0.1),
+                             lambda msg_list: None)
+            central.start()
+        relays = [Relay(work_dir, host_id, addr, batch_size)
+                  for host_id in host_ids]
+        envs = [{'OPUS_PROV_COMM_MODE': "unix",
+                 'OPUS_UDS_PATH': rel.path} for rel in relays]
+
+    spooled = 0
+    drain = 0.0
+    try:
+        elapsed = run_hosts(cmd, lib, envs)
+        time.sleep(1.0)
+        if central is None:
+            central = Poller(RelayCentral(addr, max_conn=64,
+                                          select_timeout=0.1),
+                             lambda msg_list: None)
+            spooled = sum(rel.analyser.spool.pending() for rel in relays)
+            start = time.time()
+            central.start()
+            wait_drained(central, relays)
+            drain = time.time() - start
+        for rel in relays:
+            rel.close()
+        time.sleep(0.5)
+    finally:
+        if central is not None:
+            central.close()
+    stats = central.comm_manager.closed_stats
+    return elapsed, spooled, drain, central.msgs, stats
+
+
+def main():
+    '''Run the workload straight to the central producer and through
+    relays with each batch size.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark bandwidth of relay backends.")
+    parser.add_argument("lib", help="Path to libopusinterpose.so.")
+    parser.add_argument("--iters", type=int, default=50,
+                        help="Set the number of iterations of the workload.")
+    parser.add_argument("--hosts", type=int, default=2,
+                        help="Set the number of hosts.")
+    parser.add_argument("--port", type=int, default=10200,
+                        help="Set the central producer port.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[16, 64, 256],
+                        help="Set the relay batch sizes to test in KB.")
+    parser.add_argument("--outage", action="store_true",
+                        help="Start the central producer only once the "
+                        "workload has finished.")
+    args = parser.parse_args()
+
+    cmd = ["bash", "-c", SHELL_WORKLOAD.format(iters=args.iters)]
+    settings = [None] + args.batch_sizes
+    if args.outage:
+        settings = args.batch_sizes
+
+    print("{:<9} {:>6} {:>8} {:>11} {:>11} {:>10} {:>6} {:>10} {:>8} "
+          "{:>10} {:>8}".format("setting", "conns", "msgs", "wire bytes",
+                                "raw bytes", "wire B/msg", "ratio",
+                                "inflate us", "run s", "spooled", "drain s"))
+    for batch_size in settings:
+        work_dir = tempfile.mkdtemp()
+        try:
+            elapsed, spooled, drain, msgs, stats = run_setting(
+                cmd, os.path.abspath(args.lib), args.port, args.hosts,
+                work_dir, batch_size, args.outage)
+        finally:
+            shutil.rmtree(work_dir)
+        wire = sum(conn['wire_bytes'] for conn in stats)
+        raw = sum(conn['raw_bytes'] for conn in stats)
+        inflate = sum(conn['inflate_time'] for conn in stats)
+        msgs = max(msgs, 1)
+        name = ("direct" if batch_size is None
+                else "relay:{:d}".format(batch_size))
+        print("{:<9} {:>6d} {:>8d} {:>11d} {:>11d} {:>10.1f} {:>6.2f} "
+              "{:>10.2f} {:>8.2f} {:>10d} {:>8.2f}".format(
+                  name, len(stats), msgs, wire, raw, wire / msgs,
+                  raw / max(wire, 1), inflate * 10**6 / msgs, elapsed,
+                  spooled, drain))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Connection scaling benchmark of the producer. Client processes open an
+increasing number of connections to the SocketProducer and to the
+ShardedProducer with an increasing number of shards, send a fixed number of
+messages on each connection and the time taken for every message to reach
+the producer fetcher queue is measured, along with the latency of the
+messages from being sent to reaching the queue.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import multiprocessing
+import os
+import Queue
+import resource
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from opus import ipc, messaging, production
+from opus import uds_msg_pb2 as uds_msg
+from opus.pf_queue import ProducerFetcherQueue
+
+
+TIMESTAMP = struct.Struct(str("Q"))
+
+
+def make_msg(pid, seq):
+    '''Frames a generic message with a header as the client library
+    does, stamped with the time it is sent in microseconds.'''
+    gen_msg = uds_msg.GenericMessage()
+    gen_msg.msg_type = uds_msg.SIGNAL
+    gen_msg.msg_desc = "bench message %d" % seq
+    pay_buf = gen_msg.SerializeToString()
+    hdr = messaging.Header()
+    hdr.timestamp = int(time.time() * 1e6)
+    hdr.pid = pid
+    hdr.payload_type = uds_msg.GENERIC_MSG
+    hdr.payload_len = len(pay_buf)
+    hdr.tid = pid
+    hdr.sys_time = int(time.time())
+    return hdr.dumps() + pay_buf
+
+
+def connect(addr):
+    '''Connects a client socket to a producer address.'''
+    if addr.startswith("tcp://"):
+        host, port = addr[len("tcp://"):].rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, int(port)))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(addr[len("unix://"):])
+    return sock
+
+
+def client(addr, conns, msgs, ready, go):
+    '''Opens conns connections, waits for every client to be connected and
+    then sends msgs messages on each connection in turn.'''
+    socks = [connect(addr) for _ in range(conns)]
+    ready.put(len(socks))
+    go.wait()
+    pid = os.getpid()
+    for seq in range(msgs):
+        buf = make_msg(pid, seq)
+        for sock in socks:
+            sock.sendall(buf)
+    ready.get()
+    for sock in socks:
+        sock.close()
+
+
+def make_producer(addr, shards, pf_queue, router):
+    '''Creates the SocketProducer if shards is 0, or a ShardedProducer.'''
+    comm_mgr_args = {'addr': addr,
+                     'max_conn': 1024,
+                     'select_timeout': 0.5}
+    if shards == 0:
+        return production.SocketProducer("MultiCommunicationManager",
+                                         comm_mgr_args,
+                                         pf_queue=pf_queue,
+                                         router=router)
+    return production.ShardedProducer(comm_mgr_args, shards=shards,
+                                      pf_queue=pf_queue, router=router)
+
+
+def run(addr, shards, conns, clients, msgs):
+    '''Returns the connection setup time, the message throughput and the
+    sorted latencies in milliseconds of a producer with the given number of
+    shards. The latency of the last message of each batch taken from the
+    queue is sampled.'''
+    router = ipc.Router()
+    pf_queue = ProducerFetcherQueue(max(shards, 1))
+    pf_queue.register_event(threading.Event(), Exception)
+    producer = make_producer(addr, shards, pf_queue, router)
+    producer.start()
+    time.sleep(1.0)
+
+    ready = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    procs = []
+    for i in range(clients):
+        share = conns // clients + (1 if i < conns % clients else 0)
+        proc = multiprocessing.Process(target=client,
+                                       args=(addr, share, msgs, ready, go))
+        proc.start()
+        procs.append(proc)
+
+    start = time.time()
+    for _ in procs:
+        ready.get()
+    setup = time.time() - start
+
+    expected = conns * msgs
+    received = 0
+    latencies = []
+    start = time.time()
+    go.set()
+    while received < expected:
+        try:
+            batch = pf_queue.dequeue()
+        except Queue.Empty:
+            continue
+        received += len(batch)
+        sent = TIMESTAMP.unpack_from(batch[-1][0])[0]
+        latencies.append(time.time() * 1e3 - sent / 1e3)
+    elapsed = time.time() - start
+
+    for _ in procs:
+        ready.put(None)
+    for proc in procs:
+        proc.join()
+    producer.do_shutdown()
+    return setup, expected / elapsed, sorted(latencies)
+
+
+def main():
+    '''Run the benchmark over the connection and shard counts.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark producer connection scaling.")
+    parser.add_argument("--addr", default=None,
+                        help="Set the producer address, defaults to a UDS "
+                        "socket in a temporary directory.")
+    parser.add_argument("--conns", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="Set the numbers of connections to test.")
+    parser.add_argument("--shards", type=int, nargs="+",
+                        default=[0, 1, 2, 4, 8],
+                        help="Set the numbers of shards to test, 0 for the "
+                        "SocketProducer.")
+    parser.add_argument("--clients", type=int, default=50,
+                        help="Set the number of client processes.")
+    parser.add_argument("--msgs", type=int, default=20,
+                        help="Set the number of messages per connection.")
+    args = parser.parse_args()
+
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < max(args.conns) + 1024:
+        print("The open file limit of {:d} is too low for {:d} "
+              "connections.".format(hard, max(args.conns)))
+        return
+
+    tmp_dir = tempfile.mkdtemp()
+    addr = args.addr or "unix://" + os.path.join(tmp_dir, "bench.sock")
+    try:
+        print("{:>8} {:>7} {:>10} {:>12} {:>10} {:>10}".format(
+            "conns", "shards", "setup (s)", "msgs/s", "p50 (ms)",
+            "p99 (ms)"))
+        for conns in args.conns:
+            for shards in args.shards:
+                setup, rate, lat = run(addr, shards, conns, args.clients,
+                                       args.msgs)
+                print("{:>8d} {:>7d} {:>10.2f} {:>12.0f} {:>10.1f} "
+                      "{:>10.1f}".format(conns, shards, setup, rate,
+                                         lat[len(lat) // 2],
+                                         lat[int(len(lat) * 0.99)]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
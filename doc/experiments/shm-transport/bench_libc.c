@@ -0,0 +1,58 @@
+/*
+ * Times libc calls captured by the interposition library. Prints the
+ * mean time per call in nanoseconds for each call tested.
+ */
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+static double now_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1e9 + ts.tv_nsec;
+}
+
+int main(int argc, char **argv)
+{
+    long iters = argc > 1 ? atol(argv[1]) : 100000;
+    const char *path = argc > 2 ? argv[2] : "bench_libc.dat";
+    char buf[4096];
+    double start;
+    long i;
+
+    memset(buf, 'x', sizeof(buf));
+    int fd = open(path, O_RDWR | O_CREAT | O_TRUNC, 0600);
+    if (fd < 0 || write(fd, buf, sizeof(buf)) != sizeof(buf))
+    {
+        perror("setup");
+        return 1;
+    }
+
+    start = now_ns();
+    for (i = 0; i < iters; ++i)
+        close(open(path, O_RDONLY));
+    printf("open_close %.1f\n", (now_ns() - start) / iters);
+
+    start = now_ns();
+    for (i = 0; i < iters; ++i)
+        pread(fd, buf, 64, (i * 64) % 4096);
+    printf("pread %.1f\n", (now_ns() - start) / iters);
+
+    start = now_ns();
+    for (i = 0; i < iters; ++i)
+        pwrite(fd, buf, 64, (i * 64) % 4096);
+    printf("pwrite %.1f\n", (now_ns() - start) / iters);
+
+    start = now_ns();
+    for (i = 0; i < iters; ++i)
+        fclose(fopen(path, "r"));
+    printf("fopen_fclose %.1f\n", (now_ns() - start) / iters);
+
+    close(fd);
+    unlink(path);
+    return 0;
+}
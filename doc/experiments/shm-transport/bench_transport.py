@@ -0,0 +1,126 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Interposition overhead benchmark of the UDS and shared memory transports. A
+libc heavy microbenchmark is run natively and under the interposition
+library connected to a producer using each transport, and the time per call
+is compared.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from opus import production
+
+
+BENCH_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "bench_libc.c")
+
+MANAGERS = {"unix": "MultiCommunicationManager",
+            "shm": "SharedMemoryCommunicationManager"}
+
+
+class Sink(threading.Thread):
+    '''Polls a communication manager and counts the messages received.'''
+    def __init__(self, comm_manager):
+        super(Sink, self).__init__()
+        self.comm_manager = comm_manager
+        self.msgs = 0
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            self.msgs += len(self.comm_manager.do_poll())
+        self.comm_manager.close()
+
+
+def run_bench(binary, iters, work_dir, env=None):
+    '''Runs the microbenchmark, returning the time per call of each test.'''
+    out = subprocess.check_output([binary, str(iters),
+                                   os.path.join(work_dir, "bench.dat")],
+                                  env=env)
+    results = {}
+    for line in out.decode().splitlines():
+        name, nsecs = line.split()
+        results[name] = float(nsecs)
+    return results
+
+
+def run_mode(mode, binary, lib, iters, work_dir, aggr, ring_size):
+    '''Runs the microbenchmark under the interposition library connected to
+    a producer with the comm manager of mode.'''
+    sock_path = os.path.join(work_dir, "bench.sock")
+    comm_manager = getattr(production, MANAGERS[mode])(
+        "unix://" + sock_path, max_conn=64, select_timeout=0.5)
+    sink = Sink(comm_manager)
+    sink.start()
+
+    env = dict(os.environ)
+    env.update({'LD_PRELOAD': lib,
+                'OPUS_UDS_PATH': sock_path,
+                'OPUS_PROV_COMM_MODE': mode,
+                'OPUS_LOG_LEVEL': "3",
+                'OPUS_INTERPOSE_MODE': "1",
+                'OPUS_SHM_RING_SIZE': str(ring_size)})
+    if aggr:
+        env['OPUS_MSG_AGGR'] = "1"
+        env['OPUS_MAX_AGGR_MSG_SIZE'] = "65536"
+    try:
+        return run_bench(binary, iters, work_dir, env), sink
+    finally:
+        sink.stop.set()
+        sink.join()
+
+
+def main():
+    '''Build and run the microbenchmark natively and over each transport.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark interposition overhead per transport.")
+    parser.add_argument("lib", help="Path to libopusinterpose.so.")
+    parser.add_argument("--iters", type=int, default=100000,
+                        help="Set the number of calls of each test.")
+    parser.add_argument("--no-aggr", action="store_true",
+                        help="Send each message separately rather than "
+                        "aggregating them.")
+    parser.add_argument("--ring-size", type=int, default=1024 * 1024,
+                        help="Set the shared memory ring size in bytes.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        binary = os.path.join(work_dir, "bench_libc")
+        subprocess.check_call(["cc", "-O2", "-o", binary, BENCH_SRC])
+
+        native = run_bench(binary, args.iters, work_dir)
+        results = {}
+        for mode in sorted(MANAGERS):
+            results[mode], sink = run_mode(mode, binary,
+                                           os.path.abspath(args.lib),
+                                           args.iters, work_dir,
+                                           not args.no_aggr, args.ring_size)
+            print("{}: {:d} messages received.".format(mode, sink.msgs))
+
+        print("{:<14} {:>10} {:>18} {:>18}".format(
+            "call", "native ns", "unix ns (+ovh)", "shm ns (+ovh)"))
+        for name in sorted(native):
+            print("{:<14} {:>10.1f} {:>9.1f} ({:>+6.1f}) {:>9.1f} "
+                  "({:>+6.1f})".format(
+                      name, native[name],
+                      results['unix'][name], results['unix'][name] -
+                      native[name],
+                      results['shm'][name], results['shm'][name] -
+                      native[name]))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Bandwidth and CPU benchmark of compressed TCP connections. A workload is run
+under the interposition library connected over TCP to a producer, without
+compression and then with each zlib level and flush policy given. The bytes
+read from the sockets, the bytes after decompression and the time spent
+decompressing are summed over the connections as ps reports them.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from opus import production
+
+
+BENCH_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, "shm-transport", "bench_libc.c")
+
+SHELL_WORKLOAD = ("for i in $(seq {iters}); do "
+                  "ls -l /usr/bin > /dev/null; "
+                  "cat /etc/passwd /etc/hostname > /dev/null; done")
+
+
+class StatsCommunicationManager(production.MultiCommunicationManager):
+    '''Communication manager keeping the counters of closed connections.'''
+    def __init__(self, *args, **kwargs):
+        super(StatsCommunicationManager, self).__init__(*args, **kwargs)
+        self.closed_stats = []
+
+    def _handle_close_connection(self, sock_obj, ret_list):
+        sock_rdr = self.input_client_map.get(sock_obj.fileno())
+        if sock_rdr is not None:
+            self.closed_stats.append(sock_rdr.stats())
+        super(StatsCommunicationManager,
+              self)._handle_close_connection(sock_obj, ret_list)
+
+
+class Sink(threading.Thread):
+    '''Polls a communication manager and counts the messages received.'''
+    def __init__(self, comm_manager):
+        super(Sink, self).__init__()
+        self.comm_manager = comm_manager
+        self.msgs = 0
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            self.msgs += len(self.comm_manager.do_poll())
+
+
+def run_setting(cmd, lib, port, level, flush):
+    '''Runs cmd under the interposition library with the given compression
+    setting, returning the seconds taken, the messages received and the
+    counters of every connection.'''
+    comm_manager = StatsCommunicationManager(
+        "tcp://127.0.0.1:{:d}".format(port), max_conn=64, select_timeout=0.5)
+    sink = Sink(comm_manager)
+    sink.start()
+
+    env = dict(os.environ)
+    env.update({'LD_PRELOAD': lib,
+                'OPUS_PROV_COMM_MODE': "tcp",
+                'OPUS_TCP_ADDRESS': "127.0.0.1",
+                'OPUS_TCP_PORT': str(port),
+                'OPUS_LOG_LEVEL': "3",
+                'OPUS_INTERPOSE_MODE': "1",
+                'OPUS_MSG_AGGR': "1",
+                'OPUS_MAX_AGGR_MSG_SIZE': "65536",
+                'OPUS_PROTOCOL_VERSION': "2",
+                'OPUS_TCP_COMPRESSION': str(level),
+                'OPUS_TCP_COMPRESSION_FLUSH': flush})
+    try:
+        start = time.time()
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(cmd, env=env, stdout=devnull)
+        elapsed = time.time() - start
+        time.sleep(1.0)
+    finally:
+        sink.stop.set()
+        sink.join()
+        comm_manager.close()
+    return elapsed, sink.msgs, comm_manager.closed_stats
+
+
+def main():
+    '''Run the workload with each compression setting.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark bandwidth and CPU cost of compressed TCP "
+        "connections.")
+    parser.add_argument("lib", help="Path to libopusinterpose.so.")
+    parser.add_argument("--iters", type=int, default=100,
+                        help="Set the number of iterations of the workload.")
+    parser.add_argument("--libc", action="store_true",
+                        help="Run the libc microbenchmark rather than the "
+                        "shell workload.")
+    parser.add_argument("--port", type=int, default=10199,
+                        help="Set the producer port.")
+    parser.add_argument("--settings", nargs="+",
+                        default=["0", "1:sync", "6:sync", "6:partial",
+                                 "6:block", "9:block"],
+                        help="Set the level:flush settings to test.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        if args.libc:
+            binary = os.path.join(work_dir, "bench_libc")
+            subprocess.check_call(["cc", "-O2", "-o", binary, BENCH_SRC])
+            cmd = [binary, str(args.iters), os.path.join(work_dir,
+                                                         "bench.dat")]
+        else:
+            cmd = ["bash", "-c", SHELL_WORKLOAD.format(iters=args.iters)]
+
+        print("{:<10} {:>6} {:>8} {:>11} {:>11} {:>10} {:>9} {:>6} "
+              "{:>10} {:>8}".format("setting", "conns", "msgs", "wire bytes",
+                                    "raw bytes", "wire B/msg", "raw B/msg",
+                                    "ratio", "inflate us", "run s"))
+        for setting in args.settings:
+            level, _, flush = setting.partition(":")
+            elapsed, msgs, stats = run_setting(cmd, os.path.abspath(args.lib),
+                                               args.port, int(level),
+                                               flush or "sync")
+            wire = sum(conn['wire_bytes'] for conn in stats)
+            raw = sum(conn['raw_bytes'] for conn in stats)
+            inflate = sum(conn['inflate_time'] for conn in stats)
+            msgs = max(msgs, 1)
+            print("{:<10} {:>6d} {:>8d} {:>11d} {:>11d} {:>10.1f} {:>9.1f} "
+                  "{:>6.2f} {:>10.2f} {:>8.2f}".format(
+                      setting, len(stats), msgs, wire, raw, wire / msgs,
+                      raw / msgs, raw / max(wire, 1),
+                      inflate * 10**6 / msgs, elapsed))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
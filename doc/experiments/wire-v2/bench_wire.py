@@ -0,0 +1,173 @@
+#! /usr/local/bin/python2.7
+# -*- coding: utf-8 -*-
+'''
+Wire size and decode time benchmark of protocol v1 and v2. A libc heavy
+microbenchmark is run under the interposition library connected to a
+producer speaking each protocol version. The bytes read from the sockets and
+the time taken to decode the received messages are compared.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from opus import analysis, messaging, production, uds_msg_pb2
+
+
+BENCH_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, "shm-transport", "bench_libc.c")
+
+
+class CountingSocket(object):
+    '''Wraps a client socket, counting the bytes received from it.'''
+    def __init__(self, sock_obj):
+        self.sock_obj = sock_obj
+        self.bytes_read = 0
+
+    def recv(self, size):
+        data = self.sock_obj.recv(size)
+        self.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock_obj, name)
+
+
+class CountingCommunicationManager(production.MultiCommunicationManager):
+    '''Communication manager counting the bytes read from its clients and
+    the time taken to read and frame their messages.'''
+    def __init__(self, *args, **kwargs):
+        super(CountingCommunicationManager, self).__init__(*args, **kwargs)
+        self.socks = []
+        self.read_time = 0.0
+
+    def _handle_client(self, sock_obj, ret_list):
+        start = time.time()
+        super(CountingCommunicationManager, self)._handle_client(sock_obj,
+                                                                 ret_list)
+        self.read_time += time.time() - start
+
+    def add_connection(self, client_fd):
+        sock = CountingSocket(client_fd)
+        self.socks.append(sock)
+        super(CountingCommunicationManager, self).add_connection(sock)
+
+    def bytes_read(self):
+        return sum(sock.bytes_read for sock in self.socks)
+
+
+class Sink(threading.Thread):
+    '''Polls a communication manager and keeps the messages received.'''
+    def __init__(self, comm_manager):
+        super(Sink, self).__init__()
+        self.comm_manager = comm_manager
+        self.msgs = []
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            self.msgs += self.comm_manager.do_poll()
+
+
+def decode_msgs(msgs):
+    '''Decodes every message as the analyser does, returning the seconds
+    taken and the number of function messages.'''
+    funcs = 0
+    start = time.time()
+    for hdr, pay in msgs:
+        msg = analysis.DecodedMsg(hdr, pay)
+        if msg.funcs is not None:
+            funcs += len(msg.funcs)
+        elif msg.hdr_obj.payload_type == uds_msg_pb2.FUNCINFO_MSG:
+            funcs += 1
+    return time.time() - start, funcs
+
+
+def run_version(version, binary, lib, iters, work_dir, aggr):
+    '''Runs the microbenchmark under the interposition library speaking
+    protocol version, returning the bytes read, the seconds taken to read
+    them, the messages received and the time per call of each test.'''
+    sock_path = os.path.join(work_dir, "bench.sock")
+    comm_manager = CountingCommunicationManager(
+        "unix://" + sock_path, max_conn=64, select_timeout=0.5)
+    sink = Sink(comm_manager)
+    sink.start()
+
+    env = dict(os.environ)
+    env.update({'LD_PRELOAD': lib,
+                'OPUS_UDS_PATH': sock_path,
+                'OPUS_PROV_COMM_MODE': "unix",
+                'OPUS_LOG_LEVEL': "3",
+                'OPUS_INTERPOSE_MODE': "1",
+                'OPUS_PROTOCOL_VERSION': str(version)})
+    if aggr:
+        env['OPUS_MSG_AGGR'] = "1"
+        env['OPUS_MAX_AGGR_MSG_SIZE'] = "65536"
+    try:
+        out = subprocess.check_output(
+            [binary, str(iters), os.path.join(work_dir, "bench.dat")],
+            env=env)
+        time.sleep(1.0)
+    finally:
+        sink.stop.set()
+        sink.join()
+        comm_manager.close()
+
+    calls = {}
+    for line in out.decode().splitlines():
+        name, nsecs = line.split()
+        calls[name] = float(nsecs)
+    return (comm_manager.bytes_read(), comm_manager.read_time, sink.msgs,
+            calls)
+
+
+def main():
+    '''Build and run the microbenchmark over each protocol version.'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark wire size and decode time per protocol.")
+    parser.add_argument("lib", help="Path to libopusinterpose.so.")
+    parser.add_argument("--iters", type=int, default=20000,
+                        help="Set the number of calls of each test.")
+    parser.add_argument("--no-aggr", action="store_true",
+                        help="Send each message separately rather than "
+                        "aggregating them.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        binary = os.path.join(work_dir, "bench_libc")
+        subprocess.check_call(["cc", "-O2", "-o", binary, BENCH_SRC])
+
+        print("{:<8} {:>9} {:>8} {:>11} {:>9} {:>10} {:>12}".format(
+            "protocol", "messages", "funcs", "wire bytes", "bytes/fn",
+            "read us/fn", "decode us/fn"))
+        for version in [1, 2]:
+            wire, read, msgs, calls = run_version(version, binary,
+                                                  os.path.abspath(args.lib),
+                                                  args.iters, work_dir,
+                                                  not args.no_aggr)
+            decode, funcs = decode_msgs(msgs)
+            funcs = max(funcs, 1)
+            print("{:<8} {:>9d} {:>8d} {:>11d} {:>9.1f} {:>10.2f} "
+                  "{:>12.2f}".format("v{:d}".format(version), len(msgs),
+                                     funcs, wire, wire / funcs,
+                                     read * 10**6 / funcs,
+                                     decode * 10**6 / funcs))
+            print("         " + "  ".join(
+                "{} {:.0f}ns".format(name, calls[name])
+                for name in sorted(calls)))
+        print("Header length v1: {:d} bytes.".format(messaging.Header.length))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
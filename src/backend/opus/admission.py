@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+'''
+Admission control of client messages in the communication managers. The
+function calls of each process, and of all the processes running each
+binary, are metered by token buckets. A process over its limit is shed in
+stages the longer it stays over:
+
+    SUMMARISE   repeats of a call already passed in the current summary
+                interval are coalesced into a SUMMARY_MSG counting them,
+                except for calls that open or close descriptors or change
+                the state of the process
+    DROP        every call is dropped and the gap left in the provenance of
+                the process is recorded on its process node
+    DETACH      the process is detached from OPUS
+
+Startup, library, generic and string table messages are never shed.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import struct
+import time
+
+from . import common_utils, filtering, messaging, uds_msg_pb2
+from .pvm.posix.utils import StringTable
+
+
+HEADER = struct.Struct(str(messaging.Header.struct_string))
+
+ShedStage = common_utils.enum(NONE=0, SUMMARISE=1, DROP=2, DETACH=3)
+
+SHED_RULE = "rate_limit"
+
+# Calls that create or close descriptors or change the state of a process
+# are never coalesced, as a repeat of one is not a no-op to the PVM.
+UNCOALESCED_FUNCS = (filtering.DESC_RESULT_FUNCS | filtering.CLOSE_FUNCS |
+                     filtering.PROC_FUNCS |
+                     frozenset(filtering.DESC_ARG_FUNCS) |
+                     frozenset(["fcntl"]))
+
+
+class TokenBucket(object):
+    '''Admits rate calls a second on average in bursts of up to burst.
+    Calls over the limit run the bucket into debt, down to -burst, so that
+    it measures the load offered. A bucket that has gone over its limit
+    stays over until it has refilled to half of burst.'''
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+        self.over_since = None
+
+    def take(self, calls, now):
+        '''Takes tokens for calls, returning the time the bucket went over
+        its limit or None if it is within it.'''
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.tokens = max(self.tokens - calls, -self.burst)
+        self.last = now
+        if self.over_since is None:
+            if self.tokens < 0:
+                self.over_since = now
+        elif self.tokens >= self.burst / 2:
+            self.over_since = None
+        return self.over_since
+
+
+class ProcAdmission(object):
+    '''The admission state of a client process.'''
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.exec_name = None
+        self.binary = None  # TokenBucket of the binary
+        self.stage = ShedStage.NONE
+        self.passed = set()  # Calls passed in the current summary interval
+        self.coalesced = [0, 0, 0]  # calls, timestamp, sys_time
+        self.gap = None  # [calls, begin, end, sys_time]
+        self.last_summary = 0.0
+        self.passed_since = 0.0
+        self.total_coalesced = 0
+        self.total_dropped = 0
+
+
+class AdmissionControl(object):
+    '''Meters the function calls of each process with a bucket of pid_rate
+    calls a second and pid_burst calls, and those of each binary with a
+    bucket of binary_rate and binary_burst. A process over either limit is
+    coalesced for drop_after seconds, then dropped, and then detached once
+    detach_after seconds have passed if it is given. Coalesced calls are
+    summarised every summary_interval seconds.'''
+    def __init__(self, pid_rate=None, pid_burst=None, binary_rate=None,
+                 binary_burst=None, drop_after=10.0, detach_after=None,
+                 summary_interval=1.0):
+        self.pid_rate = pid_rate
+        self.pid_burst = pid_burst if pid_burst is not None else pid_rate
+        self.binary_rate = binary_rate
+        self.binary_burst = (binary_burst if binary_burst is not None
+                             else binary_rate)
+        self.drop_after = drop_after
+        self.detach_after = detach_after
+        self.summary_interval = summary_interval
+        self.procs = {}  # pid -> ProcAdmission
+        self.binaries = {}  # binary -> TokenBucket
+        self.detach_pids = set()
+        self.pending = set()  # pids with coalesced calls to summarise
+        self.strtabs = {}  # (pid, tid) -> StringTable
+
+    def _state(self, pid, now):
+        state = self.procs.get(pid)
+        if state is None:
+            bucket = None
+            if self.pid_rate is not None:
+                bucket = TokenBucket(self.pid_rate, self.pid_burst, now)
+            state = self.procs[pid] = ProcAdmission(bucket)
+        return state
+
+    def _stage(self, state, calls, now):
+        '''Charges calls to the buckets of a process, returning the stage
+        it is to be shed at.'''
+        over_since = None
+        if state.bucket is not None:
+            over_since = state.bucket.take(calls, now)
+        if state.binary is not None:
+            bin_over = state.binary.take(calls, now)
+            if bin_over is not None and (over_since is None or
+                                         bin_over < over_since):
+                over_since = bin_over
+        if over_since is None:
+            return ShedStage.NONE
+        over = now - over_since
+        if self.detach_after is not None and over >= self.detach_after:
+            return ShedStage.DETACH
+        if self.drop_after is not None and over >= self.drop_after:
+            return ShedStage.DROP
+        return ShedStage.SUMMARISE
+
+    def admit(self, msg_list):
+        '''Returns the messages of msg_list that are admitted, with the
+        summaries and gaps of processes that are shed. Processes to detach
+        are added to detach_pids.'''
+        now = time.time()
+        ret_list = []
+        for msg in msg_list:
+            hdr_buf, pay_buf = msg
+            hdr = HEADER.unpack(hdr_buf)
+            pid = hdr[1]
+            pay_type = hdr[2]
+            if pay_type == uds_msg_pb2.FUNCINFO_MSG:
+                self._admit_calls(self._state(pid, now), hdr, msg, None,
+                                  now, ret_list)
+            elif pay_type == uds_msg_pb2.AGGREGATION_MSG:
+                agg_msg = uds_msg_pb2.AggregationMessage()
+                agg_msg.ParseFromString(pay_buf)
+                self._admit_calls(self._state(pid, now), hdr, msg, agg_msg,
+                                  now, ret_list)
+            elif pay_type == uds_msg_pb2.STARTUP_MSG:
+                state = self._state(pid, now)
+                self._summarise(pid, state, ret_list)
+                startup_msg = uds_msg_pb2.StartupMessage()
+                startup_msg.ParseFromString(pay_buf)
+                state.exec_name = startup_msg.exec_name
+                if self.binary_rate is not None:
+                    state.binary = self.binaries.get(state.exec_name)
+                    if state.binary is None:
+                        state.binary = TokenBucket(self.binary_rate,
+                                                   self.binary_burst, now)
+                        self.binaries[state.exec_name] = state.binary
+                ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.GENERIC_MSG:
+                gen_msg = uds_msg_pb2.GenericMessage()
+                gen_msg.ParseFromString(pay_buf)
+                if gen_msg.msg_type == uds_msg_pb2.DISCON:
+                    state = self.procs.pop(pid, None)
+                    if state is not None:
+                        self._summarise(pid, state, ret_list)
+                    self.detach_pids.discard(pid)
+                    for key in [key for key in self.strtabs
+                                if key[0] == pid]:
+                        del self.strtabs[key]
+                ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.PROTOCOL_MSG:
+                proto_msg = uds_msg_pb2.ProtocolMessage()
+                proto_msg.ParseFromString(pay_buf)
+                if proto_msg.version >= 2:
+                    self.strtabs[(pid, hdr[4])] = StringTable()
+                ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.STRTAB_MSG:
+                strtab = self.strtabs.get((pid, hdr[4]))
+                if strtab is not None:
+                    strtab_msg = uds_msg_pb2.StringTableMessage()
+                    strtab_msg.ParseFromString(pay_buf)
+                    strtab.define(strtab_msg.strings)
+                ret_list.append(msg)
+            else:
+                ret_list.append(msg)
+
+        for pid in list(self.pending):
+            state = self.procs[pid]
+            if now - state.last_summary >= self.summary_interval:
+                self._summarise(pid, state, ret_list, False)
+                state.last_summary = now
+        return ret_list
+
+    def _admit_calls(self, state, hdr, msg, agg_msg, now, ret_list):
+        '''Admits the calls of a function or aggregation message according
+        to the stage of its process.'''
+        calls = 1 if agg_msg is None else len(agg_msg.messages)
+        stage = self._stage(state, calls, now)
+        if stage != state.stage:
+            if stage == ShedStage.NONE:
+                self._summarise(hdr[1], state, ret_list)
+            elif (stage >= ShedStage.DROP and
+                  state.stage == ShedStage.SUMMARISE):
+                self._summarise(hdr[1], state, ret_list, False)
+            state.stage = stage
+        if stage == ShedStage.DETACH:
+            self.detach_pids.add(hdr[1])
+
+        if stage == ShedStage.NONE:
+            ret_list.append(msg)
+        elif stage == ShedStage.SUMMARISE:
+            msg = self._coalesce(state, hdr, msg, agg_msg, now)
+            if msg is not None:
+                ret_list.append(msg)
+        else:
+            if state.gap is None:
+                state.gap = [0, hdr[0], hdr[0], hdr[5]]
+            state.gap[0] += calls
+            state.gap[2] = hdr[0]
+            state.gap[3] = hdr[5]
+            state.total_dropped += calls
+
+    def _coalesce(self, state, hdr, msg, agg_msg, now):
+        '''Returns msg without the calls already passed in the current
+        summary interval, or None if it has none left.'''
+        if now - state.passed_since >= self.summary_interval:
+            state.passed = set()
+            state.passed_since = now
+        if agg_msg is None:
+            smsgs = [msg[1]]
+        else:
+            smsgs = agg_msg.messages
+        strtab = self.strtabs.get((hdr[1], hdr[4]))
+        kept = []
+        for smsg in smsgs:
+            func_msg = uds_msg_pb2.FuncInfoMessage()
+            func_msg.ParseFromString(smsg)
+            func_name = func_msg.func_name
+            if func_msg.func_id and strtab is not None:
+                func_name = strtab.lookup(func_msg.func_id)
+            if func_name in UNCOALESCED_FUNCS:
+                kept.append(smsg)
+                continue
+            key = (hdr[4], func_name, func_msg.func_id, func_msg.ret_val,
+                   tuple((arg.key, arg.key_id, arg.value)
+                         for arg in func_msg.args))
+            if key in state.passed:
+                continue
+            state.passed.add(key)
+            kept.append(smsg)
+
+        coalesced = len(smsgs) - len(kept)
+        if coalesced:
+            state.coalesced[0] += coalesced
+            state.coalesced[1] = hdr[0]
+            state.coalesced[2] = hdr[5]
+            state.total_coalesced += coalesced
+            self.pending.add(hdr[1])
+        if not kept:
+            return None
+        if agg_msg is None or not coalesced:
+            return msg
+        del agg_msg.messages[:]
+        agg_msg.messages.extend(kept)
+        pay_buf = agg_msg.SerializeToString()
+        return (HEADER.pack(hdr[0], hdr[1], hdr[2], len(pay_buf), hdr[4],
+                            hdr[5]),
+                pay_buf)
+
+    def _summarise(self, pid, state, ret_list, gap=True):
+        '''Appends a SUMMARY_MSG for the coalesced calls of a process and,
+        if gap is set, one for the gap left by its dropped calls.'''
+        if state.coalesced[0]:
+            sum_msg = uds_msg_pb2.SummaryMessage()
+            sum_msg.rule = SHED_RULE
+            sum_msg.count = state.coalesced[0]
+            ret_list.append(self._pack(pid, state.coalesced[1],
+                                       state.coalesced[2], sum_msg))
+            state.coalesced = [0, 0, 0]
+            self.pending.discard(pid)
+        state.passed = set()
+        if gap and state.gap is not None:
+            calls, begin, end, sys_time = state.gap
+            sum_msg = uds_msg_pb2.SummaryMessage()
+            sum_msg.rule = SHED_RULE
+            sum_msg.count = calls
+            sum_msg.gap = True
+            sum_msg.begin_time = begin
+            sum_msg.end_time = end
+            ret_list.append(self._pack(pid, end, sys_time, sum_msg))
+            state.gap = None
+
+    @staticmethod
+    def _pack(pid, timestamp, sys_time, sum_msg):
+        pay_buf = sum_msg.SerializeToString()
+        return (HEADER.pack(timestamp, pid, uds_msg_pb2.SUMMARY_MSG,
+                            len(pay_buf), pid, sys_time),
+                pay_buf)
+
+    def offenders(self):
+        '''Returns the stage and shed counts of every process that has been
+        shed.'''
+        return [{'pid': pid,
+                 'binary': state.exec_name,
+                 'stage': ShedStage.enum_str(state.stage),
+                 'coalesced': state.total_coalesced,
+                 'dropped': state.total_dropped}
+                for pid, state in self.procs.items()
+                if state.stage != ShedStage.NONE or state.total_coalesced or
+                state.total_dropped]
@@ -12,23 +12,28 @@ import threading
 import multiprocessing
 import Queue
 import logging
-import types
 import psutil
 import time
 import commands
 
-from . import config_util, ipc
+from . import config_util, ipc, journal
 from .exception import SnapshotException
 
 
 class AnalyserController(object):
     '''Controller class that starts a fetcher process and
     a memory monitor thread that periodically checks memory
-    usage of the ananlyser process'''
+    usage of the ananlyser process. Commands sent to the analyser are
+    handled by cmd_threads threads, so that status requests are answered
+    while queries run. Queries are run as jobs with the query_jobs
+    parameters of the QueryJobManager.'''
     def __init__(self, pf_queue, router, config,
-                 mem_mon_params, memory_params):
+                 mem_mon_params, memory_params, cmd_threads=4,
+                 query_jobs=None):
         self.config = config
-        self.queue_triple = None
+        self.cmd_threads = cmd_threads
+        self.query_job_params = query_jobs or {}
+        self.channel = None
         self.node = None
         self.router = router
         self.drop = False
@@ -39,7 +44,7 @@ class AnalyserController(object):
         self.snapshot_event = multiprocessing.Event()
 
         self.analyser = None
-        self.query = None
+        self.query_jobs = None
 
         self.mem_monitor = None
         self.mem_mon_stop_event = threading.Event()
@@ -55,6 +60,8 @@ class AnalyserController(object):
             ret = {}
             try:
                 ret['num_msgs'] = self.analyser.event_orderer.get_queue_size()
+                ret['num_spilled'] = \
+                    self.analyser.event_orderer.get_spilled_size()
             except AttributeError:
                 pass
             try:
@@ -62,9 +69,18 @@ class AnalyserController(object):
                 ret['outbound_rate'] = self.analyser.outbound.rate
             except AttributeError:
                 pass
+            try:
+                ret['decode_time'] = self.analyser.get_decode_time()
+                ret['apply_time'] = self.analyser.apply_time
+            except AttributeError:
+                pass
             return ret
+        elif self.query_jobs is None:
+            return {"success": False, "msg": "Analyser is starting."}
         elif cmd['cmd'] == "exec_qry_method":
-            return self.query(cmd)
+            return self.query_jobs.run(cmd)
+        elif cmd['cmd'].startswith("query_"):
+            return self.query_jobs.handle(cmd)
 
     def start_service(self):
         '''Starts the fetcher process and memory monitor thread'''
@@ -74,14 +90,15 @@ class AnalyserController(object):
     def _start_fetcher(self):
         '''Initialises fetcher process specific members and
         starts the fetcher'''
-        self.queue_triple = self.router.add("ANALYSER",
-                                            queue_class=multiprocessing.Queue,
-                                            queue_triple=True)
+        self.channel = self.router.add("ANALYSER", process=True)
         self.fetcher_stop_event.clear()
         self.snapshot_event.clear()
         self.fetcher = multiprocessing.Process(name='fetcher',
                                                target=self._run_fetcher)
         self.fetcher.start()
+        # Only the fetcher keeps the worker end, so that the router sees
+        # the channel close when the fetcher exits.
+        self.channel.close()
         if __debug__:
             logging.debug("Started fetcher process with pid: %d",
                           self.fetcher.pid)
@@ -106,9 +123,9 @@ class AnalyserController(object):
         from . import query
 
         self.node = ipc.Worker(ident="ANALYSER",
-                               queue_triple=self.queue_triple,
+                               channel=self.channel,
                                handler=self._handle_command,
-                               queue_class=multiprocessing.Queue)
+                               threads=self.cmd_threads)
         self.node.run_forever()
 
         neo4j_cfg = {}
@@ -117,14 +134,22 @@ class AnalyserController(object):
                                                 analysis.Analyser,
                                                 neo4j_cfg)
 
-        def _query(self, msg):
+        journal_cfg = self.config.get("JOURNAL")
+        if journal_cfg is not None:
+            self.analyser.set_checkpoint(journal.JournalCheckpoint(
+                journal_cfg['journal_dir'],
+                journal_cfg.get('checkpoint_interval', 1.0)))
+
+        def _attach_jvm():
             if not jpype.isThreadAttachedToJVM():
                 jpype.attachThreadToJVM()
 
-            return query.ClientQueryControl.exec_method(
-                self.analyser.db_iface, msg)
+        def _get_db_iface():
+            return getattr(self.analyser, 'db_iface', None)
 
-        self.query = types.MethodType(_query, self)
+        self.query_jobs = query.QueryJobManager(_get_db_iface,
+                                                thread_init=_attach_jvm,
+                                                **self.query_job_params)
 
         if __debug__:
             logging.debug("Starting analyser....")
@@ -9,16 +9,26 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import Queue
+import contextlib
+import cPickle as pickle
 import os
 import logging
+import socket
 import threading
 import time
+import traceback
+import zlib
 
-from . import common_utils, exception, storage, opuspb, order, messaging
+from . import (common_utils, exception, storage, opuspb, order, messaging,
+               journal, msglog, relay)
 from . import uds_msg_pb2 as uds_msg
 from .pvm import posix
 
 
+# Seconds between checks that a partition being drained is still running
+PARTITION_CLEAR_POLL = 1.0
+
+
 class Analyser(threading.Thread):
     '''Base class for the analyser'''
     def __init__(self, *args, **kwargs):
@@ -26,6 +36,7 @@ class Analyser(threading.Thread):
         super(Analyser, self).__init__(*args, **kwargs)
         self.stop_event = threading.Event()
         self.daemon = True
+        self.checkpoint = None
 
     def run(self):
         '''Should be overridden in the derived class'''
@@ -35,6 +46,24 @@ class Analyser(threading.Thread):
         '''Should be overridden in the derived class'''
         pass
 
+    def set_checkpoint(self, checkpoint):
+        '''Record committed journal messages through checkpoint.'''
+        self.checkpoint = checkpoint
+
+    def journal_msgs(self, msg_list):
+        '''Returns the messages of msg_list tagged with their journal
+        sequence numbers and records them as pending.'''
+        if self.checkpoint is None:
+            return msg_list
+        msgs = journal.tag_batch(msg_list)
+        self.checkpoint.add(msgs)
+        return msgs
+
+    def journal_commit(self, msg):
+        '''Record that a tagged message has been committed.'''
+        if self.checkpoint is not None:
+            self.checkpoint.commit(getattr(msg, 'journal_seq', None))
+
     def do_shutdown(self):
         '''Shutdown the thread gracefully'''
         if __debug__:
@@ -50,49 +79,330 @@ class Analyser(threading.Thread):
 
 
 class LoggingAnalyser(Analyser):
-    '''Implementation of a logging analyser'''
+    '''Implementation of a logging analyser. Messages are written by the
+    analyser thread, which coalesces every batch queued since its last
+    write and writes them in blocks of up to block_size kilobytes, each
+    recorded in the side index of the log segment. The log is synced every
+    fsync_interval seconds, or only on rotation and shutdown if it is None.
+    If rotate_size is given in megabytes the segment is moved aside to a
+    numbered segment once it grows past it. If compress is set each block
+    is zlib compressed and the log is written to log_path with a .z
+    suffix.'''
     def __init__(self, log_path, *args, **kwargs):
         '''Initialize class members'''
+        self.fsync_interval = kwargs.pop('fsync_interval', None)
+        rotate_size = kwargs.pop('rotate_size', None)
+        self.compress = kwargs.pop('compress', False)
+        self.block_size = int(kwargs.pop('block_size', 256) * 1024)
         super(LoggingAnalyser, self).__init__(*args, **kwargs)
         self.file_object = None
+        self.index = None
+        self.offset = 0
         self.logfile_path = log_path
+        if self.compress:
+            self.logfile_path += ".z"
+        self.rotate_size = None
+        if rotate_size is not None:
+            self.rotate_size = int(rotate_size * 1024 * 1024)
+        self.write_queue = Queue.Queue()
+        self.last_sync = time.time()
+        self._open_log()
 
+    def _open_log(self):
+        '''Open the log segment and its index for appending. A segment left
+        without an index is rotated aside first, so that it is scanned in
+        full when read.'''
         try:
+            if (os.path.exists(self.logfile_path) and
+                    os.path.getsize(self.logfile_path) > 0 and
+                    not os.path.exists(msglog.index_path(self.logfile_path))):
+                msglog.rotate(self.logfile_path)
             self.file_object = open(self.logfile_path, "a+b")
-        except IOError as exc:
+            self.index = msglog.IndexWriter(self.logfile_path)
+        except (IOError, OSError) as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException("log file open error")
+        self.offset = os.path.getsize(self.logfile_path)
         if __debug__:
             logging.debug("Opened file %s", self.logfile_path)
 
+    def _sync(self):
+        '''Flush and sync the log segment and its index to disk.'''
+        self.file_object.flush()
+        os.fsync(self.file_object.fileno())
+        self.index.sync()
+        self.last_sync = time.time()
+
+    def _close_log(self):
+        '''Sync and close the log segment and its index.'''
+        self._sync()
+        self.file_object.close()
+        self.index.close()
+
+    def _rotate(self):
+        '''Move the log segment aside and start a new one.'''
+        self._close_log()
+        msglog.rotate(self.logfile_path)
+        self._open_log()
+
+    def _write_block(self, frames, min_ts, max_ts, pids):
+        '''Write a block of frames to the log and index it.'''
+        data = b"".join(frames)
+        if self.compress:
+            data = zlib.compress(data)
+        self.file_object.write(data)
+        self.index.add_block(self.offset, len(data), min_ts, max_ts, pids)
+        self.offset += len(data)
+
+    def _write(self, msg_list):
+        '''Write a list of messages to the log in blocks.'''
+        frames = []
+        size = 0
+        min_ts = max_ts = None
+        pids = set()
+        for hdr, pay in msg_list:
+            if not (hdr and pay):
+                continue
+            hdr_obj = messaging.Header()
+            hdr_obj.loads(hdr)
+            frames.append(hdr + pay)
+            size += len(frames[-1])
+            min_ts = (hdr_obj.timestamp if min_ts is None
+                      else min(min_ts, hdr_obj.timestamp))
+            max_ts = (hdr_obj.timestamp if max_ts is None
+                      else max(max_ts, hdr_obj.timestamp))
+            pids.add(hdr_obj.pid)
+            if size >= self.block_size:
+                self._write_block(frames, min_ts, max_ts, pids)
+                frames = []
+                size = 0
+                min_ts = max_ts = None
+                pids = set()
+        if frames:
+            self._write_block(frames, min_ts, max_ts, pids)
+
+        if self.fsync_interval is not None:
+            if time.time() - self.last_sync >= self.fsync_interval:
+                self._sync()
+        else:
+            self.file_object.flush()
+            self.index.flush()
+        if self.rotate_size is not None and self.offset >= self.rotate_size:
+            self._rotate()
+
+    def run(self):
+        '''Write out queued batches until a shutdown marker is queued.'''
+        stop = False
+        while not stop:
+            batches = [self.write_queue.get()]
+            try:
+                while True:
+                    batches.append(self.write_queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in batches:
+                stop = True
+                batches = batches[:batches.index(None)]
+
+            msg_list = [msg for batch in batches for msg in batch]
+            self._write(msg_list)
+            for msg in msg_list:
+                self.journal_commit(msg)
+        self._close_log()
+
     def put_msg(self, msg_list):
         '''Takes a list of tuples (header, payload)
-        and writes them to a file'''
+        and queues them to be written to a file'''
+        self.write_queue.put(self.journal_msgs(msg_list))
+
+    def snapshot_shutdown(self):
+        '''Write out every queued message and stop.'''
+        self.do_shutdown()
+
+    def do_shutdown(self, drop=False):
+        '''Write out the queued messages, dropping them if drop is set, then
+        flush all pending writes to disk and close the file object'''
+        if not self.isAlive():
+            return True
+        if drop:
+            try:
+                while True:
+                    self.write_queue.get_nowait()
+            except Queue.Empty:
+                pass
+        self.write_queue.put(None)
+        return super(LoggingAnalyser, self).do_shutdown()
+
+
+class RelayAnalyser(Analyser):
+    '''Forwards messages to a central backend in place of analysing them,
+    making the backend a relay for the clients of its host. Messages are
+    gathered into batches that are sent once they reach batch_size
+    kilobytes or batch_interval seconds after their first message. Each
+    batch is compressed at zlib level compress_level and sent over one
+    connection to the RelayCommunicationManager at central_addr, which
+    namespaces the pids and paths of the messages by host_id, the host name
+    by default. Batches that cannot be sent are spooled in spool_dir, up to
+    max_spool megabytes, and sent in order once the central backend can be
+    reached again, which is tried every retry_interval seconds. The term
+    message of a restart of the relay is forwarded as a host message
+    telling the central backend that the processes of the host are
+    gone.'''
+    def __init__(self, central_addr, spool_dir, host_id=None,
+                 batch_size=64, batch_interval=0.5, compress_level=1,
+                 retry_interval=5.0, max_spool=None, neo4j_cfg=None,
+                 *args, **kwargs):
+        '''Initialize class members'''
+        super(RelayAnalyser, self).__init__(*args, **kwargs)
+        if host_id is None:
+            host_id = socket.gethostname()
+        self.client = relay.RelayClient(central_addr, host_id)
+        self.spool = relay.RelaySpool(spool_dir, max_spool)
+        self.batch_size = int(batch_size * 1024)
+        self.batch_interval = batch_interval
+        self.compress_level = compress_level
+        self.retry_interval = retry_interval
+        self.write_queue = Queue.Queue()
+        self.frames = []
+        self.batch_msgs = []
+        self.size = 0
+        self.min_ts = None
+        self.deadline = None
+        self.restart = False
+        self.next_retry = 0.0
+
+    def _add(self, msg_list):
+        '''Add a list of messages to the batch, flushing it whenever it
+        fills.'''
         for msg in msg_list:
-            if msg[0] and msg[1]:
-                self.file_object.write(msg[0])
-                self.file_object.write(msg[1])
-        self.file_object.flush()
+            hdr, pay = msg
+            hdr_obj = messaging.Header()
+            hdr_obj.loads(hdr)
+            if hdr_obj.payload_type == uds_msg.TERM_MSG or not pay:
+                if hdr_obj.payload_type == uds_msg.TERM_MSG:
+                    self.restart = True
+                self.journal_commit(msg)
+                continue
+            if not self.frames:
+                self.deadline = time.time() + self.batch_interval
+            self.frames.append(hdr + pay)
+            self.batch_msgs.append(msg)
+            self.size += len(self.frames[-1])
+            self.min_ts = (hdr_obj.timestamp if self.min_ts is None
+                           else min(self.min_ts, hdr_obj.timestamp))
+            if self.size >= self.batch_size:
+                self._flush()
 
-    def do_shutdown(self):
-        '''Flush all pending writes to disk
-        and close the file object'''
-        os.fsync(self.file_object.fileno())
-        self.file_object.close()
-        return True
+    def _flush(self):
+        '''Compress the batch and forward it. After a restart the batch
+        opens with a host message ordered before its other messages.'''
+        if self.restart:
+            self.frames.insert(0, b"".join(relay.host_message(
+                self.client.host_id,
+                timestamp=max(self.min_ts - 1, 0),
+                restart=True)))
+            self.restart = False
+        self._forward(relay.pack_batch(self.frames, self.compress_level))
+        for msg in self.batch_msgs:
+            self.journal_commit(msg)
+        self.frames = []
+        self.batch_msgs = []
+        self.size = 0
+        self.min_ts = None
+
+    def _forward(self, batch):
+        '''Send a batch to the central backend after any spooled batches,
+        spooling it if it cannot be sent. If batch is None only the spooled
+        batches are sent.'''
+        if not self.client.connected() and time.time() >= self.next_retry:
+            if not self.client.connect():
+                self.next_retry = time.time() + self.retry_interval
+        if self.client.connected() and self.spool.pending():
+            self._send_spool()
+        if batch is None:
+            return
+        if self.client.connected() and not self.spool.pending():
+            if self.client.send(batch):
+                return
+            self.next_retry = time.time() + self.retry_interval
+        self.spool.append(batch)
+
+    def _send_spool(self):
+        '''Send the spooled batches in order, stopping at the first that
+        cannot be sent.'''
+        for offset, batch in self.spool.batches():
+            if not self.client.send(batch):
+                self.next_retry = time.time() + self.retry_interval
+                self.spool.save()
+                return
+            self.spool.sent(offset)
+        self.spool.clear()
+
+    def run(self):
+        '''Batch and forward queued messages until a shutdown marker is
+        queued.'''
+        stop = False
+        while not stop:
+            try:
+                msg_list = self.write_queue.get(timeout=self.batch_interval)
+            except Queue.Empty:
+                msg_list = []
+            if msg_list is None:
+                stop = True
+            else:
+                self._add(msg_list)
+
+            if self.frames and (stop or time.time() >= self.deadline):
+                self._flush()
+            elif self.spool.pending():
+                self._forward(None)
+        self.client.close()
+        self.spool.save()
+
+    def put_msg(self, msg_list):
+        '''Takes a list of tuples (header, payload)
+        and queues them to be forwarded'''
+        self.write_queue.put(self.journal_msgs(msg_list))
+
+    def snapshot_shutdown(self):
+        '''Forward or spool every queued message and stop.'''
+        self.do_shutdown()
+
+    def do_shutdown(self, drop=False):
+        '''Forward the queued messages, dropping them if drop is set, and
+        spool whatever cannot be sent.'''
+        if not self.isAlive():
+            return True
+        if drop:
+            try:
+                while True:
+                    self.write_queue.get_nowait()
+            except Queue.Empty:
+                pass
+        self.write_queue.put(None)
+        return super(RelayAnalyser, self).do_shutdown()
 
 
 class OrderingAnalyser(Analyser):
     '''The ordering analyser implements a event ordering queue and calls the
-    process method to consume messages.'''
+    process method to consume messages. The queue holds back at least
+    orderer_window messages to order them. If orderer_mem_budget is given
+    in megabytes, queued messages beyond it are spilled to the snapshot
+    directory.'''
     def __init__(self, opus_snapshot_dir, *args, **kwargs):
+        mem_budget = kwargs.pop('orderer_mem_budget', None)
+        self.orderer_window = kwargs.pop('orderer_window', 50)
         super(OrderingAnalyser, self).__init__(*args, **kwargs)
-        # TODO(tb403) - Proper max_wind
-        self.event_orderer = order.EventOrderer(50)
+        if mem_budget is not None:
+            mem_budget = int(mem_budget * 1024 * 1024)
+        self.event_orderer = order.EventOrderer(self.orderer_window,
+                                                opus_snapshot_dir,
+                                                mem_budget)
+        self.msg_source = self.event_orderer
         self.queue_cleared = threading.Event()
         self.msg_handler = self.process
         self.snapshot_state = False
-        self.msg_fh = None
+        self.msg_dump = None
         self.opus_snapshot_dir = opus_snapshot_dir
         self.msg_queue_data_file = None
         self.load_orderer()
@@ -106,23 +416,13 @@ class OrderingAnalyser(Analyser):
         if not os.path.isfile(self.msg_queue_data_file):
             return
 
-        hdr_len = messaging.Header.length
         try:
-            with open(self.msg_queue_data_file, "rb") as fp:
-                while True:
-                    hdr = fp.read(hdr_len)
-                    if hdr == b'':
-                        break
-                    hdr_obj = messaging.Header()
-                    hdr_obj.loads(hdr)
-
-                    pay_len = hdr_obj.payload_len
-                    if pay_len == 0:
-                        continue
-                    pay = fp.read(pay_len)
-                    msg = [(hdr_obj.timestamp, (hdr, pay))]
-                    self.event_orderer.push(msg)
-        except IOError as exc:
+            if order.is_queue_dump(self.msg_queue_data_file):
+                self.event_orderer.push_bulk(
+                    order.read_queue_dump(self.msg_queue_data_file))
+            else:
+                self.load_legacy_orderer()
+        except (IOError, OSError) as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException(
                   "Could not open OPUS message queue file for reading")
@@ -132,13 +432,33 @@ class OrderingAnalyser(Analyser):
             logging.debug("Removing file: %s", self.msg_queue_data_file)
         os.unlink(self.msg_queue_data_file)
 
+    def load_legacy_orderer(self):
+        '''Load a message queue dump written one message at a time by an
+        earlier version.'''
+        msgs = []
+        hdr_len = messaging.Header.length
+        with open(self.msg_queue_data_file, "rb") as fp:
+            while True:
+                hdr = fp.read(hdr_len)
+                if hdr == b'':
+                    break
+                hdr_obj = messaging.Header()
+                hdr_obj.loads(hdr)
+
+                pay_len = hdr_obj.payload_len
+                if pay_len == 0:
+                    continue
+                pay = fp.read(pay_len)
+                msgs.append((hdr_obj.timestamp, (hdr, pay)))
+        self.event_orderer.push_bulk(msgs)
+
 
     def run(self):
         '''Pull events from the queue and process them as long as the
         stop_event is not set.'''
         while not self.stop_event.is_set():
             try:
-                _, msg = self.event_orderer.pop()
+                _, msg = self.msg_source.pop()
                 self.msg_handler(msg)
             except Queue.Empty:
                 if __debug__:
@@ -146,9 +466,10 @@ class OrderingAnalyser(Analyser):
                 self.queue_cleared.set()
 
                 if self.snapshot_state:
-                    os.fsync(self.msg_fh.fileno())
-                    self.msg_fh.close()
+                    self.msg_dump.close()
                     self.dump_internal_state()
+                elif self.checkpoint is not None:
+                    self.checkpoint.drained()
 
                 self.cleanup()
                 if __debug__:
@@ -182,7 +503,7 @@ class OrderingAnalyser(Analyser):
 
     def snapshot_shutdown(self):
         try:
-            self.msg_fh = open(self.msg_queue_data_file, "wb")
+            self.msg_dump = order.QueueDumpWriter(self.msg_queue_data_file)
         except IOError as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException(
@@ -193,19 +514,28 @@ class OrderingAnalyser(Analyser):
         self.do_shutdown()
 
     def put_msg_file(self, (hdr, pay)):
-        self.msg_fh.write(hdr)
-        self.msg_fh.write(pay)
-        self.msg_fh.flush()
+        hdr_obj = messaging.Header()
+        hdr_obj.loads(hdr)
+        if hdr_obj.payload_len == 0:
+            return
+        self.msg_dump.write(hdr_obj.timestamp, hdr, pay)
+
+    def set_checkpoint(self, checkpoint):
+        '''Record committed journal messages through checkpoint, holding it
+        back while messages restored from a snapshot are queued.'''
+        super(OrderingAnalyser, self).set_checkpoint(checkpoint)
+        if self.event_orderer.get_queue_size() > 0:
+            checkpoint.hold()
 
     def put_msg(self, msg_list):
         '''Place a set of messages onto the queue, clearing the queue if any
         blank markers are found.'''
         msg_chunk = []
-        for hdr, pay in msg_list:
+        for msg in self.journal_msgs(msg_list):
             hdr_obj = messaging.Header()
-            hdr_obj.loads(hdr)
+            hdr_obj.loads(msg[0])
 
-            msg_chunk += [(hdr_obj.timestamp, (hdr, pay))]
+            msg_chunk += [(hdr_obj.timestamp, msg)]
 
             if hdr_obj.payload_type == uds_msg.TERM_MSG:
                 if __debug__:
@@ -243,27 +573,159 @@ class OrderingAnalyser(Analyser):
         raise NotImplementedError()
 
 
+class DecodedMsg(tuple):
+    '''A (header, payload) message pair carrying its decoded header and
+    payload objects, the decoded arguments of a function message or the
+    decoded function messages of an aggregation message, the order in which
+    it left the EventOrderer and its journal sequence number.'''
+    def __new__(cls, hdr, pay):
+        return super(DecodedMsg, cls).__new__(cls, (hdr, pay))
+
+    def __init__(self, hdr, pay):
+        super(DecodedMsg, self).__init__()
+        self.seq = None
+        self.journal_seq = None
+        self.hdr_obj = messaging.Header()
+        self.hdr_obj.loads(hdr)
+        self.pay_obj = common_utils.get_payload_type(self.hdr_obj)
+        self.pay_obj.ParseFromString(pay)
+        self.funcs = None
+        self.args = None
+        pay_type = self.hdr_obj.payload_type
+        if pay_type == uds_msg.AGGREGATION_MSG:
+            self.funcs = posix.decode_bulk_functions(self.hdr_obj,
+                                                     self.pay_obj)
+        elif pay_type == uds_msg.FUNCINFO_MSG:
+            self.args = posix.decode_function(self.hdr_obj, self.pay_obj)
+        elif pay_type == uds_msg.STRTAB_MSG:
+            posix.decode_string_table(self.hdr_obj, self.pay_obj)
+        elif pay_type == uds_msg.PROTOCOL_MSG:
+            posix.decode_protocol(self.hdr_obj, self.pay_obj)
+        elif (pay_type == uds_msg.GENERIC_MSG and
+              self.pay_obj.msg_type == uds_msg.DISCON):
+            posix.decode_disconnect(self.hdr_obj)
+        elif pay_type == uds_msg.STARTUP_MSG:
+            posix.decode_startup(self.hdr_obj, self.pay_obj)
+        elif pay_type == uds_msg.LIBINFO_MSG:
+            posix.decode_libinfo(self.hdr_obj, self.pay_obj)
+        elif pay_type == uds_msg.HOST_MSG:
+            posix.decode_host(self.hdr_obj, self.pay_obj)
+
+
+class DecodeStage(threading.Thread):
+    '''Decodes the messages popped from an EventOrderer on a thread of its
+    own, so that the analyser thread is left with only the graph work.
+    Protobuf parsing holds the interpreter lock with either implementation,
+    so decoding overlaps only with time the analyser thread spends in the
+    database with the lock released, and the stage is off by default. It
+    offers the same pop interface as the orderer, returning DecodedMsg
+    records stamped with their order and raising Queue.Empty once a clear
+    has drained both the orderer and the decoded records. A message that
+    fails to decode is logged and skipped, and passed to skip so that its
+    journal entry is still committed.'''
+    _EMPTY = object()
+
+    def __init__(self, event_orderer, depth=1024, skip=None):
+        super(DecodeStage, self).__init__(name="decode_stage")
+        self.daemon = True
+        self.event_orderer = event_orderer
+        self.skip = skip
+        self.decoded = Queue.Queue(depth)
+        self.resume = threading.Event()
+        self.paused = False
+        self.seq = 0
+        self.decode_time = 0.0
+
+        from google.protobuf.internal import api_implementation
+        if api_implementation.Type() != 'cpp':
+            logging.info("Decoding with the %s protobuf implementation, set "
+                         "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp to use "
+                         "the C++ one.", api_implementation.Type())
+
+    def run(self):
+        '''Decode messages in orderer order, pausing after each clear until
+        the consumer asks for more.'''
+        while True:
+            try:
+                pri, raw = self.event_orderer.pop()
+            except Queue.Empty:
+                self.decoded.put((None, self._EMPTY))
+                self.resume.wait()
+                self.resume.clear()
+                continue
+
+            start = time.time()
+            try:
+                msg = DecodedMsg(*raw)
+            except Exception:  # pylint: disable=broad-except
+                logging.error("Skipping message that failed to decode: %s",
+                              traceback.format_exc())
+                if self.skip is not None:
+                    self.skip(raw)
+                continue
+            finally:
+                self.decode_time += time.time() - start
+
+            msg.journal_seq = getattr(raw, 'journal_seq', None)
+            msg.seq = self.seq
+            self.seq += 1
+            self.decoded.put((pri, msg))
+
+    def pop(self):
+        '''Returns the next (priority, DecodedMsg) pair.'''
+        if self.paused:
+            self.paused = False
+            self.resume.set()
+        item = self.decoded.get()
+        if item[1] is self._EMPTY:
+            self.paused = True
+            raise Queue.Empty()
+        return item
+
+
 class PVMAnalyser(OrderingAnalyser):
     '''The PVM analyser class implements the core of the PVM model, including
     the significant operations and their interactions with the underlying
-    storage system.'''
+    storage system. io_chain_horizon is the number of seconds of IO event
+    history read back from the graph when an fd chain is not cached. If
+    decode_stage is set messages are decoded ahead of the analyser thread
+    by a DecodeStage. The decode_time and apply_time of the server status
+    show whether it can help.'''
     def __init__(self, storage_type, storage_args, opus_lite,
                  neo4j_cfg, *args, **kwargs):
+        io_chain_horizon = kwargs.pop('io_chain_horizon', 60.0)
+        self.use_decode_stage = kwargs.pop('decode_stage', False)
         super(PVMAnalyser, self).__init__(*args, **kwargs)
         self.storage_type = storage_type
         self.storage_args = storage_args
         self.storage_args['neo4j_cfg'] = neo4j_cfg
         self.opus_lite = opus_lite
+        # Event times are CLOCK_MONOTONIC_RAW nanoseconds.
+        self.io_chain_horizon = int(io_chain_horizon * 10**9)
         self.proc_state_file = None
+        self.decode_stage = None
+        self.decode_time = 0.0
+        self.apply_time = 0.0
 
-    def run(self):
-        '''Run a standard processing loop, also close the storage interface
-        once it is complete.'''
+    def open_storage(self):
+        '''Open the storage interface and restore the process state of a
+        previous run.'''
         self.db_iface = common_utils.meta_factory(storage.StorageIFace,
                                                   self.storage_type,
                                                   **self.storage_args)
+        posix.handle_db_upgrade(self.db_iface)
         self.proc_state_file = self.get_snapshot_dir() + "/.opus_proc_state.dat"
         posix.handle_proc_load_state(self.proc_state_file)
+
+    def run(self):
+        '''Run a standard processing loop, also close the storage interface
+        once it is complete.'''
+        self.open_storage()
+        if self.use_decode_stage:
+            self.decode_stage = DecodeStage(self.event_orderer,
+                                            skip=self.journal_commit)
+            self.msg_source = self.decode_stage
+            self.decode_stage.start()
         super(PVMAnalyser, self).run()
         self.db_iface.close()
 
@@ -276,46 +738,75 @@ class PVMAnalyser(OrderingAnalyser):
             logging.error("Dumping process state to file")
         posix.handle_proc_dump_state(self.proc_state_file)
 
-    def process(self, (hdr, pay)):
+    def get_decode_time(self):
+        '''Returns the total seconds spent decoding messages.'''
+        if self.decode_stage is not None:
+            return self.decode_stage.decode_time
+        return self.decode_time
+
+    def process(self, msg):
         '''Process a single front end message, applying it's effects to the
-        database.'''
-        hdr_obj = messaging.Header()
-        hdr_obj.loads(hdr)
-        pay_obj = common_utils.get_payload_type(hdr_obj)
-        pay_obj.ParseFromString(pay)
+        database. Messages not already decoded by the decode stage are
+        decoded here.'''
+        if not isinstance(msg, DecodedMsg):
+            start = time.time()
+            raw = msg
+            msg = DecodedMsg(*raw)
+            msg.journal_seq = getattr(raw, 'journal_seq', None)
+            self.decode_time += time.time() - start
+
+        start = time.time()
+        self.apply_msg(self.db_iface, msg)
+        self.apply_time += time.time() - start
+        self.journal_commit(msg)
 
+    def apply_msg(self, db_iface, msg):
+        '''Apply the effects of a decoded message to the database through
+        db_iface in a single transaction.'''
+        hdr_obj = msg.hdr_obj
+        pay_obj = msg.pay_obj
         # Set system time for current message
-        self.db_iface.set_sys_time_for_msg(hdr_obj.sys_time)
+        db_iface.set_sys_time_for_msg(hdr_obj.sys_time)
 
-        with self.db_iface.start_transaction():
+        with db_iface.start_transaction():
             if hdr_obj.payload_type == uds_msg.FUNCINFO_MSG:
-                posix.handle_function(self.db_iface,
+                posix.handle_function(db_iface,
                                       hdr_obj.pid,
-                                      pay_obj)
+                                      pay_obj,
+                                      msg.args)
             elif hdr_obj.payload_type == uds_msg.AGGREGATION_MSG:
-                posix.handle_bulk_functions(self.db_iface,
+                posix.handle_bulk_functions(db_iface,
                                             hdr_obj.pid,
-                                            pay_obj)
+                                            msg.funcs,
+                                            self.io_chain_horizon)
             elif hdr_obj.payload_type == uds_msg.STARTUP_MSG:
-                posix.handle_process(self.db_iface,
+                posix.handle_process(db_iface,
                                      hdr_obj,
                                      pay_obj,
                                      self.opus_lite)
             elif hdr_obj.payload_type == uds_msg.GENERIC_MSG:
                 if pay_obj.msg_type == uds_msg.DISCON:
-                    posix.handle_disconnect(self.db_iface,
+                    posix.handle_disconnect(db_iface,
                                             hdr_obj,
                                             hdr_obj.pid)
                 elif pay_obj.msg_type == uds_msg.PRE_FUNC_CALL:
                     posix.handle_prefunc(hdr_obj.pid,
                                          pay_obj)
             elif hdr_obj.payload_type == uds_msg.TERM_MSG:
-                posix.handle_startup(self.db_iface,
+                posix.handle_startup(db_iface,
                                      pay_obj)
             elif hdr_obj.payload_type == uds_msg.LIBINFO_MSG:
-                posix.handle_libinfo(self.db_iface,
+                posix.handle_libinfo(db_iface,
                                      hdr_obj.pid,
                                      pay_obj)
+            elif hdr_obj.payload_type == uds_msg.HOST_MSG:
+                posix.handle_host(db_iface,
+                                  hdr_obj,
+                                  pay_obj)
+            elif hdr_obj.payload_type == uds_msg.SUMMARY_MSG:
+                posix.handle_summary(db_iface,
+                                     hdr_obj,
+                                     pay_obj)
 
 
 class StatisticsAnalyser(PVMAnalyser):
@@ -363,6 +854,456 @@ class StatisticsAnalyser(PVMAnalyser):
         self.inbound.add(len(msg_list))
         return super(StatisticsAnalyser, self).put_msg(msg_list)
 
-    def process(self, (hdr, pay)):
+    def process(self, msg):
         self.outbound.add(1)
-        return super(StatisticsAnalyser, self).process((hdr, pay))
+        return super(StatisticsAnalyser, self).process(msg)
+
+
+class TeeLeg(threading.Thread):
+    '''Feeds the batches queued for one analyser of a TeeAnalyser to it,
+    so that an analyser blocking in put_msg holds up only its own leg.'''
+    def __init__(self, analyser):
+        super(TeeLeg, self).__init__(name="tee_" + type(analyser).__name__)
+        self.daemon = True
+        self.analyser = analyser
+        self.msg_queue = Queue.Queue()
+
+    def run(self):
+        '''Pass batches on until a shutdown marker is queued.'''
+        while True:
+            msg_list = self.msg_queue.get()
+            if msg_list is None:
+                break
+            self.analyser.put_msg(msg_list)
+
+
+class TeeAnalyser(Analyser):
+    '''Fans each batch of messages out to several analysers, given as a list
+    of analyser arguments with the analyser type under the key type. Each
+    analyser is fed by its own TeeLeg. The first analyser is the primary one,
+    used for queries and status. A journalled message is checkpointed once
+    every analyser has committed it.'''
+    def __init__(self, analysers, neo4j_cfg, *args, **kwargs):
+        super(TeeAnalyser, self).__init__(*args, **kwargs)
+        self.analysers = []
+        for anal_cfg in analysers:
+            anal_args = dict(anal_cfg)
+            anal_type = anal_args.pop('type')
+            # Only the storage backed analysers take the Neo4j settings.
+            if 'storage_type' in anal_args:
+                anal_args['neo4j_cfg'] = neo4j_cfg
+            self.analysers.append(common_utils.meta_factory(Analyser,
+                                                            anal_type,
+                                                            **anal_args))
+        self.primary = self.analysers[0]
+        self.legs = [TeeLeg(anal) for anal in self.analysers]
+
+    def __getattr__(self, name):
+        '''Look up attributes not held by the tee on the primary
+        analyser.'''
+        if name in ('primary', 'analysers', 'legs'):
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def set_checkpoint(self, checkpoint):
+        '''Share checkpoint between the analysers, so that it only advances
+        past messages committed by all of them.'''
+        self.checkpoint = checkpoint
+        tee_checkpoint = journal.TeeCheckpoint(checkpoint, len(self.analysers))
+        for index, anal in enumerate(self.analysers):
+            anal.set_checkpoint(tee_checkpoint.leg(index))
+
+    def run(self):
+        '''Start the analysers and their legs and wait to be stopped.'''
+        for anal in self.analysers:
+            anal.start()
+        for leg in self.legs:
+            leg.start()
+        self.stop_event.wait()
+
+    def put_msg(self, msg_list):
+        '''Queue a batch of messages for every analyser.'''
+        msgs = self.journal_msgs(msg_list)
+        for leg in self.legs:
+            leg.msg_queue.put(msgs)
+
+    def _stop_legs(self):
+        '''Hand every queued batch to its analyser and stop the legs.'''
+        for leg in self.legs:
+            leg.msg_queue.put(None)
+        for leg in self.legs:
+            leg.join()
+
+    def snapshot_shutdown(self):
+        '''Snapshot every analyser and stop.'''
+        if not self.isAlive():
+            return
+        self._stop_legs()
+        for anal in self.analysers:
+            anal.snapshot_shutdown()
+        super(TeeAnalyser, self).do_shutdown()
+
+    def do_shutdown(self, drop=False):
+        '''Shut down every analyser, then the tee itself.'''
+        if not self.isAlive():
+            return True
+        if not drop:
+            self._stop_legs()
+        success = True
+        for anal in self.analysers:
+            success = anal.do_shutdown(drop) and success
+        return super(TeeAnalyser, self).do_shutdown() and success
+
+
+class GlobalCoordinator(object):
+    '''Serialises the partitions of a ParallelPVMAnalyser around global
+    objects. Messages that only add events to the locals of their own
+    process, such as aggregated calls and reads and writes, run concurrently
+    under the shared lock. Messages that may get, version or drop globals
+    shared between process trees, look up the name to latest version map or
+    touch the process tables beyond the entries of their own process run
+    under the exclusive lock once all shared holders have committed. They
+    first wait their turn, so that the global operations of different trees
+    are applied in timestamp order.'''
+    def __init__(self, partitions=None):
+        super(GlobalCoordinator, self).__init__()
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.partitions = partitions if partitions is not None else []
+        self.turn = threading.Condition()
+
+    def wait_turn(self, partition, timestamp):
+        '''Wait until no other running partition is applying, or is free to
+        apply, a message ordered before the message at timestamp of
+        partition. Ties are broken by partition index.'''
+        key = (timestamp, partition.index)
+        with self.turn:
+            while any(pos is not None and pos < key
+                      for pos in (other.position()
+                                  for other in self.partitions
+                                  if other is not partition and
+                                  other.is_alive())):
+                self.turn.wait(PARTITION_CLEAR_POLL)
+
+    def advance(self):
+        '''Wake the partitions waiting their turn, after a partition has
+        handled a message.'''
+        with self.turn:
+            self.turn.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        '''Hold the shared lock, waiting for any exclusive holder.'''
+        with self.cond:
+            while self.writer or self.writers_waiting > 0:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        '''Hold the exclusive lock, waiting for all other holders.'''
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers > 0:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class PVMPartition(threading.Thread):
+    '''A worker of a ParallelPVMAnalyser. It applies the messages of the
+    process trees assigned to it in the order given by its own
+    EventOrderer, which holds back the orderer_window of the analyser,
+    through its own database session.'''
+    def __init__(self, analyser, index):
+        super(PVMPartition, self).__init__(name="pvm_partition_%d" % index)
+        self.daemon = True
+        self.index = index
+        self.analyser = analyser
+        self.event_orderer = order.EventOrderer(analyser.orderer_window)
+        self.queue_cleared = threading.Event()
+        self.stop_event = threading.Event()
+        self.db_iface = None
+
+    def run(self):
+        '''Pull events from the partition queue and apply them until the
+        stop_event is set, signalling queue_cleared whenever the queue is
+        drained during a clear. A message that cannot be applied is logged
+        and skipped, so that one bad message does not stop the partition.'''
+        import jpype
+        if not jpype.isThreadAttachedToJVM():
+            jpype.attachThreadToJVM()
+
+        self.db_iface = self.analyser.db_iface.session()
+
+        while not self.stop_event.is_set():
+            try:
+                _, msg = self.event_orderer.pop()
+            except Queue.Empty:
+                self.queue_cleared.set()
+                while (self.queue_cleared.is_set() and
+                       not self.stop_event.is_set()):
+                    time.sleep(0)
+                continue
+            try:
+                self.analyser.process_partition(self, msg)
+            except Exception:  # pylint: disable=broad-except
+                logging.error("%s skipping message that failed to apply: "
+                              "%s", self.name, traceback.format_exc())
+                self.analyser.journal_commit(msg)
+            self.event_orderer.pop_done()
+            self.analyser.coordinator.advance()
+
+    def position(self):
+        '''Returns the (timestamp, index) of the message the partition is
+        applying or will apply next without waiting, or None if it has
+        none.'''
+        front = self.event_orderer.front()
+        if front is None:
+            return None
+        return (front, self.index)
+
+
+class ParallelPVMAnalyser(PVMAnalyser):
+    '''A PVM analyser that spreads messages over a number of partition
+    threads. Each process tree, identified by the pid of its root process,
+    is assigned to one partition so the processes of a tree keep the
+    EventOrderer ordering between them. Operations on globals shared
+    between trees are serialised by a GlobalCoordinator.'''
+    def __init__(self, *args, **kwargs):
+        workers = kwargs.pop('workers', 4)
+        super(ParallelPVMAnalyser, self).__init__(*args, **kwargs)
+        self.partitions = [PVMPartition(self, i) for i in range(workers)]
+        self.coordinator = GlobalCoordinator(self.partitions)
+        self.proc_roots = {}  # pid -> pid of the process tree root
+        self.root_partitions = {}  # root pid -> partition index
+        self.root_procs = {}  # root pid -> connected processes of the tree
+        self.next_partition = 0
+        self.msg_dump_lock = threading.Lock()
+        self.partition_state_file = (self.get_snapshot_dir() +
+                                     "/.opus_partition_state.dat")
+        self.load_partition_state()
+
+        # Messages restored by load_orderer are repartitioned.
+        msg_chunks = {}
+        self.event_orderer.start_clear()
+        while True:
+            try:
+                pri, (hdr, pay) = self.event_orderer.pop()
+            except Queue.Empty:
+                break
+            hdr_obj = messaging.Header()
+            hdr_obj.loads(hdr)
+            part = self._route(hdr_obj, pay)
+            msg_chunks.setdefault(part, []).append((pri, (hdr, pay)))
+        self.event_orderer.stop_clear()
+        for part, chunk in msg_chunks.items():
+            part.event_orderer.push_bulk(chunk)
+
+    def load_partition_state(self):
+        '''Restores the process tree assignments of a previous run.'''
+        if not os.path.isfile(self.partition_state_file):
+            return
+
+        try:
+            with open(self.partition_state_file, "rb") as fh:
+                self.proc_roots = pickle.load(fh)
+                self.root_partitions = pickle.load(fh)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise exception.OPUSException(
+                "Could not open OPUS partition state file for reading")
+        for root in self.proc_roots.values():
+            self.root_procs[root] = self.root_procs.get(root, 0) + 1
+
+        os.unlink(self.partition_state_file)
+
+    def dump_internal_state(self):
+        super(ParallelPVMAnalyser, self).dump_internal_state()
+        try:
+            with open(self.partition_state_file, "wb") as fh:
+                pickle.dump(self.proc_roots, fh)
+                pickle.dump(self.root_partitions, fh)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise exception.OPUSException(
+                "Could not open OPUS partition state file for writing")
+
+    def cleanup(self):
+        '''Clear the process data structures and tree assignments.'''
+        super(ParallelPVMAnalyser, self).cleanup()
+        self.proc_roots = {}
+        self.root_partitions = {}
+        self.root_procs = {}
+
+    def run(self):
+        '''Open the storage interface, start the partitions and close the
+        storage interface once they have all stopped.'''
+        self.open_storage()
+
+        for partition in self.partitions:
+            partition.start()
+
+        self.stop_event.wait()
+
+        for partition in self.partitions:
+            partition.join(common_utils.THREAD_JOIN_SLACK)
+        self.db_iface.close()
+
+    def _partition_for(self, hdr_obj, pay):
+        '''Returns the partition that handles messages from the process
+        tree of the process that sent a message.'''
+        pid = hdr_obj.pid
+        if pid not in self.proc_roots:
+            root = pid
+            if hdr_obj.payload_type == uds_msg.STARTUP_MSG:
+                pay_obj = common_utils.get_payload_type(hdr_obj)
+                pay_obj.ParseFromString(pay)
+                posix.decode_startup(hdr_obj, pay_obj)
+                root = self.proc_roots.get(pay_obj.ppid, pid)
+            self.proc_roots[pid] = root
+            self.root_procs[root] = self.root_procs.get(root, 0) + 1
+
+        root = self.proc_roots[pid]
+        if root not in self.root_partitions:
+            self.root_partitions[root] = self.next_partition
+            self.next_partition = ((self.next_partition + 1) %
+                                   len(self.partitions))
+        return self.partitions[self.root_partitions[root]]
+
+    def _route(self, hdr_obj, pay):
+        '''Returns the partition for a message, forgetting the tree of its
+        process once the message is a disconnect.'''
+        partition = self._partition_for(hdr_obj, pay)
+        if hdr_obj.payload_type == uds_msg.GENERIC_MSG:
+            pay_obj = common_utils.get_payload_type(hdr_obj)
+            pay_obj.ParseFromString(pay)
+            if pay_obj.msg_type == uds_msg.DISCON:
+                self._disconnect(hdr_obj.pid)
+        return partition
+
+    def _disconnect(self, pid):
+        '''Forgets the tree of a disconnected process, so that a reused pid
+        is assigned afresh. A tree keeps its partition while any of its
+        processes is connected.'''
+        root = self.proc_roots.pop(pid, None)
+        if root is None:
+            return
+        self.root_procs[root] -= 1
+        if self.root_procs[root] == 0:
+            del self.root_procs[root]
+            self.root_partitions.pop(root, None)
+
+    def _clear_partitions(self):
+        '''Drain every partition, leaving them waiting with queue_cleared
+        set.'''
+        for partition in self.partitions:
+            partition.event_orderer.start_clear()
+        for partition in self.partitions:
+            while not partition.queue_cleared.wait(PARTITION_CLEAR_POLL):
+                if not partition.is_alive():
+                    logging.error("%s has stopped, its queue is not "
+                                  "drained.", partition.name)
+                    break
+
+    def put_msg(self, msg_list):
+        '''Place a set of messages onto their partition queues, clearing
+        every partition if any blank markers are found.'''
+        msg_chunks = {}
+        for msg in self.journal_msgs(msg_list):
+            hdr, pay = msg
+            hdr_obj = messaging.Header()
+            hdr_obj.loads(hdr)
+
+            if hdr_obj.payload_type == uds_msg.HOST_MSG:
+                # Partitions decode concurrently, so a host is known before
+                # any of its messages are decoded.
+                pay_obj = common_utils.get_payload_type(hdr_obj)
+                pay_obj.ParseFromString(pay)
+                posix.decode_host(hdr_obj, pay_obj)
+
+            partition = self._route(hdr_obj, pay)
+            msg_chunks.setdefault(partition, []).append(
+                (hdr_obj.timestamp, msg))
+
+            if hdr_obj.payload_type == uds_msg.TERM_MSG:
+                if __debug__:
+                    logging.debug("M:Received term message.")
+                for part, chunk in msg_chunks.items():
+                    part.event_orderer.push(chunk)
+                msg_chunks = {}
+                self._clear_partitions()
+                if self.checkpoint is not None:
+                    self.checkpoint.drained()
+                self.cleanup()
+                for part in self.partitions:
+                    part.event_orderer.stop_clear()
+                for part in self.partitions:
+                    part.queue_cleared.clear()
+                if __debug__:
+                    logging.debug("M:Partitions cleared, continuing.")
+
+        for part, chunk in msg_chunks.items():
+            part.event_orderer.push(chunk)
+
+    def process_partition(self, partition, raw):
+        '''Apply a single message on behalf of partition, under the
+        coordinator lock its payload type requires.'''
+        if self.snapshot_state:
+            with self.msg_dump_lock:
+                self.put_msg_file(raw)
+            return
+
+        db_iface = partition.db_iface
+        with self.coordinator.shared():
+            # Decoding touches only the string tables of the process.
+            msg = DecodedMsg(*raw)
+            exclusive = posix.touches_globals(msg.hdr_obj, msg.pay_obj)
+            if not exclusive:
+                db_iface.reserve_ids(len(msg.funcs) if msg.funcs else 1)
+                db_iface.use_id_block = True
+                self.apply_msg(db_iface, msg)
+        if exclusive:
+            self.coordinator.wait_turn(partition, msg.hdr_obj.timestamp)
+            with self.coordinator.exclusive():
+                # Node IDs stay in creation order for globals.
+                db_iface.use_id_block = False
+                self.apply_msg(db_iface, msg)
+        self.journal_commit(raw)
+
+    def do_shutdown(self, drop=False):
+        '''Drain every partition unless drop is set, then stop the
+        partitions and the analyser.'''
+        if not self.isAlive():
+            return True
+
+        if not drop:
+            self._clear_partitions()
+            if self.snapshot_state:
+                self.msg_dump.close()
+                self.dump_internal_state()
+            elif self.checkpoint is not None:
+                self.checkpoint.drained()
+            self.cleanup()
+
+        for partition in self.partitions:
+            partition.stop_event.set()
+            # Wakes partitions still waiting on their queue when dropping.
+            partition.event_orderer.start_clear()
+            partition.queue_cleared.clear()
+        return Analyser.do_shutdown(self)
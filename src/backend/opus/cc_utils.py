@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 '''
 Utilities for manipulation of command control messages.
+
+Each message is a JSON object behind a CC_HDR giving its length. A
+connection may carry any number of requests, and a client may send further
+requests before the responses to earlier ones arrive. Requests given an
+"id" have it copied into their responses, which may arrive in any order.
+A "subscribe" request asks for the response to a command to be pushed
+every interval until an "unsubscribe" naming the id of the subscription.
+Queries submitted with "query_submit" run as jobs, whose rows are fetched
+in chunks with "query_fetch".
 '''
 
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import itertools
 import json
 import socket
 import struct
@@ -16,12 +26,15 @@ from .exception import BackendConnectionError
 CC_HDR = struct.Struct(str("@I"))
 
 
+def pack_cc_msg(msg):
+    '''Returns the framed command control message msg.'''
+    msg_txt = json.dumps(msg)
+    return CC_HDR.pack(len(msg_txt)) + msg_txt
+
+
 def send_cc_msg(sock, msg):
     '''Sends a command control message over the socket sock.'''
-    msg_txt = json.dumps(msg)
-    buf = CC_HDR.pack(len(msg_txt))
-    buf += msg_txt
-    sock.send(buf)
+    sock.sendall(pack_cc_msg(msg))
 
 
 def __recv(sock, data_len):
@@ -30,7 +43,7 @@ def __recv(sock, data_len):
     buf = []
     size = data_len
     while size > 0:
-        tmp = sock.recv(data_len)
+        tmp = sock.recv(size)
         if tmp == str(""):
             raise IOError()
         buf += [tmp]
@@ -47,30 +60,137 @@ def recv_cc_msg(sock):
     return pay
 
 
+def split_cc_msgs(buf):
+    '''Returns the command control messages framed in buf and the bytes
+    left over after the last whole message.'''
+    msgs = []
+    pos = 0
+    while len(buf) - pos >= CC_HDR.size:
+        pay_len = CC_HDR.unpack_from(buf, pos)[0]
+        end = pos + CC_HDR.size + pay_len
+        if end > len(buf):
+            break
+        msgs.append(json.loads(buf[pos + CC_HDR.size:end]))
+        pos = end
+    return msgs, buf[pos:]
+
+
 class CommandConnectionHelper(object):
     '''Manages a connection to the backend and provides helpers for making
-    requests.'''
+    requests. The connection is opened by the first request and kept for
+    those that follow, until it fails or is closed.'''
     def __init__(self, addr):
         self.addr = addr
+        self.conn = None
+        self.req_ids = itertools.count(1)
+        self.responses = {}  # Responses read ahead of the one waited for
+        self.ended = set()  # Subscriptions whose pushes are discarded
 
-    def make_request(self, msg):
-        '''Sends a request message to the backend and retrieves a response.'''
+    def _connect(self):
+        if self.conn is not None:
+            return
         try:
             conn = multisocket.MultiFamilySocket(socket.SOCK_STREAM)
             conn.connect(self.addr)
         except IOError as exc:
             raise BackendConnectionError("Failed to make contact with "
                                          "the backend: %s" % exc)
+        self.conn = conn.socket
+        if conn.family == socket.AF_INET:
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        '''Closes the connection to the backend.'''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.responses.clear()
+        self.ended.clear()
 
+    def send_requests(self, msgs):
+        '''Sends request messages to the backend without waiting for the
+        responses, returning the ids to retrieve them by.'''
+        self._connect()
+        req_ids = [next(self.req_ids) for _ in msgs]
+        buf = str("").join(pack_cc_msg(dict(msg, id=req_id))
+                           for msg, req_id in zip(msgs, req_ids))
         try:
-            send_cc_msg(conn, msg)
+            self.conn.sendall(buf)
         except IOError as exc:
+            self.close()
             raise BackendConnectionError("Failed to send message to backend:"
                                          " %s" % exc)
+        return req_ids
+
+    def send_request(self, msg):
+        '''Sends a request message to the backend without waiting for the
+        response, returning the id to retrieve it by.'''
+        return self.send_requests([msg])[0]
+
+    def get_response(self, req_id):
+        '''Retrieves the next response to the request or subscription
+        req_id.'''
+        pending = self.responses.get(req_id)
+        if pending:
+            ret = pending.pop(0)
+            if not pending:
+                del self.responses[req_id]
+            return ret
+        if self.conn is None:
+            raise BackendConnectionError("Connection to backend closed.")
+        while True:
+            try:
+                ret = recv_cc_msg(self.conn)
+            except IOError as exc:
+                self.close()
+                raise BackendConnectionError("Failed to receive message from"
+                                             " backend: %s" % exc)
+            ret_id = ret.pop('id', None)
+            if ret_id == req_id:
+                return ret
+            if ret_id in self.ended:
+                continue
+            self.responses.setdefault(ret_id, []).append(ret)
+
+    def make_request(self, msg):
+        '''Sends a request message to the backend and retrieves a response.'''
+        return self.get_response(self.send_request(msg))
+
+    def make_requests(self, msgs):
+        '''Sends several request messages to the backend at once, returning
+        their responses in order.'''
+        req_ids = self.send_requests(msgs)
+        return [self.get_response(req_id) for req_id in req_ids]
+
+    def subscribe(self, msg, interval):
+        '''Yields the response to the request msg, and then each response
+        the backend pushes every interval seconds. The subscription ends
+        when the generator is closed, or when the backend refuses it.'''
+        sub_id = self.send_request({'cmd': "subscribe", 'sub': msg,
+                                    'interval': interval})
         try:
-            ret = recv_cc_msg(conn)
-        except IOError as exc:
-            raise BackendConnectionError("Failed to receive message from"
-                                         " backend: %s" % exc)
-        conn.close()
-        return ret
+            while True:
+                ret = self.get_response(sub_id)
+                yield ret
+                if ret.get('unsubscribed'):
+                    return
+        finally:
+            self.ended.add(sub_id)
+            self.responses.pop(sub_id, None)
+            if self.conn is not None:
+                try:
+                    self.ended.add(self.send_request({'cmd': "unsubscribe",
+                                                      'sub_id': sub_id}))
+                except BackendConnectionError:
+                    pass
+
+    def fetch_query(self, job_id, interval=0.5):
+        '''Yields the chunks of rows of query job job_id as the backend
+        pushes them every interval seconds, in responses that also give the
+        progress of the job. The last response holds the rest of the result
+        of the job, or the error that ended it.'''
+        for rsp in self.subscribe({'cmd': "query_fetch", 'job_id': job_id},
+                                  interval):
+            yield rsp
+            if not rsp['success'] or 'result' in rsp:
+                return
@@ -8,35 +8,100 @@ from __future__ import (absolute_import, division,
 
 import errno
 import logging
+import Queue
 import random
 import select
 import socket
 import threading
+import time
 import traceback
 
 from . import cc_utils, ipc, multisocket
 from .exception import CommandInterfaceStartupError
 
 
+class CommandConnection(object):
+    '''A client connection to command and control, buffering the requests
+    read from it until they are whole. Responses may be sent from any
+    thread.'''
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.buf = str("")
+        self.send_lock = threading.Lock()
+        self.subs = {}  # subscription id -> Subscription
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        '''Returns the whole requests read from the connection. If the
+        client has closed the connection an IOError is raised.'''
+        data = self.sock.recv(65536)
+        if data == str(""):
+            raise IOError("Connection closed by client.")
+        msgs, self.buf = cc_utils.split_cc_msgs(self.buf + data)
+        return msgs
+
+    def send(self, msg):
+        '''Sends a response, returning False if the connection has
+        failed.'''
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                cc_utils.send_cc_msg(self.sock, msg)
+            except IOError as exc:
+                logging.error("Failed to send response to %s: %s",
+                              self.addr, str(exc))
+                return False
+        return True
+
+    def close(self):
+        with self.send_lock:
+            self.closed = True
+            self.sock.close()
+
+
+class Subscription(object):
+    '''A command whose response is pushed to a connection every
+    interval seconds.'''
+    def __init__(self, conn, sub_id, msg, interval):
+        self.conn = conn
+        self.sub_id = sub_id
+        self.msg = msg
+        self.interval = interval
+        self.due = time.time()
+        self.busy = False  # A push is being made
+
+
 class CommandControl(object):
-    '''Command and control core system.'''
+    '''Command and control core system. Connections are kept open for as
+    many requests as the client sends, and the requests are handled by a
+    pool of worker_threads so that a slow command does not hold up the
+    others.'''
 
     command_handlers = {}
+    subscribable = set()
 
     @classmethod
-    def register_command_handler(cls, cmd):
+    def register_command_handler(cls, cmd, subscribable=False):
         def wrap(func):
             cls.command_handlers[cmd] = func
+            if subscribable:
+                cls.subscribable.add(cmd)
             return func
         return wrap
 
     def __init__(self, daemon_manager, router,
-                 listen_addr, whitelist_location=None):
+                 listen_addr, whitelist_location=None, worker_threads=4,
+                 min_interval=0.1):
         self.daemon_manager = daemon_manager
         self.node = ipc.Master(ident="CAC",
                                router=router)
-        self.node.run_forever()
         self.running = False
+        self.min_interval = min_interval
 
         self.whitelist = []
 
@@ -63,6 +128,14 @@ class CommandControl(object):
             raise CommandInterfaceStartupError("Failed to bind socket.")
         self.host_sock.listen(10)
 
+        self.conns = {}  # fileno -> CommandConnection
+        self.subs = []
+        self.work_queue = Queue.Queue()
+        for _ in range(worker_threads):
+            worker = threading.Thread(target=self._run_worker)
+            worker.daemon = True
+            worker.start()
+
     def exec_cmd(self, msg):
         '''Executes a command message that it has recieved, producing a
         response message.'''
@@ -85,6 +158,96 @@ class CommandControl(object):
                    "msg": "Errorid: {}".format(errorid)}
             return rsp
 
+    def _run_worker(self):
+        '''Executes requests from the work queue, sending each response
+        back on the connection it came from.'''
+        while True:
+            conn, msg, sub = self.work_queue.get()
+            rsp = self.exec_cmd(msg)
+            if 'id' in msg:
+                rsp['id'] = msg['id']
+            conn.send(rsp)
+            if sub is not None:
+                sub.busy = False
+
+    def _handle_request(self, conn, msg):
+        '''Queues a request for the workers, or handles it directly if it
+        starts or ends a subscription.'''
+        if not isinstance(msg, dict) or 'cmd' not in msg:
+            conn.send({"success": False, "msg": "Malformed command."})
+        elif msg['cmd'] == "subscribe":
+            self._subscribe(conn, msg)
+        elif msg['cmd'] == "unsubscribe":
+            sub = conn.subs.pop(msg.get('sub_id'), None)
+            if sub is not None:
+                self.subs.remove(sub)
+            rsp = {"success": sub is not None, "unsubscribed": True}
+            if sub is None:
+                rsp['msg'] = "No such subscription."
+            if 'id' in msg:
+                rsp['id'] = msg['id']
+            conn.send(rsp)
+        else:
+            self.work_queue.put((conn, msg, None))
+
+    def _subscribe(self, conn, msg):
+        sub_msg = msg.get('sub')
+        rsp = None
+        if 'id' not in msg:
+            rsp = {"success": False,
+                   "msg": "Subscriptions require a request id."}
+        elif (not isinstance(sub_msg, dict) or
+              sub_msg.get('cmd') not in self.subscribable):
+            rsp = {"success": False,
+                   "msg": "That command cannot be subscribed to.",
+                   "id": msg['id'], "unsubscribed": True}
+        elif msg['id'] in conn.subs:
+            rsp = {"success": False,
+                   "msg": "Subscription id already in use.",
+                   "id": msg['id'], "unsubscribed": True}
+        if rsp is not None:
+            conn.send(rsp)
+            return
+        sub_msg = dict(sub_msg, id=msg['id'])
+        sub = Subscription(conn, msg['id'], sub_msg,
+                           max(msg.get('interval', 1.0), self.min_interval))
+        conn.subs[sub.sub_id] = sub
+        self.subs.append(sub)
+
+    def _push_subs(self):
+        '''Queues the pushes of subscriptions that are due, returning the
+        time until the next is.'''
+        now = time.time()
+        wait = 2.0
+        for sub in self.subs:
+            if sub.due <= now and not sub.busy:
+                sub.busy = True
+                sub.due = now + sub.interval
+                self.work_queue.put((sub.conn, sub.msg, sub))
+            wait = min(wait, max(sub.due - now, 0.0))
+        return wait
+
+    def _accept(self):
+        (new_conn, new_addr) = self.host_sock.accept()
+
+        if self.whitelist and new_addr not in self.whitelist:
+            new_conn.close()
+            logging.info("Recieved connection from %s, dropped due"
+                         " to not matching white list.", new_addr)
+            return
+
+        if new_conn.family == socket.AF_INET:
+            new_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = CommandConnection(new_conn, new_addr)
+        self.conns[conn.fileno()] = conn
+
+    def _close(self, conn):
+        del self.conns[conn.fileno()]
+        for sub in conn.subs.values():
+            self.subs.remove(sub)
+        conn.subs.clear()
+        conn.close()
+
     def stop(self):
         if self.running:
             self.running = False
@@ -92,24 +255,32 @@ class CommandControl(object):
     def run(self):
         self.running = True
         while self.running:
+            wait = self._push_subs()
             try:
-                if select.select([self.host_sock], [], [], 2) == ([], [], []):
-                    continue
-            except IOError as exc:
-                if exc.errno != errno.EINTR:
+                ready = select.select([self.host_sock] +
+                                      self.conns.values(), [], [], wait)[0]
+            except (IOError, select.error) as exc:
+                if exc.args[0] != errno.EINTR:
                     raise
-
-            (new_conn, new_addr) = self.host_sock.accept()
-
-            if self.whitelist and new_addr not in self.whitelist:
-                new_conn.close()
-                logging.info("Recieved connection from %s, dropped due"
-                             " to not matching white list.", new_addr)
                 continue
 
-            pay = cc_utils.recv_cc_msg(new_conn)
-            rsp = self.exec_cmd(pay)
-            cc_utils.send_cc_msg(new_conn, rsp)
+            for conn in ready:
+                if conn is self.host_sock:
+                    self._accept()
+                    continue
+                try:
+                    msgs = conn.read()
+                except (IOError, ValueError) as exc:
+                    if __debug__:
+                        logging.debug("Closing command connection from %s: "
+                                      "%s", conn.addr, str(exc))
+                    self._close(conn)
+                    continue
+                for msg in msgs:
+                    self._handle_request(conn, msg)
+
+        for conn in self.conns.values():
+            self._close(conn)
 
 
 def _shutdown_inner(cac, drop):
@@ -132,11 +303,15 @@ handle_shutdown.shutdown_lock = threading.Lock()
 
 
 @CommandControl.register_command_handler("exec_qry_method")
+@CommandControl.register_command_handler("query_submit")
+@CommandControl.register_command_handler("query_status", subscribable=True)
+@CommandControl.register_command_handler("query_fetch", subscribable=True)
+@CommandControl.register_command_handler("query_cancel")
 def analyser(cac, msg):
     return cac.node.send("ANALYSER", msg).result()
 
 
-@CommandControl.register_command_handler("status")
+@CommandControl.register_command_handler("status", subscribable=True)
 def handle_status(cac, _):
     rsp = {"success": True, 'analyser': {}, 'producer': {}, 'query': {}}
 
@@ -168,7 +343,8 @@ def handle_status(cac, _):
     return rsp
 
 
-@CommandControl.register_command_handler("ps")
+@CommandControl.register_command_handler("ps", subscribable=True)
 @CommandControl.register_command_handler("detach")
+@CommandControl.register_command_handler("filters")
 def producer(cac, msg):
     return cac.node.send("PRODUCER", msg).result()
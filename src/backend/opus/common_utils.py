@@ -6,10 +6,9 @@ be used by multiple modules in the OPUS backend
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
-import bisect
-import collections
 import copy
 import logging
+import random
 import time
 import os
 
@@ -49,44 +48,148 @@ class FixedDict(object):  # pylint: disable=R0903
         return len(self._dictionary)
 
 
-class IndexList(collections.MutableSequence):
-    '''A list that maintains a bisectable index based on a key function.'''
-    def __init__(self, key):
-        self.key = key
-        self.list = []
-        self.index = []
-
-    def insert(self, i, val):
-        '''Insert an item into the list.'''
-        self.list.insert(i, val)
-        self.index.insert(i, self.key(val))
-
-    def find(self, val, key=None):
-        '''Find an items position in the list by bisecting the index.'''
-        if key is None:
-            return bisect.bisect(self.index, self.key(val))
-        else:
-            return bisect.bisect(self.index, key(val))
+class SkipList(object):
+    '''A list kept sorted by a key function, supporting logarithmic
+    insertion and lookup. Items with equal keys are kept in insertion order.
+    Insertion returns the list node holding the item, whose prev and next
+    attributes give its neighbours in sorted order.'''
+    MAX_LEVEL = 32
 
-    def __getitem__(self, i):
-        return self.list[i]
+    class Node(object):  # pylint: disable=R0903
+        '''A node of the skip list.'''
+        __slots__ = ('val', 'key', 'prev', 'next', 'forward')
 
-    def __setitem__(self, i, x):
-        self.list[i] = x
-        self.index[i] = self.key(x)
+        def __init__(self, val, key, level):
+            self.val = val
+            self.key = key
+            self.prev = None
+            self.next = None
+            self.forward = [None] * level
 
-    def __delitem__(self, i):
-        del self.list[i]
-        del self.index[i]
+    def __init__(self, key):
+        self.key = key
+        self.head = SkipList.Node(None, None, self.MAX_LEVEL)
+        self.tail = [self.head] * self.MAX_LEVEL
+        self.level = 1
+        self.size = 0
+
+    @classmethod
+    def _random_level(cls):
+        '''Returns a level with a geometric distribution, p = 1/2.'''
+        level = 1
+        while level < cls.MAX_LEVEL and random.getrandbits(1):
+            level += 1
+        return level
+
+    def _link(self, node, update):
+        '''Links node in after the nodes in update at each of its levels.'''
+        for i in range(len(node.forward)):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+            if node.forward[i] is None:
+                self.tail[i] = node
+
+        prev = update[0]
+        if prev is not self.head:
+            node.prev = prev
+            prev.next = node
+        node.next = node.forward[0]
+        if node.next is not None:
+            node.next.prev = node
+        self.size += 1
+
+    def insert(self, val):
+        '''Insert an item into its sorted position after any items with an
+        equal key, returning its node.'''
+        key = self.key(val)
+        level = self._random_level()
+        if level > self.level:
+            self.level = level
+
+        if self.tail[0] is self.head or self.tail[0].key <= key:
+            # Fast path, the item belongs at the end of the list.
+            node = SkipList.Node(val, key, level)
+            self._link(node, self.tail[:level])
+            return node
+
+        update = [self.head] * level
+        cur = self.head
+        for i in reversed(range(self.level)):
+            while cur.forward[i] is not None and cur.forward[i].key <= key:
+                cur = cur.forward[i]
+            if i < level:
+                update[i] = cur
+
+        node = SkipList.Node(val, key, level)
+        self._link(node, update)
+        return node
+
+    def prepend(self, val):
+        '''Insert an item into its sorted position before any items with an
+        equal key, returning its node. Used when backfilling older history.'''
+        key = self.key(val)
+        level = self._random_level()
+        if level > self.level:
+            self.level = level
+
+        update = [self.head] * level
+        cur = self.head
+        for i in reversed(range(self.level)):
+            while cur.forward[i] is not None and cur.forward[i].key < key:
+                cur = cur.forward[i]
+            if i < level:
+                update[i] = cur
+
+        node = SkipList.Node(val, key, level)
+        self._link(node, update)
+        return node
+
+    def append(self, val):
+        '''Adds an item to the list, items are expected to arrive in key
+        order so this is usually constant time.'''
+        return self.insert(val)
+
+    def floor_node(self, key):
+        '''Returns the node of the last item whose key is less than or equal
+        to key, or None if every item has a greater key.'''
+        cur = self.head
+        for i in reversed(range(self.level)):
+            while cur.forward[i] is not None and cur.forward[i].key <= key:
+                cur = cur.forward[i]
+        return cur if cur is not self.head else None
+
+    def floor(self, key):
+        '''Returns the last item whose key is less than or equal to key, or
+        None if every item has a greater key.'''
+        node = self.floor_node(key)
+        return node.val if node is not None else None
+
+    def first(self):
+        '''Returns the item with the smallest key or None if empty.'''
+        node = self.head.forward[0]
+        return node.val if node is not None else None
+
+    def last(self):
+        '''Returns the item with the largest key or None if empty.'''
+        node = self.tail[0]
+        return node.val if node is not self.head else None
+
+    def __iter__(self):
+        node = self.head.forward[0]
+        while node is not None:
+            yield node.val
+            node = node.forward[0]
 
     def __len__(self):
-        return len(self.list)
-
-    def __contains__(self, x):
-        return x in self.list
+        return self.size
 
     def __repr__(self):
-        return str(self.index)
+        node = self.head.forward[0]
+        keys = []
+        while node is not None:
+            keys.append(node.key)
+            node = node.forward[0]
+        return str(keys)
 
 
 def meta_factory(base, tag, *args, **kwargs):
@@ -132,6 +235,14 @@ def get_payload_type(header):
         pay_obj = uds_msg_pb2.FrontendTelemetry()
     elif header.payload_type == uds_msg_pb2.AGGREGATION_MSG:
         pay_obj = uds_msg_pb2.AggregationMessage()
+    elif header.payload_type == uds_msg_pb2.PROTOCOL_MSG:
+        pay_obj = uds_msg_pb2.ProtocolMessage()
+    elif header.payload_type == uds_msg_pb2.STRTAB_MSG:
+        pay_obj = uds_msg_pb2.StringTableMessage()
+    elif header.payload_type == uds_msg_pb2.HOST_MSG:
+        pay_obj = uds_msg_pb2.HostMessage()
+    elif header.payload_type == uds_msg_pb2.SUMMARY_MSG:
+        pay_obj = uds_msg_pb2.SummaryMessage()
     else:
         logging.error("Invalid payload type %d", header.payload_type)
     return pay_obj
@@ -112,3 +112,10 @@ class SnapshotException(OPUSException):
     process'''
     def __init__(self):
         super(SnapshotException, self).__init__("SnapshotException")
+
+
+class QueryCancelledException(OPUSException):
+    '''Exception raised in a query job that has been cancelled.'''
+    def __init__(self, job_id):
+        super(QueryCancelledException, self).__init__(
+            "Query job %d cancelled." % job_id)
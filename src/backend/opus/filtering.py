@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+'''
+Filtering of client messages in the producer. Rules read from a YAML rule
+file drop the function calls of excluded binaries, on excluded paths or of
+excluded functions before they are journalled and enqueued, so that they
+are never ordered or stored. A rule may instead summarise the calls it
+removes, in which case the number removed is sent on to the analyser in a
+SUMMARY_MSG and recorded on the process node.
+
+A rule file holds a list of rules under 'rules', each of the form
+
+    - name: system_paths
+      action: drop            # or summarise
+      binaries: [/usr/bin/]   # prefixes of the binary of the process
+      path_prefixes: [/proc/, /dev/]
+      path_suffixes: [.bashrc]
+      funcs: [stat]
+
+A rule matches a function call when the call meets every criterion the
+rule gives. A call meets the path criterion if each of its path arguments
+has one of the prefixes or suffixes. Calls on a descriptor opened by a
+removed call are removed with it and counted against the same rule.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import logging
+import struct
+
+import yaml
+
+from . import messaging, uds_msg_pb2
+from .pvm.posix.utils import PATH_ARGS, StringTable
+
+
+HEADER = struct.Struct(str(messaging.Header.struct_string))
+
+FILTER_ACTIONS = ("drop", "summarise")
+
+# Arguments naming the descriptor a call operates on
+DESC_ARGS = ("fd", "fp", "stream", "filedes", "oldfd")
+
+# Calls returning a new descriptor and calls returning new descriptors in
+# their arguments
+DESC_RESULT_FUNCS = frozenset([
+    "accept", "creat", "creat64", "dup", "fopen", "fopen64", "freopen",
+    "freopen64", "mkostemp", "mkostemps", "mkstemp", "mkstemps", "open",
+    "open64", "openat", "openat64", "popen", "socket", "tmpfile",
+    "tmpfile64"])
+DESC_ARG_FUNCS = {"dup2": ("newfd",),
+                  "dup3": ("newfd",),
+                  "pipe": ("read_fd", "write_fd"),
+                  "pipe2": ("read_fd", "write_fd"),
+                  "socketpair": ("read_fd", "write_fd")}
+FCNTL_DUP_CMDS = frozenset(["0", "1030"])  # F_DUPFD, F_DUPFD_CLOEXEC
+CLOSE_FUNCS = frozenset(["close", "fclose", "pclose"])
+
+# Calls that change the state of a process rather than doing I/O. Binary
+# and path rules keep them so the PVM can follow the process.
+PROC_FUNCS = frozenset([
+    "fork", "chdir", "fchdir", "umask", "seteuid", "setegid", "setgid",
+    "setreuid", "setregid", "setuid", "clearenv", "putenv", "setenv",
+    "unsetenv"])
+
+
+class FilterRule(object):
+    '''A producer filter rule.'''
+    def __init__(self, name, action="drop", binaries=None,
+                 path_prefixes=None, path_suffixes=None, funcs=None):
+        if action not in FILTER_ACTIONS:
+            raise ValueError("Unknown action %s for rule %s." % (action,
+                                                                 name))
+        self.name = name
+        self.action = action
+        self.binaries = tuple(binaries or ())
+        self.path_prefixes = tuple(path_prefixes or ())
+        self.path_suffixes = tuple(path_suffixes or ())
+        self.funcs = frozenset(funcs or ())
+        self.paths = bool(self.path_prefixes or self.path_suffixes)
+
+    def matches_binary(self, exec_name):
+        '''Returns True if the rule applies to a process running
+        exec_name.'''
+        if not self.binaries:
+            return True
+        return exec_name is not None and exec_name.startswith(self.binaries)
+
+    def matches_call(self, func_name, args):
+        '''Returns True if a call of func_name with args meets the function
+        and path criteria of the rule.'''
+        if self.funcs:
+            if func_name not in self.funcs:
+                return False
+        elif func_name in PROC_FUNCS:
+            return False
+        if not self.paths:
+            return True
+        paths = [val for key, val in args.items() if key in PATH_ARGS]
+        if not paths:
+            return False
+        for path in paths:
+            if not (path.startswith(self.path_prefixes) or
+                    (self.path_suffixes and
+                     path.endswith(self.path_suffixes))):
+                return False
+        return True
+
+
+class ProcFilterState(object):
+    '''What the filter knows of a client process.'''
+    def __init__(self):
+        self.exec_name = None
+        self.rules = ()  # Rules applying to the binary of the process
+        self.descs = {}  # descriptor -> name of the rule that removed it
+        self.summary = {}  # rule name -> [calls, timestamp, sys_time]
+
+
+class MessageFilter(object):
+    '''Filters lists of (header, payload) messages by the rules of
+    rule_file. The rule file is read again on reload, keeping the counts of
+    rules whose names are unchanged.'''
+    def __init__(self, rule_file):
+        self.rule_file = rule_file
+        self.rules = []
+        self.actions = {}  # rule name -> action
+        self.counts = {}  # rule name -> [calls, bytes]
+        self.procs = {}  # pid -> ProcFilterState
+        self.strtabs = {}  # (pid, tid) -> StringTable
+        if not self.reload():
+            raise ValueError("Could not load filter rules from %s." %
+                             rule_file)
+
+    def reload(self):
+        '''Reads the rule file, returning False and keeping the current
+        rules if it cannot be read.'''
+        try:
+            with open(self.rule_file, "r") as rule_fp:
+                cfg = yaml.safe_load(rule_fp) or {}
+            rules = [FilterRule(**rule) for rule in cfg.get('rules') or []]
+        except (IOError, yaml.YAMLError, TypeError, ValueError) as exc:
+            logging.error("Failed to load filter rules from %s: %s",
+                          self.rule_file, str(exc))
+            return False
+
+        self.rules = rules
+        self.actions = {rule.name: rule.action for rule in rules}
+        for rule in rules:
+            self.counts.setdefault(rule.name, [0, 0])
+        for state in self.procs.values():
+            state.rules = self._rules_for(state.exec_name)
+        logging.info("Loaded %d filter rules from %s.", len(rules),
+                     self.rule_file)
+        return True
+
+    def stats(self):
+        '''Returns the calls and bytes removed by each rule.'''
+        return [{'name': name,
+                 'action': self.actions.get(name, "-"),
+                 'calls': calls,
+                 'bytes': size}
+                for name, (calls, size) in sorted(self.counts.items())]
+
+    def _rules_for(self, exec_name):
+        return tuple(rule for rule in self.rules
+                     if rule.matches_binary(exec_name))
+
+    def _state(self, pid):
+        state = self.procs.get(pid)
+        if state is None:
+            state = self.procs[pid] = ProcFilterState()
+            state.rules = self._rules_for(None)
+        return state
+
+    def filter(self, msg_list):
+        '''Returns msg_list without the messages removed by the rules,
+        with the summaries of processes that exec or disconnect.'''
+        if not self.rules and not self.procs:
+            return msg_list
+        ret_list = []
+        for msg in msg_list:
+            hdr_buf, pay_buf = msg
+            hdr = HEADER.unpack(hdr_buf)
+            pid = hdr[1]
+            pay_type = hdr[2]
+            if pay_type == uds_msg_pb2.FUNCINFO_MSG:
+                state = self._state(pid)
+                if not state.rules and not state.descs:
+                    ret_list.append(msg)
+                elif self._keep_call(state, hdr, pay_buf,
+                                     len(hdr_buf) + len(pay_buf)):
+                    ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.AGGREGATION_MSG:
+                state = self._state(pid)
+                if not state.rules and not state.descs:
+                    ret_list.append(msg)
+                else:
+                    msg = self._filter_aggregate(state, msg, hdr)
+                    if msg is not None:
+                        ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.STARTUP_MSG:
+                self._startup(pid, pay_buf, ret_list)
+                ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.GENERIC_MSG:
+                gen_msg = uds_msg_pb2.GenericMessage()
+                gen_msg.ParseFromString(pay_buf)
+                if gen_msg.msg_type == uds_msg_pb2.DISCON:
+                    self._disconnect(pid, ret_list)
+                ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.PROTOCOL_MSG:
+                proto_msg = uds_msg_pb2.ProtocolMessage()
+                proto_msg.ParseFromString(pay_buf)
+                if proto_msg.version >= 2:
+                    self.strtabs[(pid, hdr[4])] = StringTable()
+                ret_list.append(msg)
+            elif pay_type == uds_msg_pb2.STRTAB_MSG:
+                strtab = self.strtabs.get((pid, hdr[4]))
+                if strtab is not None:
+                    strtab_msg = uds_msg_pb2.StringTableMessage()
+                    strtab_msg.ParseFromString(pay_buf)
+                    strtab.define(strtab_msg.strings)
+                ret_list.append(msg)
+            else:
+                ret_list.append(msg)
+        return ret_list
+
+    def flush(self):
+        '''Returns the pending summaries of every process.'''
+        ret_list = []
+        for pid, state in self.procs.items():
+            self._summarise(pid, state, ret_list)
+        return ret_list
+
+    def _startup(self, pid, pay_buf, ret_list):
+        '''Learns the binary of a process. A new process inherits the
+        removed descriptors of its parent, an execed one sends the summary
+        of its old binary first.'''
+        startup_msg = uds_msg_pb2.StartupMessage()
+        startup_msg.ParseFromString(pay_buf)
+        state = self._state(pid)
+        if state.exec_name is None:
+            parent = self.procs.get(startup_msg.ppid)
+            if parent is not None and not state.descs:
+                state.descs = dict(parent.descs)
+        else:
+            self._summarise(pid, state, ret_list)
+        state.exec_name = startup_msg.exec_name
+        state.rules = self._rules_for(state.exec_name)
+
+    def _disconnect(self, pid, ret_list):
+        '''Sends the summary of a disconnected process and forgets it.'''
+        state = self.procs.pop(pid, None)
+        if state is not None:
+            self._summarise(pid, state, ret_list)
+        for key in [key for key in self.strtabs if key[0] == pid]:
+            del self.strtabs[key]
+
+    def _summarise(self, pid, state, ret_list):
+        '''Appends a SUMMARY_MSG for each rule with calls to summarise.'''
+        for name, (calls, timestamp, sys_time) in state.summary.items():
+            sum_msg = uds_msg_pb2.SummaryMessage()
+            sum_msg.rule = name
+            sum_msg.count = calls
+            pay_buf = sum_msg.SerializeToString()
+            ret_list.append((HEADER.pack(timestamp, pid,
+                                         uds_msg_pb2.SUMMARY_MSG,
+                                         len(pay_buf), pid, sys_time),
+                             pay_buf))
+        state.summary = {}
+
+    def _decode(self, hdr, pay_buf):
+        '''Returns the function name and arguments of a serialised function
+        message.'''
+        func_msg = uds_msg_pb2.FuncInfoMessage()
+        func_msg.ParseFromString(pay_buf)
+        strtab = self.strtabs.get((hdr[1], hdr[4]))
+        if strtab is None:
+            args = {arg.key: arg.value for arg in func_msg.args}
+            return func_msg.func_name, args, func_msg
+        func_name = func_msg.func_name
+        if func_msg.func_id:
+            func_name = strtab.lookup(func_msg.func_id)
+        args = {}
+        for arg in func_msg.args:
+            args[strtab.lookup(arg.key_id) if arg.key_id else arg.key] = \
+                arg.value
+        return func_name, args, func_msg
+
+    def _keep_call(self, state, hdr, pay_buf, size):
+        '''Returns True if a function call is kept, counting it against its
+        rule otherwise.'''
+        func_name, args, func_msg = self._decode(hdr, pay_buf)
+
+        name = None
+        for rule in state.rules:
+            if rule.matches_call(func_name, args):
+                name = rule.name
+                break
+        if (name is None and state.descs and func_name not in PROC_FUNCS and
+                not any(key in PATH_ARGS for key in args)):
+            for key in DESC_ARGS:
+                if args.get(key) in state.descs:
+                    name = state.descs[args[key]]
+                    break
+
+        new_descs = ()
+        if func_msg.error_num == 0:
+            if (func_name in DESC_RESULT_FUNCS or
+                    (func_name == "fcntl" and
+                     args.get("cmd") in FCNTL_DUP_CMDS)):
+                new_descs = ("%d" % func_msg.ret_val,)
+            elif func_name in DESC_ARG_FUNCS:
+                new_descs = [args[key] for key in DESC_ARG_FUNCS[func_name]
+                             if key in args]
+
+        if name is None:
+            for desc in new_descs:
+                state.descs.pop(desc, None)
+            return True
+
+        for desc in new_descs:
+            state.descs[desc] = name
+        if func_name in CLOSE_FUNCS:
+            for key in DESC_ARGS:
+                state.descs.pop(args.get(key), None)
+
+        counts = self.counts.setdefault(name, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+        if self.actions.get(name) == "summarise":
+            summary = state.summary.get(name)
+            if summary is None:
+                summary = state.summary[name] = [0, 0, 0]
+            summary[0] += 1
+            summary[1] = hdr[0]
+            summary[2] = hdr[5]
+        return False
+
+    def _filter_aggregate(self, state, msg, hdr):
+        '''Returns an aggregation message holding only the kept calls of
+        msg, or None if none are kept.'''
+        agg_msg = uds_msg_pb2.AggregationMessage()
+        agg_msg.ParseFromString(msg[1])
+        kept = [smsg for smsg in agg_msg.messages
+                if self._keep_call(state, hdr, smsg, len(smsg))]
+        if len(kept) == len(agg_msg.messages):
+            return msg
+        if not kept:
+            return None
+        del agg_msg.messages[:]
+        agg_msg.messages.extend(kept)
+        pay_buf = agg_msg.SerializeToString()
+        return (HEADER.pack(hdr[0], hdr[1], hdr[2], len(pay_buf), hdr[4],
+                            hdr[5]),
+                pay_buf)
+
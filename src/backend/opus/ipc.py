@@ -1,56 +1,73 @@
 # -*- coding: utf-8 -*-
+'''
+Request and response messaging between the command and control master and
+the workers of the backend. The master holds a duplex channel of its own to
+each worker: a pipe to a worker in another process, or a pair of queues to
+a worker in the same process. Requests are numbered from a counter, and
+responses are matched to them by number.
+'''
 
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 
 import collections
+import itertools
+import multiprocessing
 import Queue
 import threading
-import uuid
 
-from . import common_utils
+Message = collections.namedtuple("Message", ['id', 'cont'])
 
-Message = collections.namedtuple("Message", ['id',
-                                             'src',
-                                             'dest',
-                                             'type',
-                                             'cont'])
 
-MSG_TYPE = common_utils.enum(REQUEST=0,
-                             RESPONSE=1,
-                             ERROR=-1)
+class QueueConnection(object):
+    '''One end of a duplex connection made of a pair of queues, for a
+    worker running in the same process as the master.'''
+    def __init__(self, recv_queue, send_queue):
+        self.recv_queue = recv_queue
+        self.send_queue = send_queue
 
+    def send(self, obj):
+        self.send_queue.put(obj)
 
-class QueuePair(object):
-    def __init__(self, recv_queue, send_queue, watch_queue=None):
-        self.recv = recv_queue
-        self.send = send_queue
-        self.watch = watch_queue
+    def recv(self):
+        return self.recv_queue.get()
 
-    def get(self, *args, **kwargs):
-        return self.recv.get(*args, **kwargs)
+    def close(self):
+        pass
 
-    def put(self, msg, *args, **kwargs):
-        if self.watch is not None:
-            self.watch.put(msg.src)
-        return self.send.put(msg, *args, **kwargs)
+
+class Channel(object):
+    '''One end of a duplex channel between the master and a worker. Any
+    number of threads may send on it.'''
+    def __init__(self, conn):
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, obj):
+        with self.send_lock:
+            self.conn.send(obj)
+
+    def recv(self):
+        return self.conn.recv()
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
 
     @classmethod
-    def create_pair(cls, queue_class=Queue.Queue,
-                    watch_queue=None, queue_triple=False):
-        roli = queue_class()
-        rilo = queue_class()
-
-        router_queue = cls(recv_queue=rilo,
-                           send_queue=roli)
-        if queue_triple:
-            leaf_queue = (roli, rilo, watch_queue)
+    def create_pair(cls, process=False):
+        '''Returns the master and worker ends of a new channel, a pipe if
+        the worker is to run in another process.'''
+        if process:
+            master_conn, worker_conn = multiprocessing.Pipe(duplex=True)
         else:
-            leaf_queue = cls(recv_queue=roli,
-                             send_queue=rilo,
-                             watch_queue=watch_queue)
-        return (router_queue, leaf_queue)
+            mowi = Queue.Queue()
+            wimo = Queue.Queue()
+            master_conn = QueueConnection(recv_queue=wimo, send_queue=mowi)
+            worker_conn = QueueConnection(recv_queue=mowi, send_queue=wimo)
+        return cls(master_conn), cls(worker_conn)
 
 
 class Node(object):
@@ -68,119 +85,131 @@ class Node(object):
             self._main_loop()
 
 
-class Client(Node):
-    def __init__(self, ident, router=None,
-                 queue_triple=None, queue_class=Queue.Queue):
-        super(Client, self).__init__()
+class Worker(Node):
+    '''Answers the requests received on a channel with handler. The
+    channel is added to router, or given as the worker end of a channel
+    already added. Given more than one thread, requests are handled
+    concurrently by a pool of that many threads, so that a slow request
+    does not hold up the others.'''
+    def __init__(self, handler, ident, router=None, channel=None,
+                 threads=1):
+        super(Worker, self).__init__()
         self.ident = ident
-        if queue_triple is not None and router is None:
-            self.queue = QueuePair(*queue_triple)
-        elif router is not None and queue_triple is None:
-            self.queue = router.add(ident, queue_class)
+        if channel is None and router is not None:
+            self.channel = router.add(ident)
+        elif channel is not None and router is None:
+            self.channel = channel
         else:
-            raise TypeError("Either router or queue_triple must not be None.")
+            raise TypeError("Either router or channel must not be None.")
+        self.handler = handler
+        self.threads = threads
+        self.requests = Queue.Queue()
+
+    def _respond(self, msg):
+        ret = self.handler(msg)
+        self.channel.send((msg.id, ret))
+
+    def _run_pool_thread(self):
+        while True:
+            self._respond(self.requests.get())
 
     def _main_loop(self):
-        raise NotImplementedError()
+        if self.threads > 1:
+            for _ in range(self.threads):
+                pool_thread = threading.Thread(target=self._run_pool_thread)
+                pool_thread.daemon = True
+                pool_thread.start()
+        while True:
+            try:
+                msg = Message(*self.channel.recv())
+            except (EOFError, IOError):
+                break
+            if self.threads > 1:
+                self.requests.put(msg)
+            else:
+                self._respond(msg)
 
-    def _send(self, msg):
-        self.queue.put(msg)
 
-    def _get(self):
-        return self.queue.get()
+class Future(object):
+    def __init__(self):
+        self.ready = threading.Event()
+        self.data = None
 
+    def result(self):
+        self.ready.wait()
+        return self.data
 
-class Worker(Client):
-    def __init__(self, handler, *args, **kwargs):
-        super(Worker, self).__init__(*args, **kwargs)
-        self.handler = handler
+    def fulfill(self, data):
+        self.data = data
+        self.ready.set()
 
-    def _main_loop(self):
-        while True:
-            msg = self._get()
-            if msg.type == MSG_TYPE.REQUEST:
-                ret = self.handler(msg)
-                self._send(Message(id=msg.id,
-                                   src=self.ident,
-                                   dest=msg.src,
-                                   type=MSG_TYPE.RESPONSE,
-                                   cont=ret))
-            elif msg.type == MSG_TYPE.RESPONSE:
-                self._send(Message(id=msg.id,
-                                   src=self.ident,
-                                   dest=msg.src,
-                                   type=MSG_TYPE.ERROR,
-                                   cont="Sent RESPONSE type "
-                                        "message to worker."))
-
-
-class Master(Client):
-    class Future(object):
-        def __init__(self):
-            self.ready = threading.Event()
-            self.data = None
-
-        def result(self):
-            self.ready.wait()
-            return self.data
-
-        def fulfill(self, data):
-            self.data = data
-            self.ready.set()
-
-    def __init__(self, *args, **kwargs):
-        super(Master, self).__init__(*args, **kwargs)
-        self.futures = {}
 
-    def send(self, dest, msg):
-        future = Master.Future()
-        msg_id = uuid.uuid4().hex
-        self.futures[msg_id] = future
-        self._send(Message(id=msg_id,
-                           src=self.ident,
-                           dest=dest,
-                           type=MSG_TYPE.REQUEST,
-                           cont=msg))
+class Router(object):
+    '''Holds the master end of the channel to each worker. A reader thread
+    for each channel fulfils the futures of the responses it receives. If
+    a channel closes, as it does when the process of its worker exits, the
+    requests still waiting on it fail.'''
+    def __init__(self):
+        self.channels = {}
+        self.futures = {}
+        self.req_ids = itertools.count(1)
+
+    def add(self, ident, process=False):
+        '''Adds a channel to the worker ident, in place of any it had, and
+        returns the worker end of it. The channel is a pipe if process is
+        set, for a worker that will run in a child process.'''
+        master_end, worker_end = Channel.create_pair(process)
+        self.channels[ident] = master_end
+        reader = threading.Thread(target=self._read,
+                                  args=(ident, master_end))
+        reader.daemon = True
+        reader.start()
+        return worker_end
+
+    def _fail(self, req_id, reason):
+        entry = self.futures.pop(req_id, None)
+        if entry is not None:
+            entry[0].fulfill({"success": False, "msg": reason})
+
+    def request(self, dest, msg):
+        '''Sends the request msg to the worker dest, returning a future for
+        the response.'''
+        future = Future()
+        chan = self.channels.get(dest)
+        if chan is None:
+            future.fulfill({"success": False,
+                            "msg": "That destination does not exist."})
+            return future
+        req_id = next(self.req_ids)
+        self.futures[req_id] = (future, chan)
+        try:
+            if chan.closed:
+                raise IOError("channel closed")
+            chan.send((req_id, msg))
+        except (IOError, ValueError):
+            self._fail(req_id, "Lost connection to %s." % dest)
         return future
 
-    def _main_loop(self):
+    def _read(self, ident, chan):
         while True:
-            msg = self._get()
-            if msg.type == MSG_TYPE.RESPONSE:
-                self.futures[msg.id].fulfill(msg.cont)
-                del self.futures[msg.id]
-            elif msg.type == MSG_TYPE.REQUEST:
-                self._send(Message(id=msg.id,
-                                   src=self.ident,
-                                   dest=msg.src,
-                                   type=MSG_TYPE.ERROR,
-                                   cont="Send REQUEST type "
-                                        "message to master."))
-
-
-class Router(Node):
-    def __init__(self, queue_class=Queue.Queue):
-        super(Router, self).__init__()
-        self.clients = {}
-        self.wait_queue = queue_class()
+            try:
+                req_id, ret = chan.recv()
+            except (EOFError, IOError):
+                break
+            entry = self.futures.pop(req_id, None)
+            if entry is not None:
+                entry[0].fulfill(ret)
+        chan.close()
+        for req_id, entry in self.futures.items():
+            if entry[1] is chan:
+                self._fail(req_id, "Lost connection to %s." % ident)
+
+
+class Master(object):
+    '''Sends requests to the workers of router.'''
+    def __init__(self, ident, router):
+        self.ident = ident
+        self.router = router
 
-    def _main_loop(self):
-        while True:
-            elm = self.wait_queue.get()
-            msg = self.clients[elm].get()
-            if msg.dest in self.clients:
-                self.clients[msg.dest].put(msg)
-            else:
-                self.clients[elm].put(Message(id=msg.id,
-                                              src=None,
-                                              dest=None,
-                                              type=MSG_TYPE.ERROR,
-                                              cont="That destination "
-                                                   "does not exist."))
-
-    def add(self, ident, queue_class=Queue.Queue, queue_triple=False):
-        router, leaf = QueuePair.create_pair(queue_class,
-                                             self.wait_queue,
-                                             queue_triple)
-        self.clients[ident] = router
-        return leaf
+    def send(self, dest, msg):
+        return self.router.request(dest, msg)
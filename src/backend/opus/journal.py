@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+'''
+Write ahead journal of the messages received by the producer. Messages are
+appended to segment files before they are handed to the fetcher, the
+analyser records a checkpoint of the messages it has committed and after a
+crash the messages past the checkpoint are replayed.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import glob
+import heapq
+import logging
+import os
+import struct
+import threading
+import time
+
+from .exception import OPUSException
+
+
+SEGMENT_PREFIX = "journal."
+CHECKPOINT_FILE = "checkpoint"
+SEGMENT_RECORD = struct.Struct(str("<QII"))
+
+
+class JournalBatch(list):
+    '''A list of (header, payload) messages of which the first was given the
+    journal sequence number first_seq and the rest the following ones.'''
+    def __init__(self, msgs, first_seq):
+        super(JournalBatch, self).__init__(msgs)
+        self.first_seq = first_seq
+
+
+class JournalMsg(tuple):
+    '''A (header, payload) message tagged with its journal sequence
+    number.'''
+    def __new__(cls, msg, journal_seq=None):
+        return super(JournalMsg, cls).__new__(cls, msg)
+
+    def __init__(self, msg, journal_seq=None):
+        super(JournalMsg, self).__init__()
+        self.journal_seq = journal_seq
+
+
+def tag_batch(msg_list):
+    '''Returns the messages of a JournalBatch tagged with their sequence
+    numbers, or msg_list unchanged if it is not a batch.'''
+    first_seq = getattr(msg_list, 'first_seq', None)
+    if first_seq is None:
+        return msg_list
+    return [JournalMsg(msg, first_seq + i) for i, msg in enumerate(msg_list)]
+
+
+def _segment_seq(path):
+    '''Returns the first sequence number held in a segment.'''
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):])
+
+
+def read_checkpoint(journal_dir):
+    '''Returns the last committed sequence number, or -1 if there is none.'''
+    try:
+        with open(os.path.join(journal_dir, CHECKPOINT_FILE), "rb") as fp:
+            return int(fp.read().strip() or -1)
+    except IOError:
+        return -1
+
+
+def read_segment(path):
+    '''Yields the (seq, header, payload) records of a segment, stopping at a
+    record torn by a crash.'''
+    with open(path, "rb") as fp:
+        while True:
+            rec = fp.read(SEGMENT_RECORD.size)
+            if len(rec) < SEGMENT_RECORD.size:
+                break
+            seq, hdr_len, pay_len = SEGMENT_RECORD.unpack(rec)
+            hdr = fp.read(hdr_len)
+            pay = fp.read(pay_len)
+            if len(hdr) < hdr_len or len(pay) < pay_len:
+                logging.error("Journal segment %s ends in a torn record.",
+                              path)
+                break
+            yield seq, hdr, pay
+
+
+class IngestJournal(object):
+    '''Appends the messages received by the producer to rotating segment
+    files. Each append is synced to disk, at most once every sync_interval
+    seconds. Segments are rotated once they reach segment_size bytes and
+    removed once the checkpoint has passed every message in them.'''
+    def __init__(self, journal_dir, segment_size=64, sync_interval=0.0):
+        self.journal_dir = journal_dir
+        self.segment_size = int(segment_size * 1024 * 1024)
+        self.sync_interval = sync_interval
+        self.last_sync = 0.0
+        self.seg_fh = None
+        self.seg_len = 0
+        self.next_seq = 0
+
+        try:
+            if not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+        except OSError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("Could not create journal directory")
+
+        segments = self.segments()
+        if segments:
+            for seq, _, _ in read_segment(segments[-1]):
+                self.next_seq = seq + 1
+            if self.next_seq == 0:
+                self.next_seq = _segment_seq(segments[-1])
+        self.next_seq = max(self.next_seq,
+                            read_checkpoint(self.journal_dir) + 1)
+
+    def segments(self):
+        '''Returns the segment paths in sequence order.'''
+        return sorted(glob.glob(os.path.join(self.journal_dir,
+                                             SEGMENT_PREFIX + "*")),
+                      key=_segment_seq)
+
+    def replay(self):
+        '''Returns a JournalBatch of the messages past the checkpoint.'''
+        checkpoint = read_checkpoint(self.journal_dir)
+        msgs = []
+        first_seq = None
+        for path in self.segments():
+            for seq, hdr, pay in read_segment(path):
+                if seq <= checkpoint:
+                    continue
+                if first_seq is None:
+                    first_seq = seq
+                msgs.append((hdr, pay))
+        logging.info("Replaying %d journalled messages after checkpoint %d.",
+                     len(msgs), checkpoint)
+        return JournalBatch(msgs, first_seq)
+
+    def _rotate(self):
+        '''Close the current segment, remove the segments the checkpoint has
+        passed and open a new segment.'''
+        if self.seg_fh is not None:
+            self._sync()
+            self.seg_fh.close()
+
+        checkpoint = read_checkpoint(self.journal_dir)
+        segments = self.segments()
+        for path, next_path in zip(segments, segments[1:]):
+            if _segment_seq(next_path) - 1 > checkpoint:
+                break
+            os.unlink(path)
+
+        path = os.path.join(self.journal_dir,
+                            "%s%020d" % (SEGMENT_PREFIX, self.next_seq))
+        self.seg_fh = open(path, "ab")
+        self.seg_len = 0
+
+    def _sync(self):
+        '''Flush and sync the current segment.'''
+        self.seg_fh.flush()
+        os.fsync(self.seg_fh.fileno())
+        self.last_sync = time.time()
+
+    def append(self, msg_list):
+        '''Append a list of messages to the journal, returning them as a
+        JournalBatch.'''
+        if self.seg_fh is None or self.seg_len >= self.segment_size:
+            self._rotate()
+
+        first_seq = self.next_seq
+        buf = []
+        for hdr, pay in msg_list:
+            buf.append(SEGMENT_RECORD.pack(self.next_seq, len(hdr), len(pay)))
+            buf.append(hdr)
+            buf.append(pay)
+            self.next_seq += 1
+        data = b"".join(buf)
+        self.seg_fh.write(data)
+        self.seg_len += len(data)
+
+        if time.time() - self.last_sync >= self.sync_interval:
+            self._sync()
+        return JournalBatch(msg_list, first_seq)
+
+    def close(self):
+        '''Sync and close the current segment.'''
+        if self.seg_fh is not None:
+            self._sync()
+            self.seg_fh.close()
+            self.seg_fh = None
+
+
+class JournalCheckpoint(object):
+    '''Tracks the journalled messages held by an analyser and records the
+    highest sequence number below which every message has been committed.
+    The checkpoint is written at most once every interval seconds.'''
+    def __init__(self, journal_dir, interval=1.0):
+        self.path = os.path.join(journal_dir, CHECKPOINT_FILE)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []  # heap of uncommitted sequence numbers
+        self.done = set()
+        self.highest = read_checkpoint(journal_dir)
+        self.written = self.highest
+        self.last_write = 0.0
+        self.held = False
+
+    def add(self, msgs):
+        '''Record the tagged messages msgs as pending.'''
+        with self.lock:
+            for msg in msgs:
+                seq = getattr(msg, 'journal_seq', None)
+                if seq is None:
+                    continue
+                heapq.heappush(self.pending, seq)
+                self.highest = max(self.highest, seq)
+
+    def hold(self):
+        '''Stop the checkpoint advancing until the next drain, for when
+        messages of unknown sequence are queued.'''
+        with self.lock:
+            self.held = True
+
+    def commit(self, seq):
+        '''Record that the message with sequence number seq has been
+        committed.'''
+        if seq is None:
+            return
+        with self.lock:
+            self.done.add(seq)
+            while self.pending and self.pending[0] in self.done:
+                self.done.discard(heapq.heappop(self.pending))
+            if time.time() - self.last_write >= self.interval:
+                self._write()
+
+    def drained(self):
+        '''Record that every queued message has been committed.'''
+        with self.lock:
+            self.pending = []
+            self.done = set()
+            self.held = False
+            self._write()
+
+    def release(self):
+        '''Let a held checkpoint advance again, once the messages of unknown
+        sequence have been committed.'''
+        with self.lock:
+            self.held = False
+            self._write()
+
+    def _write(self):
+        '''Atomically replace the checkpoint file.'''
+        if self.held:
+            return
+        if self.pending:
+            checkpoint = self.pending[0] - 1
+        else:
+            checkpoint = self.highest
+        self.last_write = time.time()
+        if checkpoint == self.written:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as fp:
+                fp.write(b"%d\n" % checkpoint)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            return
+        self.written = checkpoint
+
+
+class TeeCheckpoint(object):
+    '''Shares a JournalCheckpoint between the analysers of a TeeAnalyser.
+    A message is committed to the checkpoint once every analyser has
+    committed it, so no segment is removed while an analyser still holds
+    its messages. The tee records the messages as pending on the checkpoint
+    and each analyser is given its own LegCheckpoint.'''
+    def __init__(self, checkpoint, count):
+        self.checkpoint = checkpoint
+        self.count = count
+        self.lock = threading.Lock()
+        self.commits = {}  # sequence number -> analysers that committed it
+        self.held = set()
+
+    def leg(self, index):
+        '''Returns the LegCheckpoint of analyser index.'''
+        return LegCheckpoint(self, index)
+
+    def commit(self, seq):
+        '''Record that one analyser has committed the message with
+        sequence number seq.'''
+        with self.lock:
+            count = self.commits.pop(seq, 0) + 1
+            if count < self.count:
+                self.commits[seq] = count
+                return
+        self.checkpoint.commit(seq)
+
+    def hold(self, index):
+        '''Hold the checkpoint until analyser index has drained.'''
+        with self.lock:
+            self.held.add(index)
+            self.checkpoint.hold()
+
+    def drained(self, index):
+        '''Release the checkpoint once no analyser holds it.'''
+        with self.lock:
+            self.held.discard(index)
+            if not self.held:
+                self.checkpoint.release()
+
+
+class LegCheckpoint(object):
+    '''The view of a TeeCheckpoint given to one analyser of a tee.'''
+    def __init__(self, tee, index):
+        self.tee = tee
+        self.index = index
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def add(self, msgs):
+        '''Record the tagged messages msgs as held by the analyser.'''
+        with self.lock:
+            for msg in msgs:
+                seq = getattr(msg, 'journal_seq', None)
+                if seq is not None:
+                    self.pending.add(seq)
+
+    def hold(self):
+        '''Hold the shared checkpoint until the analyser has drained.'''
+        self.tee.hold(self.index)
+
+    def commit(self, seq):
+        '''Record that the analyser has committed the message with
+        sequence number seq.'''
+        with self.lock:
+            if seq not in self.pending:
+                return
+            self.pending.discard(seq)
+        self.tee.commit(seq)
+
+    def drained(self):
+        '''Record that the analyser has committed every queued message.'''
+        with self.lock:
+            seqs, self.pending = self.pending, set()
+        for seq in seqs:
+            self.tee.commit(seq)
+        self.tee.drained(self.index)
@@ -0,0 +1,164 @@
+#! /usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+External sort of message logs by timestamp. The headers of a log are
+scanned into sorted runs of (epoch, timestamp, offset, length) records of
+bounded size, which are merged into an index giving the messages of the log
+in time order. An epoch is the span of a log between term messages, as
+timestamps are only comparable within a run of the backend.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import argparse
+import heapq
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from . import messaging
+from . import uds_msg_pb2 as uds_msg
+
+
+INDEX_DTYPE = np.dtype([(str('epoch'), np.uint32),
+                        (str('timestamp'), np.uint64),
+                        (str('offset'), np.uint64),
+                        (str('length'), np.uint32)])
+
+HEADER = struct.Struct(str(messaging.Header.struct_string))
+
+# Records read from each run at a time while merging.
+MERGE_BLOCK = 65536
+
+
+def _save_run(run_dir, records):
+    '''Sort a chunk of records and save it as a run, returning its path.'''
+    run = np.array(records, dtype=INDEX_DTYPE)
+    run = run[np.lexsort((run['offset'], run['timestamp'], run['epoch']))]
+    path = os.path.join(run_dir, "run%06d.npy" % len(os.listdir(run_dir)))
+    np.save(path, run)
+    return path
+
+
+def scan_runs(log_path, run_dir, chunk_size):
+    '''Scan the headers of a log into sorted runs of at most chunk_size
+    records, returning the run paths and the number of messages.'''
+    runs = []
+    records = []
+    count = 0
+    epoch = 0
+    with open(log_path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return runs, count
+        log = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset + HEADER.size <= len(log):
+            hdr = HEADER.unpack_from(log, offset)
+            length = HEADER.size + hdr[3]
+            if offset + length > len(log):
+                logging.error("Log %s ends in a torn message.", log_path)
+                break
+            records.append((epoch, hdr[0], offset, length))
+            if hdr[2] == uds_msg.TERM_MSG:
+                epoch += 1
+            offset += length
+            count += 1
+            if len(records) >= chunk_size:
+                runs.append(_save_run(run_dir, records))
+                records = []
+    finally:
+        log.close()
+    if records:
+        runs.append(_save_run(run_dir, records))
+    return runs, count
+
+
+def _iter_run(path):
+    '''Yields the records of a run as tuples, reading it in blocks.'''
+    run = np.load(path, mmap_mode=str('r'))
+    for start in range(0, len(run), MERGE_BLOCK):
+        for rec in run[start:start + MERGE_BLOCK].tolist():
+            yield rec
+
+
+def sort_log(log_path, index_path, chunk_size=5000000, tmp_dir=None):
+    '''Write an index of the messages of a log in time order to index_path,
+    holding at most chunk_size records in memory while sorting. Returns the
+    number of messages indexed.'''
+    run_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        runs, count = scan_runs(log_path, run_dir, chunk_size)
+        if len(runs) <= 1:
+            index = (np.load(runs[0]) if runs
+                     else np.zeros(0, dtype=INDEX_DTYPE))
+            with open(index_path, "wb") as fp:
+                np.save(fp, index)
+            return count
+
+        index = np.lib.format.open_memmap(index_path, mode=str('w+'),
+                                          dtype=INDEX_DTYPE, shape=(count,))
+        pos = 0
+        block = []
+        for rec in heapq.merge(*[_iter_run(path) for path in runs]):
+            block.append(rec)
+            if len(block) >= MERGE_BLOCK:
+                index[pos:pos + len(block)] = block
+                pos += len(block)
+                block = []
+        if block:
+            index[pos:pos + len(block)] = block
+        index.flush()
+        del index
+    finally:
+        shutil.rmtree(run_dir)
+    return count
+
+
+def index_len(index_path):
+    '''Returns the number of messages in an index.'''
+    return len(np.load(index_path, mmap_mode=str('r')))
+
+
+def read_sorted(log_path, index_path):
+    '''Yields the (header, payload) messages of a log in the order given by
+    its index.'''
+    index = np.load(index_path, mmap_mode=str('r'))
+    if len(index) == 0:
+        return
+    with open(log_path, "rb") as fp:
+        log = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for start in range(0, len(index), MERGE_BLOCK):
+            block = index[start:start + MERGE_BLOCK]
+            for offset, length in zip(block['offset'].tolist(),
+                                      block['length'].tolist()):
+                mid = offset + HEADER.size
+                yield log[offset:mid], log[mid:offset + length]
+    finally:
+        log.close()
+
+
+def main():
+    '''Sort a log given on the command line.'''
+    parser = argparse.ArgumentParser(
+        description="Index the messages of an OPUS log in time order.")
+    parser.add_argument("log", help="Log to sort.")
+    parser.add_argument("index", help="Path to write the index to.")
+    parser.add_argument("--chunk-size", type=int, default=5000000,
+                        help="Number of messages sorted in memory at once.")
+    parser.add_argument("--tmp-dir", default=None,
+                        help="Directory to hold the sorted runs.")
+    args = parser.parse_args()
+
+    count = sort_log(args.log, args.index, args.chunk_size, args.tmp_dir)
+    print("Indexed {:d} messages.".format(count))
+
+
+if __name__ == "__main__":
+    main()
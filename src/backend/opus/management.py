@@ -6,12 +6,11 @@ control systems.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
-from . import (command, config_util, ipc, production, messaging)
+from . import (command, config_util, ipc, journal, production, messaging)
 from . import uds_msg_pb2 as uds_msg
 from .analyser_controller import AnalyserController
 from .pf_queue import ProducerFetcherQueue
 
-import multiprocessing
 import os
 import os.path
 import time
@@ -52,10 +51,21 @@ class DaemonManager(object):
     def __init__(self, config):
         self.config = config
 
-        self.router = ipc.Router(queue_class=multiprocessing.Queue)
-        self.router.run_forever()
+        self.router = ipc.Router()
 
-        self.pf_queue = ProducerFetcherQueue()
+        prod_type = config_util.safe_read_config(self.config, "MODULES",
+                                                 "Producer")
+        prod_cfg = config_util.safe_read_config(self.config, "PRODUCER",
+                                                prod_type)
+        self.pf_queue = ProducerFetcherQueue(prod_cfg.get('shards', 1))
+
+        self.journal = None
+        journal_cfg = self.config.get("JOURNAL")
+        if journal_cfg is not None:
+            self.journal = journal.IngestJournal(
+                journal_cfg['journal_dir'],
+                journal_cfg.get('segment_size', 64),
+                journal_cfg.get('sync_interval', 0.0))
 
         analyser_ctlr_cfg = config_util.safe_read_config(self.config,
                                                          "ANALYSER_CONTROLLER")
@@ -67,7 +77,8 @@ class DaemonManager(object):
         self.producer = config_util.load_module(config, "Producer",
                                                 production.Producer,
                                                 {"pf_queue": self.pf_queue,
-                                                 "router": self.router})
+                                                 "router": self.router,
+                                                 "journal": self.journal})
 
         command_cfg = config_util.safe_read_config(self.config, "COMMAND")
 
@@ -77,9 +88,14 @@ class DaemonManager(object):
 
         self.analyser_ctl.start_service()
 
-        startup_msg_pair = _startup_touch_file(
-            config_util.safe_read_config(self.config, "GENERAL", "touch_file")
-            )
+        touch_file = config_util.safe_read_config(self.config, "GENERAL",
+                                                  "touch_file")
+        if self.journal is not None and os.path.exists(touch_file):
+            replay_batch = self.journal.replay()
+            if replay_batch:
+                self.pf_queue.enqueue(replay_batch)
+
+        startup_msg_pair = _startup_touch_file(touch_file)
         self.pf_queue.enqueue([startup_msg_pair])
         self.producer.start()
 
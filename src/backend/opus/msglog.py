@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+'''
+Reading and indexing of the message logs written by the LoggingAnalyser. A
+log is a current segment at the log path and the segments rotated out of it
+at the log path with a numeric suffix. Each segment is a series of blocks
+of (header, payload) frames, compressed separately with zlib if the log
+path ends in .z, and has a side index giving the offset, length, timestamp
+range and pids of each of its blocks.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import collections
+import glob
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from . import messaging
+
+
+INDEX_SUFFIX = ".idx"
+INDEX_ENTRY = struct.Struct(str("<QQQQI"))
+
+IndexEntry = collections.namedtuple('IndexEntry',
+                                    'offset length min_ts max_ts pids')
+
+
+def index_path(seg_path):
+    '''Returns the path of the side index of a segment.'''
+    return seg_path + INDEX_SUFFIX
+
+
+def is_compressed(log_path):
+    '''Returns whether a log is written with zlib compressed blocks.'''
+    return log_path.endswith(".z")
+
+
+def segments(log_path):
+    '''Returns the segment paths of a log, oldest first.'''
+    rotated = [path for path in glob.glob(log_path + ".[0-9]*")
+               if not path.endswith(INDEX_SUFFIX)]
+    rotated.sort(key=lambda path: int(path[len(log_path) + 1:]))
+    if os.path.exists(log_path):
+        rotated.append(log_path)
+    return rotated
+
+
+def rotate(log_path):
+    '''Move the current segment of a log and its index aside to the next
+    free numbered segment.'''
+    num = 1
+    while os.path.exists("%s.%06d" % (log_path, num)):
+        num += 1
+    seg_path = "%s.%06d" % (log_path, num)
+    os.rename(log_path, seg_path)
+    if os.path.exists(index_path(log_path)):
+        os.rename(index_path(log_path), index_path(seg_path))
+
+
+class IndexWriter(object):
+    '''Appends block entries to the side index of a segment.'''
+    def __init__(self, seg_path):
+        self.fp = open(index_path(seg_path), "ab")
+
+    def add_block(self, offset, length, min_ts, max_ts, pids):
+        '''Record a block written at offset.'''
+        pids = sorted(pids)
+        self.fp.write(INDEX_ENTRY.pack(offset, length, min_ts, max_ts,
+                                       len(pids)) +
+                      struct.pack(str("<%dQ" % len(pids)), *pids))
+
+    def sync(self):
+        '''Flush and sync the index.'''
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def read_index(seg_path):
+    '''Returns the block entries of a segment, or None if it has no index.
+    An entry torn by a crash ends the index.'''
+    if not os.path.exists(index_path(seg_path)):
+        return None
+    with open(index_path(seg_path), "rb") as fp:
+        data = fp.read()
+    entries = []
+    offset = 0
+    while offset + INDEX_ENTRY.size <= len(data):
+        blk_off, length, min_ts, max_ts, n_pids = \
+            INDEX_ENTRY.unpack_from(data, offset)
+        offset += INDEX_ENTRY.size
+        if offset + 8 * n_pids > len(data):
+            break
+        pids = frozenset(struct.unpack_from(str("<%dQ" % n_pids),
+                                            data, offset))
+        offset += 8 * n_pids
+        entries.append(IndexEntry(blk_off, length, min_ts, max_ts, pids))
+    return entries
+
+
+def iter_frames(data):
+    '''Yields the header object, header and payload of each frame in a block
+    of data.'''
+    hdr_len = messaging.Header.length
+    offset = 0
+    while offset + hdr_len <= len(data):
+        hdr = data[offset:offset + hdr_len]
+        hdr_obj = messaging.Header()
+        hdr_obj.loads(hdr)
+        end = offset + hdr_len + hdr_obj.payload_len
+        if end > len(data):
+            logging.error("Log block ends in a torn message.")
+            break
+        yield hdr_obj, hdr, data[offset + hdr_len:end]
+        offset = end
+
+
+class ZlibReader(object):
+    '''Reads the concatenated zlib streams of a compressed log as one
+    stream of data. tell() gives the offset in the compressed file.'''
+    CHUNK = 1024 * 1024
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.decomp = zlib.decompressobj()
+        self.buf = b''
+        self.pos = 0
+
+    def read(self, size):
+        while len(self.buf) - self.pos < size:
+            data = self.decomp.unused_data or self.fp.read(self.CHUNK)
+            if not data:
+                break
+            if self.decomp.unused_data:
+                self.decomp = zlib.decompressobj()
+            self.buf = self.buf[self.pos:] + self.decomp.decompress(data)
+            self.pos = 0
+        ret = self.buf[self.pos:self.pos + size]
+        self.pos += len(ret)
+        return ret
+
+    def tell(self):
+        return self.fp.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fp.close()
+
+
+def _scan_segment(seg_path, compressed):
+    '''Yields the frames of a segment without an index along with the
+    offset in the segment after each one.'''
+    hdr_len = messaging.Header.length
+    fp = open(seg_path, "rb")
+    if compressed:
+        fp = ZlibReader(fp)
+    with fp:
+        while True:
+            hdr = fp.read(hdr_len)
+            if len(hdr) < hdr_len:
+                break
+            hdr_obj = messaging.Header()
+            hdr_obj.loads(hdr)
+            pay = fp.read(hdr_obj.payload_len)
+            if len(pay) < hdr_obj.payload_len:
+                logging.error("Log %s ends in a torn message.", seg_path)
+                break
+            yield hdr_obj, hdr, pay, fp.tell()
+
+
+class LogReader(object):
+    '''Reads the messages of a log, using the segment indexes to read only
+    the blocks that may hold messages in a timestamp range or from a set of
+    pids.'''
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.compressed = is_compressed(log_path)
+        self.segments = segments(log_path)
+
+    def total_size(self):
+        '''Returns the combined size of the segments in bytes.'''
+        return sum(os.path.getsize(path) for path in self.segments)
+
+    def iter_msgs(self, start_ts=None, end_ts=None, pids=None):
+        '''Yields the (header, payload) messages of the log with timestamps
+        in [start_ts, end_ts] sent by pids, along with the position in the
+        log reached, in bytes over all segments.'''
+        base = 0
+        for seg_path in self.segments:
+            for hdr_obj, hdr, pay, pos in self._iter_segment(seg_path,
+                                                             start_ts,
+                                                             end_ts, pids):
+                if start_ts is not None and hdr_obj.timestamp < start_ts:
+                    continue
+                if end_ts is not None and hdr_obj.timestamp > end_ts:
+                    continue
+                if pids is not None and hdr_obj.pid not in pids:
+                    continue
+                yield (hdr, pay), base + pos
+            base += os.path.getsize(seg_path)
+
+    def _iter_segment(self, seg_path, start_ts, end_ts, pids):
+        '''Yields the frames of the blocks of a segment that may match.'''
+        entries = read_index(seg_path)
+        if entries is None:
+            for frame in _scan_segment(seg_path, self.compressed):
+                yield frame
+            return
+        if os.path.getsize(seg_path) == 0:
+            return
+
+        with open(seg_path, "rb") as fp:
+            seg = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for entry in entries:
+                if start_ts is not None and entry.max_ts < start_ts:
+                    continue
+                if end_ts is not None and entry.min_ts > end_ts:
+                    continue
+                if pids is not None and not entry.pids & pids:
+                    continue
+                data = seg[entry.offset:entry.offset + entry.length]
+                if self.compressed:
+                    try:
+                        data = zlib.decompress(data)
+                    except zlib.error:
+                        logging.error("Log %s ends in a torn block.",
+                                      seg_path)
+                        return
+                pos = entry.offset + entry.length
+                for hdr_obj, hdr, pay in iter_frames(data):
+                    yield hdr_obj, hdr, pay, pos
+        finally:
+            seg.close()
@@ -9,6 +9,7 @@ import os
 import psutil
 
 from .. import config, server_start, utils
+from ..ext_deps import yaml
 
 
 def get_current_shell():
@@ -19,6 +20,21 @@ def get_current_shell():
     return cur_shell, shell_args
 
 
+def uses_shm_transport(cfg):
+    '''Returns whether the server reads UDS clients through shared memory
+    rings.'''
+    server_cfg_path = utils.path_normalise(os.path.join(cfg['install_dir'],
+                                                        "opus-cfg.yaml"))
+    try:
+        with open(server_cfg_path, "r") as server_cfg:
+            server_cfg = yaml.safe_load(server_cfg)
+        prod_cfg = server_cfg['PRODUCER'][server_cfg['MODULES']['Producer']]
+    except (IOError, KeyError, TypeError):
+        return False
+    return (prod_cfg.get('comm_mgr_type') ==
+            "SharedMemoryCommunicationManager")
+
+
 @config.auto_read_config
 def handle_launch(cfg, binary, arguments):
     if not utils.is_server_active(cfg=cfg):
@@ -39,7 +55,10 @@ def handle_launch(cfg, binary, arguments):
 
     if cfg['server_addr'][:4] == "unix":
         os.environ['OPUS_UDS_PATH'] = utils.path_normalise(cfg['server_addr'][7:])
-        os.environ['OPUS_PROV_COMM_MODE'] = cfg['server_addr'][:4]
+        if uses_shm_transport(cfg):
+            os.environ['OPUS_PROV_COMM_MODE'] = "shm"
+        else:
+            os.environ['OPUS_PROV_COMM_MODE'] = cfg['server_addr'][:4]
     else:
         os.environ['OPUS_PROV_COMM_MODE'] = cfg['server_addr'][:3]
         addr = cfg['server_addr'][6:].split(":")
@@ -49,6 +68,7 @@ def handle_launch(cfg, binary, arguments):
     os.environ['OPUS_MAX_AGGR_MSG_SIZE'] = "65536"
     os.environ['OPUS_LOG_LEVEL'] = "3"  # Log critical
     os.environ['OPUS_INTERPOSE_MODE'] = "1"  # OPUS lite
+    os.environ['OPUS_PROTOCOL_VERSION'] = "2"
 
     if not binary:
         binary, arguments = get_current_shell()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+Replay a message log written by the logging analyser into a database.
+'''
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+
+from .. import config, utils
+from ..ext_deps import yaml
+
+
+def _format_eta(secs):
+    m, s = divmod(int(secs), 60)
+    h, m = divmod(m, 60)
+    return "{:02d}:{:02d}:{:02d}".format(h, m, s)
+
+
+def _make_progress():
+    start = time.time()
+
+    def progress(done, total, msgs):
+        elapsed = time.time() - start
+        rate = msgs / elapsed if elapsed > 0 else 0
+        if done > 0 and done < total:
+            eta = _format_eta(elapsed * (total - done) / done)
+        else:
+            eta = ""
+        print(" " * 70, end="\r")
+        print("{:.2f}% {:d} msgs {:.0f}/s {}".format(
+            (done / total) * 100 if total else 100, msgs, rate, eta),
+            end="\r")
+        sys.stdout.flush()
+    return progress
+
+
+@config.auto_read_config
+def handle(cfg, log, db, window, txn_size, presort, sort_chunk,
+           start, end, pid):
+    db_path = utils.path_normalise(db if db is not None else cfg['db_path'])
+    if (db_path == utils.path_normalise(cfg['db_path']) and
+            utils.is_server_active(cfg=cfg)):
+        print("The OPUS server is using {}, stop it or choose another "
+              "database with --db.".format(db_path))
+        return
+
+    server_cfg_path = utils.path_normalise(os.path.join(cfg['install_dir'],
+                                                        "opus-cfg.yaml"))
+    with open(server_cfg_path, "r") as server_cfg:
+        neo4j_cfg = yaml.safe_load(server_cfg)['NEO4J_PARAMS']
+
+    if 'JAVA_HOME' not in os.environ:
+        os.environ['JAVA_HOME'] = cfg['java_home']
+    os.environ['PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION'] = 'cpp'
+    os.environ['PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION_VERSION'] = '2'
+    from ... import replay
+
+    from ... import msglog
+
+    log = utils.path_normalise(log)
+    index_path = None
+    if presort:
+        if (len(msglog.segments(log)) != 1 or msglog.is_compressed(log) or
+                start is not None or end is not None or pid):
+            print("--presort takes a single uncompressed log segment and "
+                  "no filters.")
+            return
+        try:
+            from ... import logsort
+        except ImportError:
+            print("Sorting a log requires the numpy module.")
+            return
+        index_path = log + ".idx"
+        print("Sorting {}...".format(log))
+        count = logsort.sort_log(log, index_path, sort_chunk)
+        print("Indexed {:d} msgs in time order.".format(count))
+
+    replayer = replay.LogReplayer(log,
+                                  {'filename': db_path},
+                                  neo4j_cfg,
+                                  window=window,
+                                  txn_size=txn_size,
+                                  index_path=index_path,
+                                  start_ts=start,
+                                  end_ts=end,
+                                  pids=set(pid) if pid else None)
+    start = time.time()
+    msgs = replayer.run(progress=_make_progress())
+    elapsed = time.time() - start
+    print()
+    print("Replayed {:d} msgs in {:.1f}s, {:.0f} msgs/s.".format(
+        msgs, elapsed, msgs / elapsed if elapsed > 0 else 0))
+
+
+def setup_parser(parser):
+    parser.add_argument(
+        "log",
+        help="Path to the message log to replay.")
+    parser.add_argument(
+        "--db", default=None,
+        help="Database to replay into, defaults to the OPUS database.")
+    parser.add_argument(
+        "--window", type=int, default=10000,
+        help="Number of messages to reorder by timestamp at once.")
+    parser.add_argument(
+        "--txn-size", type=int, default=1000,
+        help="Number of messages applied in each transaction.")
+    parser.add_argument(
+        "--start", type=int, default=None,
+        help="Replay only messages with timestamps from this one on.")
+    parser.add_argument(
+        "--end", type=int, default=None,
+        help="Replay only messages with timestamps up to this one.")
+    parser.add_argument(
+        "--pid", type=int, action="append", default=[],
+        help="Replay only messages from this pid, may be repeated.")
+    parser.add_argument(
+        "--presort", action="store_true",
+        help="Sort the whole log by timestamp on disk before replaying it "
+        "rather than reordering within a window. Requires numpy.")
+    parser.add_argument(
+        "--sort-chunk", type=int, default=5000000,
+        help="Number of messages sorted in memory at once by --presort.")
@@ -42,8 +42,7 @@ def monitor_shutdown(helper, msg):
     print("Shutdown initiated.")
     print("Shutting down Producer...", end="")
     try:
-        while True:
-            ret = helper.make_request({"cmd": "status"})
+        for ret in helper.subscribe({"cmd": "status"}, 0.5):
             if ret['producer']['status'] == "Dead":
                 break
     except exception.BackendConnectionError:
@@ -54,8 +53,7 @@ def monitor_shutdown(helper, msg):
     total_msgs = msg['msg_count']
     if total_msgs > 0:
         try:
-            while True:
-                ret = helper.make_request({"cmd": "status"})
+            for ret in helper.subscribe({"cmd": "status"}, 2.0):
                 if ret['analyser']['status'] == 'Dead':
                     break
                 cur_msg = ret['analyser']['num_msgs']
@@ -69,8 +67,6 @@ def monitor_shutdown(helper, msg):
                                                   rem_time),
                       end="\r")
                 sys.stdout.flush()
-
-                time.sleep(2)
         except exception.BackendConnectionError:
             pass
         print(" "*50, end="\r")
@@ -83,18 +79,18 @@ def _rewind(n):
 
 
 def monitor_status(helper, follow):
-    pay = helper.make_request({'cmd': 'status'})
-    print_status_rsp(pay)
-    n = (len(pay) - 1) + (len(pay['analyser']) - 1)
-    while follow:
-        _rewind(n)
-        print("\n".join([" "*50]*n))
-        _rewind(n)
-        pay = helper.make_request({'cmd': 'status'})
+    if not follow:
+        print_status_rsp(helper.make_request({'cmd': 'status'}))
+        return
+    n = 0
+    for pay in helper.subscribe({'cmd': 'status'}, 1.0):
+        if n:
+            _rewind(n)
+            print("\n".join([" "*50]*n))
+            _rewind(n)
         print_status_rsp(pay)
         n = (len(pay) - 1) + (len(pay['analyser']) - 1)
         sys.stdout.flush()
-        time.sleep(1)
 
 
 def print_status_rsp(pay):
@@ -105,14 +101,98 @@ def print_status_rsp(pay):
     print("{0:<20} {1:<12}".format("Analyser", tmp_an['status']))
     if 'num_msgs' in tmp_an:
         print("    {:d} msgs in queue".format(tmp_an['num_msgs']))
+    if tmp_an.get('num_spilled'):
+        print("    {:d} msgs spilled to disk".format(tmp_an['num_spilled']))
     if 'inbound_rate' in tmp_an:
         print("    {:.1f}/s msgs added".format(tmp_an['inbound_rate']))
     if 'outbound_rate' in tmp_an:
         print("    {:.1f}/s msgs processed".format(tmp_an['outbound_rate']))
+    if 'decode_time' in tmp_an:
+        print("    {:.1f}s decoding, {:.1f}s applying".format(
+            tmp_an['decode_time'], tmp_an['apply_time']))
 
     print("{0:<20} {1:<12}".format("Query Interface", pay['query']['status']))
 
 
+def print_conn_stats(conn_stats):
+    '''Prints the traffic of each client connection to stdout'''
+    tab = prettytable.PrettyTable(['Pid',
+                                   'Tid',
+                                   'Protocol',
+                                   'zlib Level',
+                                   'Msgs',
+                                   'Wire B/msg',
+                                   'Raw B/msg',
+                                   'Ratio',
+                                   'Inflate us/msg'])
+    print("\nConnections:\n\n")
+    for stats in sorted(conn_stats, key=lambda s: (s['pid'], s['tid'])):
+        msgs = max(stats['msgs'], 1)
+        tab.add_row([stats['pid'],
+                     stats['tid'],
+                     stats.get('protocol',
+                               "v2" if stats['compact'] else "v1"),
+                     stats['compression'] if stats['compression'] else "-",
+                     stats['msgs'],
+                     "{:.1f}".format(stats['wire_bytes'] / msgs),
+                     "{:.1f}".format(stats['raw_bytes'] / msgs),
+                     "{:.2f}".format(stats['raw_bytes'] /
+                                     max(stats['wire_bytes'], 1)),
+                     "{:.2f}".format(stats['inflate_time'] * 1e6 / msgs)])
+    print(tab)
+
+
+def print_offenders(offenders):
+    '''Prints the processes shed by admission control to stdout'''
+    tab = prettytable.PrettyTable(['Pid',
+                                   'Binary',
+                                   'Stage',
+                                   'Coalesced',
+                                   'Dropped'])
+    print("\nRate Limited Processes:\n\n")
+    for offender in sorted(offenders, key=lambda o: o['pid']):
+        tab.add_row([offender['pid'],
+                     offender['binary'] or "-",
+                     offender['stage'],
+                     offender['coalesced'],
+                     offender['dropped']])
+    print(tab)
+
+
+def print_query_jobs(jobs):
+    '''Prints the query jobs of the analyser to stdout'''
+    tab = prettytable.PrettyTable(['Job',
+                                   'Method',
+                                   'State',
+                                   'Elapsed',
+                                   'Rows',
+                                   'Chunks'])
+    print("Query Jobs:\n\n")
+    for job in jobs:
+        tab.add_row([job['job_id'],
+                     job['qry_method'],
+                     job['state'],
+                     "{:.2f}s".format(job['elapsed']),
+                     job['rows'],
+                     job['chunks']])
+    print(tab)
+
+
+def print_filter_stats(rules):
+    '''Prints the calls removed by each producer filter rule to stdout'''
+    tab = prettytable.PrettyTable(['Rule',
+                                   'Action',
+                                   'Calls',
+                                   'Bytes'])
+    print("Filter Rules:\n\n")
+    for rule in rules:
+        tab.add_row([rule['name'],
+                     rule['action'],
+                     rule['calls'],
+                     rule['bytes']])
+    print(tab)
+
+
 @config.auto_read_config
 def handle(cfg, cmd, **params):
     helper = cc_utils.CommandConnectionHelper(cfg['cc_addr'])
@@ -134,7 +214,12 @@ def handle(cfg, cmd, **params):
         if not utils.is_server_active(helper=helper):
             print("Server is not running.")
             return
-        msg = {"cmd": cmd}
+        if cmd == "jobs":
+            msg = {"cmd": "query_status"}
+        elif cmd == "cancel":
+            msg = {"cmd": "query_cancel"}
+        else:
+            msg = {"cmd": cmd}
         msg.update(params)
         pay = helper.make_request(msg)
 
@@ -155,6 +240,20 @@ def handle(cfg, cmd, **params):
                     )
                 tab.add_row([pid, cmd_line, count])
             print(tab)
+            if pay.get('offenders'):
+                print_offenders(pay['offenders'])
+            if 'conn_stats' in pay:
+                print_conn_stats(pay['conn_stats'])
+        elif cmd == "filters":
+            print_filter_stats(pay['rules'])
+        elif cmd == "jobs":
+            print_query_jobs(pay['jobs'])
+        elif cmd == "cancel":
+            if pay['job']['state'] == "CANCELLED":
+                print("Query job {} cancelled.".format(pay['job']['job_id']))
+            else:
+                print("Query job {} will stop at its next database "
+                      "query.".format(pay['job']['job_id']))
         else:
             print(pay['msg'])
 
@@ -177,9 +276,12 @@ def setup_parser(parser):
     cmds.add_parser(
         "restart",
         help="Restart the OPUS provenance collection server.")
-    cmds.add_parser(
+    ps_parser = cmds.add_parser(
         "ps",
         help="Display a list of processes currently being interposed.")
+    ps_parser.add_argument(
+        "--conns", action="store_true",
+        help="Also display the traffic and compression of each connection.")
 
     status_parser = cmds.add_parser(
         "status",
@@ -195,6 +297,24 @@ def setup_parser(parser):
         "pid", type=int,
         help="The PID requiring interposition deactivation.")
 
+    filters_parser = cmds.add_parser(
+        "filters",
+        help="Display the calls removed by each producer filter rule.")
+    filters_parser.add_argument(
+        "--reload", action="store_true",
+        help="Read the filter rules again before displaying them.")
+
+    cmds.add_parser(
+        "jobs",
+        help="Display the query jobs of the analyser.")
+
+    cancel_parser = cmds.add_parser(
+        "cancel",
+        help="Cancel a query job.")
+    cancel_parser.add_argument(
+        "job_id", type=int,
+        help="The id of the query job to cancel.")
+
     cmds.add_parser("getan")
 
     setan_parser = cmds.add_parser("setan")
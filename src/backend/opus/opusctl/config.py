@@ -84,11 +84,30 @@ MODULES:
 
 PRODUCER:
   SocketProducer:
+    # SharedMemoryCommunicationManager reads UDS clients through shared
+    # memory rings, RelayCommunicationManager reads relay backends on a
+    # central backend.
     comm_mgr_type: MultiCommunicationManager
     comm_mgr_args:
         addr: {server_addr}
         max_conn: 10
         select_timeout: 5.0
+        # Uncomment to rate limit the calls of each process and binary.
+        # admission:
+        #   pid_rate: 20000
+        #   binary_rate: 50000
+        #   drop_after: 10.0
+        #   detach_after: 60.0
+    # Uncomment to drop or summarise messages by the rules of a rule file.
+    # filter_file: {opus_home}/filters.yaml
+    # summary_interval: 60.0
+  # Use as the Producer module to read connections in several processes.
+  ShardedProducer:
+    shards: 4
+    comm_mgr_args:
+        addr: {server_addr}
+        max_conn: 1024
+        select_timeout: 1.0
 
 ANALYSER:
   StatisticsAnalyser:
@@ -96,7 +115,18 @@ ANALYSER:
     storage_args:
       filename: {db_path}
     opus_lite: true
+    io_chain_horizon: 60.0
+    decode_stage: false
+    orderer_window: 50
+    orderer_mem_budget: 512
     opus_snapshot_dir: {opus_home}
+  # Use as the Analyser module to relay this host to a central backend.
+  RelayAnalyser:
+    central_addr: tcp://localhost:10200
+    spool_dir: {opus_home}/relay_spool
+    batch_size: 64
+    batch_interval: 0.5
+    compress_level: 1
 
 ANALYSER_CONTROLLER:
   mem_mon_params:
@@ -107,6 +137,11 @@ ANALYSER_CONTROLLER:
     jvm_usage_threshold: 0.90
     min_percent_avail_mem: 0.25
     max_rss_percent_mem: 0.35
+  # cmd_threads: 4
+  # query_jobs:
+  #   max_jobs: 2
+  #   chunk_rows: 500
+  #   keep_secs: 600.0
 
 NEO4J_PARAMS:
   max_jvm_heap_size: default
@@ -123,8 +158,17 @@ NEO4J_PARAMS:
   keep_logical_logs: false
   cache_type: weak
 
+# Uncomment to journal incoming messages for replay after a crash.
+# JOURNAL:
+#   journal_dir: {opus_home}/journal
+#   segment_size: 64
+#   sync_interval: 0.0
+#   checkpoint_interval: 1.0
+
 COMMAND:
   listen_addr: {cc_addr}
+  # worker_threads: 4
+  # min_interval: 0.1
 
 GENERAL:
   touch_file: {touch_file}
@@ -6,7 +6,7 @@ import sys
 
 from . import config
 
-from .cmds import conf, process, server, util
+from .cmds import conf, process, replay, server, util
 
 
 def make_parser():
@@ -18,7 +18,7 @@ def make_parser():
                         help="Print verbose errors.")
 
     group_parser = parser.add_subparsers(dest="group")
-    for cmd in [conf, process, server, util]:
+    for cmd in [conf, process, replay, server, util]:
         name = cmd.__name__.split(".")[-1]
         doc = cmd.__doc__.strip()
         cmd_parse = group_parser.add_parser(name, help=doc)
@@ -44,6 +44,8 @@ def run():
             conf.handle(**params)
         elif args.group == "util":
             util.handle(**params)
+        elif args.group == "replay":
+            replay.handle(**params)
     except config.FailedConfigError:
         print("Failed to execute command due to insufficient configuration. "
               "Please run the '{} conf' command "
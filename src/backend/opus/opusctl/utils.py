@@ -43,7 +43,9 @@ def reset_opus_env(cfg):
                  'OPUS_UDS_PATH',
                  'OPUS_MSG_AGGR',
                  'OPUS_MAX_AGGR_MSG_SIZE',
-                 'OPUS_LOG_LEVEL']
+                 'OPUS_LOG_LEVEL',
+                 'OPUS_SHM_RING_SIZE',
+                 'OPUS_PROTOCOL_VERSION']
     for var in opus_vars:
         if var in os.environ:
             del os.environ[var]
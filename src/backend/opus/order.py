@@ -6,10 +6,30 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import Queue
+import glob
+import heapq
+import logging
+import mmap
+import os
+import struct
+import tempfile
 import threading
 import time
 
-from .exception import QueueClearingException
+from .exception import OPUSException, QueueClearingException
+from .journal import JournalMsg
+
+
+RUN_PREFIX = ".opus_orderer_run_"
+RUN_RECORD = struct.Struct(str("<QqII"))
+
+DUMP_MAGIC = b"OPUSMQ\x00\x02"
+DUMP_BLOCK = struct.Struct(str("<IQ"))
+DUMP_BLOCK_MSGS = 65536
+
+# Rough per message cost of the tuples and string objects holding a queued
+# message, on top of the length of its header and payload.
+_ENTRY_OVERHEAD = 160
 
 
 def _cur_time():
@@ -17,11 +37,148 @@ def _cur_time():
     return time.clock_gettime(time.CLOCK_MONOTONIC_RAW) * 1000000
 
 
+class SortedRun(object):
+    '''A run of messages spilled to a segment file in priority order and
+    read back through an mmap. Each record is a (priority, journal sequence
+    number, header length, payload length) tuple followed by the header and
+    payload. Messages without a sequence number are stored with -1.'''
+    def __init__(self, spill_dir, msgs):
+        fd, self.path = tempfile.mkstemp(prefix=RUN_PREFIX, dir=spill_dir)
+        try:
+            with os.fdopen(fd, "wb", 1024 * 1024) as fp:
+                for pri, msg in msgs:
+                    hdr, pay = msg
+                    seq = getattr(msg, 'journal_seq', None)
+                    fp.write(RUN_RECORD.pack(pri, -1 if seq is None else seq,
+                                             len(hdr), len(pay)))
+                    fp.write(hdr)
+                    fp.write(pay)
+            with open(self.path, "rb") as fp:
+                self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError) as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("Could not spill orderer run to disk")
+        self.size = len(msgs)
+        self.offset = 0
+        self.head = None
+        self.advance()
+
+    def advance(self):
+        '''Read the next record of the run into head, returning False once
+        the run is exhausted.'''
+        if self.offset >= len(self.map):
+            self.head = None
+            return False
+        pri, seq, hdr_len, pay_len = RUN_RECORD.unpack_from(self.map,
+                                                             self.offset)
+        start = self.offset + RUN_RECORD.size
+        mid = start + hdr_len
+        self.offset = mid + pay_len
+        msg = (self.map[start:mid], self.map[mid:self.offset])
+        if seq >= 0:
+            msg = JournalMsg(msg, seq)
+        self.head = (pri, msg)
+        self.size -= 1
+        return True
+
+    def close(self):
+        '''Unmap and remove the segment file.'''
+        self.map.close()
+        os.unlink(self.path)
+
+
+class QueueDumpWriter(object):
+    '''Writes the messages of a queue to a dump file in blocks. Each block
+    is a (message count, data length) pair, an index of the priorities,
+    header lengths and payload lengths of its messages and then their
+    concatenated headers and payloads.'''
+    def __init__(self, path):
+        self.fp = open(path, "wb")
+        self.fp.write(DUMP_MAGIC)
+        self.pris = []
+        self.hdr_lens = []
+        self.pay_lens = []
+        self.data = []
+        self.data_len = 0
+
+    def write(self, pri, hdr, pay):
+        '''Add a message to the current block.'''
+        self.pris.append(pri)
+        self.hdr_lens.append(len(hdr))
+        self.pay_lens.append(len(pay))
+        self.data.append(hdr)
+        self.data.append(pay)
+        self.data_len += len(hdr) + len(pay)
+        if len(self.pris) >= DUMP_BLOCK_MSGS:
+            self.flush()
+
+    def flush(self):
+        '''Write out the current block.'''
+        count = len(self.pris)
+        if count == 0:
+            return
+        self.fp.write(DUMP_BLOCK.pack(count, self.data_len) +
+                      struct.pack(str("<%dQ" % count), *self.pris) +
+                      struct.pack(str("<%dI" % count), *self.hdr_lens) +
+                      struct.pack(str("<%dI" % count), *self.pay_lens))
+        self.fp.write(b"".join(self.data))
+        self.pris = []
+        self.hdr_lens = []
+        self.pay_lens = []
+        self.data = []
+        self.data_len = 0
+
+    def close(self):
+        '''Write out the last block and sync the file to disk.'''
+        self.flush()
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+
+
+def is_queue_dump(path):
+    '''Returns whether the file at path was written by a QueueDumpWriter.'''
+    with open(path, "rb") as fp:
+        return fp.read(len(DUMP_MAGIC)) == DUMP_MAGIC
+
+
+def read_queue_dump(path):
+    '''Returns the (priority, (header, payload)) messages of a queue dump
+    in the order they were written.'''
+    msgs = []
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size <= len(DUMP_MAGIC):
+            return msgs
+        dump = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = len(DUMP_MAGIC)
+        while offset < len(dump):
+            count, data_len = DUMP_BLOCK.unpack_from(dump, offset)
+            offset += DUMP_BLOCK.size
+            pris = struct.unpack_from(str("<%dQ" % count), dump, offset)
+            offset += 8 * count
+            hdr_lens = struct.unpack_from(str("<%dI" % count), dump, offset)
+            offset += 4 * count
+            pay_lens = struct.unpack_from(str("<%dI" % count), dump, offset)
+            offset += 4 * count
+            for pri, hdr_len, pay_len in zip(pris, hdr_lens, pay_lens):
+                mid = offset + hdr_len
+                end = mid + pay_len
+                msgs.append((pri, (dump[offset:mid], dump[mid:end])))
+                offset = end
+    finally:
+        dump.close()
+    return msgs
+
+
 class EventOrderer(object):
-    '''In memory priority queue to order messages'''
+    '''In memory priority queue to order messages. If given a spill_dir and
+    a mem_budget in bytes, messages beyond the budget are spilled to sorted
+    runs in spill_dir which are merged back with the in memory queue on
+    pop.'''
     _EMWA_CONSTANT = 0.9
 
-    def __init__(self, max_wind):
+    def __init__(self, max_wind, spill_dir=None, mem_budget=None):
         super(EventOrderer, self).__init__()
         self.priority_queue = Queue.PriorityQueue()
         self.q_over_min = threading.Condition()
@@ -30,6 +187,47 @@ class EventOrderer(object):
         self.inter = 1
         self.min_inter = 100000
         self.clearing = False
+        self.spill_dir = spill_dir
+        self.mem_budget = mem_budget
+        self.mem_used = 0
+        self.runs = []
+        self.spilled = 0
+        self.in_flight = None  # Priority popped and not yet marked done
+        if self.spill_dir is not None:
+            self._remove_stale_runs()
+
+    def _remove_stale_runs(self):
+        '''Remove runs left behind by an orderer that was not cleared.'''
+        for path in glob.glob(os.path.join(self.spill_dir, RUN_PREFIX + "*")):
+            os.unlink(path)
+
+    def _queue_size(self):
+        '''Number of messages in memory and spilled.'''
+        return self.priority_queue.qsize() + self.spilled
+
+    def _spill(self):
+        '''Write the in memory queue out as a new sorted run.'''
+        msgs = []
+        while not self.priority_queue.empty():
+            msgs.append(self.priority_queue.get(False))
+        run = SortedRun(self.spill_dir, msgs)
+        heapq.heappush(self.runs, (run.head[0], run.path, run))
+        self.spilled += len(msgs)
+        self.mem_used = 0
+        if __debug__:
+            logging.debug("Spilled %d messages to %s, %d runs pending.",
+                          len(msgs), run.path, len(self.runs))
+
+    def _pop_run(self):
+        '''Pop the head of the run with the lowest priority head.'''
+        _, _, run = heapq.heappop(self.runs)
+        item = run.head
+        self.spilled -= 1
+        if run.advance():
+            heapq.heappush(self.runs, (run.head[0], run.path, run))
+        else:
+            run.close()
+        return item
 
     def _update_inter(self):
         '''Update the queues interval count.'''
@@ -49,7 +247,7 @@ class EventOrderer(object):
     def _extract_cond(self):
         '''Evaluate the extraction condition, queue_size > min_window'''
         return (self.clearing or
-                self.priority_queue.qsize() > self._window_size())
+                self._queue_size() > self._window_size())
 
     def push(self, msgs):
         '''Push a list of messages msgs onto the queue.'''
@@ -58,18 +256,70 @@ class EventOrderer(object):
                 raise QueueClearingException()
             for (pri, val) in msgs:
                 self.priority_queue.put((pri, val), False)
+                if self.mem_budget is not None:
+                    self.mem_used += (len(val[0]) + len(val[1]) +
+                                      _ENTRY_OVERHEAD)
+            if self.mem_budget is not None and self.mem_used > self.mem_budget:
+                self._spill()
             self._update_inter()
             if self._extract_cond():
                 self.q_over_min.notify()
 
+    def push_bulk(self, msgs):
+        '''Push a large list of messages msgs onto the queue at once,
+        reordering the queue once rather than per message. Used to restore
+        a queue and so does not update the interval estimate.'''
+        with self.q_over_min:
+            if self.clearing:
+                raise QueueClearingException()
+            # Queue.PriorityQueue keeps its heap in the queue attribute.
+            heap = self.priority_queue.queue
+            heap.extend(msgs)
+            heapq.heapify(heap)
+            if self.mem_budget is not None:
+                self.mem_used += sum(len(val[0]) + len(val[1])
+                                     for _, val in msgs)
+                self.mem_used += _ENTRY_OVERHEAD * len(msgs)
+                if self.mem_used > self.mem_budget:
+                    self._spill()
+            if self._extract_cond():
+                self.q_over_min.notify()
+
     def pop(self):
         '''Pop the message from the queue with the lowest priority.'''
         with self.q_over_min:
             while not self._extract_cond():
                 self.q_over_min.wait()
-            item = self.priority_queue.get(False)
+            if self.runs and (self.priority_queue.empty() or
+                              self.runs[0][0] < self.priority_queue.queue[0][0]):
+                item = self._pop_run()
+            else:
+                item = self.priority_queue.get(False)
+                if self.mem_budget is not None:
+                    self.mem_used -= (len(item[1][0]) + len(item[1][1]) +
+                                      _ENTRY_OVERHEAD)
+            self.in_flight = item[0]
             return item
 
+    def pop_done(self):
+        '''Mark the message last popped as handled.'''
+        with self.q_over_min:
+            self.in_flight = None
+
+    def front(self):
+        '''Returns the priority of the message popped and not yet marked
+        done, or else of the message pop would return without waiting, or
+        None if there is neither.'''
+        with self.q_over_min:
+            if self.in_flight is not None:
+                return self.in_flight
+            if not self._extract_cond():
+                return None
+            heads = [run[0] for run in self.runs[:1]]
+            if not self.priority_queue.empty():
+                heads.append(self.priority_queue.queue[0][0])
+            return min(heads) if heads else None
+
     def start_clear(self):
         '''Clear the queue of message returning all remaining messages as a
         list.'''
@@ -84,4 +334,8 @@ class EventOrderer(object):
 
     def get_queue_size(self):
         '''Returns queue size'''
-        return self.priority_queue.qsize()
+        return self._queue_size()
+
+    def get_spilled_size(self):
+        '''Returns the number of messages held in spilled runs.'''
+        return self.spilled
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 '''
 This module wraps the python Queue class with helper methods
-necessary to work in a single producer and consumer scenario.
+necessary to work in a single producer and consumer scenario. A queue may
+be split into shards so that several producer processes can each enqueue on
+their own queue.
 '''
 
 from __future__ import (absolute_import, division,
@@ -9,39 +11,55 @@ from __future__ import (absolute_import, division,
 
 import logging
 import collections
+import Queue
 
 from multiprocessing import Queue as MPQueue, Event, Condition
 
 class ProducerFetcherQueue(object):
     '''Wrapper around multiprocessing Queue'''
 
-    def __init__(self):
+    def __init__(self, shards=1):
         super(ProducerFetcherQueue, self).__init__()
-        self.pf_queue = MPQueue()
+        self.pf_queues = [MPQueue() for _ in range(shards)]
+        self.next_shard = 0
         self.pfq_cond = Condition()
         self.clear_event = Event()
         self.event_exe = collections.namedtuple('Event', 'event excep')
 
-    def enqueue(self, msg):
+    def enqueue(self, msg, shard=0):
         with self.pfq_cond:
             if self.clear_event.is_set():
                 if __debug__:
                     logging.debug("Cannot enqueue, queue is in clearing mode")
                 return
-            self.pf_queue.put(msg)
+            self.pf_queues[shard].put(msg)
             self.pfq_cond.notify()
 
     def dequeue(self):
         with self.pfq_cond:
             while not (self.clear_event.is_set() or
                        self.event_exe.event.is_set() or
-                       self.pf_queue.qsize() > 0):
+                       self.get_queue_size() > 0):
                 if __debug__:
                     logging.debug("Waiting on queue condition")
                 self.pfq_cond.wait()
             if self.event_exe.event.is_set():
                 raise self.event_exe.excep
-            return self.pf_queue.get(False)
+            return self._get_next()
+
+    def _get_next(self):
+        '''Takes the next item from the shards in turn, raising Queue.Empty
+        if every shard is empty.'''
+        num_shards = len(self.pf_queues)
+        for i in range(num_shards):
+            shard = (self.next_shard + i) % num_shards
+            try:
+                msg = self.pf_queues[shard].get(False)
+            except Queue.Empty:
+                continue
+            self.next_shard = (shard + 1) % num_shards
+            return msg
+        raise Queue.Empty()
 
     def start_clear(self):
         with self.pfq_cond:
@@ -58,4 +76,4 @@ class ProducerFetcherQueue(object):
         self.pfq_cond.notify()
 
     def get_queue_size(self):
-        return self.pf_queue.qsize()
+        return sum(pf_queue.qsize() for pf_queue in self.pf_queues)
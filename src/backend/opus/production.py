@@ -10,18 +10,47 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 
+import collections
 import errno
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.reduction
+import os
 import select
 import socket
 import struct
 import threading
 import time
+import zlib
 
-from . import common_utils, ipc, messaging, multisocket, opuspb, uds_msg_pb2
+from . import (common_utils, filtering, ipc, messaging, multisocket, opuspb,
+               relay, uds_msg_pb2)
+from .admission import AdmissionControl
 from .exception import OPUSException
 
 
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)  # From socket.h
+
+# Layout of a shared memory ring, must match struct RingHeader of the
+# interposition library.
+RING_MAGIC = struct.unpack(str("<Q"), b"OPUSRING")[0]
+RING_HDR = struct.Struct(str("<QQ"))  # magic, capacity
+RING_POS = struct.Struct(str("<Q"))
+RING_FLAG = struct.Struct(str("<I"))
+RING_HEAD_OFF = 64
+RING_TAIL_OFF = 128
+RING_WAITING_OFF = 192
+RING_CLOSED_OFF = 196
+RING_DATA_OFF = 256
+
+PROTOCOL_V2 = 2
+PROTOCOL_ACK_COMPRESSED = 0x80  # Set in the ack if compression is on
+COMPACT_RECV_SIZE = 65536
+HEADER = struct.Struct(str(messaging.Header.struct_string))
+UINT64_MASK = (1 << 64) - 1
+
+
 def get_credentials(client_fd):
     '''Reads the peer credentials from a UDS descriptor'''
     if not hasattr(get_credentials, "SO_PEERCRED"):
@@ -67,16 +96,39 @@ def create_close_conn_obj(sock_obj, pid):
 
 
 class SockReader(object):
-    '''Reads header and payload from a non-blocking socket'''
-
-    def __init__(self, sock_obj):
+    '''Reads header and payload from a non-blocking socket. A client that
+    opens with a protocol v2 hello asking for compact headers is
+    acknowledged and then read in compact mode, where each header is a
+    series of varints, the payload type and length followed by zigzag
+    deltas of the other fields from the previous header. Compact headers
+    are expanded back to full headers so that the rest of the backend sees
+    v1 messages. A compact client may also ask for its data to be sent in
+    a zlib stream below the framing, which is accepted if allow_compression
+    is set. The messages, bytes and decompression time of the connection
+    are counted for ps.'''
+
+    def __init__(self, sock_obj, pid=0, allow_compression=True):
         '''Initialize data members'''
         self.sock_obj = sock_obj
         self.buf_data = b''
         self.header = None
+        self.compact = False
+        self.ready = collections.deque()  # Expanded compact messages
+        self.last_hdr = None  # timestamp, pid, tid, sys_time
+        self.allow_compression = allow_compression
+        self.decompressor = None
+        self.compression = 0  # zlib level used by the client
+        self.pid = pid
+        self.tid = 0
+        self.msgs = 0
+        self.wire_bytes = 0  # Bytes read from the socket
+        self.raw_bytes = 0  # Bytes after decompression
+        self.inflate_time = 0.0
 
     def get_message(self):
         '''Reads message from socket'''
+        if self.compact:
+            return self._get_compact_message()
 
         # Read header
         if self.header is None:
@@ -118,14 +170,126 @@ class SockReader(object):
 
         # Reset data members
         self.buf_data = b''
+        if self.header.payload_type == uds_msg_pb2.PROTOCOL_MSG:
+            self.pid = self.header.pid
+            self.tid = self.header.tid
+            self._start_protocol(pay_buf)
         self.header = None
+        self.msgs += 1
 
         return status_code, hdr_buf, pay_buf
 
+    def _start_protocol(self, pay_buf):
+        '''Acknowledges a protocol v2 hello and switches to reading compact
+        headers if the client asked for them.'''
+        proto_msg = uds_msg_pb2.ProtocolMessage()
+        proto_msg.ParseFromString(pay_buf)
+        if proto_msg.version < PROTOCOL_V2:
+            return
+        compress = (proto_msg.compact_header and proto_msg.compression > 0
+                    and self.allow_compression)
+        ack = PROTOCOL_V2
+        if compress:
+            ack |= PROTOCOL_ACK_COMPRESSED
+        try:
+            self.sock_obj.send(struct.pack(str("B"), ack))
+        except socket.error as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            return
+        if proto_msg.compact_header:
+            self.compact = True
+            self.buf_data = bytearray()
+            self.last_hdr = [0, 0, 0, 0]
+        if compress:
+            self.decompressor = zlib.decompressobj()
+            self.compression = proto_msg.compression
+
+    def has_message(self):
+        '''Returns True if a received message is waiting to be returned.'''
+        return bool(self.ready)
+
+    def _get_compact_message(self):
+        '''Returns the next compact message, receiving more data from the
+        socket if none is waiting.'''
+        status_code = MultiCommunicationManager.StatusCode.success
+        if not self.ready:
+            data, status_code = self._receive_some(COMPACT_RECV_SIZE)
+            if data and self.decompressor is not None:
+                data, status_code = self._inflate(data, status_code)
+            if data:
+                self.raw_bytes += len(data)
+                self.buf_data += data
+                self._expand_compact()
+
+        if not self.ready:
+            if status_code == MultiCommunicationManager.StatusCode.success:
+                status_code = \
+                    MultiCommunicationManager.StatusCode.try_again_later
+            return status_code, None, None
+
+        hdr_buf, pay_buf = self.ready.popleft()
+        self.msgs += 1
+        return MultiCommunicationManager.StatusCode.success, hdr_buf, pay_buf
+
+    def _inflate(self, data, status_code):
+        '''Decompresses data received on a compressed connection.'''
+        start = time.time()
+        try:
+            data = self.decompressor.decompress(data)
+        except zlib.error as exc:
+            logging.error("Failed to decompress client data: %s", str(exc))
+            return b'', MultiCommunicationManager.StatusCode.close_connection
+        finally:
+            self.inflate_time += time.time() - start
+        return data, status_code
+
+    def _expand_compact(self):
+        '''Expands every complete compact message in the buffer to a full
+        header and payload and queues it to be returned.'''
+        buf = self.buf_data
+        end = len(buf)
+        last = self.last_hdr
+        done = 0
+        while done < end:
+            pos = done
+            fields = []
+            try:
+                for _ in range(6):
+                    byte = buf[pos]
+                    pos += 1
+                    val = byte & 0x7f
+                    shift = 7
+                    while byte & 0x80:
+                        byte = buf[pos]
+                        pos += 1
+                        val |= (byte & 0x7f) << shift
+                        shift += 7
+                    fields.append(val)
+            except IndexError:
+                break
+            pay_end = pos + fields[1]
+            if pay_end > end:
+                break
+
+            for i in range(4):
+                delta = fields[i + 2]
+                last[i] = (last[i] + ((delta >> 1) ^ -(delta & 1))) & \
+                    UINT64_MASK
+            hdr_buf = HEADER.pack(last[0], last[1], fields[0], fields[1],
+                                  last[2], last[3])
+            if __debug__:
+                logging.debug("Compact header: %s",
+                              str(HEADER.unpack(hdr_buf)))
+            self.ready.append((hdr_buf, bytes(buf[pos:pay_end])))
+            done = pay_end
+        del buf[:done]
+
     def _fill_buffer(self, remaining_len):
         '''Calls receive and appends buffer'''
         tmp_buf, status_code = self._receive(self.sock_obj, remaining_len)
         self.buf_data += tmp_buf
+        self.wire_bytes += len(tmp_buf)
+        self.raw_bytes += len(tmp_buf)
         return status_code
 
     def _receive(self, sock_obj, size):
@@ -157,15 +321,71 @@ class SockReader(object):
             size -= len(data)
         return buf, status_code
 
+    def _receive_some(self, size):
+        '''Receives whatever data up to size bytes is waiting on the
+        socket'''
+        status_code = MultiCommunicationManager.StatusCode.success
+        while True:
+            try:
+                data = self.sock_obj.recv(size)
+            except socket.error as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno == errno.EAGAIN or exc.errno == errno.EWOULDBLOCK:
+                    status_code = \
+                        MultiCommunicationManager.StatusCode.try_again_later
+                else:
+                    logging.error("Error: %d, Message: %s",
+                                  exc.errno, exc.strerror)
+                    status_code = \
+                        MultiCommunicationManager.StatusCode.close_connection
+                return b'', status_code
+            if data == b'':
+                status_code = \
+                    MultiCommunicationManager.StatusCode.close_connection
+            self.wire_bytes += len(data)
+            return data, status_code
+
     def get_sock_obj(self):
         '''Returns socket object'''
         return self.sock_obj
 
+    def stats(self):
+        '''Returns the traffic counters of the connection.'''
+        return {"pid": self.pid,
+                "tid": self.tid,
+                "compact": self.compact,
+                "compression": self.compression,
+                "msgs": self.msgs,
+                "wire_bytes": self.wire_bytes,
+                "raw_bytes": self.raw_bytes,
+                "inflate_time": self.inflate_time}
+
     def close(self):
         '''Closes the underlying socket object'''
         self.sock_obj.close()
 
 
+def listen_socket(addr, max_conn, reuse_port=False):
+    '''Returns a non-blocking socket listening on addr. With reuse_port set
+    several sockets may listen on the same TCP address.'''
+    server_socket = None
+    try:
+        server_socket = multisocket.MultiFamilySocket(socket.SOCK_STREAM,
+                                                      addr)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        server_socket.bind(addr)
+        server_socket.listen(max_conn)
+    except socket.error as err:
+        if server_socket:
+            server_socket.close()
+        logging.error("Error: %s", str(err))
+        raise OPUSException("socket error")
+    server_socket.setblocking(0)  # Make the socket non-blocking
+    return server_socket
+
+
 class CommunicationManager(object):
     '''Base class for the communication manager class'''
     def __init__(self):
@@ -182,14 +402,17 @@ class CommunicationManager(object):
 
 
 class MultiCommunicationManager(CommunicationManager):
-    '''multisocket specific server implementation'''
+    '''multisocket specific server implementation. If given admission
+    arguments, the messages read are metered by an AdmissionControl and
+    processes it sheds for long enough are detached.'''
     StatusCode = common_utils.enum(success=0,
                                    close_connection=100,
                                    try_again_later=101)
 
     def __init__(self, addr,
                  max_conn=10, select_timeout=5.0,
-                 *args, **kwargs):
+                 listen=True, reuse_port=False, compression=True,
+                 admission=None, *args, **kwargs):
         '''Initialize the class members'''
         super(MultiCommunicationManager, self).__init__(*args, **kwargs)
         self.input_client_map = {}  # fd -> SockReader
@@ -197,29 +420,41 @@ class MultiCommunicationManager(CommunicationManager):
         self.addr = addr  # Configurable
         self.max_server_conn = max_conn  # Configurable
         self.select_timeout = select_timeout  # Configurable
+        self.compression = compression  # Configurable
+        self.admission = None
+        if admission is not None:
+            self.admission = AdmissionControl(**admission)
         self.server_socket = None
-
-        try:
-            self.server_socket = multisocket.MultiFamilySocket(
-                socket.SOCK_STREAM)
-            self.server_socket.bind(self.addr)
-            self.server_socket.listen(self.max_server_conn)
-        except socket.error as err:
-            if self.server_socket:
-                self.server_socket.close()
-            logging.error("Error: %s", str(err))
-            raise OPUSException("socket error")
-        self.server_socket.setblocking(0)  # Make the socket non-blocking
         self.epoll = select.epoll()
+
+        if not listen:
+            return
+        self.server_socket = listen_socket(self.addr, self.max_server_conn,
+                                           reuse_port)
         self.epoll.register(self.server_socket.fileno(),
                             select.EPOLLIN | select.EPOLLERR)
 
-    def do_poll(self):
+    def do_poll(self, timeout=None):
+        '''Returns a list of tuples for all ready file descriptors, less
+        any shed by admission control'''
+        ret_list = self._poll(timeout)
+        if self.admission is None:
+            return ret_list
+        ret_list = self.admission.admit(ret_list)
+        for pid in list(self.admission.detach_pids):
+            logging.error("Detaching process %d over its rate limit.", pid)
+            ret_list += self.detach(pid)[1]
+        self.admission.detach_pids.clear()
+        return ret_list
+
+    def _poll(self, timeout):
         '''Returns a list of tuples for all ready file descriptors'''
         ret_list = []  # List of tuples of form (header, payload)
+        if timeout is None:
+            timeout = self.select_timeout
 
         try:
-            event_list = self.epoll.poll(self.select_timeout)
+            event_list = self.epoll.poll(timeout)
         except IOError as err:
             logging.error("Error: %s", str(err))
             return ret_list
@@ -230,8 +465,11 @@ class MultiCommunicationManager(CommunicationManager):
             return ret_list
 
         for fileno, event in event_list:
-            if fileno == self.server_socket.fileno():
+            if (self.server_socket is not None and
+                    fileno == self.server_socket.fileno()):
                 self._handle_new_connection()
+            elif fileno not in self.input_client_map:
+                self._handle_other(fileno, event, ret_list)
             elif event & select.EPOLLIN:
                 sock_obj = self.input_client_map[fileno].get_sock_obj()
                 self._handle_client(sock_obj, ret_list)
@@ -242,20 +480,30 @@ class MultiCommunicationManager(CommunicationManager):
                 self._handle_close_connection(sock_obj, ret_list)
         return ret_list
 
+    def _handle_other(self, fileno, event, ret_list):
+        '''Override to handle events on descriptors registered by derived
+        classes.'''
+        pass
+
     def _handle_client(self, sock_obj, ret_list):
         '''Receives data from client or closes the client connection'''
         sock_rdr = self.input_client_map[sock_obj.fileno()]
-        status_code, header_buf, payload_buf = sock_rdr.get_message()
+        while True:
+            status_code, header_buf, payload_buf = sock_rdr.get_message()
 
-        if status_code == self.StatusCode.success:
-            if __debug__:
-                logging.debug("Got valid data")
-            ret_list += [(header_buf, payload_buf)]
-        elif status_code == self.StatusCode.close_connection:
-            self._handle_close_connection(sock_obj, ret_list)
-        elif status_code == self.StatusCode.try_again_later:
-            if __debug__:
-                logging.debug("Will try again later")
+            if status_code == self.StatusCode.success:
+                if __debug__:
+                    logging.debug("Got valid data")
+                ret_list += [(header_buf, payload_buf)]
+                # Compact mode receives several messages at once
+                if sock_rdr.has_message():
+                    continue
+            elif status_code == self.StatusCode.close_connection:
+                self._handle_close_connection(sock_obj, ret_list)
+            elif status_code == self.StatusCode.try_again_later:
+                if __debug__:
+                    logging.debug("Will try again later")
+            break
 
     def _handle_close_connection(self, sock_obj, ret_list):
         '''Handles close event or hang up event on the client socket'''
@@ -278,6 +526,10 @@ class MultiCommunicationManager(CommunicationManager):
     def _handle_new_connection(self):
         '''Accepts and adds the new connection to the fd list'''
         client_fd, _ = self.server_socket.accept()
+        self.add_connection(client_fd)
+
+    def add_connection(self, client_fd):
+        '''Adds an accepted connection to the fd list'''
         pid, uid, gid = get_credentials(client_fd)
         if __debug__:
             logging.debug("Got a new connection from"
@@ -287,7 +539,8 @@ class MultiCommunicationManager(CommunicationManager):
         self.epoll.register(client_fd.fileno(),
                             select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)
 
-        sock_rdr = SockReader(client_fd)  # Instantiate a SockReader object
+        # Instantiate a SockReader object
+        sock_rdr = SockReader(client_fd, pid, self.compression)
         self.input_client_map[client_fd.fileno()] = sock_rdr
 
         if pid in self.pid_map:
@@ -303,27 +556,450 @@ class MultiCommunicationManager(CommunicationManager):
             ret_list = []
             for sock in sock_objs:
                 self._handle_close_connection(sock, ret_list)
+            if self.admission is not None:
+                ret_list = self.admission.admit(ret_list)
             return len(sock_objs), ret_list
 
     def ps(self):
         return {pid: len(threads)
                 for pid, threads in self.pid_map.items()}
 
+    def offenders(self):
+        '''Returns the processes shed by admission control.'''
+        if self.admission is None:
+            return []
+        return self.admission.offenders()
+
+    def conn_stats(self):
+        '''Returns the traffic counters of every client connection.'''
+        return [sock_rdr.stats()
+                for sock_rdr in self.input_client_map.values()]
+
     def close(self):
         '''Close all connections and cleanup'''
-        self.epoll.unregister(self.server_socket.fileno())
-        self.server_socket.close()
+        if self.server_socket is not None:
+            self.epoll.unregister(self.server_socket.fileno())
+            self.server_socket.close()
         for fileno in self.input_client_map:
             self.epoll.unregister(fileno)
             self.input_client_map[fileno].close()
 
 
+class RingReader(object):
+    '''Reads the messages a client writes to its shared memory ring. The
+    client only publishes the head of the ring after writing whole
+    messages.'''
+    def __init__(self, mem_fd, event_fd):
+        self.event_fd = event_fd
+        self.ring = mmap.mmap(mem_fd, os.fstat(mem_fd).st_size)
+        magic, self.capacity = RING_HDR.unpack_from(self.ring, 0)
+        if (magic != RING_MAGIC or
+                RING_DATA_OFF + self.capacity > len(self.ring)):
+            self.ring.close()
+            raise OPUSException("Invalid shared memory ring")
+        self.tail = RING_POS.unpack_from(self.ring, RING_TAIL_OFF)[0]
+        self.header = struct.Struct(str(messaging.Header.struct_string))
+
+    def _read(self, pos, size):
+        '''Returns size bytes of the ring from pos, which may wrap.'''
+        start = RING_DATA_OFF + pos % self.capacity
+        end = start + size
+        limit = RING_DATA_OFF + self.capacity
+        if end <= limit:
+            return self.ring[start:end]
+        return (self.ring[start:limit] +
+                self.ring[RING_DATA_OFF:end - self.capacity])
+
+    def read_msgs(self, ret_list):
+        '''Appends the messages in the ring to ret_list and frees their
+        space.'''
+        head = RING_POS.unpack_from(self.ring, RING_HEAD_OFF)[0]
+        if head == self.tail:
+            return
+        hdr_len = messaging.Header.length
+        tail = self.tail
+        while tail < head:
+            hdr = self._read(tail, hdr_len)
+            pay_len = self.header.unpack(hdr)[3]
+            ret_list.append((hdr, self._read(tail + hdr_len, pay_len)))
+            tail += hdr_len + pay_len
+        self.tail = tail
+        RING_POS.pack_into(self.ring, RING_TAIL_OFF, tail)
+
+    def set_waiting(self, waiting):
+        '''Sets whether the client must wake the backend after writing.'''
+        RING_FLAG.pack_into(self.ring, RING_WAITING_OFF, waiting)
+
+    def clear_event(self):
+        '''Resets the eventfd of the ring after a wakeup.'''
+        try:
+            os.read(self.event_fd, 8)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        '''Marks the ring closed, so the client stops writing to it, and
+        releases it.'''
+        RING_FLAG.pack_into(self.ring, RING_CLOSED_OFF, 1)
+        self.ring.close()
+        os.close(self.event_fd)
+
+
+class SharedMemoryCommunicationManager(MultiCommunicationManager):
+    '''UDS server for clients that write messages to shared memory rings.
+    On connecting a client passes the memfd of its ring and an eventfd over
+    the socket. The rings are drained on every poll and only when all of
+    them are empty does the manager flag each one as waiting and sleep, to
+    be woken by a client writing to the eventfd of a flagged ring. Clients
+    wait for space in a full ring and send messages larger than their ring
+    over the socket once it is empty. The poll timeout bounds the delay if
+    a wakeup is missed.'''
+    def __init__(self, *args, **kwargs):
+        super(SharedMemoryCommunicationManager, self).__init__(*args,
+                                                               **kwargs)
+        self.rings = {}  # socket fd -> RingReader
+        self.event_map = {}  # eventfd -> socket fd
+
+    def _recv_fd(self, client_fd):
+        '''Receives a descriptor passed by a client.'''
+        readable, _, _ = select.select([client_fd], [], [],
+                                       self.select_timeout)
+        if not readable:
+            raise OPUSException("Timed out waiting for a ring descriptor")
+        return multiprocessing.reduction.recv_handle(client_fd)
+
+    def add_connection(self, client_fd):
+        '''Maps the ring of a new client and adds its connection.'''
+        try:
+            mem_fd = self._recv_fd(client_fd)
+            try:
+                event_fd = self._recv_fd(client_fd)
+                ring = RingReader(mem_fd, event_fd)
+            finally:
+                os.close(mem_fd)
+        except (OSError, mmap.error, OPUSException) as err:
+            logging.error("Failed to map client ring: %s", str(err))
+            client_fd.close()
+            return
+
+        super(SharedMemoryCommunicationManager,
+              self).add_connection(client_fd)
+        self.rings[client_fd.fileno()] = ring
+        self.event_map[event_fd] = client_fd.fileno()
+        self.epoll.register(event_fd, select.EPOLLIN)
+
+    def _drain_rings(self):
+        ret_list = []
+        for ring in self.rings.values():
+            ring.read_msgs(ret_list)
+        return ret_list
+
+    def _set_waiting(self, waiting):
+        for ring in self.rings.values():
+            ring.set_waiting(waiting)
+
+    def _poll(self, timeout):
+        '''Returns the messages in the rings and of any ready
+        descriptors'''
+        ret_list = self._drain_rings()
+        if not ret_list:
+            self._set_waiting(1)
+            ret_list = self._drain_rings()
+        sleep = not ret_list
+        ret_list += super(SharedMemoryCommunicationManager,
+                          self)._poll(timeout if sleep else 0)
+        if sleep:
+            self._set_waiting(0)
+        return ret_list
+
+    def _handle_other(self, fileno, event, ret_list):
+        '''Handles a wakeup on the eventfd of a ring.'''
+        if fileno not in self.event_map:
+            return
+        ring = self.rings[self.event_map[fileno]]
+        ring.clear_event()
+        ring.read_msgs(ret_list)
+
+    def _handle_client(self, sock_obj, ret_list):
+        '''Drains the ring of a client before reading its socket'''
+        ring = self.rings.get(sock_obj.fileno())
+        if ring is not None:
+            ring.read_msgs(ret_list)
+        super(SharedMemoryCommunicationManager,
+              self)._handle_client(sock_obj, ret_list)
+
+    def _handle_close_connection(self, sock_obj, ret_list):
+        '''Drains and releases the ring of a closing client'''
+        ring = self.rings.pop(sock_obj.fileno(), None)
+        if ring is not None:
+            ring.read_msgs(ret_list)
+            self.epoll.unregister(ring.event_fd)
+            del self.event_map[ring.event_fd]
+            ring.close()
+        super(SharedMemoryCommunicationManager,
+              self)._handle_close_connection(sock_obj, ret_list)
+
+    def close(self):
+        '''Close all connections and rings and cleanup'''
+        for ring in self.rings.values():
+            self.epoll.unregister(ring.event_fd)
+            ring.close()
+        self.rings = {}
+        self.event_map = {}
+        super(SharedMemoryCommunicationManager, self).close()
+
+
+class ShardCommunicationManager(MultiCommunicationManager):
+    '''Communication manager of a producer shard. TCP shards listen on the
+    shared address with SO_REUSEPORT, UDS shards are handed the connections
+    accepted by the producer over ctl_conn. Commands from the producer
+    arrive on ctl_conn and are answered on it.'''
+    def __init__(self, ctl_conn, addr, *args, **kwargs):
+        self.tcp = addr.startswith("tcp://")
+        super(ShardCommunicationManager, self).__init__(addr,
+                                                       listen=self.tcp,
+                                                       reuse_port=True,
+                                                       *args, **kwargs)
+        self.ctl_conn = ctl_conn
+        self.stopped = False
+        self.epoll.register(self.ctl_conn.fileno(),
+                            select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)
+
+    def _handle_other(self, fileno, event, ret_list):
+        '''Handles a message from the producer.'''
+        if fileno != self.ctl_conn.fileno():
+            return
+        if not event & select.EPOLLIN:
+            self.stopped = True
+            return
+        try:
+            msg = self.ctl_conn.recv()
+        except EOFError:
+            self.stopped = True
+            return
+
+        if msg[0] == "conn":
+            handle = multiprocessing.reduction.recv_handle(self.ctl_conn)
+            client_fd = socket.fromfd(handle, socket.AF_UNIX,
+                                      socket.SOCK_STREAM)
+            os.close(handle)
+            self.add_connection(client_fd)
+        elif msg[0] == "ps":
+            self.ctl_conn.send((self.ps(),
+                                self.conn_stats() if msg[1] else [],
+                                self.offenders()))
+        elif msg[0] == "detach":
+            res, close_msgs = self.detach(msg[1])
+            ret_list += close_msgs
+            self.ctl_conn.send(res)
+        elif msg[0] == "stop":
+            self.stopped = True
+
+    def close(self):
+        '''Close all connections and cleanup'''
+        self.epoll.unregister(self.ctl_conn.fileno())
+        super(ShardCommunicationManager, self).close()
+
+
+class RelayReader(SockReader):
+    '''Reads the connection of a relay backend. The connection opens with
+    the HOST_MSG of the relay, which is answered with whether accept_host
+    accepted its host id, and is followed by batches of messages. Each
+    batch is inflated and split into its messages, whose pids and tids are
+    namespaced by the host number of the relay, held in their upper 32
+    bits. A HOST_MSG naming the host is queued ahead of them with a zero
+    timestamp so that the analyser knows the host before its messages.'''
+
+    def __init__(self, sock_obj, accept_host):
+        '''Initialize data members'''
+        super(RelayReader, self).__init__(sock_obj)
+        self.accept_host = accept_host
+        self.buf_data = bytearray()
+        self.host_id = None
+        self.host_num = None
+        self.batches = 0
+
+    def get_message(self):
+        '''Returns the next relayed message, receiving more data from the
+        socket if none is waiting.'''
+        status_code = MultiCommunicationManager.StatusCode.success
+        if not self.ready:
+            data, status_code = self._receive_some(COMPACT_RECV_SIZE)
+            if data:
+                self.buf_data += data
+                if not self._read_frames():
+                    status_code = \
+                        MultiCommunicationManager.StatusCode.close_connection
+
+        if not self.ready:
+            if status_code == MultiCommunicationManager.StatusCode.success:
+                status_code = \
+                    MultiCommunicationManager.StatusCode.try_again_later
+            return status_code, None, None
+
+        hdr_buf, pay_buf = self.ready.popleft()
+        self.msgs += 1
+        return MultiCommunicationManager.StatusCode.success, hdr_buf, pay_buf
+
+    def _read_frames(self):
+        '''Reads every complete frame in the buffer, returning False if the
+        connection should be closed.'''
+        buf = self.buf_data
+        end = len(buf)
+        done = 0
+        while True:
+            if self.host_num is None:
+                if end - done < HEADER.size:
+                    break
+                fields = HEADER.unpack_from(buf, done)
+                pay_end = done + HEADER.size + fields[3]
+                if pay_end > end:
+                    break
+                if fields[2] != uds_msg_pb2.HOST_MSG:
+                    logging.error("Relay connection opened without a host "
+                                  "message.")
+                    return False
+                host_msg = uds_msg_pb2.HostMessage()
+                host_msg.ParseFromString(bytes(buf[done + HEADER.size:
+                                                   pay_end]))
+                if not self._start_relay(host_msg.host_id):
+                    return False
+            else:
+                if end - done < relay.BATCH.size:
+                    break
+                comp_len, _ = relay.BATCH.unpack_from(buf, done)
+                pay_end = done + relay.BATCH.size + comp_len
+                if pay_end > end:
+                    break
+                start = time.time()
+                try:
+                    raw = zlib.decompress(bytes(buf[done + relay.BATCH.size:
+                                                    pay_end]))
+                except zlib.error as exc:
+                    logging.error("Failed to decompress relay batch: %s",
+                                  str(exc))
+                    return False
+                finally:
+                    self.inflate_time += time.time() - start
+                self.batches += 1
+                self.raw_bytes += len(raw)
+                self._split_batch(raw)
+            done = pay_end
+        del buf[:done]
+        return True
+
+    def _start_relay(self, host_id):
+        '''Answers the host message of a relay, returning True if its host
+        was accepted.'''
+        host_num = self.accept_host(host_id)
+        ack = relay.RELAY_REFUSE if host_num is None else relay.RELAY_ACCEPT
+        try:
+            self.sock_obj.send(ack)
+        except socket.error as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            host_num = None
+        if host_num is None:
+            return False
+        self.host_id = host_id
+        self.host_num = host_num
+        self.ready.append(relay.host_message(host_id,
+                                             host_num << relay.HOST_SHIFT))
+        return True
+
+    def _split_batch(self, raw):
+        '''Queues the messages of a batch with namespaced pids and tids.'''
+        host_bits = self.host_num << relay.HOST_SHIFT
+        end = len(raw)
+        pos = 0
+        while pos < end:
+            (timestamp, pid, pay_type,
+             pay_len, tid, sys_time) = HEADER.unpack_from(raw, pos)
+            pos += HEADER.size
+            self.ready.append((HEADER.pack(timestamp, host_bits | pid,
+                                           pay_type, pay_len,
+                                           host_bits | tid, sys_time),
+                               raw[pos:pos + pay_len]))
+            pos += pay_len
+
+    def stats(self):
+        '''Returns the traffic counters of the connection.'''
+        stats = super(RelayReader, self).stats()
+        stats.update({"pid": self.host_id,
+                      "tid": self.host_num,
+                      "protocol": "relay",
+                      "compression": "zlib",
+                      "batches": self.batches})
+        return stats
+
+
+class RelayCommunicationManager(MultiCommunicationManager):
+    '''Reads the connections of relay backends on a central backend. Relays
+    are refused while another relay whose host id has the same host number
+    is connected. Relayed processes cannot be detached as their connections
+    are held by their relays.'''
+    def __init__(self, *args, **kwargs):
+        '''Initialize the class members'''
+        super(RelayCommunicationManager, self).__init__(*args, **kwargs)
+        self.hosts = {}  # host num -> [host id, connections]
+
+    def accept_host(self, host_id):
+        '''Returns the host number of a connecting relay, or None if it is
+        refused.'''
+        host_num = relay.host_num(host_id)
+        if host_num in self.hosts and self.hosts[host_num][0] != host_id:
+            logging.error("Refusing relay %s, its host number %d is used by "
+                          "relay %s.", host_id, host_num,
+                          self.hosts[host_num][0])
+            return None
+        self.hosts.setdefault(host_num, [host_id, 0])[1] += 1
+        logging.info("Relay %s connected as host %d.", host_id, host_num)
+        return host_num
+
+    def add_connection(self, client_fd):
+        '''Adds an accepted relay connection to the fd list'''
+        client_fd.setblocking(0)  # Make the socket non-blocking
+        self.epoll.register(client_fd.fileno(),
+                            select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)
+        self.input_client_map[client_fd.fileno()] = RelayReader(
+            client_fd, self.accept_host)
+
+    def _handle_close_connection(self, sock_obj, ret_list):
+        '''Handles close event or hang up event on a relay socket. A relay
+        spools what it cannot send, so its processes are not
+        disconnected.'''
+        self.epoll.unregister(sock_obj.fileno())
+        sock_rdr = self.input_client_map.pop(sock_obj.fileno(), None)
+        if sock_rdr is not None and sock_rdr.host_num is not None:
+            host = self.hosts[sock_rdr.host_num]
+            host[1] -= 1
+            if host[1] == 0:
+                del self.hosts[sock_rdr.host_num]
+            logging.info("Relay %s disconnected.", sock_rdr.host_id)
+
+        if __debug__:
+            logging.debug('closing socket: %d', sock_obj.fileno())
+        sock_obj.close()
+
+
+def _run_shard(shard, pf_queue, ctl_conn, comm_mgr_args):
+    '''Body of a producer shard process.'''
+    comm_manager = ShardCommunicationManager(ctl_conn, **comm_mgr_args)
+    while not comm_manager.stopped:
+        msg_list = comm_manager.do_poll()
+        if msg_list:
+            pf_queue.enqueue(msg_list, shard)
+    comm_manager.close()
+
+
 class Producer(threading.Thread):
-    '''Base class for the producer thread'''
-    def __init__(self, pf_queue, router):
+    '''Base class for the producer thread. If given an IngestJournal,
+    messages are journalled before they are handed to the fetcher.'''
+    def __init__(self, pf_queue, router, journal=None):
         '''Initialize class data members'''
         super(Producer, self).__init__()
         self.pf_queue = pf_queue
+        self.journal = journal
         self.node = ipc.Worker(ident="PRODUCER",
                                router=router,
                                handler=self._command)
@@ -348,6 +1024,8 @@ class Producer(threading.Thread):
 
     def _send_data_to_fetcher(self, msg_list):
         '''Enqueues messages on the producer fetcher queue'''
+        if self.journal is not None:
+            msg_list = self.journal.append(msg_list)
         self.pf_queue.enqueue(msg_list)
 
     def do_shutdown(self):
@@ -361,12 +1039,19 @@ class Producer(threading.Thread):
             logging.error("Failed to shutdown thread sucessfully.")
             logging.error(exc)
             return False
-        return not self.isAlive()
+        if self.isAlive():
+            return False
+        if self.journal is not None:
+            self.journal.close()
+        return True
 
 
 class SocketProducer(Producer):
-    '''Implementation of a socket producer class'''
-    def __init__(self, comm_mgr_type, comm_mgr_args, *args, **kwargs):
+    '''Implementation of a socket producer class. If given a filter_file
+    of rules, messages are filtered as they are read and the summaries of
+    processes still running are sent every summary_interval seconds.'''
+    def __init__(self, comm_mgr_type, comm_mgr_args, filter_file=None,
+                 summary_interval=60.0, *args, **kwargs):
         '''Initialize the class data members'''
         super(SocketProducer, self).__init__(*args, **kwargs)
         try:
@@ -375,6 +1060,14 @@ class SocketProducer(Producer):
                                                           **comm_mgr_args)
         except common_utils.InvalidTagException as err_msg:
             raise OPUSException(err_msg.msg)
+        self.msg_filter = None
+        if filter_file is not None:
+            try:
+                self.msg_filter = filtering.MessageFilter(filter_file)
+            except ValueError as exc:
+                raise OPUSException(str(exc))
+        self.summary_interval = summary_interval
+        self.last_summary = time.time()
 
     def run(self):
         '''Spin until thread stop event is set'''
@@ -387,6 +1080,9 @@ class SocketProducer(Producer):
                 msg_list += additional_msgs
                 self.ret_done.set()
 
+            if self.msg_filter is not None:
+                msg_list = self._filter(msg_list)
+
             if not msg_list:
                 if __debug__:
                     logging.debug("No message to be logged")
@@ -396,6 +1092,16 @@ class SocketProducer(Producer):
                 self._send_data_to_fetcher(msg_list)
         self.comm_manager.close()
 
+    def _filter(self, msg_list):
+        '''Filters the messages read, adding the pending summaries once
+        summary_interval has passed.'''
+        msg_list = self.msg_filter.filter(msg_list)
+        now = time.time()
+        if now - self.last_summary >= self.summary_interval:
+            self.last_summary = now
+            msg_list += self.msg_filter.flush()
+        return msg_list
+
     def do_shutdown(self):
         '''Shutdown the thread gracefully'''
         return super(SocketProducer, self).do_shutdown()
@@ -405,7 +1111,10 @@ class SocketProducer(Producer):
         cmd = self.msg.cont
         if cmd['cmd'] == "ps":
             self.ret = {"success": True,
-                        "pid_map": self.comm_manager.ps()}
+                        "pid_map": self.comm_manager.ps(),
+                        "offenders": self.comm_manager.offenders()}
+            if cmd.get('conns'):
+                self.ret['conn_stats'] = self.comm_manager.conn_stats()
         elif cmd['cmd'] == "detach":
             if 'pid' in cmd:
                 res, ret_msg = self.comm_manager.detach(cmd['pid'])
@@ -421,7 +1130,189 @@ class SocketProducer(Producer):
             else:
                 self.ret = {"success": False,
                             "msg": "Missing pid argument."}
+        elif cmd['cmd'] == "filters":
+            if self.msg_filter is None:
+                self.ret = {"success": False,
+                            "msg": "No filter rules are configured."}
+            elif cmd.get('reload') and not self.msg_filter.reload():
+                self.ret = {"success": False,
+                            "msg": "Failed to reload filter rules from "
+                            "%s." % self.msg_filter.rule_file}
+            else:
+                self.ret = {"success": True,
+                            "rules": self.msg_filter.stats()}
         else:
             self.ret = {"success": False,
                         "msg": "%s is not a valid command." % cmd['cmd']}
         return []
+
+
+class ShardedProducer(Producer):
+    '''Producer that spreads client connections over several shard
+    processes, each of which reads its own connections and enqueues their
+    messages on its own shard of the producer fetcher queue. TCP shards
+    listen on the same address with SO_REUSEPORT and the kernel balances
+    connections between them. UDS connections are accepted by the producer
+    thread and passed to the shard chosen by the client pid, so that all
+    the connections of a process are read by one shard.'''
+    def __init__(self, comm_mgr_args, shards=None, *args, **kwargs):
+        '''Initialize the class data members'''
+        super(ShardedProducer, self).__init__(*args, **kwargs)
+        if self.journal is not None:
+            raise OPUSException("The sharded producer does not support "
+                                "journalling.")
+        num_queues = len(self.pf_queue.pf_queues)
+        self.num_shards = shards if shards is not None else num_queues
+        if self.num_shards != num_queues:
+            raise OPUSException("Producer has %d shards but the producer "
+                                "fetcher queue has %d." % (self.num_shards,
+                                                           num_queues))
+        self.comm_mgr_args = comm_mgr_args
+        self.select_timeout = comm_mgr_args.get('select_timeout', 5.0)
+
+        self.server_socket = None
+        if not comm_mgr_args['addr'].startswith("tcp://"):
+            self.server_socket = listen_socket(
+                comm_mgr_args['addr'], comm_mgr_args.get('max_conn', 10))
+
+        self.ctl_conns = []
+        self.shard_conns = []
+        self.shards = []
+        for shard in range(self.num_shards):
+            ctl_conn, shard_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_run_shard,
+                                           args=(shard, self.pf_queue,
+                                                 shard_conn, comm_mgr_args))
+            proc.daemon = True
+            self.ctl_conns.append(ctl_conn)
+            self.shard_conns.append(shard_conn)
+            self.shards.append(proc)
+
+    def start(self):
+        '''Start the shard processes and then the producer thread.'''
+        for proc, shard_conn in zip(self.shards, self.shard_conns):
+            proc.start()
+            shard_conn.close()
+        super(ShardedProducer, self).start()
+
+    def run(self):
+        '''Accept and pass on UDS connections and handle commands until
+        the thread stop event is set'''
+        while not self.stop_event.isSet():
+            if self.server_socket is not None:
+                self._accept()
+            else:
+                self.msg_waiting.wait(self.select_timeout)
+
+            if self.msg_waiting.is_set():
+                self.msg_waiting.clear()
+                self._process_command(self)
+                self.ret_done.set()
+
+        for ctl_conn in self.ctl_conns:
+            ctl_conn.send(("stop",))
+        for proc in self.shards:
+            proc.join(common_utils.THREAD_JOIN_SLACK)
+        if self.server_socket is not None:
+            self.server_socket.close()
+
+    def _accept(self):
+        '''Waits for new UDS connections and passes them to their
+        shards.'''
+        try:
+            readable, _, _ = select.select([self.server_socket], [], [],
+                                           self.select_timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        if not readable:
+            return
+        while True:
+            try:
+                client_fd, _ = self.server_socket.accept()
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            pid, _, _ = get_credentials(client_fd)
+            shard = pid % self.num_shards
+            self.ctl_conns[shard].send(("conn",))
+            multiprocessing.reduction.send_handle(self.ctl_conns[shard],
+                                                  client_fd.fileno(),
+                                                  self.shards[shard].pid)
+            client_fd.close()
+
+    def _query_shards(self, msg):
+        '''Sends a command to every live shard, returning the replies of
+        those that answer within select_timeout. Replies that arrive too
+        late are discarded before the next command.'''
+        queried = []
+        for shard, (proc, ctl_conn) in enumerate(zip(self.shards,
+                                                     self.ctl_conns)):
+            if not proc.is_alive():
+                logging.error("Shard %d is not running.", shard)
+                continue
+            try:
+                while ctl_conn.poll():
+                    ctl_conn.recv()
+                ctl_conn.send(msg)
+            except (EOFError, IOError):
+                logging.error("Lost connection to shard %d.", shard)
+                continue
+            queried.append((shard, proc, ctl_conn))
+
+        replies = []
+        for shard, proc, ctl_conn in queried:
+            try:
+                if ctl_conn.poll(self.select_timeout):
+                    replies.append(ctl_conn.recv())
+                    continue
+            except (EOFError, IOError):
+                pass
+            if proc.is_alive():
+                logging.error("Shard %d did not reply to %s.", shard, msg[0])
+            else:
+                logging.error("Shard %d exited before replying to %s.",
+                              shard, msg[0])
+        return replies
+
+    def _process_command(self, msg):
+        '''Handles a command message from the command and control system.
+        The close messages of detached connections are enqueued by the
+        shards themselves.'''
+        cmd = self.msg.cont
+        if cmd['cmd'] == "ps":
+            pid_map = {}
+            conn_stats = []
+            offenders = []
+            replies = self._query_shards(("ps", bool(cmd.get('conns'))))
+            for shard_map, shard_stats, shard_offenders in replies:
+                for pid, count in shard_map.items():
+                    pid_map[pid] = pid_map.get(pid, 0) + count
+                conn_stats += shard_stats
+                offenders += shard_offenders
+            self.ret = {"success": True,
+                        "pid_map": pid_map,
+                        "offenders": offenders}
+            if cmd.get('conns'):
+                self.ret['conn_stats'] = conn_stats
+        elif cmd['cmd'] == "detach":
+            if 'pid' in cmd:
+                results = [res for res in self._query_shards(("detach",
+                                                              cmd['pid']))
+                           if res is not None]
+                if results:
+                    self.ret = {"success": True,
+                                "msg": "Success. {:d} connections "
+                                "closed.".format(sum(results))}
+                else:
+                    self.ret = {"success": False,
+                                "msg": "Pid {:d} not connected to "
+                                "OPUS.".format(cmd['pid'])}
+            else:
+                self.ret = {"success": False,
+                            "msg": "Missing pid argument."}
+        else:
+            self.ret = {"success": False,
+                        "msg": "%s is not a valid command." % cmd['cmd']}
@@ -4,4 +4,5 @@ PVM - Init Module
 '''
 
 from .core import (version_local, version_global, get_l, get_g, drop_l, drop_g,
-                   bind, unbind)
+                   bind, unbind, FdTable, get_valid_local, get_open_locals,
+                   get_process_from_local, set_local_state)
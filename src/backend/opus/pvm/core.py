@@ -8,23 +8,187 @@ from __future__ import (absolute_import, division,
 
 from .. import storage, traversal, common_utils
 
-def cache_new_local(db_iface, loc_node, proc_node, loc_proc_rel):
-    '''Updates the IO_EVENT_CHAIN and VALID_LOCAL
-    cache with the new local'''
+
+class FdEntry(object):  # pylint: disable=R0903
+    '''An open descriptor of a process, its current local, local->process
+    link and state and the global the local is bound to.'''
+    def __init__(self, loc_id, rel_id, state, glob_id):
+        self.loc_id = loc_id
+        self.rel_id = rel_id
+        self.state = state
+        self.glob_id = glob_id
+
+
+class FdTable(object):
+    '''In memory table of the open descriptors of every live process. It
+    is kept up to date by the PVM operations so that resolving a descriptor
+    name of a tracked process never needs to query the database.'''
+    procs = {}  # proc_node.id -> {loc_name: FdEntry}
+    owners = {}  # loc_node.id -> (proc_node.id, loc_name)
+
+    @classmethod
+    def add_proc(cls, proc_id):
+        '''Starts tracking a process with no open descriptors.'''
+        cls.procs[proc_id] = {}
+
+    @classmethod
+    def remove_proc(cls, proc_id):
+        '''Stops tracking a process.'''
+        for entry in cls.procs.pop(proc_id, {}).values():
+            cls.owners.pop(entry.loc_id, None)
+
+    @classmethod
+    def is_tracked(cls, proc_id):
+        '''Returns True if the table holds the descriptors of proc_id.'''
+        return proc_id in cls.procs
+
+    @classmethod
+    def open(cls, proc_id, loc_name, loc_node, loc_proc_rel, glob_id=None):
+        '''Records loc_node as the local named loc_name in a tracked
+        process, replacing any previous local of that name.'''
+        if proc_id not in cls.procs:
+            return
+        fds = cls.procs[proc_id]
+        if loc_name in fds:
+            cls.owners.pop(fds[loc_name].loc_id, None)
+        fds[loc_name] = FdEntry(loc_node.id, loc_proc_rel.id,
+                                storage.LinkState.NONE, glob_id)
+        cls.owners[loc_node.id] = (proc_id, loc_name)
+
+    @classmethod
+    def close(cls, loc_id):
+        '''Removes the descriptor whose current local is loc_id.'''
+        owner = cls.owners.pop(loc_id, None)
+        if owner is not None:
+            proc_id, loc_name = owner
+            del cls.procs[proc_id][loc_name]
+
+    @classmethod
+    def owner(cls, loc_id):
+        '''Returns the process id and entry of the descriptor whose current
+        local is loc_id, or (None, None) if it is not tracked.'''
+        if loc_id not in cls.owners:
+            return None, None
+        proc_id, loc_name = cls.owners[loc_id]
+        return proc_id, cls.procs[proc_id][loc_name]
+
+    @classmethod
+    def lookup(cls, proc_id, loc_name):
+        '''Returns the entry for loc_name in a tracked process or None.'''
+        return cls.procs[proc_id].get(loc_name)
+
+    @classmethod
+    def entries(cls, proc_id):
+        '''Returns the entries of a tracked process in the order their
+        locals were created.'''
+        return sorted(cls.procs[proc_id].values(), key=lambda e: e.loc_id)
+
+    @classmethod
+    def set_state(cls, loc_id, state):
+        '''Records the local->process link state of a descriptor.'''
+        _, entry = cls.owner(loc_id)
+        if entry is not None:
+            entry.state = state
+
+    @classmethod
+    def set_global(cls, loc_id, glob_id):
+        '''Records the global a descriptor is bound to.'''
+        _, entry = cls.owner(loc_id)
+        if entry is not None:
+            entry.glob_id = glob_id
+
+    @classmethod
+    def snapshot(cls):
+        '''Returns the table contents for persisting.'''
+        return cls.procs
+
+    @classmethod
+    def restore(cls, procs):
+        '''Restores the table from persisted contents.'''
+        cls.procs = procs
+        cls.owners = {}
+        for proc_id, fds in procs.items():
+            for loc_name, entry in fds.items():
+                cls.owners[entry.loc_id] = (proc_id, loc_name)
+
+    @classmethod
+    def clear(cls):
+        '''Clears the table.'''
+        cls.procs = {}
+        cls.owners = {}
+
+
+def _track_process(db_iface, proc_node):
+    '''Fills the fd table for a live process from the database.'''
+    FdTable.add_proc(proc_node.id)
+    for (loc_node, loc_proc_rel) in traversal.get_locals_from_process(
+            db_iface, proc_node):
+        if loc_proc_rel['state'] == storage.LinkState.CLOSED:
+            continue
+        glob_id = None
+        gl_list = traversal.get_globals_from_local(db_iface, loc_node)
+        if len(gl_list) > 0:
+            glob_id = gl_list[0][0].id
+        FdTable.open(proc_node.id, loc_node['name'], loc_node,
+                     loc_proc_rel, glob_id)
+        FdTable.set_state(loc_node.id, loc_proc_rel['state'])
+
+
+def get_valid_local(db_iface, proc_node, loc_name):
+    '''Returns the current local named loc_name of proc_node and its
+    local->process link, or (None, None) if there is no such descriptor.'''
+    if not FdTable.is_tracked(proc_node.id):
+        if proc_node['status'] != storage.PROCESS_STATE.ALIVE:
+            return traversal.get_valid_local(db_iface, proc_node, loc_name)
+        _track_process(db_iface, proc_node)
+
+    entry = FdTable.lookup(proc_node.id, loc_name)
+    if entry is None:
+        return None, None
+    loc_proc_rel = db_iface.get_rel_by_id(entry.rel_id)
+    return loc_proc_rel.start, loc_proc_rel
+
+
+def get_open_locals(db_iface, proc_node):
+    '''Returns the local, local->process link tuples of the descriptors
+    proc_node has not closed.'''
+    if not FdTable.is_tracked(proc_node.id):
+        return [(loc_node, rel) for (loc_node, rel)
+                in traversal.get_locals_from_process(db_iface, proc_node)
+                if rel['state'] != storage.LinkState.CLOSED]
+
+    ret = []
+    for entry in FdTable.entries(proc_node.id):
+        loc_proc_rel = db_iface.get_rel_by_id(entry.rel_id)
+        ret.append((loc_proc_rel.start, loc_proc_rel))
+    return ret
+
+
+def get_process_from_local(db_iface, loc_node):
+    '''Gets the process node and local->process link of loc_node.'''
+    proc_id, entry = FdTable.owner(loc_node.id)
+    if entry is None:
+        return traversal.get_process_from_local(db_iface, loc_node)
+    return (db_iface.get_node_by_id(proc_id),
+            db_iface.get_rel_by_id(entry.rel_id))
+
+
+def set_local_state(db_iface, loc_node, state):
+    '''Sets the state of the local->process link of loc_node.'''
+    db_iface.set_link_state(loc_node.PROC_OBJ.outgoing, state)
+    FdTable.set_state(loc_node.id, state)
+
+
+def cache_new_local(db_iface, loc_node, proc_node):
+    '''Updates the IO_EVENT_CHAIN cache with the new local'''
     if proc_node['status'] == storage.PROCESS_STATE.DEAD:
         return
 
-    # Update VALID_LOCAL cache
-    db_iface.cache_man.update(storage.CACHE_NAMES.VALID_LOCAL,
-                                (proc_node.id, loc_node['name']),
-                                (loc_node, loc_proc_rel))
-
-
     # Update IO_EVENT_CHAIN cache
     idx_list = db_iface.cache_man.get(storage.CACHE_NAMES.IO_EVENT_CHAIN,
                                         (proc_node.id, loc_node['name']))
     if idx_list is None:
-        idx_list = common_utils.IndexList(lambda x: int(x.local['mono_time']))
+        idx_list = common_utils.SkipList(lambda x: int(x.local['mono_time']))
 
     fd_chain = storage.FdChain()
     fd_chain.local = loc_node
@@ -52,8 +216,7 @@ def version_local(db_iface, old_loc_node, glob_node, glob_loc_rel):
                                  storage.RelType.LOC_OBJ_PREV)
 
     # Get process and link from old local
-    proc_node, rel_link = traversal.get_process_from_local(db_iface,
-                                                           old_loc_node)
+    proc_node, rel_link = get_process_from_local(db_iface, old_loc_node)
 
     # Copy over state from previous global->local link if mode is OPUS lite
     if (proc_node.has_key('opus_lite') and proc_node['opus_lite']
@@ -64,11 +227,13 @@ def version_local(db_iface, old_loc_node, glob_node, glob_loc_rel):
     new_rel = db_iface.create_relationship(new_loc_node, proc_node,
                                  storage.RelType.PROC_OBJ)
 
-    db_iface.cache_man.invalidate(storage.CACHE_NAMES.VALID_LOCAL,
-                                  (proc_node.id, old_loc_node['name']))
+    # The new version replaces the old one in the fd table if it was open
+    if FdTable.owner(old_loc_node.id)[1] is not None:
+        FdTable.open(proc_node.id, new_loc_node['name'], new_loc_node,
+                     new_rel, glob_node.id)
 
     # Add the new local object node to the IO_EVENT_CHAIN cache
-    cache_new_local(db_iface, new_loc_node, proc_node, new_rel)
+    cache_new_local(db_iface, new_loc_node, proc_node)
 
     # Change local->process link status to INACTIVE
     rel_link['state'] = storage.LinkState.INACTIVE
@@ -111,11 +276,6 @@ def version_global(db_iface, old_glob_node):
 def get_l(db_iface, proc_node, loc_name):
     '''Performs a PVM get on the local object named 'loc_name' of the process
     identified by proc_node.'''
-
-    # Invalidate the VALID_LOCAL cache
-    db_iface.cache_man.invalidate(storage.CACHE_NAMES.VALID_LOCAL,
-                                  (proc_node.id, loc_name))
-
     loc_node = db_iface.create_node(storage.NodeType.LOCAL)
     loc_node['name'] = loc_name
 
@@ -123,8 +283,10 @@ def get_l(db_iface, proc_node, loc_name):
     loc_proc_rel = db_iface.create_relationship(loc_node, proc_node,
                                  storage.RelType.PROC_OBJ)
 
+    FdTable.open(proc_node.id, loc_name, loc_node, loc_proc_rel)
+
     # Add the new local object node to the IO_EVENT_CHAIN cache
-    cache_new_local(db_iface, loc_node, proc_node, loc_proc_rel)
+    cache_new_local(db_iface, loc_node, proc_node)
 
     return loc_node
 
@@ -164,11 +326,10 @@ def drop_l(db_iface, loc_node):
     '''PVM drop on loc_node.'''
     # Set the link between the local object and
     # process object to LinkState.CLOSED
-    proc_node, rel_link = traversal.get_process_from_local(db_iface, loc_node)
+    _, rel_link = get_process_from_local(db_iface, loc_node)
     rel_link['state'] = storage.LinkState.CLOSED
 
-    db_iface.cache_man.invalidate(storage.CACHE_NAMES.VALID_LOCAL,
-                                  (proc_node.id, loc_node['name']))
+    FdTable.close(loc_node.id)
 
 
 def drop_g(db_iface, loc_node, glob_node, githash=None):
@@ -186,6 +347,7 @@ def bind(db_iface, loc_node, glob_node, link_state=None):
     '''PVM bind between loc_node and glob_node.'''
     db_iface.create_relationship(glob_node, loc_node,
                                  storage.RelType.LOC_OBJ, link_state)
+    FdTable.set_global(loc_node.id, glob_node.id)
     db_iface.cache_man.invalidate(storage.CACHE_NAMES.LOCAL_GLOBAL,
                                   loc_node.id)
     ref_count = 0
@@ -198,6 +360,7 @@ def unbind(db_iface, loc_node, glob_node):
     '''PVM unbind between loc_node and glob_node.'''
     db_iface.find_and_del_rel(glob_node, loc_node)
     loc_node['ref_count'] = 0
+    FdTable.set_global(loc_node.id, None)
 
     db_iface.cache_man.invalidate(storage.CACHE_NAMES.LOCAL_GLOBAL,
                                   loc_node.id)
@@ -6,5 +6,10 @@ PVM posix package.
 from .core import (handle_function, handle_process,
                    handle_disconnect, handle_prefunc,
                    handle_startup, handle_cleanup,
-                   handle_bulk_functions, handle_libinfo,
-                   handle_proc_load_state, handle_proc_dump_state)
+                   handle_bulk_functions, decode_bulk_functions,
+                   decode_function, decode_protocol, decode_string_table,
+                   decode_disconnect, decode_startup, decode_libinfo,
+                   decode_host, handle_host, handle_summary,
+                   handle_libinfo, touches_globals,
+                   handle_proc_load_state, handle_proc_dump_state,
+                   handle_db_upgrade)
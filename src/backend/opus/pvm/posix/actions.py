@@ -12,6 +12,11 @@ from ... import pvm, storage, traversal
 from . import utils
 
 
+# Actions that only touch the locals of the calling process, never getting,
+# versioning or dropping a global.
+LOCAL_ACTIONS = frozenset(["event", "read", "write", "null"])
+
+
 class ActionMap(object):
     '''Mapping of action names to action functions.'''
     action_map = {}
@@ -26,6 +31,13 @@ class ActionMap(object):
             return cls.action_map[name]['func'](*args, **kwargs)
         return cls.action_map[name]['func'](err, *args, **kwargs)
 
+    @classmethod
+    def get(cls, name):
+        '''Returns the function associated with name and whether it is only
+        called for messages without an error.'''
+        entry = cls.action_map[name]
+        return entry['func'], entry['proc_err']
+
     @classmethod
     def add(cls, name, proc_err):
         '''Adds name => fun to the map.'''
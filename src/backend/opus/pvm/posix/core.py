@@ -10,19 +10,20 @@ from __future__ import (absolute_import, division,
 import logging
 
 from . import functions, process, utils
-from ... import storage
+from ... import storage, uds_msg_pb2
 
 
-def handle_function(db_iface, pid, msg):
-    '''Handle a function call message from the given pid.'''
+def handle_function(db_iface, pid, msg, args=None):
+    '''Handle a function call message from the given pid, with its
+    arguments if already decoded.'''
     db_iface.set_mono_time_for_msg(msg.begin_time)
+    if args is None:
+        args = utils.parse_kvpair_list(msg.args)
     try:
         proc_node = db_iface.get_node_by_id(
             process.ProcStateController.resolve_process(pid))
-        affected_node = functions.FuncController.call(msg.func_name,
-                                                      db_iface,
-                                                      proc_node,
-                                                      msg)
+        affected_node = functions.FuncController.call(
+            msg.func_name, db_iface, proc_node, msg, args)
         utils.add_event(db_iface, affected_node, msg)
     except functions.MissingMappingError as ex:
         logging.debug(ex)
@@ -31,14 +32,105 @@ def handle_function(db_iface, pid, msg):
         logging.error(msg)
 
 
-def handle_bulk_functions(db_iface, pid, msg):
-    '''Handle an aggregation message containing many messages.'''
+def decode_function(hdr, msg):
+    '''Decode the arguments of a function message, restoring the strings it
+    refers to by string table id.'''
+    strtab = utils.StringTable.get(hdr.pid, hdr.tid)
+    if strtab is None:
+        args = utils.parse_kvpair_list(msg.args)
+    else:
+        args = strtab.resolve(msg)
+    if hdr.pid >> utils.HOST_SHIFT:
+        utils.namespace_function(hdr.pid, msg, args)
+    return args
+
+
+def decode_bulk_functions(hdr, msg):
+    '''Decode the function messages of an aggregation message, returning
+    (message, arguments) pairs for handle_bulk_functions.'''
+    funcs = functions.decode_aggregate_functions(
+        msg.messages, utils.StringTable.get(hdr.pid, hdr.tid))
+    if hdr.pid >> utils.HOST_SHIFT:
+        for func_msg, args in funcs:
+            utils.namespace_function(hdr.pid, func_msg, args)
+    return funcs
+
+
+def decode_startup(hdr, pay):
+    '''Namespace the parent pid and paths of a startup message from a
+    relayed process.'''
+    host_id = utils.HostTable.lookup(hdr.pid)
+    if host_id is None:
+        return
+    pay.ppid = utils.host_pid(hdr.pid, pay.ppid)
+    pay.exec_name = utils.host_path(host_id, pay.exec_name)
+    if pay.HasField('cwd'):
+        pay.cwd = utils.host_path(host_id, pay.cwd)
+
+
+def decode_libinfo(hdr, pay):
+    '''Namespace the library paths of a library message from a relayed
+    process.'''
+    host_id = utils.HostTable.lookup(hdr.pid)
+    if host_id is None:
+        return
+    for pair in pay.library:
+        pair.key = utils.host_path(host_id, pair.key)
+
+
+def decode_host(hdr, pay):
+    '''Record the host id of a relay.'''
+    utils.HostTable.add(hdr.pid >> utils.HOST_SHIFT, pay.host_id)
+
+
+def decode_protocol(hdr, pay):
+    '''Start a string table for a connection opening with a protocol v2
+    hello.'''
+    if pay.version >= 2:
+        utils.StringTable.reset(hdr.pid, hdr.tid)
+
+
+def decode_string_table(hdr, pay):
+    '''Add the strings a connection defines to its string table.'''
+    strtab = utils.StringTable.get(hdr.pid, hdr.tid)
+    if strtab is None:
+        logging.error("String table message from %d:%d without a protocol "
+                      "hello.", hdr.pid, hdr.tid)
+        return
+    strtab.define(pay.strings)
+
+
+def decode_disconnect(hdr):
+    '''Drop the string tables of a disconnected process.'''
+    utils.StringTable.remove_pid(hdr.pid)
+
+
+def touches_globals(hdr, pay):
+    '''Returns whether handling a message may get, version or drop globals,
+    or change other state shared between process trees. Aggregated calls,
+    calls whose action only touches the locals of the process, pre-call
+    notices, summaries, term messages and messages handled when decoded do
+    not.'''
+    if hdr.payload_type == uds_msg_pb2.FUNCINFO_MSG:
+        return not functions.FuncController.is_local(pay.func_name)
+    elif hdr.payload_type == uds_msg_pb2.GENERIC_MSG:
+        return pay.msg_type == uds_msg_pb2.DISCON
+    return hdr.payload_type not in (uds_msg_pb2.AGGREGATION_MSG,
+                                    uds_msg_pb2.SUMMARY_MSG,
+                                    uds_msg_pb2.TERM_MSG,
+                                    uds_msg_pb2.PROTOCOL_MSG,
+                                    uds_msg_pb2.STRTAB_MSG)
+
+
+def handle_bulk_functions(db_iface, pid, funcs, chain_horizon):
+    '''Handle the decoded function messages of an aggregation message.'''
     proc_node = db_iface.get_node_by_id(
         process.ProcStateController.resolve_process(pid))
 
     functions.process_aggregate_functions(db_iface,
                                           proc_node,
-                                          msg.messages)
+                                          funcs,
+                                          chain_horizon)
 
 
 def handle_process(db_iface, hdr, pay, opus_lite):
@@ -63,6 +155,30 @@ def handle_disconnect(db_iface, hdr, pid):
     process.ProcStateController.proc_discon(db_iface, pid)
 
 
+def handle_host(db_iface, hdr, pay):
+    '''Handle a relay host message, disconnecting the processes of the
+    host if its relay restarted.'''
+    if pay.restart:
+        db_iface.set_mono_time_for_msg(hdr.timestamp)
+        process.ProcStateController.host_discon(db_iface,
+                                                hdr.pid >> utils.HOST_SHIFT)
+
+
+def handle_summary(db_iface, hdr, pay):
+    '''Handle a summary of the calls a producer filter rule removed or of
+    the gap left by calls the producer shed.'''
+    proc_id = process.ProcStateController.resolve_process(hdr.pid)
+    if proc_id is None:
+        return
+    proc_node = db_iface.get_node_by_id(proc_id)
+    if pay.gap:
+        utils.add_gap(db_iface, proc_node, pay.rule, pay.count,
+                      pay.begin_time, pay.end_time)
+    else:
+        utils.add_filtered_calls(db_iface, proc_node, pay.rule, pay.count,
+                                 hdr.timestamp)
+
+
 def handle_prefunc(pid, msg):
     '''Handle a pre-function call message.'''
     if "exec" in msg.msg_desc:
@@ -87,7 +203,15 @@ def handle_libinfo(db_iface, pid, pay):
     proc_node = db_iface.get_node_by_id(
         process.ProcStateController.resolve_process(pid))
 
-    time_stamp = proc_node['timestamp']
-    for pair in pay.library:
-        utils.add_meta_to_proc(db_iface, proc_node, pair.key, pair.value,
-                                time_stamp, storage.RelType.LIB_META)
+    utils.add_libs_to_proc(db_iface, proc_node,
+                           [(pair.key, pair.value) for pair in pay.library])
+
+
+def handle_db_upgrade(db_iface):
+    '''Bring a database written by an older analyser up to the current
+    PVM graph layout.'''
+    if db_iface.get_schema_version() < 1:
+        logging.info("Migrating library meta data to shared library sets.")
+        utils.migrate_lib_meta(db_iface)
+        with db_iface.start_transaction():
+            db_iface.set_schema_version(1)
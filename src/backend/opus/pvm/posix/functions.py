@@ -29,33 +29,54 @@ from ... import common_utils, opuspb, storage, traversal, uds_msg_pb2
 from ...exception import MissingMappingError
 
 
-def _parse_mapping(msg, mapping):
-    '''Given a message and an argument mapping, retrieve the value of that
-    argument.'''
-    if mapping[0] == "msg_arg":
-        args = utils.parse_kvpair_list(msg.args)
-        return args[mapping[1]]
-    elif mapping[0] == "msg_field":
-        if msg.HasField(mapping[1]):
-            return getattr(msg, mapping[1])
-        else:
-            return None
-    elif mapping[0] == "ret_val":
-        return str(msg.ret_val)
-    elif mapping[0] == "const":
-        return str(mapping[1])
-
-
-def wrap_action(action, arg_map):
-    '''Converts an item from the ActionMap into a lambda taking
-    storage interface, process node and a msg.'''
-    def fun(db_iface, proc_node, msg):
-        '''Wrapper internal. '''
-        arg_set = {}
-        for k, val in arg_map.items():
-            arg_set[k] = _parse_mapping(msg, val)
-        return actions.ActionMap.call(action, msg.error_num,
-                                      db_iface, proc_node, **arg_set)
+def _compile_mapping(mapping):
+    '''Given an argument mapping, return a function retrieving the value of
+    that argument from a message and its decoded argument dictionary.'''
+    kind, field = mapping[0], mapping[1] if len(mapping) > 1 else None
+    if kind == "msg_arg":
+        return lambda msg, args: args[field]
+    elif kind == "msg_field":
+        return lambda msg, args: (getattr(msg, field)
+                                  if msg.HasField(field) else None)
+    elif kind == "ret_val":
+        return lambda msg, args: str(msg.ret_val)
+    elif kind == "const":
+        const = str(field)
+        return lambda msg, args: const
+    raise ValueError("Invalid argument mapping {}.".format(mapping))
+
+
+def compile_arg_map(arg_map):
+    '''Compiles an argument mapping from the function specification into a
+    decoder producing the keyword arguments of the action from a message and
+    its decoded argument dictionary.'''
+    getters = [(name, _compile_mapping(mapping))
+               for name, mapping in arg_map.items()]
+
+    def decode(msg, args):
+        '''Decoder internal.'''
+        return {name: getter(msg, args) for name, getter in getters}
+    return decode
+
+
+def compile_action(action, arg_map):
+    '''Converts an item from the ActionMap into a function taking storage
+    interface, process node, a msg and its decoded arguments, binding the
+    action and its argument decoder once at load time.'''
+    func, proc_err = actions.ActionMap.get(action)
+    decode = compile_arg_map(arg_map)
+
+    if proc_err:
+        def fun(db_iface, proc_node, msg, args):
+            '''Compiled action internal.'''
+            if msg.error_num > 0:
+                return proc_node
+            return func(db_iface, proc_node, **decode(msg, args))
+    else:
+        def fun(db_iface, proc_node, msg, args):
+            '''Compiled action internal.'''
+            return func(msg.error_num, db_iface, proc_node,
+                        **decode(msg, args))
     return fun
 
 
@@ -63,16 +84,24 @@ class FuncController(object):
     '''Mapping for function names to definitions.'''
     funcs = {}
     func_map = {}
+    fd_getters = {}
+    local_funcs = set()  # Functions whose action touches no global
 
     @classmethod
     def load(cls, func_file):
-        '''Loads a YAML action specification from func_file.'''
+        '''Loads a YAML action specification from func_file, compiling each
+        mapping into a specialised handler.'''
         try:
             with pkg_resources.resource_stream("opus.pvm.posix",
                                                func_file) as conf:
                 cls.func_map = yaml.safe_load(conf)
                 for func_name, mapping in cls.func_map.items():
-                    cls.register(func_name, wrap_action(**mapping))
+                    cls.register(func_name, compile_action(**mapping))
+                    if mapping['action'] in actions.LOCAL_ACTIONS:
+                        cls.local_funcs.add(func_name)
+                    if 'filedes' in mapping['arg_map']:
+                        cls.fd_getters[func_name] = _compile_mapping(
+                            mapping['arg_map']['filedes'])
         except IOError:
             logging.error("Failed to read in config file.")
             raise
@@ -83,14 +112,21 @@ class FuncController(object):
         cls.funcs[name] = func
 
     @classmethod
-    def call(cls, name, *args):
-        '''Calls the method associated with name with any subsequent
-        arguments.'''
-        if name in cls.funcs:
-            return cls.funcs[name](*args)
-        else:
+    def call(cls, name, db_iface, proc_node, msg, args):
+        '''Calls the method associated with name with the storage
+        interface, process node, message and decoded message arguments.'''
+        try:
+            func = cls.funcs[name]
+        except KeyError:
             logging.error("Failed to find mapping for function %s.", name)
             raise MissingMappingError()
+        return func(db_iface, proc_node, msg, args)
+
+    @classmethod
+    def is_local(cls, name):
+        '''Returns whether the function name only touches the locals of the
+        calling process.'''
+        return name in cls.local_funcs
 
     @classmethod
     def dec(cls, name):
@@ -105,14 +141,16 @@ class FuncController(object):
 FuncController.load("pvm.yaml")
 
 
-def get_fd_from_msg(msg):
-    '''Given a function message retrieves the filedescriptor it operates on.'''
-    mapping = FuncController.func_map[msg.func_name]['arg_map']['filedes']
-    return _parse_mapping(msg, mapping)
+def get_fd_from_msg(msg, args):
+    '''Given a function message and its decoded arguments retrieves the
+    filedescriptor it operates on.'''
+    return FuncController.fd_getters[msg.func_name](msg, args)
 
 
-def load_cache(db_iface, loc_name, proc_node, mono_time):
-    '''Loads the event cache data for a given local node.'''
+def load_cache(db_iface, loc_name, proc_node, mono_time, horizon):
+    '''Loads the event cache data for a given local node. Only the suffix
+    of each chain reaching back horizon nanoseconds before mono_time is
+    read, older events are fetched on demand by extend_chain.'''
     logging.debug("Loading IO event cache from the database")
 
     db_iface.set_mono_time_for_msg(mono_time)
@@ -122,32 +160,101 @@ def load_cache(db_iface, loc_name, proc_node, mono_time):
     except utils.NoMatchingLocalError:
         pass
 
-    result = db_iface.query("START s=node(" + str(proc_node.id) + ") "
+    result = db_iface.query("START s=node({id}) "
                             "MATCH (s)<-[:PROC_OBJ]-(l),"
-                            "(l)-[?:IO_EVENTS]->(m), "
-                            "p=(m)-[:PREV_EVENT*0..]->(n) "
-                            "WHERE l.name = '" + loc_name + "' "
-                            "AND not((n)-[:PREV_EVENT]->()) "
-                            "RETURN l,NODES(p) ORDER BY l.mono_time")
+                            "(l)-[?:IO_EVENTS]->(m) "
+                            "WHERE l.name = {name} "
+                            "RETURN l,m ORDER BY l.mono_time",
+                            id=proc_node.id, name=loc_name)
 
-    ret = common_utils.IndexList(lambda x: int(x.local['mono_time']))
+    ret = common_utils.SkipList(lambda x: int(x.local['mono_time']))
 
     for row in result:
         chain = storage.FdChain()
         chain.local = row['l']
-        if row['NODES(p)'] is not None:
-            for node in row['NODES(p)']:
-                chain.chain.insert(0, node)
+        chain.frontier = row['m']
+        extend_chain(chain, mono_time, horizon)
         ret.append(chain)
     return ret
 
 
-def process_aggregate_functions(db_iface, proc_node, msg_list):
-    '''Processes an aggregation message.'''
+def extend_chain(chain, mono_time, horizon):
+    '''Walks the PREV_EVENT links back from the frontier of chain, adding
+    events until one at least horizon nanoseconds older than mono_time has
+    been loaded or the start of the chain is reached.'''
+    limit = mono_time - horizon
+    node = chain.frontier
+    while node is not None:
+        chain.chain.prepend(node)
+        older = None
+        for tmp_rel in node.PREV_EVENT.outgoing:
+            older = tmp_rel.end
+        if int(node['before_time']) <= limit:
+            chain.frontier = older
+            return
+        node = older
+    chain.frontier = None
+
+
+def needs_extension(chain, mono_time):
+    '''Checks if an event at mono_time could precede events of chain that
+    have not been loaded from the graph yet.'''
+    if chain.frontier is None:
+        return False
+    first = chain.chain.first()
+    return first is None or mono_time <= int(first['before_time'])
+
+
+def relink_chain(db_iface, chain):
+    '''Writes the positions of the events inserted into chain since the last
+    relink to the graph, linking each new event between its neighbours.'''
+    for node in chain.pending:
+        evt = node.val
+
+        if node.prev is not None:
+            db_iface.create_relationship(evt, node.prev.val,
+                                         storage.RelType.PREV_EVENT)
+
+        if node.next is None:
+            for tmp_rel in chain.local.IO_EVENTS.outgoing:
+                db_iface.delete_relationship(tmp_rel)
+            db_iface.create_relationship(chain.local, evt,
+                                         storage.RelType.IO_EVENTS)
+            db_iface.cache_man.invalidate(storage.CACHE_NAMES.LAST_EVENT,
+                                          chain.local.id)
+        elif node.next not in chain.pending:
+            for tmp_rel in node.next.val.PREV_EVENT.outgoing:
+                db_iface.delete_relationship(tmp_rel)
+            db_iface.create_relationship(node.next.val, evt,
+                                         storage.RelType.PREV_EVENT)
+    chain.pending = set()
+
+
+def decode_aggregate_functions(msg_list, strtab=None):
+    '''Decodes the serialised function messages carried by an aggregation
+    message into a list of (message, decoded arguments) pairs, resolving
+    string ids from the string table strtab of the sending connection.'''
+    funcs = []
     for smsg in msg_list:
         msg = uds_msg_pb2.FuncInfoMessage()
         msg.ParseFromString(smsg)
-        des = get_fd_from_msg(msg)
+        if strtab is None:
+            funcs.append((msg, utils.parse_kvpair_list(msg.args)))
+        else:
+            funcs.append((msg, strtab.resolve(msg)))
+    return funcs
+
+
+def process_aggregate_functions(db_iface, proc_node, funcs, horizon):
+    '''Processes an aggregation message. Events are slotted into their fd
+    chains in memory and the chains are relinked in the graph once all of
+    the messages have been placed. Chains read from the graph hold only
+    the last horizon nanoseconds of events until an older event arrives.'''
+    loaded = {}
+    dirty = []
+
+    for msg, args in funcs:
+        des = get_fd_from_msg(msg, args)
 
         db_iface.set_mono_time_for_msg(msg.begin_time)
 
@@ -155,63 +262,37 @@ def process_aggregate_functions(db_iface, proc_node, msg_list):
                                           (proc_node.id, des))
 
         if idx_list is None:
-            idx_list = load_cache(db_iface, des, proc_node, msg.begin_time)
+            # Chains loaded for this message are reused so that events
+            # placed but not yet relinked are seen by later events.
+            if des not in loaded:
+                loaded[des] = load_cache(db_iface, des, proc_node,
+                                         msg.begin_time, horizon)
+            idx_list = loaded[des]
 
         evt = utils.event_from_msg(db_iface, msg)
 
-        j = idx_list.find(evt, key=lambda x: int(x['before_time']))
+        chain = idx_list.floor(int(evt['before_time']))
 
-        if j == 0:
+        if chain is None:
             logging.error("Misplaced message.")
             logging.error(evt.__repr__())
             logging.error(idx_list)
             logging.error(evt['before_time'])
             continue
 
-        # J pointed to local after the needed one
-        chain = idx_list[j-1]
-
-        if len(chain.chain) == 0:
-            db_iface.create_relationship(chain.local, evt,
-                                         storage.RelType.IO_EVENTS)
-            db_iface.cache_man.invalidate(storage.CACHE_NAMES.LAST_EVENT,
-                                          chain.local.id)
-            chain.chain.insert(0, evt)
-        else:
-            i = chain.chain.find(evt)
-
-            if i == 0:
-                db_iface.create_relationship(
-                    chain.chain[0], evt, storage.RelType.PREV_EVENT)
-                chain.chain.insert(0, evt)
-            elif i == len(chain.chain):
-                end = len(chain.chain)
-
-                for tmp_rel in chain.local.IO_EVENTS.outgoing:
-                    db_iface.delete_relationship(tmp_rel)
+        if needs_extension(chain, int(evt['before_time'])):
+            extend_chain(chain, int(evt['before_time']), horizon)
 
-                db_iface.create_relationship(
-                    evt, chain.chain[end-1], storage.RelType.PREV_EVENT)
-                db_iface.create_relationship(
-                    chain.local, evt, storage.RelType.IO_EVENTS)
+        if not chain.pending:
+            dirty.append(chain)
+        chain.pending.add(chain.chain.insert(evt))
 
-                db_iface.cache_man.invalidate(storage.CACHE_NAMES.LAST_EVENT,
-                                              chain.local.id)
-                chain.chain.append(evt)
-            else:
-                for tmp_rel in chain.chain[i].PREV_EVENT.outgoing:
-                    db_iface.delete_relationship(tmp_rel)
-
-                db_iface.create_relationship(
-                    chain.chain[i], evt, storage.RelType.PREV_EVENT)
-                db_iface.create_relationship(
-                    evt, chain.chain[i-1], storage.RelType.PREV_EVENT)
-
-                chain.chain.insert(i, evt)
+    for chain in dirty:
+        relink_chain(db_iface, chain)
 
 
 @FuncController.dec('fork')
-def posix_fork(db_iface, proc_node, msg):
+def posix_fork(db_iface, proc_node, msg, args):
     '''Implementation of fork in PVM semantics.'''
     process.ProcStateController.proc_fork(db_iface, proc_node,
                                           msg.ret_val, msg.begin_time)
@@ -220,7 +301,7 @@ def posix_fork(db_iface, proc_node, msg):
 
 @FuncController.dec('popen')
 @utils.check_message_error_num
-def posix_popen(db_iface, proc_node, msg):
+def posix_popen(db_iface, proc_node, msg, args):
     '''Implementation of popen in PVM semantics.'''
     loc_node = pvm.get_l(db_iface, proc_node, str(msg.ret_val))
     return loc_node  # TODO(tb403) properly implement pipes
@@ -228,7 +309,7 @@ def posix_popen(db_iface, proc_node, msg):
 
 @FuncController.dec('fcloseall')
 @utils.check_message_error_num
-def posix_fcloseall(db_iface, proc_node, _):
+def posix_fcloseall(db_iface, proc_node, _, args):
     '''Implementation of fcloseall in PVM semantics.'''
     local_node_link_list = traversal.get_locals_from_process(db_iface,
                                                              proc_node)
@@ -245,10 +326,8 @@ def posix_fcloseall(db_iface, proc_node, _):
 
 
 @FuncController.dec('freopen')
-def posix_freopen(db_iface, proc_node, msg):
+def posix_freopen(db_iface, proc_node, msg, args):
     '''Implementation of freopen in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
-
     try:
         utils.proc_get_local(db_iface, proc_node, args['stream'])
     except utils.NoMatchingLocalError:
@@ -263,9 +342,8 @@ def posix_freopen(db_iface, proc_node, msg):
 
 
 @FuncController.dec('freopen64')
-def posix_freopen64(db_iface, proc_node, msg):
+def posix_freopen64(db_iface, proc_node, msg, args):
     '''Implementation of freopen64 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     try:
         utils.proc_get_local(db_iface, proc_node, args['stream'])
     except utils.NoMatchingLocalError:
@@ -281,7 +359,7 @@ def posix_freopen64(db_iface, proc_node, msg):
 
 @FuncController.dec('socket')
 @utils.check_message_error_num
-def posix_socket(db_iface, proc_node, msg):
+def posix_socket(db_iface, proc_node, msg, args):
     '''Implementation of socket in PVM semantics.'''
     loc_node = pvm.get_l(db_iface, proc_node, str(msg.ret_val))
     return loc_node
@@ -289,7 +367,7 @@ def posix_socket(db_iface, proc_node, msg):
 
 @FuncController.dec('accept')
 @utils.check_message_error_num
-def posix_accept(db_iface, proc_node, msg):
+def posix_accept(db_iface, proc_node, msg, args):
     '''Implementation of accept in PVM semantics.'''
     loc_node = pvm.get_l(db_iface, proc_node, str(msg.ret_val))
     return loc_node
@@ -297,30 +375,29 @@ def posix_accept(db_iface, proc_node, msg):
 
 @FuncController.dec('pipe')
 @utils.check_message_error_num
-def posix_pipe(db_iface, proc_node, msg):
+def posix_pipe(db_iface, proc_node, msg, args):
     '''Implementation of pipe in PVM semantics.'''
-    return utils.process_rw_pair(db_iface, proc_node, msg)
+    return utils.process_rw_pair(db_iface, proc_node, msg, args)
 
 
 @FuncController.dec('pipe2')
 @utils.check_message_error_num
-def posix_pipe2(db_iface, proc_node, msg):
+def posix_pipe2(db_iface, proc_node, msg, args):
     '''Implementation of pipe2 in PVM semantics.'''
-    return utils.process_rw_pair(db_iface, proc_node, msg)
+    return utils.process_rw_pair(db_iface, proc_node, msg, args)
 
 
 @FuncController.dec('socketpair')
 @utils.check_message_error_num
-def posix_socketpair(db_iface, proc_node, msg):
+def posix_socketpair(db_iface, proc_node, msg, args):
     '''Implementation of socketpair in PVM semantics.'''
-    return utils.process_rw_pair(db_iface, proc_node, msg)
+    return utils.process_rw_pair(db_iface, proc_node, msg, args)
 
 
 @FuncController.dec('dup')
 @utils.check_message_error_num
-def posix_dup(db_iface, proc_node, msg):
+def posix_dup(db_iface, proc_node, msg, args):
     '''Implementation of dup in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     old_fd = args['oldfd']
     new_fd = str(msg.ret_val)
     loc_node = utils.proc_get_local(db_iface, proc_node, old_fd)
@@ -330,9 +407,8 @@ def posix_dup(db_iface, proc_node, msg):
 
 @FuncController.dec('dup2')
 @utils.check_message_error_num
-def posix_dup2(db_iface, proc_node, msg):
+def posix_dup2(db_iface, proc_node, msg, args):
     '''Implementation of dup2 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     old_fd = args['oldfd']
     new_fd = args['newfd']
     loc_node = utils.proc_get_local(db_iface, proc_node, old_fd)
@@ -342,9 +418,8 @@ def posix_dup2(db_iface, proc_node, msg):
 
 @FuncController.dec('dup3')
 @utils.check_message_error_num
-def posix_dup3(db_iface, proc_node, msg):
+def posix_dup3(db_iface, proc_node, msg, args):
     '''Implementation of dup3 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     old_fd = args['oldfd']
     new_fd = args['newfd']
     loc_node = utils.proc_get_local(db_iface, proc_node, old_fd)
@@ -353,16 +428,15 @@ def posix_dup3(db_iface, proc_node, msg):
 
 
 @FuncController.dec('renameat')
-def posix_renameat(db_iface, p_id, msg):
+def posix_renameat(db_iface, p_id, msg, args):
     '''Implementation of renameat in PVM semantics.'''
-    return posix_rename(db_iface, p_id, msg)
+    return posix_rename(db_iface, p_id, msg, args)
 
 
 @FuncController.dec('rename')
-def posix_rename(db_iface, proc_node, msg):
+def posix_rename(db_iface, proc_node, msg, args):
     '''Implementation of rename in PVM semantics.'''
     # TODO(tb403): Fix to only use a single omega.
-    args = utils.parse_kvpair_list(msg.args)
     dest_glob_node = traversal.get_latest_glob_version(db_iface,
                                                        args['newpath'])
 
@@ -376,9 +450,8 @@ def posix_rename(db_iface, proc_node, msg):
 
 
 @FuncController.dec('umask')
-def posix_umask(db_iface, proc_node, msg):
+def posix_umask(db_iface, proc_node, msg, args):
     '''Implementation of umask in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "file_mode_creation_mask",
                            args["mask"], msg.end_time)
     return proc_node
@@ -386,7 +459,7 @@ def posix_umask(db_iface, proc_node, msg):
 
 @FuncController.dec('tmpfile')
 @utils.check_message_error_num
-def posix_tmpfile(db_iface, proc_node, msg):
+def posix_tmpfile(db_iface, proc_node, msg, args):
     '''Implementation of tmpfile in PVM semantics.'''
     loc_node = pvm.get_l(db_iface, proc_node, str(msg.ret_val))
     return loc_node
@@ -394,7 +467,7 @@ def posix_tmpfile(db_iface, proc_node, msg):
 
 @FuncController.dec('tmpfile64')
 @utils.check_message_error_num
-def posix_tmpfile64(db_iface, proc_node, msg):
+def posix_tmpfile64(db_iface, proc_node, msg, args):
     '''Implementation of tmpfile64 in PVM semantics.'''
     loc_node = pvm.get_l(db_iface, proc_node, str(msg.ret_val))
     return loc_node
@@ -402,18 +475,16 @@ def posix_tmpfile64(db_iface, proc_node, msg):
 
 @FuncController.dec('chdir')
 @utils.check_message_error_num
-def posix_chdir(db_iface, proc_node, msg):
+def posix_chdir(db_iface, proc_node, msg, args):
     '''Implementation of chdir in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "cwd",
                            args["path"], msg.end_time)
     return proc_node
 
 
 @FuncController.dec('fchdir')
-def posix_fchdir(db_iface, proc_node, msg):
+def posix_fchdir(db_iface, proc_node, msg, args):
     '''Implementation of fchdir in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     try:
         loc_node = utils.proc_get_local(db_iface, proc_node, args['fd'])
     except utils.NoMatchingLocalError:
@@ -437,9 +508,8 @@ def posix_fchdir(db_iface, proc_node, msg):
 
 @FuncController.dec('seteuid')
 @utils.check_message_error_num
-def posix_seteuid(db_iface, proc_node, msg):
+def posix_seteuid(db_iface, proc_node, msg, args):
     '''Implementation of seteuid in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "euid",
                            args["euid"], msg.end_time)
     return proc_node
@@ -447,9 +517,8 @@ def posix_seteuid(db_iface, proc_node, msg):
 
 @FuncController.dec('setegid')
 @utils.check_message_error_num
-def posix_setegid(db_iface, proc_node, msg):
+def posix_setegid(db_iface, proc_node, msg, args):
     '''Implementation of setegid in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "egid",
                            args["egid"], msg.end_time)
     return proc_node
@@ -457,9 +526,8 @@ def posix_setegid(db_iface, proc_node, msg):
 
 @FuncController.dec('setgid')
 @utils.check_message_error_num
-def posix_setgid(db_iface, proc_node, msg):
+def posix_setgid(db_iface, proc_node, msg, args):
     '''Implementation of setgid in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "gid",
                            args["gid"], msg.end_time)
     return proc_node
@@ -467,9 +535,8 @@ def posix_setgid(db_iface, proc_node, msg):
 
 @FuncController.dec('setreuid')
 @utils.check_message_error_num
-def posix_setreuid(db_iface, proc_node, msg):
+def posix_setreuid(db_iface, proc_node, msg, args):
     '''Implementation of setreuid in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "ruid",
                            args["ruid"], msg.end_time)
     utils.update_proc_meta(db_iface, proc_node, "euid",
@@ -479,9 +546,8 @@ def posix_setreuid(db_iface, proc_node, msg):
 
 @FuncController.dec('setregid')
 @utils.check_message_error_num
-def posix_setregid(db_iface, proc_node, msg):
+def posix_setregid(db_iface, proc_node, msg, args):
     '''Implementation of setregid in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "rgid",
                            args["rgid"], msg.end_time)
     utils.update_proc_meta(db_iface, proc_node, "egid",
@@ -491,9 +557,8 @@ def posix_setregid(db_iface, proc_node, msg):
 
 @FuncController.dec('setuid')
 @utils.check_message_error_num
-def posix_setuid(db_iface, proc_node, msg):
+def posix_setuid(db_iface, proc_node, msg, args):
     '''Implementation of setuid in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     utils.update_proc_meta(db_iface, proc_node, "uid",
                            args["uid"], msg.end_time)
     return proc_node
@@ -501,22 +566,21 @@ def posix_setuid(db_iface, proc_node, msg):
 
 @FuncController.dec('clearenv')
 @utils.check_message_error_num
-def posix_clearenv(db_iface, proc_node, msg):
+def posix_clearenv(db_iface, proc_node, msg, args):
     '''Implementation of clearenv in PVM semantics.'''
-    env_meta_list = traversal.get_proc_meta(db_iface, proc_node,
-                                            storage.RelType.ENV_META)
+    env_meta_list = utils.get_proc_meta_rels(db_iface, proc_node,
+                                             storage.RelType.ENV_META)
 
-    for meta_node, meta_rel in env_meta_list:
-        utils.version_meta(db_iface, proc_node, meta_node, meta_rel,
-                           (meta_node['name'], None, msg.end_time))
+    for name, meta_rel in env_meta_list:
+        utils.version_meta(db_iface, proc_node, meta_rel.end, meta_rel,
+                           (name, None, msg.end_time))
     return proc_node
 
 
 @FuncController.dec('putenv')
 @utils.check_message_error_num
-def posix_putenv(db_iface, proc_node, msg):
+def posix_putenv(db_iface, proc_node, msg, args):
     '''Implementation of putenv in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
 
     parts = args['string'].split("=")
     if len(parts) == 2:
@@ -529,9 +593,8 @@ def posix_putenv(db_iface, proc_node, msg):
 
 @FuncController.dec('setenv')
 @utils.check_message_error_num
-def posix_setenv(db_iface, proc_node, msg):
+def posix_setenv(db_iface, proc_node, msg, args):
     '''Implementation of setenv in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     env = (args['name'], args['value'], msg.end_time)
     utils.process_put_env(db_iface, proc_node, env, args['overwrite'] > 0)
     return proc_node
@@ -539,9 +602,8 @@ def posix_setenv(db_iface, proc_node, msg):
 
 @FuncController.dec('unsetenv')
 @utils.check_message_error_num
-def posix_unsetenv(db_iface, proc_node, msg):
+def posix_unsetenv(db_iface, proc_node, msg, args):
     '''Implementation of unsetenv in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     env = (args['name'], None, msg.end_time)
     utils.process_put_env(db_iface, proc_node, env, True)
     return proc_node
@@ -549,9 +611,8 @@ def posix_unsetenv(db_iface, proc_node, msg):
 
 @FuncController.dec('fcntl')
 @utils.check_message_error_num
-def posix_fcntl(db_iface, proc_node, msg):
+def posix_fcntl(db_iface, proc_node, msg, args):
     '''Implementation of fnctl in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_node = utils.proc_get_local(db_iface, proc_node, args['filedes'])
 
     if int(args['cmd']) == fcntl.F_DUPFD:
@@ -563,11 +624,11 @@ def posix_fcntl(db_iface, proc_node, msg):
                           storage.LinkState.CLOEXEC)
     if int(args['cmd']) == fcntl.F_SETFD:
         if int(args['arg']) == fcntl.FD_CLOEXEC:
-            db_iface.set_link_state(loc_node.PROC_OBJ.outgoing,
-                                    storage.LinkState.CLOEXEC)
+            pvm.set_local_state(db_iface, loc_node,
+                                storage.LinkState.CLOEXEC)
         else:
-            db_iface.set_link_state(loc_node.PROC_OBJ.outgoing,
-                                    storage.LinkState.NONE)
+            pvm.set_local_state(db_iface, loc_node,
+                                storage.LinkState.NONE)
 
     return loc_node
 
@@ -598,9 +659,8 @@ def parse_omode(mode):
 
 @FuncController.dec('creat')
 @utils.check_message_error_num
-def posix_creat(db_iface, proc_node, msg):
+def posix_creat(db_iface, proc_node, msg, args):
     '''Implementation of creat in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['pathname'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -612,9 +672,8 @@ def posix_creat(db_iface, proc_node, msg):
 
 @FuncController.dec('creat64')
 @utils.check_message_error_num
-def posix_creat64(db_iface, proc_node, msg):
+def posix_creat64(db_iface, proc_node, msg, args):
     '''Implementation of creat64 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['pathname'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -626,9 +685,8 @@ def posix_creat64(db_iface, proc_node, msg):
 
 @FuncController.dec('fopen')
 @utils.check_message_error_num
-def posix_fopen(db_iface, proc_node, msg):
+def posix_fopen(db_iface, proc_node, msg, args):
     '''Implementation of fopen in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     git_hash = utils.parse_git_hash(msg)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['path'], str(msg.ret_val),
@@ -642,9 +700,8 @@ def posix_fopen(db_iface, proc_node, msg):
 
 @FuncController.dec('fopen64')
 @utils.check_message_error_num
-def posix_fopen64(db_iface, proc_node, msg):
+def posix_fopen64(db_iface, proc_node, msg, args):
     '''Implementation of fopen64 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     git_hash = utils.parse_git_hash(msg)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['path'], str(msg.ret_val),
@@ -658,9 +715,8 @@ def posix_fopen64(db_iface, proc_node, msg):
 
 @FuncController.dec('open')
 @utils.check_message_error_num
-def posix_open(db_iface, proc_node, msg):
+def posix_open(db_iface, proc_node, msg, args):
     '''Implementation of open in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     git_hash = utils.parse_git_hash(msg)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['pathname'], str(msg.ret_val),
@@ -674,9 +730,8 @@ def posix_open(db_iface, proc_node, msg):
 
 @FuncController.dec('open64')
 @utils.check_message_error_num
-def posix_open64(db_iface, proc_node, msg):
+def posix_open64(db_iface, proc_node, msg, args):
     '''Implementation of open64 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     git_hash = utils.parse_git_hash(msg)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['pathname'], str(msg.ret_val),
@@ -690,9 +745,8 @@ def posix_open64(db_iface, proc_node, msg):
 
 @FuncController.dec('mkstemp')
 @utils.check_message_error_num
-def posix_mkstemp(db_iface, proc_node, msg):
+def posix_mkstemp(db_iface, proc_node, msg, args):
     '''Implementation of mkstemp in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['templ'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -704,9 +758,8 @@ def posix_mkstemp(db_iface, proc_node, msg):
 
 @FuncController.dec('mkostemp')
 @utils.check_message_error_num
-def posix_mkostemp(db_iface, proc_node, msg):
+def posix_mkostemp(db_iface, proc_node, msg, args):
     '''Implementation of mkostemp in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['templ'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -718,9 +771,8 @@ def posix_mkostemp(db_iface, proc_node, msg):
 
 @FuncController.dec('mkstemps')
 @utils.check_message_error_num
-def posix_mkstemps(db_iface, proc_node, msg):
+def posix_mkstemps(db_iface, proc_node, msg, args):
     '''Implementation of mkstemps in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['templ'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -732,9 +784,8 @@ def posix_mkstemps(db_iface, proc_node, msg):
 
 @FuncController.dec('mkostemps')
 @utils.check_message_error_num
-def posix_mkostemps(db_iface, proc_node, msg):
+def posix_mkostemps(db_iface, proc_node, msg, args):
     '''Implementation of mkostemps in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['templ'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -746,9 +797,8 @@ def posix_mkostemps(db_iface, proc_node, msg):
 
 @FuncController.dec('openat')
 @utils.check_message_error_num
-def posix_openat(db_iface, proc_node, msg):
+def posix_openat(db_iface, proc_node, msg, args):
     '''Implementation of openat in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['file_path'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -760,9 +810,8 @@ def posix_openat(db_iface, proc_node, msg):
 
 @FuncController.dec('openat64')
 @utils.check_message_error_num
-def posix_openat64(db_iface, proc_node, msg):
+def posix_openat64(db_iface, proc_node, msg, args):
     '''Implementation of openat64 in PVM semantics.'''
-    args = utils.parse_kvpair_list(msg.args)
     loc_obj = actions.open_action(db_iface, proc_node,
                                   args['file_path'], str(msg.ret_val))
     if proc_node['opus_lite']:
@@ -19,10 +19,15 @@ def create_proc(db_iface, pid, time_stamp):
     proc_node = db_iface.create_node(storage.NodeType.PROCESS)
 
     # Set properties on the process node
-    proc_node['pid'] = pid
+    proc_node['pid'] = pid & ((1 << utils.HOST_SHIFT) - 1)
+    host_id = utils.HostTable.lookup(pid)
+    if host_id is not None:
+        proc_node['host'] = host_id
     proc_node['timestamp'] = time_stamp
     proc_node['status'] = storage.PROCESS_STATE.ALIVE
 
+    pvm.FdTable.add_proc(proc_node.id)
+
     # Cache the process node by its node_id property
     db_iface.cache_man.update(storage.CACHE_NAMES.NODE_BY_ID,
                             proc_node.id, proc_node)
@@ -35,6 +40,7 @@ def expand_proc(db_iface, proc_node, pay, opus_lite):
     from a given startup message payload 'pay'.'''
     time_stamp = proc_node['timestamp']
     proc_node['opus_lite'] = opus_lite
+    utils.MetaTable.add_proc(proc_node.id)
 
     loc_node = actions.touch_action(db_iface, proc_node, pay.exec_name)
     utils.set_link(db_iface, loc_node, storage.LinkState.BIN)
@@ -72,8 +78,7 @@ def expand_proc(db_iface, proc_node, pay, opus_lite):
 def clone_file_des(db_iface, old_proc_node, new_proc_node):
     '''Copies over file descriptors, and global to process path information
     from the old_proc_node to new_proc_node.'''
-    loc_node_link_list = traversal.get_locals_from_process(db_iface,
-                                                           old_proc_node)
+    loc_node_link_list = pvm.get_open_locals(db_iface, old_proc_node)
     for (loc_node, loc_proc_rel) in loc_node_link_list:
         if loc_proc_rel['state'] in [storage.LinkState.CLOSED,
                                      storage.LinkState.CLOEXEC]:
@@ -252,6 +257,9 @@ class ProcStateController(object):
 
     @classmethod
     def __clear_process_cache(cls, db_iface, proc_node):
+        pvm.FdTable.remove_proc(proc_node.id)
+        utils.MetaTable.remove_proc(proc_node.id)
+
         for tmp_rel in proc_node.PROC_OBJ.incoming:
             tmp_loc = tmp_rel.start
 
@@ -260,10 +268,6 @@ class ProcStateController(object):
                 storage.CACHE_NAMES.IO_EVENT_CHAIN,
                 (proc_node.id, tmp_loc['name']))
 
-            db_iface.cache_man.invalidate(
-                storage.CACHE_NAMES.VALID_LOCAL,
-                (proc_node.id, tmp_loc['name']))
-
             db_iface.cache_man.invalidate(
                 storage.CACHE_NAMES.LOCAL_GLOBAL,
                 tmp_loc.id)
@@ -335,6 +339,16 @@ class ProcStateController(object):
                             pid)
             return False
 
+    @classmethod
+    def host_discon(cls, db_iface, host_num):
+        '''Handles every process of the relayed host host_num
+        disconnecting at once, as when its relay restarts.'''
+        for pid in [pid for pid in cls.proc_map
+                    if pid >> utils.HOST_SHIFT == host_num]:
+            # A process that exec'd will not disconnect its new image.
+            cls.proc_map[pid] = cls.proc_states.NORMAL
+            cls.proc_discon(db_iface, pid)
+
     @classmethod
     def resolve_process(cls, pid):
         '''Attempts to resolve an ID for a process with pid 'pid'. Logs an
@@ -355,6 +369,10 @@ class ProcStateController(object):
                 pickle.dump(cls.proc_map, fh)
                 pickle.dump(cls.PIDMAP, fh)
                 pickle.dump(cls.pid_proc_nodes_map, fh)
+                pickle.dump(pvm.FdTable.snapshot(), fh)
+                pickle.dump(utils.MetaTable.snapshot(), fh)
+                pickle.dump(utils.StringTable.snapshot(), fh)
+                pickle.dump(utils.HostTable.snapshot(), fh)
         except IOError as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException("OPUS file open error, %s", file_name)
@@ -370,6 +388,25 @@ class ProcStateController(object):
                 cls.proc_map = pickle.load(fh)
                 cls.PIDMAP = pickle.load(fh)
                 cls.pid_proc_nodes_map = pickle.load(fh)
+                try:
+                    pvm.FdTable.restore(pickle.load(fh))
+                    utils.MetaTable.restore(pickle.load(fh))
+                except EOFError:
+                    # Snapshot written before descriptors and meta objects
+                    # were tracked, tables are rebuilt from the database on
+                    # first use.
+                    pvm.FdTable.clear()
+                    utils.MetaTable.clear()
+                try:
+                    utils.StringTable.restore(pickle.load(fh))
+                except EOFError:
+                    # Snapshot written before string tables were kept.
+                    utils.StringTable.clear()
+                try:
+                    utils.HostTable.restore(pickle.load(fh))
+                except EOFError:
+                    # Snapshot written before hosts were relayed.
+                    utils.HostTable.clear()
         except IOError as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException("OPUS file open error, %s", file_name)
@@ -382,3 +419,6 @@ class ProcStateController(object):
         '''Clears up the classes data structures.'''
         cls.PIDMAP = {}
         cls.proc_map = {}
+        pvm.FdTable.clear()
+        utils.MetaTable.clear()
+        utils.StringTable.clear()
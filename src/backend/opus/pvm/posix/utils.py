@@ -9,10 +9,18 @@ from __future__ import (absolute_import, division,
 
 
 import functools
+import hashlib
 import logging
 
 from ... import pvm, storage, traversal
 from ...exception import NoMatchingLocalError, InvalidNodeTypeException
+from ...relay import HOST_SHIFT
+
+
+# Function arguments holding paths, prefixed with the host id of relayed
+# messages.
+PATH_ARGS = frozenset(["filename", "file_path", "newpath", "oldpath", "path",
+                       "path1", "path2", "pathname", "templ"])
 
 
 def parse_git_hash(msg):
@@ -27,6 +35,153 @@ def parse_kvpair_list(args):
     return {arg.key: arg.value for arg in args}
 
 
+class StringTable(object):
+    '''The strings a client connection sends once and then refers to by id
+    in the function names and argument keys of its messages. Tables are
+    kept for each (pid, tid) of a connection, started by its protocol hello
+    and dropped when its process disconnects. They are grouped by pid, so
+    that the partition of a process touches only the entry of its own
+    process. The strings of every table are interned so each name is held
+    once and compares by identity.'''
+    tables = {}  # pid -> {tid: StringTable}
+    interned = {}  # string -> string
+
+    def __init__(self, strings=None):
+        self.strings = strings if strings is not None else {}
+
+    def define(self, str_defs):
+        '''Adds a list of StringDef messages to the table.'''
+        for str_def in str_defs:
+            self.strings[str_def.id] = self.interned.setdefault(str_def.value,
+                                                                str_def.value)
+
+    def lookup(self, str_id):
+        '''Returns the string with id str_id.'''
+        try:
+            return self.strings[str_id]
+        except KeyError:
+            logging.error("Unknown string table id %d.", str_id)
+            return ""
+
+    def resolve(self, msg):
+        '''Restores the function name and argument keys a function message
+        refers to by id and returns its arguments as a dictionary. Ids start
+        at 1 so an unset id reads as 0.'''
+        if msg.func_id:
+            msg.func_name = self.lookup(msg.func_id)
+        args = {}
+        for arg in msg.args:
+            key_id = arg.key_id
+            if key_id:
+                key = arg.key = self.lookup(key_id)
+            else:
+                key = arg.key
+            args[key] = arg.value
+        return args
+
+    @classmethod
+    def get(cls, pid, tid):
+        '''Returns the table of the connection of (pid, tid) or None if it
+        does not use one.'''
+        return cls.tables.get(pid, {}).get(tid)
+
+    @classmethod
+    def reset(cls, pid, tid):
+        '''Starts an empty table for a new connection of (pid, tid).'''
+        cls.tables.setdefault(pid, {})[tid] = cls()
+
+    @classmethod
+    def remove_pid(cls, pid):
+        '''Drops the tables of the connections of a process.'''
+        cls.tables.pop(pid, None)
+
+    @classmethod
+    def snapshot(cls):
+        '''Returns the table contents for persisting.'''
+        return {(pid, tid): table.strings
+                for pid, tids in cls.tables.items()
+                for tid, table in tids.items()}
+
+    @classmethod
+    def restore(cls, tables):
+        '''Restores the tables from persisted contents.'''
+        cls.clear()
+        for (pid, tid), strings in tables.items():
+            table = cls.tables.setdefault(pid, {})[tid] = cls()
+            table.strings = {str_id: cls.interned.setdefault(value, value)
+                             for str_id, value in strings.items()}
+
+    @classmethod
+    def clear(cls):
+        '''Clears the tables.'''
+        cls.tables = {}
+
+
+class HostTable(object):
+    '''The host ids of the relays forwarding to a central backend, by the
+    host number held in the upper 32 bits of the pids of their messages.
+    Hosts are added by the host message a relay connection opens with and
+    are kept across clears, as the number of a host does not change.'''
+    hosts = {}  # host num -> host id
+
+    @classmethod
+    def add(cls, host_num, host_id):
+        '''Records the host id of host number host_num.'''
+        cls.hosts[host_num] = host_id
+
+    @classmethod
+    def lookup(cls, pid):
+        '''Returns the host id of the host of pid, or None for a pid of
+        the local host.'''
+        host_num = pid >> HOST_SHIFT
+        if not host_num:
+            return None
+        try:
+            return cls.hosts[host_num]
+        except KeyError:
+            logging.error("Unknown host number %d.", host_num)
+            return cls.hosts.setdefault(host_num, "%d" % host_num)
+
+    @classmethod
+    def snapshot(cls):
+        '''Returns the table contents for persisting.'''
+        return dict(cls.hosts)
+
+    @classmethod
+    def restore(cls, hosts):
+        '''Restores the table from persisted contents.'''
+        cls.hosts = dict(hosts)
+
+    @classmethod
+    def clear(cls):
+        '''Clears the table.'''
+        cls.hosts = {}
+
+
+def host_pid(pid, local_pid):
+    '''Returns local_pid namespaced by the host of pid.'''
+    if local_pid <= 0:
+        return local_pid
+    return (pid >> HOST_SHIFT << HOST_SHIFT) | local_pid
+
+
+def host_path(host_id, path):
+    '''Returns path namespaced by host_id.'''
+    if not path:
+        return path
+    return "%s:%s" % (host_id, path)
+
+
+def namespace_function(pid, msg, args):
+    '''Namespaces the paths and the child pid of a function message from
+    the relayed process pid.'''
+    host_id = HostTable.lookup(pid)
+    for key in PATH_ARGS.intersection(args):
+        args[key] = host_path(host_id, args[key])
+    if msg.func_name == "fork":
+        msg.ret_val = host_pid(pid, msg.ret_val)
+
+
 def check_message_error_num(func):
     '''Check the error_num of the message passed and if it is a fail add an
     event to the process object then abort. Otherwise process as ususal.'''
@@ -39,10 +194,200 @@ def check_message_error_num(func):
     return wrapper
 
 
+class MetaTable(object):
+    '''In memory map from the meta object names of each live process to
+    the link to their current version, so that updating a meta value does
+    not have to read the process' meta objects from the database.'''
+    procs = {}  # proc_node.id -> {(rel_type, meta_name): meta_rel.id}
+
+    @classmethod
+    def add_proc(cls, proc_id):
+        '''Starts tracking a process with no meta objects.'''
+        cls.procs[proc_id] = {}
+
+    @classmethod
+    def remove_proc(cls, proc_id):
+        '''Stops tracking a process.'''
+        cls.procs.pop(proc_id, None)
+
+    @classmethod
+    def is_tracked(cls, proc_id):
+        '''Returns True if the table holds the meta objects of proc_id.'''
+        return proc_id in cls.procs
+
+    @classmethod
+    def get(cls, proc_id, rel_type, name):
+        '''Returns the id of the link to the current meta object name of a
+        tracked process or None.'''
+        return cls.procs[proc_id].get((rel_type, name))
+
+    @classmethod
+    def set(cls, proc_id, rel_type, name, rel_id):
+        '''Records rel_id as the link to the current meta object name.'''
+        if proc_id in cls.procs:
+            cls.procs[proc_id][(rel_type, name)] = rel_id
+
+    @classmethod
+    def items(cls, proc_id, rel_type):
+        '''Returns (name, link id) pairs of the meta objects of rel_type of
+        a tracked process.'''
+        return [(name, rel_id)
+                for (r_type, name), rel_id in cls.procs[proc_id].items()
+                if r_type == rel_type]
+
+    @classmethod
+    def snapshot(cls):
+        '''Returns the table contents for persisting.'''
+        return cls.procs
+
+    @classmethod
+    def restore(cls, procs):
+        '''Restores the table from persisted contents.'''
+        cls.procs = procs
+
+    @classmethod
+    def clear(cls):
+        '''Clears the table.'''
+        cls.procs = {}
+
+
+def _track_proc_meta(db_iface, proc_node):
+    '''Fills the meta table for a process from the database.'''
+    MetaTable.add_proc(proc_node.id)
+    for rel_type in [storage.RelType.OTHER_META, storage.RelType.ENV_META]:
+        for meta_node, meta_rel in traversal.get_proc_meta(db_iface,
+                                                           proc_node,
+                                                           rel_type):
+            MetaTable.set(proc_node.id, rel_type, meta_node['name'],
+                          meta_rel.id)
+
+
+def get_proc_meta_rel(db_iface, proc_node, rel_type, name):
+    '''Returns the link from proc_node to its current meta object called
+    name or None if it has none.'''
+    if not MetaTable.is_tracked(proc_node.id):
+        _track_proc_meta(db_iface, proc_node)
+    rel_id = MetaTable.get(proc_node.id, rel_type, name)
+    if rel_id is None:
+        return None
+    return db_iface.get_rel_by_id(rel_id)
+
+
+def get_proc_meta_rels(db_iface, proc_node, rel_type):
+    '''Returns a list of (name, link) pairs for the current meta objects of
+    rel_type of proc_node.'''
+    if not MetaTable.is_tracked(proc_node.id):
+        _track_proc_meta(db_iface, proc_node)
+    return [(name, db_iface.get_rel_by_id(rel_id))
+            for name, rel_id in MetaTable.items(proc_node.id, rel_type)]
+
+
 def add_meta_to_proc(db_iface, proc_node, name, val, time_stamp, rel_type):
     '''Creates a meta node and links it to a process node'''
     meta_node = new_meta(db_iface, name, val, time_stamp)
-    db_iface.create_relationship(proc_node, meta_node, rel_type)
+    meta_rel = db_iface.create_relationship(proc_node, meta_node, rel_type)
+    MetaTable.set(proc_node.id, rel_type, name, meta_rel.id)
+
+
+def lib_key(path, md5):
+    '''Returns the index key identifying a shared library by path and md5.'''
+    return "{}:{}".format(md5, path)
+
+
+def lib_set_hash(lib_pairs):
+    '''Returns a content address for a set of (path, md5) library pairs.'''
+    sha1 = hashlib.sha1()
+    for path, md5 in sorted(lib_pairs):
+        sha1.update(lib_key(path, md5).encode("utf-8"))
+        sha1.update(b"\0")
+    return sha1.hexdigest()
+
+
+def get_or_create_library(db_iface, path, md5):
+    '''Returns the shared node for the library, creating it the first time
+    the (path, md5) pair is seen.'''
+    key = lib_key(path, md5)
+    lib_node = traversal.get_library(db_iface, key)
+    if lib_node is None:
+        lib_node = db_iface.create_node(storage.NodeType.LIBRARY)
+        lib_node['name'] = path
+        lib_node['value'] = md5
+        db_iface.update_index(storage.DBInterface.LIB_INDEX,
+                              'lib', key, lib_node)
+        db_iface.cache_man.update(storage.CACHE_NAMES.LIBRARY,
+                                  key, lib_node)
+    return lib_node
+
+
+def get_or_create_lib_set(db_iface, lib_pairs):
+    '''Returns the content addressed node for a set of (path, md5) library
+    pairs, creating it and its member links the first time it is seen.'''
+    set_hash = lib_set_hash(lib_pairs)
+    set_node = traversal.get_lib_set(db_iface, set_hash)
+    if set_node is None:
+        set_node = db_iface.create_node(storage.NodeType.LIB_SET)
+        set_node['set_hash'] = set_hash
+        for path, md5 in lib_pairs:
+            lib_node = get_or_create_library(db_iface, path, md5)
+            db_iface.create_relationship(set_node, lib_node,
+                                         storage.RelType.LIB_MEMBER)
+        db_iface.update_index(storage.DBInterface.LIB_INDEX,
+                              'set', set_hash, set_node)
+        db_iface.cache_man.update(storage.CACHE_NAMES.LIB_SET,
+                                  set_hash, set_node)
+    return set_node
+
+
+def add_libs_to_proc(db_iface, proc_node, lib_pairs):
+    '''Adds the (path, md5) library pairs to the libraries of the process,
+    relinking the process to the library set holding the union.'''
+    old_set_node, old_rel = traversal.get_lib_set_from_process(db_iface,
+                                                               proc_node)
+    lib_pairs = set(lib_pairs)
+    if old_set_node is not None:
+        old_pairs = set((lib_node['name'], lib_node['value'])
+                        for lib_node in traversal.get_libs_from_set(
+                            db_iface, old_set_node))
+        if lib_pairs <= old_pairs:
+            return
+        lib_pairs |= old_pairs
+
+    set_node = get_or_create_lib_set(db_iface, lib_pairs)
+    if old_rel is not None:
+        db_iface.delete_relationship(old_rel)
+    db_iface.create_relationship(proc_node, set_node,
+                                 storage.RelType.LIB_SET)
+
+
+def migrate_lib_meta(db_iface, batch_size=1000):
+    '''Moves libraries stored as per process LIB_META nodes onto shared
+    library set nodes, one transaction per batch of processes. The processes
+    to migrate are found by a single scan of the graph.'''
+    with db_iface.start_transaction():
+        rows = db_iface.query("START proc_node=node(*) "
+                              "MATCH proc_node-[:" +
+                              storage.RelType.LIB_META + "]->() "
+                              "RETURN DISTINCT proc_node")
+        proc_ids = [row['proc_node'].id for row in rows]
+
+    for start in range(0, len(proc_ids), batch_size):
+        with db_iface.start_transaction():
+            for proc_id in proc_ids[start:start + batch_size]:
+                proc_node = db_iface.get_node_by_id(proc_id)
+                lib_pairs = set()
+                for meta_node, meta_rel in traversal.get_proc_meta(
+                        db_iface, proc_node, storage.RelType.LIB_META):
+                    md5 = ""
+                    if meta_node.has_key('value'):
+                        md5 = meta_node['value']
+                    lib_pairs.add((meta_node['name'], md5))
+                    db_iface.delete_relationship(meta_rel)
+                    db_iface.delete_node(meta_node)
+                add_libs_to_proc(db_iface, proc_node, lib_pairs)
+        if __debug__:
+            logging.debug("Migrated libraries of %d of %d processes.",
+                          min(start + batch_size, len(proc_ids)),
+                          len(proc_ids))
 
 
 def new_meta(db_iface, name, val, time_stamp):
@@ -83,7 +428,7 @@ def proc_get_local(db_iface, proc_node, loc_name):
     '''Retrieves the local object node that corresponds with
     a given name from a process node.'''
 
-    loc_node, _ = traversal.get_valid_local(db_iface, proc_node, loc_name)
+    loc_node, _ = pvm.get_valid_local(db_iface, proc_node, loc_name)
     if loc_node is None:
         raise NoMatchingLocalError(proc_node, loc_name)
 
@@ -95,34 +440,56 @@ def update_proc_meta(db_iface, proc_node, meta_name, new_val, timestamp):
     and timestamp. Adds a new object if an existing one cannot be found.'''
     meta_node = new_meta(db_iface, meta_name, new_val, timestamp)
 
-    other_meta_list = traversal.get_proc_meta(db_iface, proc_node,
-                                              storage.RelType.OTHER_META)
+    meta_rel = get_proc_meta_rel(db_iface, proc_node,
+                                 storage.RelType.OTHER_META, meta_name)
 
     # Version the meta object if it exists
-    for old_meta, meta_rel in other_meta_list:
-        if old_meta['name'] == meta_name:
-            db_iface.create_relationship(meta_node, old_meta,
-                                         storage.RelType.META_PREV)
-            # Delete existing link from process to the meta object node
-            db_iface.delete_relationship(meta_rel)
-            break
+    if meta_rel is not None:
+        db_iface.create_relationship(meta_node, meta_rel.end,
+                                     storage.RelType.META_PREV)
+        # Delete existing link from process to the meta object node
+        db_iface.delete_relationship(meta_rel)
 
     # Add link from process node to newly added meta node
-    db_iface.create_relationship(proc_node, meta_node,
-                                 storage.RelType.OTHER_META)
+    add_meta_rel = db_iface.create_relationship(proc_node, meta_node,
+                                                storage.RelType.OTHER_META)
+    MetaTable.set(proc_node.id, storage.RelType.OTHER_META, meta_name,
+                  add_meta_rel.id)
+
+
+def add_filtered_calls(db_iface, proc_node, rule, count, timestamp):
+    '''Adds count to the calls of proc_node that the producer filter rule
+    removed, kept in the meta object filtered:<rule>.'''
+    meta_name = "filtered:" + rule
+    meta_rel = get_proc_meta_rel(db_iface, proc_node,
+                                 storage.RelType.OTHER_META, meta_name)
+    if meta_rel is not None:
+        count += int(meta_rel.end['value'])
+    update_proc_meta(db_iface, proc_node, meta_name, "%d" % count, timestamp)
+
+
+def add_gap(db_iface, proc_node, rule, count, begin_time, end_time):
+    '''Records on proc_node that the producer shed count calls of the
+    process between begin_time and end_time under rule, leaving a gap in its
+    provenance. Each gap is a version of the meta object gap:<rule>.'''
+    meta_name = "gap:" + rule
+    update_proc_meta(db_iface, proc_node, meta_name, "%d" % count,
+                     begin_time)
+    meta_rel = get_proc_meta_rel(db_iface, proc_node,
+                                 storage.RelType.OTHER_META, meta_name)
+    meta_rel.end['end_time'] = end_time
 
 
 def update_event_chain_cache(db_iface, loc_node, event_node):
     '''Finds the correct fd chain object and appends event node to the chain'''
-    proc_node, _ = traversal.get_process_from_local(db_iface, loc_node)
+    proc_node, _ = pvm.get_process_from_local(db_iface, loc_node)
     idx_list = db_iface.cache_man.get(storage.CACHE_NAMES.IO_EVENT_CHAIN,
                                       (proc_node.id, loc_node['name']))
     if idx_list is None:
         logging.error("Unable to get cached events for pid: %d and fd: %s",
                       proc_node['pid'], loc_node['name'])
     else:
-        loc_index = idx_list.find(loc_node, key=lambda x: int(x['mono_time']))
-        fd_chain = idx_list[loc_index - 1]
+        fd_chain = idx_list.floor(int(loc_node['mono_time']))
         fd_chain.chain.append(event_node)
 
 
@@ -205,7 +572,7 @@ def proc_dup_fd(db_iface, proc_node, fd_i, fd_o, lp_link_state=None):
 
     o_loc_node = pvm.get_l(db_iface, proc_node, fd_o)
     if lp_link_state is not None:
-        db_iface.set_link_state(o_loc_node.PROC_OBJ.outgoing, lp_link_state)
+        pvm.set_local_state(db_iface, o_loc_node, lp_link_state)
 
     _bind_global_to_new_local(db_iface, proc_node, o_loc_node, i_loc_node)
 
@@ -215,23 +582,17 @@ def process_put_env(db_iface, proc_node, env, overwrite):
     into the processes environment. Clears keys if val is None, only overwrites
     existing keys if overwrite is set and inserts if the key is not found and
     val is not None.'''
-    found = False
     (name, val, time_stamp) = env
 
-    env_meta_list = traversal.get_proc_meta(db_iface, proc_node,
-                                            storage.RelType.ENV_META)
-
-    for meta_node, meta_rel in env_meta_list:
-        if meta_node['name'] == name:
-            found = True
-            if not overwrite:
-                break
-            version_meta(db_iface, proc_node, meta_node, meta_rel, env)
+    meta_rel = get_proc_meta_rel(db_iface, proc_node,
+                                 storage.RelType.ENV_META, name)
 
-    if not found and val is not None:
-        new_meta_node = new_meta(db_iface, name, val, time_stamp)
-        db_iface.create_relationship(proc_node, new_meta_node,
-                                     storage.RelType.ENV_META)
+    if meta_rel is not None:
+        if overwrite:
+            version_meta(db_iface, proc_node, meta_rel.end, meta_rel, env)
+    elif val is not None:
+        add_meta_to_proc(db_iface, proc_node, name, val, time_stamp,
+                         storage.RelType.ENV_META)
 
 
 def version_meta(db_iface, proc_node, meta_node, meta_rel, env):
@@ -242,9 +603,11 @@ def version_meta(db_iface, proc_node, meta_node, meta_rel, env):
 
     db_iface.create_relationship(new_meta_node, meta_node,
                                  storage.RelType.META_PREV)
-    db_iface.create_relationship(proc_node, new_meta_node,
-                                 storage.RelType.ENV_META)
+    new_meta_rel = db_iface.create_relationship(proc_node, new_meta_node,
+                                                storage.RelType.ENV_META)
     db_iface.delete_relationship(meta_rel)
+    MetaTable.set(proc_node.id, storage.RelType.ENV_META, name,
+                  new_meta_rel.id)
 
 
 def set_rw_lnk(db_iface, loc_node, state):
@@ -282,10 +645,9 @@ def set_link(db_iface, loc_node, state, glob_node_list=None):
                                        glob_node['sys_time'], glob_node)
 
 
-def process_rw_pair(db_iface, proc_node, msg):
+def process_rw_pair(db_iface, proc_node, msg, args):
     '''Helper function to implement PVM operations for a pair of file
     descriptors typically created by calls to pipe and socketpair'''
-    args = parse_kvpair_list(msg.args)
 
     # Create local objects for read and write fds
     read_fd = args['read_fd']
@@ -4,6 +4,7 @@ Client Query - Init Module
 '''
 
 from .client_query import (ClientQueryControl)
+from .jobs import (JobState, QueryJobManager)
 
 # Import query methods here
 from .env_diff import (get_execs, get_diffs)
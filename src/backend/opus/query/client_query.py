@@ -8,11 +8,14 @@ from __future__ import (absolute_import, division,
 
 class ClientQueryControl(object):
     client_qry_methods = {}
+    rows_keys = {}  # Key of the rows streamed from the result of a method
 
     @classmethod
-    def register_query_method(cls, query_method):
+    def register_query_method(cls, query_method, rows_key=None):
         def wrap(method):
             cls.client_qry_methods[query_method] = method
+            if rows_key is not None:
+                cls.rows_keys[query_method] = rows_key
             return method
         return wrap
 
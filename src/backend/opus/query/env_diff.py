@@ -151,15 +151,49 @@ def diff_env_meta(db_iface, proc_node1, proc_node2):
     return get_diff(env_meta_dict1, env_meta_dict2)
 
 
+def get_lib_set(db_iface, proc_node):
+    '''Returns the library set node of the process and its libraries as a
+    set of (path, md5) pairs.'''
+    qry = "START "
+    qry += "proc_node=node({id}) "
+    qry += "MATCH proc_node-[:" + storage.RelType.LIB_SET + "]->set_node, "
+    qry += "set_node-[:" + storage.RelType.LIB_MEMBER + "]->lib_node "
+    qry += "RETURN set_node, lib_node "
+    rows = db_iface.locked_query(qry, id=proc_node.id)
+
+    set_node = None
+    lib_set = set()
+    for row in rows:
+        set_node = row['set_node']
+        lib_set.add((row['lib_node']['name'], row['lib_node']['value']))
+    return set_node, lib_set
+
+
 def diff_lib_meta(db_iface, proc_node1, proc_node2):
-    lib_meta_dict1 = convert_to_dict(get_meta_data(db_iface, proc_node1,
-                                     storage.RelType.LIB_META))
-    lib_meta_dict2 = convert_to_dict(get_meta_data(db_iface, proc_node2,
-                                     storage.RelType.LIB_META))
-    return get_diff(lib_meta_dict1, lib_meta_dict2)
+    set_node1, lib_set1 = get_lib_set(db_iface, proc_node1)
+    set_node2, lib_set2 = get_lib_set(db_iface, proc_node2)
+
+    # Library sets are content addressed, so sharing a node means no diff.
+    if set_node1 is not None and set_node2 is not None:
+        if set_node1.id == set_node2.id:
+            return {'added': [], 'removed': [], 'changed': []}
+
+    only1 = dict(lib_set1 - lib_set2)
+    only2 = dict(lib_set2 - lib_set1)
+    changed = set(only1) & set(only2)
+
+    return {'added': [{'name': elem, 'value': only2[elem]}
+                      for elem in set(only2) - changed],
+            'removed': [{'name': elem, 'value': only1[elem]}
+                        for elem in set(only1) - changed],
+            'changed': [{'name': elem,
+                         'from': only1[elem],
+                         'to': only2[elem]}
+                        for elem in changed]}
 
 
-@client_query.ClientQueryControl.register_query_method("get_execs")
+@client_query.ClientQueryControl.register_query_method("get_execs",
+                                                       rows_key="data")
 def get_execs(db_iface, args):
     if 'prog_name' not in args:
         return {"success": False,
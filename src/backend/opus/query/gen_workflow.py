@@ -16,6 +16,7 @@ import cPickle as pickle
 import hashlib
 import logging
 import re
+import threading
 
 
 action_dict = {0: 'None', 1: 'Copy On Touch', 2: 'Read', 3: 'Write',
@@ -27,6 +28,8 @@ start_filters = ['/etc/', '/lib/', '/var/', '/dev/', '/usr/', '.sh_history',
 end_filters = ['.sh_history', '.bashrc', 'logilab_common-0.61.0-nspkg.pth',
                '.cache', '.config']
 
+workflow_lock = threading.Lock()
+
 
 class GlobData(object):
     proc_list = []
@@ -142,7 +145,9 @@ def find_files_read_and_written_by_process(db_iface, proc_node, proc_tree_map):
     cwd = get_cwd(proc_node)
     sys_meta = get_meta(proc_node.OTHER_META)
     env_meta = get_meta(proc_node.ENV_META)
-    lib_meta = get_meta(proc_node.LIB_META)
+    lib_meta = {}
+    for tmp_rel in proc_node.LIB_SET.outgoing:
+        lib_meta = get_meta(tmp_rel.end.LIB_MEMBER)
 
     rows = db_iface.locked_query(
         "START proc_node=node(" + str(proc_node.id) + ") "
@@ -299,7 +304,20 @@ def get_hash(name):
     return hasher.hexdigest()
 
 
-@client_query.ClientQueryControl.register_query_method("gen_workflow")
+def proc_tree_rsp(proc_tree_map, stream):
+    '''Returns the response to a workflow query. A streamed response
+    lists the processes of proc_tree_map as rows of node id and process,
+    otherwise the map is returned pickled.'''
+    if stream:
+        return {"success": True,
+                "procs": [[node_id, proc_tree_map[node_id]]
+                          for node_id in sorted(proc_tree_map)]}
+    return {"success": True,
+            "proc_tree_map": pickle.dumps(proc_tree_map)}
+
+
+@client_query.ClientQueryControl.register_query_method("gen_workflow",
+                                                       rows_key="procs")
 def gen_workflow(db_iface, args):
     if 'file_name' not in args:
         return {"success": False,
@@ -311,20 +329,22 @@ def gen_workflow(db_iface, args):
     if 'regen' in args:
         regen = args['regen']
 
+    stream = args.get('stream', False)
+
     file_hash = get_hash(file_name) + ".procmap"
     if not regen and os.path.isfile(file_hash):
-        return {"success": True,
-                "proc_tree_map": pickle.dumps(load_proc_tree_map(file_hash))}
+        return proc_tree_rsp(load_proc_tree_map(file_hash), stream)
 
-    GlobData.clear_data()
-    proc_tree_map = {}
+    # GlobData is shared, so only one workflow is generated at a time.
+    with workflow_lock:
+        GlobData.clear_data()
+        proc_tree_map = {}
 
-    GlobData.queried_file = file_name
-    get_write_history(db_iface, file_name, proc_tree_map)
-    get_all_processes(db_iface, proc_tree_map)
+        GlobData.queried_file = file_name
+        get_write_history(db_iface, file_name, proc_tree_map)
+        get_all_processes(db_iface, proc_tree_map)
 
     save_proc_tree_map(proc_tree_map, file_hash)
     logging.debug("Successfully generated workflow...saved data on disk\n")
 
-    return {"success": True,
-            "proc_tree_map": pickle.dumps(proc_tree_map)}
+    return proc_tree_rsp(proc_tree_map, stream)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+'''
+Asynchronous execution of client queries. A query submitted as a job is run
+by one of a limited number of threads, while the client polls or subscribes
+for its progress. Once the query has finished, the rows of its result are
+split into chunks for the client to fetch. A job can be cancelled while it
+is queued or running.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import collections
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+from . import client_query
+from .. import common_utils
+from ..exception import QueryCancelledException
+
+
+JobState = common_utils.enum(QUEUED=0,
+                             RUNNING=1,
+                             DONE=2,
+                             FAILED=3,
+                             CANCELLED=4)
+
+
+class CancellableDBInterface(object):
+    '''Wraps the database interface of a job, raising a
+    QueryCancelledException from the next query it makes once the job has
+    been cancelled.'''
+    def __init__(self, db_iface, job):
+        self._db_iface = db_iface
+        self._job = job
+
+    def locked_query(self, qry, **kwargs):
+        if self._job.cancel_event.is_set():
+            raise QueryCancelledException(self._job.job_id)
+        return self._db_iface.locked_query(qry, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._db_iface, name)
+
+
+class QueryJob(object):
+    '''A query submitted by a client and the chunks of its result. The
+    result of a job that does not stream is kept whole.'''
+    def __init__(self, job_id, msg, stream):
+        self.job_id = job_id
+        self.msg = msg
+        self.stream = stream
+        self.state = JobState.QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.rows = 0
+        self.chunks = collections.deque()  # Chunks not yet fetched
+        self.result = None  # The result less its rows, once finished
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+
+    def elapsed(self):
+        '''Returns the seconds the job has been running for.'''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def info(self):
+        return {'job_id': self.job_id,
+                'qry_method': self.msg['qry_method'],
+                'state': JobState.enum_str(self.state),
+                'elapsed': self.elapsed(),
+                'rows': self.rows,
+                'chunks': len(self.chunks)}
+
+
+class QueryJobManager(object):
+    '''Runs query jobs against the storage interface returned by
+    get_db_iface, max_jobs at a time. get_db_iface is called for each job,
+    as the analyser opens its storage only once it has started, and returns
+    None if the analyser has no storage. The rows of a result are sent in
+    chunks of chunk_rows. Jobs are forgotten keep_secs seconds after they
+    finish, whether or not their results have been fetched. Each job thread
+    calls thread_init, if given, before running any job.'''
+    def __init__(self, get_db_iface, max_jobs=2, chunk_rows=500,
+                 keep_secs=600.0, thread_init=None):
+        self.get_db_iface = get_db_iface
+        self.thread_init = thread_init
+        self.chunk_rows = chunk_rows
+        self.keep_secs = keep_secs
+        self.job_ids = itertools.count(1)
+        self.jobs = collections.OrderedDict()  # job_id -> QueryJob
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        for _ in range(max_jobs):
+            runner = threading.Thread(target=self._run_jobs)
+            runner.daemon = True
+            runner.start()
+
+    def handle(self, msg):
+        '''Handles a query job command from a client.'''
+        handler = {'query_submit': self.submit,
+                   'query_status': self.status,
+                   'query_fetch': self.fetch,
+                   'query_cancel': self.cancel}.get(msg['cmd'])
+        if handler is None:
+            return {"success": False, "msg": "Invalid query job command."}
+        return handler(msg)
+
+    def submit(self, msg, stream=True):
+        '''Queues a query, returning the id of its job.'''
+        if msg.get('qry_method') not in \
+                client_query.ClientQueryControl.client_qry_methods:
+            return {"success": False, "msg": "Invalid query command"}
+        if self.get_db_iface() is None:
+            return {"success": False, "msg": "Analyser has no storage."}
+        with self.lock:
+            self._expire()
+            job = QueryJob(next(self.job_ids),
+                           {'qry_method': msg['qry_method'],
+                            'qry_args': msg.get('qry_args', {})},
+                           stream)
+            self.jobs[job.job_id] = job
+            self.queue.append(job)
+            self.ready.notify()
+        return {"success": True, "job_id": job.job_id}
+
+    def run(self, msg):
+        '''Runs a query as a job and waits for its whole result.'''
+        rsp = self.submit(msg, stream=False)
+        if not rsp['success']:
+            return rsp
+        job = self.jobs[rsp['job_id']]
+        job.done_event.wait()
+        with self.lock:
+            self.jobs.pop(job.job_id, None)
+        return job.result
+
+    def _get_job(self, msg):
+        job = self.jobs.get(msg.get('job_id'))
+        if job is None:
+            return None, {"success": False, "msg": "No such query job."}
+        return job, None
+
+    def status(self, msg):
+        '''Returns the progress of a job, or of every job if none is
+        given.'''
+        with self.lock:
+            self._expire()
+            if msg.get('job_id') is None:
+                return {"success": True,
+                        "jobs": [job.info() for job in self.jobs.values()]}
+            job, err = self._get_job(msg)
+            if job is None:
+                return err
+            return {"success": True, "job": job.info()}
+
+    def fetch(self, msg):
+        '''Returns the chunks of a finished job not yet fetched, up to
+        max_chunks of them. Once the job has finished and every chunk has
+        been fetched the rest of its result is returned and the job is
+        forgotten.'''
+        with self.lock:
+            job, err = self._get_job(msg)
+            if job is None:
+                return err
+            chunks = []
+            max_chunks = msg.get('max_chunks')
+            while job.chunks and (max_chunks is None or
+                                  len(chunks) < max_chunks):
+                chunks.append(job.chunks.popleft())
+            rsp = {"success": True, "job": job.info(), "chunks": chunks}
+            if job.done_event.is_set() and not job.chunks:
+                rsp['result'] = job.result
+                del self.jobs[job.job_id]
+            return rsp
+
+    def cancel(self, msg):
+        '''Cancels a queued or running job. A running job stops at its next
+        database query.'''
+        with self.lock:
+            job, err = self._get_job(msg)
+            if job is None:
+                return err
+            if job.done_event.is_set():
+                return {"success": False,
+                        "msg": "Query job has already finished."}
+            job.cancel_event.set()
+            if job.state == JobState.QUEUED:
+                self.queue.remove(job)
+                self._finish(job, JobState.CANCELLED,
+                             {"success": False,
+                              "msg": "Query job cancelled."})
+        return {"success": True, "job": job.info()}
+
+    def _expire(self):
+        '''Forgets jobs that finished more than keep_secs ago.'''
+        now = time.time()
+        for job in self.jobs.values():
+            if (job.finished is not None and
+                    now - job.finished > self.keep_secs):
+                del self.jobs[job.job_id]
+
+    def _finish(self, job, state, result):
+        job.state = state
+        job.result = result
+        job.finished = time.time()
+        if job.started is None:
+            job.started = job.finished
+        job.done_event.set()
+
+    def _run_jobs(self):
+        '''Runs queued jobs until the process exits.'''
+        if self.thread_init is not None:
+            self.thread_init()
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.ready.wait()
+                job = self.queue.popleft()
+                job.state = JobState.RUNNING
+                job.started = time.time()
+            state, result = self._exec(job)
+            with self.lock:
+                if job.cancel_event.is_set():
+                    state = JobState.CANCELLED
+                    result = {"success": False,
+                              "msg": "Query job cancelled."}
+                    job.chunks.clear()
+                self._finish(job, state, result)
+
+    def _exec(self, job):
+        '''Executes the query of a job and, once it has finished, splits the
+        rows of its whole result into chunks. Returns the final state of the
+        job and the rest of its result.'''
+        if __debug__:
+            logging.debug("Running query job %d: %s", job.job_id, job.msg)
+        db_iface = self.get_db_iface()
+        if db_iface is None:
+            return JobState.FAILED, {"success": False,
+                                     "msg": "Analyser has no storage."}
+        try:
+            result = client_query.ClientQueryControl.exec_method(
+                CancellableDBInterface(db_iface, job),
+                dict(job.msg, qry_args=dict(job.msg['qry_args'],
+                                            stream=job.stream)))
+        except QueryCancelledException:
+            return JobState.CANCELLED, {"success": False,
+                                        "msg": "Query job cancelled."}
+        except Exception as exc:  # pylint: disable=broad-except
+            # Broad exception so that a failed query does not stop the job
+            # thread.
+            logging.error("Query job %d failed: %s\n%s", job.job_id,
+                          str(exc), traceback.format_exc())
+            return JobState.FAILED, {"success": False, "msg": str(exc)}
+
+        rows_key = client_query.ClientQueryControl.rows_keys.get(
+            job.msg['qry_method'])
+        rows = None
+        if job.stream and rows_key is not None:
+            rows = result.pop(rows_key, None)
+        if rows:
+            with self.lock:
+                for start in range(0, len(rows), self.chunk_rows):
+                    job.chunks.append(rows[start:start + self.chunk_rows])
+                job.rows = len(rows)
+        return JobState.DONE, result
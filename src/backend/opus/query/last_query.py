@@ -9,7 +9,8 @@ def fmt_time(time):
     return datetime.datetime.fromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S')
 
 
-@client_query.ClientQueryControl.register_query_method("query_file")
+@client_query.ClientQueryControl.register_query_method("query_file",
+                                                       rows_key="data")
 def query_file(db_iface, args):
     '''Given a file name, this method returns the
     last command that modified the file'''
@@ -40,7 +41,8 @@ def query_file(db_iface, args):
         return {'success': False, 'msg': "No data available for that file."}
 
 
-@client_query.ClientQueryControl.register_query_method("query_folder")
+@client_query.ClientQueryControl.register_query_method("query_folder",
+                                                       rows_key="data")
 def query_folder(db_iface, args):
     '''Given a folder name, this method returns the last N executed
     commands from that folder as current working directory'''
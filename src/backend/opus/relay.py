@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''
+Forwarding of provenance from relay backends to a central backend. A relay
+reads the clients of its host with the usual producer and, in place of an
+analyser, gathers their messages into batches that are compressed and sent
+over a single TCP connection to the RelayCommunicationManager of the
+central backend. Batches made while the central backend cannot be reached
+are spooled to disk and sent once it can be again.
+
+A relay connection opens with a HOST_MSG naming the host of the relay
+behind a full header, which the central backend answers with a single byte,
+RELAY_ACCEPT or RELAY_REFUSE. Every batch that follows is a BATCH header
+giving its compressed and raw lengths followed by the zlib compressed
+frames, full headers and payloads, of its messages.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import errno
+import logging
+import os
+import socket
+import struct
+import time
+import zlib
+
+from . import messaging, multisocket, uds_msg_pb2
+from .exception import OPUSException
+
+
+BATCH = struct.Struct(str("<II"))  # compressed length, raw length
+RELAY_ACCEPT = b"\x01"
+RELAY_REFUSE = b"\x00"
+HOST_SHIFT = 32  # Pids of relayed messages hold the host number above this
+SPOOL_FILE = "relay.spool"
+SPOOL_POS_SUFFIX = ".pos"
+
+
+def host_num(host_id):
+    '''Returns the number that namespaces the pids of a host. It is kept to
+    31 bits so that namespaced pids are still positive 64 bit integers.'''
+    return (zlib.crc32(host_id.encode("utf-8")) & 0x7fffffff) or 1
+
+
+def host_message(host_id, pid=0, timestamp=0, restart=False):
+    '''Returns the header and payload of a HOST_MSG for host_id.'''
+    host_msg = uds_msg_pb2.HostMessage()
+    host_msg.host_id = host_id
+    if restart:
+        host_msg.restart = True
+
+    header = messaging.Header()
+    header.timestamp = timestamp
+    header.pid = pid
+    header.tid = pid
+    header.payload_type = uds_msg_pb2.HOST_MSG
+    header.payload_len = host_msg.ByteSize()
+    header.sys_time = int(time.time())
+
+    return header.dumps(), host_msg.SerializeToString()
+
+
+def pack_batch(frames, level):
+    '''Returns a batch of the message frames compressed at zlib level.'''
+    raw = b"".join(frames)
+    data = zlib.compress(raw, level)
+    return BATCH.pack(len(data), len(raw)) + data
+
+
+class RelayClient(object):
+    '''The connection of a relay to the central backend at addr.'''
+    def __init__(self, addr, host_id, timeout=10.0):
+        self.addr = addr
+        self.host_id = host_id
+        self.timeout = timeout
+        self.sock = None
+
+    def connected(self):
+        '''Returns True if the relay is connected.'''
+        return self.sock is not None
+
+    def connect(self):
+        '''Connects and introduces the relay to the central backend,
+        returning True if the central backend accepted it.'''
+        try:
+            conn = multisocket.MultiFamilySocket(socket.SOCK_STREAM,
+                                                 self.addr)
+            sock = conn.socket
+            sock.settimeout(self.timeout)
+            conn.connect(self.addr)
+            sock.sendall(b"".join(host_message(self.host_id)))
+            ack = sock.recv(1)
+        except (IOError, socket.error) as exc:
+            logging.error("Could not connect to central backend %s: %s",
+                          self.addr, str(exc))
+            return False
+
+        if ack != RELAY_ACCEPT:
+            logging.error("Central backend %s refused host %s.",
+                          self.addr, self.host_id)
+            sock.close()
+            return False
+        logging.info("Relaying host %s to %s.", self.host_id, self.addr)
+        self.sock = sock
+        return True
+
+    def send(self, batch):
+        '''Sends a batch, closing the connection and returning False if it
+        could not be sent.'''
+        try:
+            self.sock.sendall(batch)
+        except socket.error as exc:
+            logging.error("Lost connection to central backend %s: %s",
+                          self.addr, str(exc))
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        '''Closes the connection.'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class RelaySpool(object):
+    '''Batches held in spool_dir while the central backend cannot be
+    reached. Batches are appended to a spool file and read back in order.
+    The offset of the first batch not yet sent is saved beside it whenever
+    sending stops part way, so that a restarted relay resumes from there.
+    If max_size is given in megabytes batches that would grow the unsent
+    part of the spool past it are dropped.'''
+    def __init__(self, spool_dir, max_size=None):
+        if not os.path.isdir(spool_dir):
+            try:
+                os.makedirs(spool_dir)
+            except OSError as exc:
+                logging.error("Error: %d, Message: %s",
+                              exc.errno, exc.strerror)
+                raise OPUSException("Could not create relay spool directory")
+        self.path = os.path.join(spool_dir, SPOOL_FILE)
+        self.pos_path = self.path + SPOOL_POS_SUFFIX
+        self.max_size = None
+        if max_size is not None:
+            self.max_size = int(max_size * 1024 * 1024)
+        self.size = 0
+        if os.path.exists(self.path):
+            self.size = os.path.getsize(self.path)
+        self.offset = 0
+        try:
+            with open(self.pos_path, "rb") as fp:
+                self.offset = min(int(fp.read().strip() or 0), self.size)
+        except IOError:
+            pass
+
+    def pending(self):
+        '''Returns the number of spooled bytes not yet sent.'''
+        return self.size - self.offset
+
+    def append(self, batch):
+        '''Spools a batch, returning False if the spool is full.'''
+        if (self.max_size is not None and
+                self.pending() + len(batch) > self.max_size):
+            logging.error("Relay spool full, dropping a batch of %d bytes.",
+                          len(batch))
+            return False
+        try:
+            with open(self.path, "ab") as fp:
+                fp.write(batch)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            return False
+        self.size += len(batch)
+        return True
+
+    def batches(self):
+        '''Yields (end offset, batch) for each spooled batch not yet sent,
+        stopping at a batch torn by a crash.'''
+        with open(self.path, "rb") as fp:
+            fp.seek(self.offset)
+            while True:
+                hdr = fp.read(BATCH.size)
+                if len(hdr) < BATCH.size:
+                    break
+                comp_len, _ = BATCH.unpack(hdr)
+                data = fp.read(comp_len)
+                if len(data) < comp_len:
+                    break
+                yield fp.tell(), hdr + data
+
+    def sent(self, offset):
+        '''Records that the batches up to offset have been sent.'''
+        self.offset = offset
+
+    def save(self):
+        '''Saves the offset of the first batch not yet sent.'''
+        if not self.pending():
+            return
+        try:
+            with open(self.pos_path, "wb") as fp:
+                fp.write(b"%d\n" % self.offset)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+
+    def clear(self):
+        '''Removes the spool once all of it has been sent.'''
+        for path in (self.path, self.pos_path):
+            try:
+                os.unlink(path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    logging.error("Error: %d, Message: %s",
+                                  exc.errno, exc.strerror)
+        self.size = 0
+        self.offset = 0
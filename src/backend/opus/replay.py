@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+Offline replay of the message logs written by the LoggingAnalyser into the
+PVM graph.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import heapq
+import os
+import shutil
+import tempfile
+import time
+
+from . import analysis, messaging, msglog
+from . import uds_msg_pb2 as uds_msg
+
+
+def read_index(log_path, index_path, start_ts=None, end_ts=None,
+               pids=None):
+    '''Yields the (header, payload) messages of a log with timestamps in
+    [start_ts, end_ts] sent by pids, in the time order given by an index
+    written by logsort, along with their position in the index.'''
+    from . import logsort
+    for pos, msg in enumerate(logsort.read_sorted(log_path, index_path)):
+        if start_ts is not None or end_ts is not None or pids is not None:
+            hdr_obj = messaging.Header()
+            hdr_obj.loads(msg[0])
+            if start_ts is not None and hdr_obj.timestamp < start_ts:
+                continue
+            if end_ts is not None and hdr_obj.timestamp > end_ts:
+                continue
+            if pids is not None and hdr_obj.pid not in pids:
+                continue
+        yield msg, pos + 1
+
+
+class LogReplayer(object):
+    '''Replays a message log through a PVMAnalyser driven from the calling
+    thread. Messages are reordered by timestamp within a window of window
+    messages, or taken in the order of an index written by logsort if
+    index_path is given, and applied txn_size messages to a transaction.
+    Messages with equal timestamps are applied in the order they were read.
+    Only messages with timestamps in [start_ts, end_ts] from the given set
+    of pids are replayed. Progress is passed to the progress callback as
+    (position, total, messages applied), in bytes of the log or messages of
+    the index.'''
+    def __init__(self, log_path, storage_args, neo4j_cfg, opus_lite=True,
+                 io_chain_horizon=60.0, window=10000, txn_size=1000,
+                 index_path=None, start_ts=None, end_ts=None, pids=None):
+        self.log_path = log_path
+        self.index_path = index_path
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.pids = None
+        if pids is not None:
+            # Term messages are sent as pid 0 and mark the ends of runs.
+            self.pids = frozenset(pids) | frozenset([0])
+        self.window = window
+        self.txn_size = txn_size
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.analyser = analysis.PVMAnalyser(
+            "DBInterface", storage_args, opus_lite, neo4j_cfg,
+            self.snapshot_dir, io_chain_horizon=io_chain_horizon,
+            decode_stage=False)
+        self.applied = 0
+        self.txn = []
+
+    def _apply(self, msg):
+        '''Add a message to the current transaction, committing it once it
+        is full.'''
+        self.txn.append(msg)
+        if len(self.txn) >= self.txn_size:
+            self._commit()
+
+    def _commit(self):
+        '''Apply the messages of the current transaction.'''
+        if not self.txn:
+            return
+        with self.analyser.db_iface.start_transaction():
+            for msg in self.txn:
+                self.analyser.process(msg)
+        self.applied += len(self.txn)
+        self.txn = []
+
+    def _drain(self, heap):
+        '''Apply every message held in heap and clear the process state, as
+        the analyser does on a term message.'''
+        while heap:
+            self._apply(heapq.heappop(heap)[2])
+        self._commit()
+        self.analyser.cleanup()
+
+    def run(self, progress=None, interval=1.0):
+        '''Replay the whole log, returning the number of messages
+        applied.'''
+        if self.index_path is not None:
+            from . import logsort
+            total = logsort.index_len(self.index_path)
+            source = read_index(self.log_path, self.index_path,
+                                self.start_ts, self.end_ts, self.pids)
+            window = 0
+        else:
+            reader = msglog.LogReader(self.log_path)
+            total = reader.total_size()
+            source = reader.iter_msgs(self.start_ts, self.end_ts, self.pids)
+            window = self.window
+
+        self.analyser.open_storage()
+        try:
+            heap = []
+            last = 0.0
+            for seq, (msg, pos) in enumerate(source):
+                hdr_obj = messaging.Header()
+                hdr_obj.loads(msg[0])
+                heapq.heappush(heap, (hdr_obj.timestamp, seq, msg))
+                if hdr_obj.payload_type == uds_msg.TERM_MSG:
+                    self._drain(heap)
+                elif len(heap) > window:
+                    self._apply(heapq.heappop(heap)[2])
+
+                if progress is not None and time.time() - last >= interval:
+                    last = time.time()
+                    progress(pos, total, self.applied)
+            self._drain(heap)
+            if progress is not None:
+                progress(total, total, self.applied)
+        finally:
+            self.analyser.db_iface.close()
+            shutil.rmtree(self.snapshot_dir)
+        return self.applied
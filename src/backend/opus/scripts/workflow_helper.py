@@ -9,7 +9,6 @@ from __future__ import (absolute_import, division,
 
 from opus import cc_cfg, cc_utils, common_utils as cu
 
-import cPickle as pickle
 import time
 import datetime
 
@@ -42,22 +41,33 @@ def sync_send_message(args, msg):
 
 def make_workflow_qry(args):
     file_name = cu.canonicalise_file_path(args.file_name)
-    proc_tree_map = None
 
     regen = False
     if args.regen:
         regen = args.regen
 
-    cmd = {'cmd': 'exec_qry_method',
+    cmd = {'cmd': 'query_submit',
            'qry_method': 'gen_workflow',
            'qry_args': {'file_name': file_name,
                         'regen': regen}}
 
-    result = sync_send_message(args, cmd)
+    helper = cc_utils.CommandConnectionHelper(args.server)
+    result = helper.make_request(cmd)
     if not result['success']:
         print(result['msg'])
-    else:
-        if 'proc_tree_map' in result:
-            proc_tree_map = pickle.loads(str(result['proc_tree_map']))
+        return None, file_name
+
+    proc_tree_map = {}
+    for result in helper.fetch_query(result['job_id']):
+        if not result['success']:
+            break
+        for chunk in result['chunks']:
+            for node_id, proc in chunk:
+                proc_tree_map[node_id] = proc
+        result = result.get('result', result)
+    helper.close()
 
+    if not result['success']:
+        print(result['msg'])
+        return None, file_name
     return proc_tree_map, file_name
@@ -7,6 +7,8 @@ systems and the opus analysers.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import collections
+import copy
 import functools
 import logging
 import threading
@@ -25,7 +27,9 @@ NodeType = common_utils.enum(META=1,
                              LOCAL=4,
                              EVENT=5,
                              ANNOT=6,
-                             TERM=7)
+                             TERM=7,
+                             LIBRARY=8,
+                             LIB_SET=9)
 
 # Enum values for relationship types
 RelType = common_utils.enum(GLOB_OBJ_PREV="GLOB_OBJ_PREV",
@@ -39,6 +43,8 @@ RelType = common_utils.enum(GLOB_OBJ_PREV="GLOB_OBJ_PREV",
                             PREV_EVENT="PREV_EVENT",
                             FILE_META="FILE_META",
                             LIB_META="LIB_META",
+                            LIB_SET="LIB_SET",
+                            LIB_MEMBER="LIB_MEMBER",
                             ENV_META="ENV_META",
                             OTHER_META="OTHER_META",
                             META_PREV="META_PREV")
@@ -57,32 +63,79 @@ LinkState = common_utils.enum(NONE=0,
                               INACTIVE=10)
 
 # Enum values for cache naming
-CACHE_NAMES = common_utils.enum(VALID_LOCAL=0,
-                                LOCAL_GLOBAL=1,
+CACHE_NAMES = common_utils.enum(LOCAL_GLOBAL=1,
                                 LAST_EVENT=2,
                                 NODE_BY_ID=3,
-                                IO_EVENT_CHAIN=4)
+                                IO_EVENT_CHAIN=4,
+                                LIBRARY=5,
+                                LIB_SET=6,
+                                GLOB_VERSION=7)
+
+# Number of node IDs reserved at a time by DBInterface.reserve_ids
+ID_BLOCK_SIZE = 1024
+
+# Number of names whose latest global version is kept in the GLOB_VERSION
+# cache, least recently used names are evicted beyond it
+GLOB_VERSION_CACHE_SIZE = 65536
 
 # Enum values for process status
 PROCESS_STATE = common_utils.enum(ALIVE=0, DEAD=1)
 
 
 class FdChain(object):
-    '''An object representing a filedescriptor chain.'''
+    '''An object representing a filedescriptor chain. Events are kept sorted
+    by their before_time, pending holds the list nodes of events inserted
+    into the chain that have not yet been linked in the graph. frontier is
+    the newest event older than the loaded events that is still only in
+    the graph, or None if the chain is fully loaded.'''
     def __init__(self):
         super(FdChain, self).__init__()
         self.local = None
-        self.chain = common_utils.IndexList(lambda x: int(x['before_time']))
+        self.chain = common_utils.SkipList(lambda x: int(x['before_time']))
+        self.pending = set()
+        self.frontier = None
 
     def __repr__(self):
-        return str(str(self.local), str(self.chain))
+        return "{}: {}".format(self.local, self.chain)
+
+
+class LRUCache(object):
+    '''A mapping holding at most max_size entries, evicting the least
+    recently used entry to make room for a new one.'''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        val = self.entries.pop(key)
+        self.entries[key] = val
+        return val
+
+    def __setitem__(self, key, val):
+        self.entries.pop(key, None)
+        self.entries[key] = val
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
 
 
 class CacheManager(object):
     '''Manages a series of caches and allows for them to be
-    updated and invalidated.'''
-    def __init__(self, cache_list):
-        self.caches = {key: dict() for key in cache_list}
+    updated and invalidated. Caches given a size in cache_sizes are bounded
+    to that many entries.'''
+    def __init__(self, cache_list, cache_sizes=None):
+        cache_sizes = cache_sizes or {}
+        self.caches = {key: (LRUCache(cache_sizes[key])
+                             if key in cache_sizes else dict())
+                       for key in cache_list}
 
     def dump_cache(self, file_name):
         '''Dumps contents of cache to file'''
@@ -191,6 +244,7 @@ class DBInterface(StorageIFace):
     PROC_INDEX = "PROC_INDEX"
     UNIQ_ID_IDX = "UNIQ_ID_IDX"
     TIME_INDEX = "TIME_INDEX"
+    LIB_INDEX = "LIB_INDEX"
 
     def __init__(self, filename, neo4j_cfg):
         super(DBInterface, self).__init__()
@@ -199,21 +253,29 @@ class DBInterface(StorageIFace):
 
         from neo4j import GraphDatabase
 
-        self.trans_lock = threading.Lock()
+        # Reentrant so that transactions can be nested in a larger one.
+        self.trans_lock = threading.RLock()
         self.mono_time = None
+        self.id_block = None
+        self.use_id_block = False
         try:
             self.db = GraphDatabase(filename, **config_params)
             self.file_index = None
             self.proc_index = None
+            self.lib_index = None
             self.node_id_idx = None
             self.id_node = None
             self.sys_time = int(time.time())
 
             self.cache_man = CacheManager([CACHE_NAMES.LOCAL_GLOBAL,
                                            CACHE_NAMES.LAST_EVENT,
-                                           CACHE_NAMES.VALID_LOCAL,
                                            CACHE_NAMES.NODE_BY_ID,
-                                           CACHE_NAMES.IO_EVENT_CHAIN])
+                                           CACHE_NAMES.IO_EVENT_CHAIN,
+                                           CACHE_NAMES.LIBRARY,
+                                           CACHE_NAMES.LIB_SET,
+                                           CACHE_NAMES.GLOB_VERSION],
+                                          {CACHE_NAMES.GLOB_VERSION:
+                                           GLOB_VERSION_CACHE_SIZE})
 
             with self.start_transaction():
                 # Unique ID index
@@ -248,6 +310,14 @@ class DBInterface(StorageIFace):
                     self.proc_index = self.db.node.indexes.create(
                         DBInterface.PROC_INDEX)
 
+                # Shared library index
+                if self.db.node.indexes.exists(DBInterface.LIB_INDEX):
+                    self.lib_index = self.db.node.indexes.get(
+                        DBInterface.LIB_INDEX)
+                else:
+                    self.lib_index = self.db.node.indexes.create(
+                        DBInterface.LIB_INDEX)
+
             # Fix for the class load error when using multiple threads
             rows = self.db.query("START n=node(1) RETURN n")
             for row in rows:
@@ -432,12 +502,79 @@ class DBInterface(StorageIFace):
         '''Adds value to a given index type with the name and key'''
         if idx_type == DBInterface.FILE_INDEX:
             self.file_index[idx_name][idx_key] = idx_val
+            if idx_name == 'name':
+                # Newly indexed globals are always the latest version
+                self.cache_man.update(CACHE_NAMES.GLOB_VERSION,
+                                      idx_key, idx_val)
         elif idx_type == DBInterface.PROC_INDEX:
             self.proc_index[idx_name][idx_key] = idx_val
+        elif idx_type == DBInterface.LIB_INDEX:
+            self.lib_index[idx_name][idx_key] = idx_val
+
+    def get_schema_version(self):
+        '''Returns the version of the PVM graph layout stored in the
+        database, databases predating versioning are version 0.'''
+        if self.id_node.has_key('schema_version'):
+            return self.id_node['schema_version']
+        return 0
+
+    def set_schema_version(self, version):
+        '''Records the version of the PVM graph layout stored in the
+        database.'''
+        self.id_node['schema_version'] = version
+
+    def session(self):
+        '''Returns an interface onto the same database and caches for use
+        by another thread. It has its own message times and transaction
+        lock, so its transactions run concurrently with those of other
+        sessions.'''
+        sess = copy.copy(self)
+        sess.trans_lock = threading.RLock()
+        sess.mono_time = None
+        sess.id_block = None
+        sess.use_id_block = False
+        return sess
+
+    def __take_ids(self, count):
+        '''Returns the first of count node IDs taken from the ID node. The
+        write lock of the ID node is taken before it is read, as Neo4j does
+        not lock on a read, so that sessions in concurrent transactions
+        never take the same IDs. The lock is held until the transaction
+        ends.'''
+        with self.start_transaction() as trans:
+            trans.acquireWriteLock(self.id_node)
+            node_id = self.id_node['serial_id']
+            self.id_node['serial_id'] = node_id + count
+        return node_id
+
+    def reserve_ids(self, count):
+        '''Ensures at least count node IDs are reserved for this interface,
+        taking them from the ID node in a transaction of their own. Nodes
+        created while use_id_block is set draw IDs from the reservation
+        instead of locking the ID node until their transaction ends. Must
+        be called outside of a transaction.'''
+        if (self.id_block is not None and
+                self.id_block[1] - self.id_block[0] >= count):
+            return
+        count = max(count, ID_BLOCK_SIZE)
+        node_id = self.__take_ids(count)
+        self.id_block = [node_id, node_id + count]
 
     def __get_next_id(self):
         '''Returns a unique node ID'''
         node_id = None
+        if self.use_id_block and self.id_block is not None:
+            node_id, end = self.id_block
+            if node_id < end:
+                self.id_block[0] = node_id + 1
+                return node_id
+            self.id_block = None
+        if self.use_id_block:
+            # The reservation ran out inside a transaction that may run
+            # concurrently with those of other sessions.
+            node_id = self.__take_ids(ID_BLOCK_SIZE)
+            self.id_block = [node_id + 1, node_id + ID_BLOCK_SIZE]
+            return node_id
         if self.id_node is not None:
             node_id = self.id_node['serial_id']
             self.id_node['serial_id'] = node_id + 1
@@ -456,6 +593,10 @@ class DBInterface(StorageIFace):
         '''Deletes relatioship given a relationship object'''
         rel.delete()
 
+    def delete_node(self, node):
+        '''Deletes a node that no longer has any relationships'''
+        node.delete()
+
     @CacheManager.dec(CACHE_NAMES.NODE_BY_ID,
                       lambda node_id: node_id)
     def get_node_by_id(self, node_id):
@@ -463,6 +604,10 @@ class DBInterface(StorageIFace):
         _node = self.db.node[node_id]
         return _node
 
+    def get_rel_by_id(self, rel_id):
+        '''Returns a relationship object given the ID'''
+        return self.db.relationship[rel_id]
+
     def set_link_state(self, rel_list, status):
         '''Sets the link state to status'''
         for rel in rel_list:
@@ -8,6 +8,8 @@ from __future__ import (absolute_import, division,
 import logging
 from . import storage
 
+@storage.CacheManager.dec(storage.CACHE_NAMES.GLOB_VERSION,
+                          lambda name: name)
 def get_latest_glob_version(db_iface, name):
     '''Gets the latest global version for the given name'''
     node = None
@@ -88,8 +90,6 @@ def get_next_local_version(db_iface, loc_node):
     return next_loc_node
 
 
-@storage.CacheManager.dec(storage.CACHE_NAMES.VALID_LOCAL,
-                          lambda proc_node, loc_name: (proc_node.id, loc_name))
 def get_valid_local(db_iface, proc_node, loc_name):
     '''Returns a local, local->process link tuple
     filtered by local node name and link state'''
@@ -211,3 +211,50 @@ def get_rel_to_dest(db_iface, rel_list, dest_node):
             rel = tmp_rel
             break
     return rel
+
+
+@storage.CacheManager.dec(storage.CACHE_NAMES.LIBRARY,
+                          lambda lib_key: lib_key)
+def get_library(db_iface, lib_key):
+    '''Returns the shared library node identified by lib_key or None if the
+    library has not been seen before'''
+    lib_node = None
+
+    rows = db_iface.query("START lib_node=node:" +
+                          storage.DBInterface.LIB_INDEX + "(lib={key}) "
+                          "RETURN lib_node", key=lib_key)
+    for row in rows:
+        lib_node = row['lib_node']
+    return lib_node
+
+
+@storage.CacheManager.dec(storage.CACHE_NAMES.LIB_SET,
+                          lambda set_hash: set_hash)
+def get_lib_set(db_iface, set_hash):
+    '''Returns the library set node with the content address set_hash or
+    None if no process has loaded that set of libraries before'''
+    set_node = None
+
+    rows = db_iface.query("START set_node=node:" +
+                          storage.DBInterface.LIB_INDEX + "(set={hash}) "
+                          "RETURN set_node", hash=set_hash)
+    for row in rows:
+        set_node = row['set_node']
+    return set_node
+
+
+def get_lib_set_from_process(db_iface, proc_node):
+    '''Returns the library set node and relationship link
+    of the process or None, None if it has no libraries'''
+    set_node = None
+    rel = None
+
+    for tmp_rel in proc_node.LIB_SET.outgoing:
+        rel = tmp_rel
+        set_node = tmp_rel.end
+    return set_node, rel
+
+
+def get_libs_from_set(db_iface, set_node):
+    '''Returns the shared library nodes that are members of a library set'''
+    return [tmp_rel.end for tmp_rel in set_node.LIB_MEMBER.outgoing]
@@ -1,24 +1,54 @@
 #ifndef SRC_FRONTEND_INTERPOSELIB_COMM_CLIENT_H_
 #define SRC_FRONTEND_INTERPOSELIB_COMM_CLIENT_H_
 
+#include <stdint.h>
+#include <sys/types.h>
 #include <string>
+#include <unordered_map>
+#include <zlib.h>
+
+#include "messaging.h"
+
+#define PROTOCOL_ACK_TIMEOUT 1000   // Milliseconds
+#define PROTOCOL_ACK_COMPRESSED 0x80  // Set in the ack if compression is on
+#define MAX_COMPACT_HDR_LEN 60      // Six varints of up to 10 bytes
+#define COMPRESS_CHUNK 16384
+#define DEFAULT_COMPRESS_BLOCK (64 * 1024)
 
 class CommClient
 {
     public:
+        CommClient();
         virtual ~CommClient() = 0;
         bool send_data(const std::string& data);
-        bool send_data(const void* const data, const int data_size);
-        bool is_opus_fd(const int fd);
+        virtual bool send_data(const void* const data, const int data_size);
+        virtual bool is_opus_fd(const int fd);
+
+        virtual bool start_protocol(const uint32_t version, const pid_t pid);
+        virtual uint32_t compression_level();
+        virtual bool flush();
+        bool uses_compact_header();
+        bool uses_string_table(const pid_t pid);
+        int pack_header(const struct Header& hdr, char *buf);
+        bool find_string(const std::string& str, uint32_t *id);
+        uint32_t add_string(const std::string& str);
 
     protected:
         void protect_fd();
+        int protect_fd(const int fd);
         int get_conn_fd();
         void set_conn_fd(const int fd);
         void close_connection();
+        virtual bool start_compression();
+
+        bool compact_header;
+        bool string_table;
+        pid_t owner_pid;    // Process whose string table this is
 
     private:
         int conn_fd;
+        struct Header last_hdr;
+        std::unordered_map<std::string, uint32_t> string_ids;
 };
 
 /**
@@ -33,27 +63,109 @@ class UDSCommClient : public CommClient
     private:
         std::string uds_path;
 
+    protected:
         bool connect();
+
+    private:
         UDSCommClient(const UDSCommClient& copy_obj) {}
         UDSCommClient& operator=(const UDSCommClient& copy_obj);
 };
 
 /**
- * TCP socket client communication class
+ * When a compressed stream is flushed to the backend
+ */
+enum FlushPolicy
+{
+    FLUSH_SYNC = 0,     // After every send
+    FLUSH_PARTIAL,      // After every send, without byte aligning
+    FLUSH_BLOCK         // After every block_size bytes and on close
+};
+
+/**
+ * TCP socket client communication class.
+ * If the backend accepts it, data is sent
+ * in a zlib stream below the message framing.
  */
 class TCPCommClient : public CommClient
 {
     public:
-        TCPCommClient(const std::string& addr, const uint16_t port);
+        TCPCommClient(const std::string& addr, const uint16_t port,
+                      const int level = 0,
+                      const FlushPolicy flush = FLUSH_SYNC,
+                      const uint32_t block_size = DEFAULT_COMPRESS_BLOCK);
         ~TCPCommClient();
 
+        using CommClient::send_data;
+        bool send_data(const void* const data, const int data_size);
+        uint32_t compression_level();
+        bool flush();
+
+    protected:
+        bool start_compression();
+
     private:
         std::string ip_addr;
         uint16_t port;
+        int level;
+        FlushPolicy flush_policy;
+        uint32_t block_size;
+        bool compressing;
+        uint32_t pending;   // Bytes compressed since the last flush
+        z_stream stream;
+        char out_buf[COMPRESS_CHUNK];
 
         bool connect();
+        bool deflate_and_send(const int flush_mode);
         TCPCommClient(const TCPCommClient& copy_obj) {}
         TCPCommClient& operator=(const TCPCommClient& copy_obj);
 };
 
+/**
+ * Layout of a shared memory ring, must match
+ * the RING_* offsets of the backend producer
+ */
+struct RingHeader
+{
+    uint64_t magic;
+    uint64_t capacity;          // Size of the data area, a power of two
+    char pad0[48];
+    uint64_t head;              // Bytes written, updated by the client
+    char pad1[56];
+    uint64_t tail;              // Bytes read, updated by the backend
+    char pad2[56];
+    uint32_t consumer_waiting;  // Set while the backend sleeps
+    uint32_t closed;            // Set when the backend drops the client
+    char pad3[56];
+};
+
+/**
+ * Shared memory ring client communication class.
+ * Connects over UDS and passes the backend a
+ * memfd backed ring and an eventfd for wakeups.
+ */
+class SHMCommClient : public UDSCommClient
+{
+    public:
+        SHMCommClient(const std::string& path, const uint64_t ring_size);
+        ~SHMCommClient();
+
+        using CommClient::send_data;
+        bool send_data(const void* const data, const int data_size);
+        bool is_opus_fd(const int fd);
+        bool start_protocol(const uint32_t version, const pid_t pid);
+
+    private:
+        struct RingHeader *ring;
+        char *ring_data;
+        size_t map_size;
+        int event_fd;
+
+        bool setup_ring(const uint64_t ring_size);
+        void send_fd(const int fd);
+        bool notify();
+        bool wait_for_space(const uint64_t size);
+        SHMCommClient(const SHMCommClient& copy_obj);
+        SHMCommClient& operator=(const SHMCommClient& copy_obj);
+};
+
 #endif  // SRC_FRONTEND_INTERPOSELIB_COMM_CLIENT_H_
@@ -17,6 +17,9 @@ namespace
     using ::fresco::opus::IPCMessage::StartupMessage;
     using ::fresco::opus::IPCMessage::FrontendTelemetry;
     using ::fresco::opus::IPCMessage::AggregationMessage;
+    using ::fresco::opus::IPCMessage::ProtocolMessage;
+    using ::fresco::opus::IPCMessage::StringDef;
+    using ::fresco::opus::IPCMessage::StringTableMessage;
 
 
     inline void set_header_data(Header *hdr_msg,
@@ -40,6 +43,16 @@ namespace
         return ProcUtils::serialise_and_send_data(hdr_msg, pay_msg);
     }
 
+    /* Function messages refer to the string table where in use */
+    inline bool set_header_and_send(FuncInfoMessage& func_msg,
+                                    const PayloadType pay_type)
+    {
+        ProcUtils::intern_strings(&func_msg);
+
+        return set_header_and_send(static_cast<const Message&>(func_msg),
+                                   pay_type);
+    }
+
     inline bool send_generic_msg(const GenMsgType gen_msg_type,
                                 const char *desc)
     {
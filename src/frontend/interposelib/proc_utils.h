@@ -16,6 +16,8 @@
 // Process global constants
 #define MAX_INT32_LEN   16
 #define MAX_TEL_DESC    256
+#define DEFAULT_SHM_RING_SIZE (1024 * 1024)
+#define OPUS_PROTOCOL_V2 2
 #define INTERPOSE_OFF_MSG "Global interpose flag is off"
 
 /**
@@ -32,7 +34,9 @@ class ProcUtils
                     const ::google::protobuf::Message& pay_obj);
 
         static bool buffer_and_send_data(
-            const ::fresco::opus::IPCMessage::FuncInfoMessage& buf_func_info_msg);
+            ::fresco::opus::IPCMessage::FuncInfoMessage& buf_func_info_msg);
+        static void intern_strings(
+            ::fresco::opus::IPCMessage::FuncInfoMessage *func_msg);
 
         static bool flush_buffered_data();
 
@@ -45,6 +49,10 @@ class ProcUtils
 
         static void get_uds_path(std::string* uds_path_str);
         static void get_tcp_address(std::string* address, int* port);
+        static void get_shm_ring_size(uint64_t* ring_size);
+        static void get_tcp_compression(int* level, FlushPolicy* flush,
+                                        uint32_t* block_size);
+        static uint32_t get_protocol_version();
         static void get_preload_path(std::string* ld_preload_path);
 
         static pid_t gettid();